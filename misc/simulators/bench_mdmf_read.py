@@ -0,0 +1,111 @@
+#! /usr/bin/env python
+
+"""
+Compare the read throughput of an MDMF mutable file with that of an
+immutable (CHK) file holding the same data, for several numbers of MDMF
+segments in flight. This runs a whole grid in this process (see
+allmydata.test.no_network), so it measures CPU cost and per-message overhead
+rather than network effects.
+
+python bench_mdmf_read.py --size=16MiB --k=3 --n=10 1 2 4 8
+
+Each positional argument is a value for mutable.download.segments_in_flight.
+"""
+
+from __future__ import print_function
+
+import os, tempfile, time
+
+from twisted.internet import defer, task
+from twisted.python import usage
+from twisted.application import service
+
+from allmydata.immutable import upload
+from allmydata.interfaces import MDMF_VERSION
+from allmydata.mutable.publish import MutableData
+from allmydata.test.common import SameProcessStreamEndpointAssigner
+from allmydata.test.no_network import NoNetworkGrid
+from allmydata.util import abbreviate, fileutil
+from allmydata.util.consumer import download_to_data
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["size", "s", "16MiB", "file size"],
+        ["k", "k", 3, "shares needed", int],
+        ["n", "n", 10, "total shares", int],
+        ["repeat", "r", 3, "downloads of each file (the best is reported)", int],
+        ["basedir", None, None, "where to put the grid (default: a temp dir)"],
+        ]
+
+    def parseArgs(self, *segments_in_flight):
+        try:
+            self["segments_in_flight"] = [int(s) for s in segments_in_flight] \
+                                         or [1, 2, 4, 8]
+        except ValueError:
+            raise usage.UsageError("segments in flight must be integers")
+
+def parse_size(s):
+    try:
+        return abbreviate.parse_abbreviated_size(s)
+    except ValueError:
+        raise usage.UsageError("unparseable size %r" % (s,))
+
+@defer.inlineCallbacks
+def best_read_time(read, data, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        downloaded = yield read()
+        elapsed = time.time() - start
+        assert downloaded == data
+        if best is None or elapsed < best:
+            best = elapsed
+    defer.returnValue(best)
+
+@defer.inlineCallbacks
+def main(reactor, config):
+    basedir = config["basedir"] or tempfile.mkdtemp(prefix="bench_mdmf_read-")
+    k, n = config["k"], config["n"]
+    data = os.urandom(parse_size(config["size"]))
+
+    assigner = SameProcessStreamEndpointAssigner()
+    assigner.setUp()
+    parent = service.MultiService()
+    parent.startService()
+    grid = NoNetworkGrid(basedir, num_clients=1, num_servers=n,
+                         client_config_hooks={}, port_assigner=assigner)
+    grid.setServiceParent(parent)
+    while not grid.clients:
+        yield task.deferLater(reactor, 0.1, lambda: None)
+    client = grid.clients[0]
+    client.encoding_params.update({"k": k, "n": n, "happy": n})
+    mb = len(data) / 1e6
+
+    print("%d byte file, %d-of-%d encoding" % (len(data), k, n))
+    print("%10s %10s %10s" % ("format", "in flight", "down MB/s"))
+    try:
+        results = yield client.upload(upload.Data(data, convergence=None))
+        chk = client.create_node_from_uri(results.get_uri())
+        elapsed = yield best_read_time(lambda: download_to_data(chk), data,
+                                       config["repeat"])
+        print("%10s %10s %10.2f" % ("CHK", "-", mb / elapsed))
+
+        mdmf = yield client.create_mutable_file(MutableData(data),
+                                                version=MDMF_VERSION)
+        for in_flight in config["segments_in_flight"]:
+            # the nodemaker hands this dict to every mutable node it makes
+            client.download_params["mutable_segments_in_flight"] = in_flight
+            elapsed = yield best_read_time(mdmf.download_best_version, data,
+                                           config["repeat"])
+            print("%10s %10d %10.2f" % ("MDMF", in_flight, mb / elapsed))
+    finally:
+        yield parent.stopService()
+        assigner.tearDown()
+        if not config["basedir"]:
+            fileutil.rm_dir(basedir)
+
+if __name__ == "__main__":
+    config = Options()
+    config.parseOptions()
+    task.react(main, [config])
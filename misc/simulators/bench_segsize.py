@@ -0,0 +1,131 @@
+#! /usr/bin/env python
+
+"""
+Compare immutable upload and download throughput, and the metadata overhead
+of the resulting shares, across segment sizes. This runs a whole grid in
+this process (see allmydata.test.no_network), so it measures CPU cost and
+per-message overhead rather than network effects.
+
+python bench_segsize.py --size=64MiB --k=3 --n=10 64KiB 128KiB 1MiB adaptive
+
+"adaptive" uses the size chosen by allmydata.immutable.segsize for this file
+(which leaves files of up to 2MiB alone). A fake round-trip time for it can
+be given with --rtt=SECONDS.
+"""
+
+from __future__ import print_function
+
+import os, tempfile, time
+
+from twisted.internet import defer, task
+from twisted.python import usage
+from twisted.application import service
+
+from allmydata.immutable import upload
+from allmydata.interfaces import DEFAULT_MAX_SEGMENT_SIZE
+from allmydata.immutable.segsize import SegmentSizePolicy
+from allmydata.storage.server import storage_index_to_dir
+from allmydata.test.common import SameProcessStreamEndpointAssigner
+from allmydata.test.no_network import NoNetworkGrid
+from allmydata.util import abbreviate, fileutil
+from allmydata.util.consumer import download_to_data
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["size", "s", "16MiB", "file size"],
+        ["k", "k", 3, "shares needed", int],
+        ["n", "n", 10, "total shares", int],
+        ["rtt", None, None, "round-trip time given to the adaptive policy", float],
+        ["basedir", None, None, "where to put the grid (default: a temp dir)"],
+        ]
+
+    def parseArgs(self, *segsizes):
+        self["segsizes"] = segsizes or ("64KiB", "128KiB", "256KiB", "1MiB",
+                                        "adaptive")
+
+def parse_size(s):
+    try:
+        return abbreviate.parse_abbreviated_size(s)
+    except ValueError:
+        raise usage.UsageError("unparseable size %r" % (s,))
+
+def share_bytes(grid, storage_index):
+    total = 0
+    for ss in grid.servers_by_number.values():
+        sharedir = os.path.join(ss.sharedir, storage_index_to_dir(storage_index))
+        if os.path.isdir(sharedir):
+            for fn in os.listdir(sharedir):
+                total += os.path.getsize(os.path.join(sharedir, fn))
+    return total
+
+@defer.inlineCallbacks
+def run_one(grid, client, data, segsize, policy):
+    k, n = client.encoding_params["k"], client.encoding_params["n"]
+    client.encoding_params["max_segment_size"] = segsize
+    client.getServiceNamed("uploader")._segment_size_policy = policy
+
+    start = time.time()
+    results = yield client.upload(upload.Data(data, convergence=None))
+    upload_time = time.time() - start
+    ueb = results.get_uri_extension_data()
+
+    node = client.create_node_from_uri(results.get_uri())
+    start = time.time()
+    downloaded = yield download_to_data(node)
+    download_time = time.time() - start
+    assert downloaded == data
+
+    stored = share_bytes(grid, node.get_storage_index())
+    overhead = stored - len(data) * n / k
+    defer.returnValue((ueb["segment_size"], ueb["num_segments"],
+                       upload_time, download_time, overhead))
+
+@defer.inlineCallbacks
+def main(reactor, config):
+    basedir = config["basedir"] or tempfile.mkdtemp(prefix="bench_segsize-")
+    k, n = config["k"], config["n"]
+    data = os.urandom(parse_size(config["size"]))
+
+    assigner = SameProcessStreamEndpointAssigner()
+    assigner.setUp()
+    parent = service.MultiService()
+    parent.startService()
+    grid = NoNetworkGrid(basedir, num_clients=1, num_servers=n,
+                         client_config_hooks={}, port_assigner=assigner)
+    grid.setServiceParent(parent)
+    while not grid.clients:
+        yield task.deferLater(reactor, 0.1, lambda: None)
+    client = grid.clients[0]
+    client.encoding_params.update({"k": k, "n": n, "happy": n})
+
+    print("%d byte file, %d-of-%d encoding" % (len(data), k, n))
+    print("%10s %10s %8s %10s %10s %12s %9s"
+          % ("policy", "segsize", "segments", "up MB/s", "down MB/s",
+             "overhead", "overhead%"))
+    try:
+        for name in config["segsizes"]:
+            if name == "adaptive":
+                policy = SegmentSizePolicy()
+                if config["rtt"] is not None:
+                    policy.rtt = config["rtt"]
+                segsize = DEFAULT_MAX_SEGMENT_SIZE
+            else:
+                policy = None
+                segsize = parse_size(name)
+            (segsize, segments, up, down, overhead) = yield run_one(
+                grid, client, data, segsize, policy)
+            mb = len(data) / 1e6
+            print("%10s %10d %8d %10.2f %10.2f %12d %8.3f%%"
+                  % (name, segsize, segments, mb / up, mb / down, overhead,
+                     100.0 * overhead / (len(data) * n / k)))
+    finally:
+        yield parent.stopService()
+        assigner.tearDown()
+        if not config["basedir"]:
+            fileutil.rm_dir(basedir)
+
+if __name__ == "__main__":
+    config = Options()
+    config.parseOptions()
+    task.react(main, [config])
@@ -0,0 +1 @@
+Immutable downloads can send extra (hedged) block requests to cut tail latency, controlled by the new ``download.hedge.extra_requests`` and ``download.hedge.percentile`` settings, which are off by default.
@@ -0,0 +1 @@
+Immutable uploads now keep up to ``upload.max_segments_in_flight`` segments (4 by default) on their way to the storage servers at once, which speeds up uploads over high-latency links.
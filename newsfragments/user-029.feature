@@ -0,0 +1 @@
+Large immutable files uploaded with a random encryption key now get segments of up to 1MiB, chosen from the file size, the encoding and the servers' round-trip time. The new ``upload.adaptive_segment_size`` setting turns this off. Convergent uploads keep the configured segment size, so their caps do not change.
@@ -0,0 +1 @@
+Immutable uploads through the web API (and ``tahoe put --resume-token=``) can be made resumable with a ``resume-token=`` argument, so that an interrupted upload carries on where it left off when it is repeated.
@@ -0,0 +1 @@
+New mutable files and directories get their RSA keys from a pool generated in background processes, so creating them no longer stalls the node. The new ``mutable.keypool.size`` and ``mutable.keypool.workers`` settings control the pool, and ``keypool`` stats report on it.
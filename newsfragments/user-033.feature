@@ -0,0 +1 @@
+Servermaps of mutable files and directories can be reused for up to ``mutable.servermap_cache.max_age`` seconds (a new setting, 0 by default), or for as long as a web API request's new ``max-age=`` argument allows, which makes repeated reads of the same directory cheaper.
@@ -0,0 +1 @@
+Mutable directories with very many children can be converted into sharded directories, with the new ``tahoe shard-directory`` command or ``POST /uri/$DIRCAP?t=shard``, so that changing one child rewrites only a small part of the directory. Tahoe-LAFS 1.17 and earlier cannot read sharded directories.
@@ -0,0 +1 @@
+Deep operations (deep-check, manifest and deep-stats) now read several directories at once. The new ``deep_traverse.concurrency`` and ``deep_traverse.max_frontier`` settings control how many, and how much memory the traversal may use.
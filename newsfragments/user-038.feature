@@ -0,0 +1 @@
+Deep-check accepts a new ``recheck-age=`` argument, which skips objects that were found healthy more recently than that many seconds ago.
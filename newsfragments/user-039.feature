@@ -0,0 +1 @@
+Reads of large MDMF mutable files now fetch several segments ahead, and decode and decrypt them off the reactor. The new ``mutable.download.segments_in_flight`` setting (4 by default) controls how many.
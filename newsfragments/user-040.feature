@@ -0,0 +1 @@
+An MDMF edit which keeps the file's number of segments and the size of its last block now writes only the changed blocks and hashes, instead of rewriting every share.
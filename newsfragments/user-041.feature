@@ -0,0 +1 @@
+``PUT /uri`` and ``PUT /uri/$DIRCAP/FILENAME`` accept a new ``streaming=true`` argument, which uploads an immutable file as its body arrives, without storing it on the gateway's disk first.
@@ -0,0 +1 @@
+File downloads now support several byte ranges in one request (as a ``multipart/byteranges`` response), carry a strong ETag, answer ``If-None-Match:`` with 304 Not Modified, and honour ``If-Range:``. Immutable files requested by their own cap are sent with a long-lived ``Cache-Control`` header.
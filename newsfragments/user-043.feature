@@ -0,0 +1 @@
+``t=json`` directory listings are now written out a little at a time, and both the JSON and the HTML listings of a directory accept new ``limit=`` and ``after=`` arguments to fetch its children a page at a time.
@@ -0,0 +1 @@
+The web API can be served by several gateway worker processes sharing one port, with the new ``web.workers`` setting.
@@ -0,0 +1 @@
+Files opened read-only over SFTP are no longer downloaded in full when they are opened: each read fetches only the segments it needs.
@@ -0,0 +1 @@
+The SFTP server now remembers the directories each session has looked at for a couple of seconds. The new ``[sftpd]`` settings ``cache.max_age`` and ``cache.per_user`` control this, and ``sftp.cache`` stats report on it.
@@ -0,0 +1 @@
+``tahoe cp`` has a new ``--jobs`` option to copy several files at once.
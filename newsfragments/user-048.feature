@@ -0,0 +1 @@
+``tahoe backup`` has a new ``--jobs`` option to check and upload several files at once, and writes its backupdb changes in batches.
@@ -0,0 +1 @@
+``tahoe backup`` has a new ``--chunk-above`` option which stores large files as content-defined chunks, so that when such a file changes only its changed chunks are uploaded again.
@@ -0,0 +1 @@
+The ``tahoe`` command now imports only what the chosen subcommand needs, so it starts faster.
@@ -137,6 +137,11 @@ install_requires = [
     "treq",
     "cbor2",
     "pycddl",
+
+    # Content-defined chunking for 'tahoe backup --chunk-above'. Its chunk
+    # boundaries are part of what the backupdb remembers, so they must not
+    # change from one version to the next.
+    "pyfastcdc >= 0.3.0, < 0.4",
 ]
 
 setup_requires = [
@@ -125,7 +125,7 @@ class ProhibitedNode(object):
     def get_current_size(self):
         return defer.succeed(None)
 
-    def get_size_of_best_version(self):
+    def get_size_of_best_version(self, max_age=None):
         return defer.succeed(None)
 
     def check(self, monitor, verify, add_lease):
@@ -139,10 +139,10 @@ class ProhibitedNode(object):
 
     # Omitting any of these methods would fail safe; they are just to ensure correct error reporting.
 
-    def get_best_readable_version(self):
+    def get_best_readable_version(self, max_age=None):
         raise FileProhibited(self.reason)
 
-    def download_best_version(self):
+    def download_best_version(self, max_age=None):
         raise FileProhibited(self.reason)
 
     def get_best_mutable_version(self):
@@ -154,7 +154,7 @@ class ProhibitedNode(object):
     def modify(self, modifier_cb):
         raise FileProhibited(self.reason)
 
-    def get_servermap(self, mode):
+    def get_servermap(self, mode, max_age=None):
         raise FileProhibited(self.reason)
 
     def download_version(self, servermap, version):
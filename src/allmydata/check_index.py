@@ -0,0 +1,250 @@
+"""
+A persistent record of when each object was last checked, and how healthy
+it was, so that deep-check can skip objects that were found healthy
+recently.
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import time
+
+from twisted.internet import defer
+
+from allmydata.check_results import CheckResults, CheckAndRepairResults
+from allmydata.interfaces import ICheckResults, ICheckAndRepairResults, \
+     IDirectoryNode
+from allmydata.util import log
+from allmydata.util.dbutil import get_db, DBError
+from allmydata.util.time_format import iso_utc
+
+
+SCHEMA_v1 = """
+CREATE TABLE version -- added in v1
+(
+ version INTEGER  -- contains one row, set to 1
+);
+
+CREATE TABLE checks -- added in v1
+(
+ verifycap VARCHAR(256) PRIMARY KEY, -- URI:CHK-Verifier:... etc
+ last_checked TIMESTAMP,
+ verified INTEGER,                   -- 1 if the shares were verified
+ healthy INTEGER,                    -- 1 if the object was healthy
+ count_happiness INTEGER,
+ count_shares_needed INTEGER,
+ count_shares_expected INTEGER,
+ count_shares_good INTEGER,
+ count_good_share_hosts INTEGER,
+ seqnum INTEGER                      -- mutable directories only, else NULL
+);
+"""
+
+# how many updates may wait before they are committed to disk
+COMMIT_INTERVAL = 100
+
+
+def get_check_index(dbfile):
+    """Open or create the check index in the given file, whose parent
+    directory must exist. Return a CheckIndex, or None if the file cannot
+    be used (in which case every deep-check is a full one)."""
+    try:
+        (sqlite3, db) = get_db(dbfile, create_version=(SCHEMA_v1, 1),
+                               dbname="check index")
+    except DBError as e:
+        log.msg("unable to use the check index: %s" % (e,),
+                level=log.WEIRD, umid="ziYSaA")
+        return None
+    return CheckIndex(db)
+
+
+class CheckRecord(object):
+    """What the check index remembers about one object."""
+
+    def __init__(self, verifycap, last_checked, verified, healthy,
+                 count_happiness, count_shares_needed, count_shares_expected,
+                 count_shares_good, count_good_share_hosts, seqnum):
+        self.verifycap = verifycap
+        self.last_checked = last_checked
+        self.verified = bool(verified)
+        self.healthy = bool(healthy)
+        self.count_happiness = count_happiness
+        self.count_shares_needed = count_shares_needed
+        self.count_shares_expected = count_shares_expected
+        self.count_shares_good = count_shares_good
+        self.count_good_share_hosts = count_good_share_hosts
+        self.seqnum = seqnum
+
+
+class CheckIndex(object):
+    """I remember the result of the most recent check of each object, by
+    verifycap. Updates are committed in batches: call flush() when a
+    deep-check is done."""
+
+    def __init__(self, db):
+        self.db = db
+        self.cursor = db.cursor()
+        self._uncommitted = 0
+
+    def get(self, verifycap):
+        """Return the CheckRecord for the given verifycap (a string), or
+        None if it has never been checked."""
+        self.cursor.execute("SELECT last_checked, verified, healthy,"
+                            " count_happiness, count_shares_needed,"
+                            " count_shares_expected, count_shares_good,"
+                            " count_good_share_hosts, seqnum"
+                            " FROM checks WHERE verifycap=?",
+                            (verifycap,))
+        row = self.cursor.fetchone()
+        if not row:
+            return None
+        return CheckRecord(verifycap, *row)
+
+    def did_check(self, verifycap, results, verified, seqnum=None, now=None):
+        """Remember the ICheckResults of a check of the given verifycap."""
+        if now is None:
+            now = time.time()
+        self.cursor.execute("INSERT OR REPLACE INTO checks VALUES"
+                            " (?,?,?,?,?,?,?,?,?,?)",
+                            (verifycap, now, int(bool(verified)),
+                             int(results.is_healthy()),
+                             results.get_happiness(),
+                             results.get_encoding_needed(),
+                             results.get_encoding_expected(),
+                             results.get_share_counter_good(),
+                             results.get_host_counter_good_shares(),
+                             seqnum))
+        self._uncommitted += 1
+        if self._uncommitted >= COMMIT_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        """Commit any updates to disk."""
+        if self._uncommitted:
+            self.db.commit()
+            self._uncommitted = 0
+
+
+class IncrementalChecker(object):
+    """I check (or check and repair) objects on behalf of a deep-check
+    walker, recording the results in a CheckIndex.
+
+    If recheck_age is not None, I skip objects which were found healthy
+    less than recheck_age seconds ago (by a verifying check, if verify is
+    set). Mutable directories are also checked again when they have changed
+    since: their sequence number is compared with the one that was recorded.
+    For a skipped object I fire with results made up from the record, so the
+    deep-check results still cover every object.
+    """
+
+    def __init__(self, check_index, verify, repair, add_lease,
+                 recheck_age=None):
+        self._index = check_index
+        self._verify = verify
+        self._repair = repair
+        self._add_lease = add_lease
+        self._recheck_age = recheck_age
+        self.objects_skipped = 0
+
+    def must_wait_for_contents(self, node):
+        """Return True if node is a mutable directory which should only be
+        checked once its contents have been read, since that tells me its
+        sequence number."""
+        return (self._index is not None and self._recheck_age is not None
+                and IDirectoryNode.providedBy(node) and node.is_mutable())
+
+    def check(self, node, monitor):
+        """Fire with the ICheckResults (or ICheckAndRepairResults, if
+        repairing) for node, or with None for a LIT file."""
+        if self._index is None:
+            return self._check(node, monitor)
+        verifycap = node.get_verify_cap()
+        if verifycap is None:
+            # LIT files are not distributed, and need no checking
+            return self._check(node, monitor)
+        verifycap = verifycap.to_string()
+        is_mutable_dir = IDirectoryNode.providedBy(node) and node.is_mutable()
+        seqnum = None
+        if is_mutable_dir:
+            seqnum = node.get_most_recent_seqnum()
+        record = self._index.get(verifycap)
+        if self._can_skip(record, seqnum):
+            self.objects_skipped += 1
+            return defer.succeed(self._results_from_record(node, record))
+        d = self._check(node, monitor)
+        d.addCallback(self._record, verifycap, is_mutable_dir)
+        return d
+
+    def _check(self, node, monitor):
+        if self._repair:
+            return node.check_and_repair(monitor, self._verify,
+                                         self._add_lease)
+        return node.check(monitor, self._verify, self._add_lease)
+
+    def _can_skip(self, record, seqnum):
+        if self._recheck_age is None or record is None:
+            return False
+        if not record.healthy:
+            return False
+        if self._verify and not record.verified:
+            return False
+        if record.last_checked + self._recheck_age < time.time():
+            return False
+        if seqnum != record.seqnum:
+            # the directory has changed since it was checked, or we do not
+            # know which version of it we have read
+            return False
+        return True
+
+    def _record(self, results, verifycap, is_mutable_dir):
+        if results:
+            if self._repair:
+                r = ICheckAndRepairResults(results).get_post_repair_results()
+            else:
+                r = ICheckResults(results)
+            seqnum = None
+            if is_mutable_dir and r.get_servermap() is not None:
+                # the version that was just checked
+                best = r.get_servermap().best_recoverable_version()
+                if best is not None:
+                    seqnum = best[0]
+            self._index.did_check(verifycap, r, self._verify, seqnum)
+        return results
+
+    def _results_from_record(self, node, record):
+        when = iso_utc(record.last_checked, sep=" ")
+        cr = CheckResults(node.get_verify_cap(), node.get_storage_index(),
+                          healthy=True, recoverable=True,
+                          count_happiness=record.count_happiness,
+                          count_shares_needed=record.count_shares_needed,
+                          count_shares_expected=record.count_shares_expected,
+                          count_shares_good=record.count_shares_good,
+                          count_good_share_hosts=record.count_good_share_hosts,
+                          count_recoverable_versions=1,
+                          count_unrecoverable_versions=0,
+                          servers_responding=[], sharemap={},
+                          count_wrong_shares=0,
+                          list_corrupt_shares=[], count_corrupt_shares=0,
+                          list_incompatible_shares=[],
+                          count_incompatible_shares=0,
+                          summary="Healthy (last checked %s)" % (when,),
+                          report=["Not checked again: this object was found"
+                                  " healthy at %s" % (when,)],
+                          share_problems=[], servermap=None)
+        if not self._repair:
+            return cr
+        crr = CheckAndRepairResults(node.get_storage_index())
+        crr.pre_repair_results = cr
+        crr.post_repair_results = cr
+        return crr
+
+    def flush(self):
+        if self._index is not None:
+            self._index.flush()
@@ -39,7 +39,11 @@ from allmydata.crypto.util import remove_prefix
 from allmydata.storage.server import StorageServer, FoolscapStorageServer
 from allmydata import storage_client
 from allmydata.immutable.upload import Uploader
+from allmydata.immutable.segsize import SegmentSizePolicy
+from allmydata.immutable.journal import UploadJournals
 from allmydata.immutable.offloaded import Helper
+from allmydata.keypool import KeyPool
+from allmydata.mutable.servermap import ServermapCache
 from allmydata.introducer.client import IntroducerClient
 from allmydata.util import (
     hashutil, base32, pollmixin, log, idlib,
@@ -63,6 +67,9 @@ from allmydata.interfaces import (
 )
 from allmydata.nodemaker import NodeMaker
 from allmydata.blacklist import Blacklist
+from allmydata.check_index import get_check_index
+from allmydata.gateway import GatewayPrimary, GatewayWorker, \
+     parse_tcp_port, reuseport_supported
 from allmydata import node
 
 
@@ -87,15 +94,25 @@ def _is_valid_section(section_name):
 _client_config = configutil.ValidConfiguration(
     static_valid_sections={
         "client": (
+            "deep_traverse.concurrency",
+            "deep_traverse.max_frontier",
+            "download.hedge.extra_requests",
+            "download.hedge.percentile",
             "helper.furl",
             "introducer.furl",
             "key_generator.furl",
+            "mutable.download.segments_in_flight",
             "mutable.format",
+            "mutable.keypool.size",
+            "mutable.keypool.workers",
+            "mutable.servermap_cache.max_age",
             "peers.preferred",
             "shares.happy",
             "shares.needed",
             "shares.total",
             "storage.plugins",
+            "upload.adaptive_segment_size",
+            "upload.max_segments_in_flight",
         ),
         "storage": (
             "debug_discard",
@@ -115,6 +132,8 @@ _client_config = configutil.ValidConfiguration(
         ),
         "sftpd": (
             "accounts.file",
+            "cache.max_age",
+            "cache.per_user",
             "enabled",
             "host_privkey_file",
             "host_pubkey_file",
@@ -605,30 +624,61 @@ class _Client(node.Node, pollmixin.PollMixin):
     # that we will abort an upload unless we can allocate space for at least
     # this many. 'total' is the total number of shares created by encoding.
     # If everybody has room then this is is how many we will upload.
+    # 'max_segments_in_flight' bounds how many segments of an immutable
+    # upload may be on their way to the servers at once.
     DEFAULT_ENCODING_PARAMETERS = {"k": 3,
                                    "happy": 7,
                                    "n": 10,
                                    "max_segment_size": DEFAULT_MAX_SEGMENT_SIZE,
+                                   "max_segments_in_flight": 4,
                                    }
 
+    # This is a dictionary of download tuning knobs.
+    # 'hedge_extra_requests' is how many block requests beyond 'k' we keep in
+    # flight for each segment of an immutable file. 'hedge_percentile' (None
+    # to disable) is the percentile of recent segment fetch times after which
+    # we send one backup block request. 'mutable_segments_in_flight' is how
+    # many segments of an MDMF file are fetched at once.
+    DEFAULT_DOWNLOAD_PARAMETERS = {"hedge_extra_requests": 0,
+                                   "hedge_percentile": None,
+                                   "mutable_segments_in_flight": 4,
+                                   }
+
+    # This is a dictionary of deep-traversal (deep-check, manifest,
+    # deep-stats) tuning knobs. 'concurrency' is how many directories are
+    # visited at once. 'max_frontier' is how many directories may wait to be
+    # visited before the traversal falls back to one directory at a time.
+    DEFAULT_TRAVERSAL_PARAMETERS = {"concurrency": 10,
+                                    "max_frontier": 10000,
+                                    }
+
     def __init__(self, config, main_tub, i2p_provider, tor_provider, introducer_clients,
-                 storage_farm_broker):
+                 storage_farm_broker, gateway=None):
         """
         Use :func:`allmydata.client.create_client` to instantiate one of these.
+
+        :param gateway: for a gateway worker process, its
+            :class:`allmydata.gateway.GatewayWorker`. A node process makes
+            its own, if it has gateway workers.
         """
         node.Node.__init__(self, config, main_tub, i2p_provider, tor_provider)
 
         self.started_timestamp = time.time()
         self.logSource = "Client"
         self.encoding_params = self.DEFAULT_ENCODING_PARAMETERS.copy()
+        self.download_params = self.DEFAULT_DOWNLOAD_PARAMETERS.copy()
+        self.traversal_params = self.DEFAULT_TRAVERSAL_PARAMETERS.copy()
 
         self.introducer_clients = introducer_clients
         self.storage_broker = storage_farm_broker
+        self.gateway = gateway
 
         self.init_stats_provider()
         self.init_secrets()
         self.init_node_key()
-        self._key_generator = KeyGenerator()
+        self.init_key_generator()
+        if self.gateway is None:
+            self.init_gateway()
         key_gen_furl = config.get_config("client", "key_generator.furl", None)
         if key_gen_furl:
             log.msg("[client]key_generator.furl= is now ignored, see #2783")
@@ -694,6 +744,41 @@ class _Client(node.Node, pollmixin.PollMixin):
         self._node_private_key = private_key
         self._node_public_key = public_key
 
+    def init_key_generator(self):
+        # RSA keys for new mutable files and directories are made in the
+        # background, and a few are kept in reserve
+        size = int(self.config.get_config("client", "mutable.keypool.size", 4))
+        workers = int(self.config.get_config("client", "mutable.keypool.workers", 1))
+        if size < 0:
+            raise ValueError("config error: mutable.keypool.size must not be negative")
+        if workers < 1:
+            raise ValueError("config error: mutable.keypool.workers must be at least 1")
+        if size == 0:
+            self._key_generator = KeyGenerator()
+            return
+        self._key_generator = KeyPool(size,
+                                      self.config.get_private_path("spare-rsa-keys"),
+                                      workers)
+        self._key_generator.setServiceParent(self)
+        self.stats_provider.register_producer(self._key_generator)
+
+    def init_gateway(self):
+        # with web.workers > 1, several processes serve the web port
+        workers = int(self.config.get_config("node", "web.workers", 1))
+        if workers < 1:
+            raise ValueError("config error: web.workers must be at least 1")
+        if workers == 1:
+            return
+        webport = self.config.get_config("node", "web.port", None)
+        if not webport:
+            raise ValueError("config error: web.workers needs web.port")
+        if not reuseport_supported():
+            raise ValueError("config error: web.workers needs SO_REUSEPORT,"
+                             " which this platform does not have")
+        parse_tcp_port(webport)
+        self.gateway = GatewayPrimary(self.config, workers)
+        self.gateway.setServiceParent(self)
+
     def get_long_nodeid(self):
         # this matches what IServer.get_longname() says about us elsewhere
         vk_string = ed25519.string_from_verifying_key(self._node_public_key)
@@ -885,6 +970,40 @@ class _Client(node.Node, pollmixin.PollMixin):
         DEP["k"] = int(self.config.get_config("client", "shares.needed", DEP["k"]))
         DEP["n"] = int(self.config.get_config("client", "shares.total", DEP["n"]))
         DEP["happy"] = int(self.config.get_config("client", "shares.happy", DEP["happy"]))
+        DEP["max_segments_in_flight"] = int(self.config.get_config(
+            "client", "upload.max_segments_in_flight",
+            DEP["max_segments_in_flight"]))
+        if DEP["max_segments_in_flight"] < 1:
+            raise ValueError("config error: upload.max_segments_in_flight "
+                             "must be at least 1")
+
+        DDP = self.download_params
+        DDP["hedge_extra_requests"] = int(self.config.get_config(
+            "client", "download.hedge.extra_requests",
+            DDP["hedge_extra_requests"]))
+        if DDP["hedge_extra_requests"] < 0:
+            raise ValueError("config error: download.hedge.extra_requests "
+                             "must not be negative")
+        percentile = self.config.get_config("client", "download.hedge.percentile", None)
+        if percentile:
+            percentile = float(percentile)
+            if not 0 < percentile <= 100:
+                raise ValueError("config error: download.hedge.percentile "
+                                 "must be between 0 and 100")
+            DDP["hedge_percentile"] = percentile
+        DDP["mutable_segments_in_flight"] = int(self.config.get_config(
+            "client", "mutable.download.segments_in_flight",
+            DDP["mutable_segments_in_flight"]))
+        if DDP["mutable_segments_in_flight"] < 1:
+            raise ValueError("config error: mutable.download.segments_in_flight "
+                             "must be at least 1")
+
+        DTP = self.traversal_params
+        for (key, name) in [("concurrency", "deep_traverse.concurrency"),
+                            ("max_frontier", "deep_traverse.max_frontier")]:
+            DTP[key] = int(self.config.get_config("client", name, DTP[key]))
+            if DTP[key] < 1:
+                raise ValueError("config error: %s must be at least 1" % (name,))
 
         # for the CLI to authenticate to local JSON endpoints
         self._create_auth_token()
@@ -892,10 +1011,17 @@ class _Client(node.Node, pollmixin.PollMixin):
         self.history = History(self.stats_provider)
         self.terminator = Terminator()
         self.terminator.setServiceParent(self)
+        segment_size_policy = None
+        if self.config.get_config("client", "upload.adaptive_segment_size",
+                                  True, boolean=True):
+            segment_size_policy = SegmentSizePolicy()
         uploader = Uploader(
             helper_furl,
             self.stats_provider,
             self.history,
+            segment_size_policy=segment_size_policy,
+            journals=UploadJournals(
+                self.config.get_private_path("upload-journals")),
         )
         uploader.setServiceParent(self)
         self.init_blacklist()
@@ -951,6 +1077,14 @@ class _Client(node.Node, pollmixin.PollMixin):
             self.mutable_file_default = MDMF_VERSION
         else:
             self.mutable_file_default = SDMF_VERSION
+        max_age = float(self.config.get_config(
+            "client", "mutable.servermap_cache.max_age", 0))
+        if max_age < 0:
+            raise ValueError("config error: mutable.servermap_cache.max_age must not be negative")
+        self.servermap_cache = ServermapCache(max_age)
+        self.stats_provider.register_producer(self.servermap_cache)
+        self.check_index = get_check_index(
+            self.config.get_private_path("check_index.sqlite"))
         self.nodemaker = NodeMaker(self.storage_broker,
                                    self._secret_holder,
                                    self.get_history(),
@@ -959,7 +1093,12 @@ class _Client(node.Node, pollmixin.PollMixin):
                                    self.get_encoding_parameters(),
                                    self.mutable_file_default,
                                    self._key_generator,
-                                   self.blacklist)
+                                   self.blacklist,
+                                   self.download_params,
+                                   self.servermap_cache,
+                                   self.traversal_params,
+                                   self.check_index,
+                                   self.gateway)
 
     def get_history(self):
         return self.history
@@ -996,6 +1135,9 @@ class _Client(node.Node, pollmixin.PollMixin):
 
         from allmydata.webish import WebishServer
         nodeurl_path = self.config.get_config_path("node.url")
+        if isinstance(self.gateway, GatewayWorker):
+            # node.url belongs to the node process
+            nodeurl_path = None
         staticdir_config = self.config.get_config("node", "web.static", "public_html")
         staticdir = self.config.get_config_path(staticdir_config)
         ws = WebishServer(
@@ -1004,6 +1146,7 @@ class _Client(node.Node, pollmixin.PollMixin):
             self._get_tempdir(),
             nodeurl_path,
             staticdir,
+            gateway=self.gateway,
         )
         ws.setServiceParent(self)
 
@@ -1015,11 +1158,18 @@ class _Client(node.Node, pollmixin.PollMixin):
             sftp_portstr = self.config.get_config("sftpd", "port", "tcp:8022")
             pubkey_file = self.config.get_config("sftpd", "host_pubkey_file")
             privkey_file = self.config.get_config("sftpd", "host_privkey_file")
+            cache_max_age = float(self.config.get_config("sftpd", "cache.max_age", 2))
+            if cache_max_age < 0:
+                raise ValueError("config error: sftpd cache.max_age must not be negative")
+            cache_per_user = self.config.get_config("sftpd", "cache.per_user",
+                                                    False, boolean=True)
 
             from allmydata.frontends import sftpd
             s = sftpd.SFTPServer(self, accountfile,
-                                 sftp_portstr, pubkey_file, privkey_file)
+                                 sftp_portstr, pubkey_file, privkey_file,
+                                 cache_max_age, cache_per_user)
             s.setServiceParent(self)
+            self.stats_provider.register_producer(s.directory_caches)
 
     def _check_exit_trigger(self, exit_trigger_file):
         if os.path.exists(exit_trigger_file):
@@ -101,6 +101,10 @@ class DeepStats(object):
         dirsize_children = len(children)
         self.max("largest-directory-children", dirsize_children)
 
+    def add_shard(self, shard, path):
+        """Notes one of the files holding a sharded directory."""
+        pass
+
     def add(self, key, value=1):
         self.stats[key] += value
 
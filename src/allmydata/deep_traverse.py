@@ -0,0 +1,163 @@
+"""
+The engine behind DirectoryNode.deep_traverse().
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from twisted.internet import defer
+from foolscap.api import fireEventually
+
+from allmydata.interfaces import IDirectoryNode
+from allmydata.monitor import OperationCancelledError
+from allmydata.unknown import UnknownNode
+from allmydata.util.deferredutil import gatherResults
+
+
+class DeepTraversal(object):
+    """I walk the tree of directories below a root directory, telling a
+    walker about every node I reach, and visiting up to 'concurrency'
+    directories at a time.
+
+    Visiting a directory means giving it to walker.add_node() while its
+    contents are fetched, then calling walker.enter_directory() and
+    walker.add_shard() for it, walker.add_node() for each of its files, and
+    putting its subdirectories on the frontier of directories still to be
+    visited. Each visit keeps the children of one directory in memory, so at
+    most 'concurrency' of them are held at once.
+
+    The frontier is a stack, so the walk stays close to depth-first and the
+    frontier stays small. Should it hold more than 'max_frontier'
+    directories anyway (a directory with very many subdirectories, say), I
+    visit one directory at a time until it shrinks again, which is how the
+    walk always used to be done.
+
+    I avoid loops, and report each node only once, by keeping track of
+    verifier-caps.
+    """
+
+    def __init__(self, root, walker, monitor, concurrency=10,
+                 max_frontier=10000):
+        assert concurrency >= 1, concurrency
+        self._walker = walker
+        self._monitor = monitor
+        self._concurrency = concurrency
+        self._max_frontier = max_frontier
+        self._found = set([root.get_verify_cap()])
+        # (dirnode, path) of the directories that are yet to be visited
+        self._frontier = [(root, [])]
+        self._active = 0
+        self._done = defer.Deferred()
+        self._finished = False
+        self._pumping = False
+        self._pump_again = False
+
+    def run(self):
+        """Return a Deferred that fires when every directory has been
+        visited, or errbacks with the first error (or with
+        OperationCancelledError if the monitor is cancelled)."""
+        self._pump()
+        return self._done
+
+    def _limit(self):
+        if len(self._frontier) > self._max_frontier:
+            return 1
+        return self._concurrency
+
+    def _pump(self):
+        # visits which finish synchronously call back in here: rather than
+        # recursing (once per directory), we loop
+        if self._pumping:
+            self._pump_again = True
+            return
+        self._pumping = True
+        try:
+            self._pump_again = True
+            while self._pump_again:
+                self._pump_again = False
+                self._start_visits()
+        finally:
+            self._pumping = False
+
+    def _start_visits(self):
+        if self._finished:
+            return
+        if self._monitor.is_cancelled():
+            self._fail(OperationCancelledError())
+            return
+        while self._frontier and self._active < self._limit():
+            (node, path) = self._frontier.pop()
+            self._active += 1
+            d = self._visit(node, path)
+            d.addCallbacks(self._visited, self._fail)
+        if not self._frontier and not self._active:
+            self._finished = True
+            self._done.callback(None)
+
+    def _visited(self, ignored):
+        self._active -= 1
+        self._pump()
+
+    def _fail(self, f):
+        if not self._finished:
+            self._finished = True
+            self._done.errback(f)
+
+    def _visit(self, node, path):
+        walker = self._walker
+        # fetch the contents while the walker looks at the directory itself
+        added = defer.maybeDeferred(walker.add_node, node, path)
+        listed = node.list()
+        d = gatherResults([added, listed])
+        d.addCallback(lambda results: self._enter(node, path, results[1]))
+        return d
+
+    def _enter(self, parent, path, children):
+        self._monitor.raise_if_cancelled()
+        walker = self._walker
+        d = defer.maybeDeferred(walker.enter_directory, parent, children)
+        for shard in parent.get_shard_nodes():
+            d.addCallback(lambda ignored, shard=shard:
+                          walker.add_shard(shard, path))
+        # we process file-like children first, so we can drop their FileNode
+        # objects as quickly as possible. Tests suggest that a FileNode (held
+        # in the client's nodecache) consumes about 2440 bytes. dirnodes (not
+        # in the nodecache) seem to consume about 2000 bytes.
+        dirkids = []
+        filekids = []
+        for name, (child, metadata) in sorted(children.items()):
+            childpath = path + [name]
+            if isinstance(child, UnknownNode):
+                walker.add_node(child, childpath)
+                continue
+            verifier = child.get_verify_cap()
+            # allow LIT files (for which verifier==None) to be processed
+            if (verifier is not None) and (verifier in self._found):
+                continue
+            self._found.add(verifier)
+            if IDirectoryNode.providedBy(child):
+                dirkids.append( (child, childpath) )
+            else:
+                filekids.append( (child, childpath) )
+        for i, (child, childpath) in enumerate(filekids):
+            d.addCallback(lambda ignored, child=child, childpath=childpath:
+                          walker.add_node(child, childpath))
+            # to work around the Deferred tail-recursion problem
+            # (specifically the defer.succeed flavor) requires us to avoid
+            # doing more than 158 LIT files in a row. We insert a turn break
+            # once every 100 files (LIT or CHK) to preserve some stack space
+            # for other code. This is a different expression of the same
+            # Twisted problem as in #237.
+            if i % 100 == 99:
+                d.addCallback(lambda ignored: fireEventually())
+        # pushed in reverse, so that they are visited in sorted order
+        d.addCallback(lambda ignored:
+                      self._frontier.extend(reversed(dirkids)))
+        return d
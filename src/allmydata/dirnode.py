@@ -14,19 +14,24 @@ if PY2:
 from past.builtins import unicode
 
 import time
+from collections import OrderedDict
 
 from zope.interface import implementer
 from twisted.internet import defer
-from foolscap.api import fireEventually
+from twisted.python.failure import Failure
 
 from allmydata.crypto import aes
 from allmydata.deep_stats import DeepStats
+from allmydata.deep_traverse import DeepTraversal
 from allmydata.mutable.common import NotWriteableError
 from allmydata.mutable.filenode import MutableFileNode
-from allmydata.unknown import UnknownNode, strip_prefix_for_ro
+from allmydata.sharded_dirnode import ShardedDirectory, is_sharded, \
+     shard_path_name
+from allmydata.unknown import strip_prefix_for_ro
 from allmydata.interfaces import IFilesystemNode, IDirectoryNode, IFileNode, \
      ExistingChildError, NoSuchChildError, ICheckable, IDeepCheckable, \
      MustBeDeepImmutableError, CapConstraintError, ChildOfWrongTypeError
+from allmydata.check_index import IncrementalChecker
 from allmydata.check_results import DeepCheckResults, \
      DeepCheckAndRepairResults
 from allmydata.monitor import Monitor
@@ -123,9 +128,11 @@ def update_metadata(metadata, new_metadata, now):
     return metadata
 
 
-# TODO: {Deleter,MetadataSetter,Adder}.modify all start by unpacking the
-# contents and end by repacking them. It might be better to apply them to
-# the unpacked contents.
+# {Deleter,MetadataSetter,Adder}.modify_children change unpacked contents in
+# place, and return whether they changed anything. They either raise before
+# changing anything or succeed, so that several of them can be applied to
+# the same contents (see _ModifierBatch). Their modify() methods unpack and
+# repack the contents around a single modify_children().
 
 class Deleter(object):
     def __init__(self, node, namex, must_exist=True, must_be_directory=False, must_be_file=False):
@@ -135,13 +142,25 @@ class Deleter(object):
         self.must_be_directory = must_be_directory
         self.must_be_file = must_be_file
 
+    def get_names(self):
+        return [self.name]
+
+    def for_names(self, names):
+        return self
+
     def modify(self, old_contents, servermap, first_time):
         children = self.node._unpack_contents(old_contents)
+        if not self.modify_children(children, first_time):
+            return None
+        new_contents = self.node._pack_contents(children)
+        return new_contents
+
+    def modify_children(self, children, first_time):
         if self.name not in children:
             if first_time and self.must_exist:
                 raise NoSuchChildError(self.name)
             self.old_child = None
-            return None
+            return False
         self.old_child, metadata = children[self.name]
 
         # Unknown children can be removed regardless of must_be_directory or must_be_file.
@@ -151,8 +170,7 @@ class Deleter(object):
             raise ChildOfWrongTypeError("delete required a file, not a directory")
 
         del children[self.name]
-        new_contents = self.node._pack_contents(children)
-        return new_contents
+        return True
 
 
 class MetadataSetter(object):
@@ -162,8 +180,19 @@ class MetadataSetter(object):
         self.metadata = metadata
         self.create_readonly_node = create_readonly_node
 
+    def get_names(self):
+        return [self.name]
+
+    def for_names(self, names):
+        return self
+
     def modify(self, old_contents, servermap, first_time):
         children = self.node._unpack_contents(old_contents)
+        self.modify_children(children, first_time)
+        new_contents = self.node._pack_contents(children)
+        return new_contents
+
+    def modify_children(self, children, first_time):
         name = self.name
         if name not in children:
             raise NoSuchChildError(name)
@@ -176,8 +205,7 @@ class MetadataSetter(object):
             child = self.create_readonly_node(child, name)
 
         children[name] = (child, metadata)
-        new_contents = self.node._pack_contents(children)
-        return new_contents
+        return True
 
 
 class Adder(object):
@@ -201,9 +229,28 @@ class Adder(object):
         precondition(IFilesystemNode.providedBy(node), node)
         self.entries[namex] = (node, metadata)
 
+    def get_names(self):
+        return [normalize(namex) for namex in self.entries]
+
+    def for_names(self, names):
+        """Return an Adder of just the entries with the given (normalized)
+        names."""
+        entries = dict((namex, entry) for (namex, entry) in self.entries.items()
+                       if normalize(namex) in names)
+        return Adder(self.node, entries, overwrite=self.overwrite,
+                     create_readonly_node=self.create_readonly_node)
+
     def modify(self, old_contents, servermap, first_time):
         children = self.node._unpack_contents(old_contents)
+        self.modify_children(children, first_time)
+        new_contents = self.node._pack_contents(children)
+        return new_contents
+
+    def modify_children(self, children, first_time):
         now = time.time()
+        # collect the new children first, so that nothing is changed if
+        # any of them cannot be added
+        added = {}
         for (namex, (child, new_metadata)) in list(self.entries.items()):
             name = normalize(namex)
             precondition(IFilesystemNode.providedBy(child), child)
@@ -213,21 +260,51 @@ class Adder(object):
             child.raise_error()
 
             metadata = None
-            if name in children:
+            existing = added.get(name, children.get(name))
+            if existing is not None:
                 if not self.overwrite:
                     raise ExistingChildError("child %s already exists" % quote_output(name, encoding='utf-8'))
 
-                if self.overwrite == ONLY_FILES and IDirectoryNode.providedBy(children[name][0]):
+                if self.overwrite == ONLY_FILES and IDirectoryNode.providedBy(existing[0]):
                     raise ExistingChildError("child %s already exists as a directory" % quote_output(name, encoding='utf-8'))
-                metadata = children[name][1].copy()
+                metadata = existing[1].copy()
 
             metadata = update_metadata(metadata, new_metadata, now)
             if self.create_readonly_node and metadata.get('no-write', False):
                 child = self.create_readonly_node(child, name)
 
-            children[name] = (child, metadata)
-        new_contents = self.node._pack_contents(children)
-        return new_contents
+            added[name] = (child, metadata)
+        for (name, value) in added.items():
+            # not children.update(), which would keep the old packed entries
+            children[name] = value
+        return True
+
+
+class _ModifierBatch(object):
+    """I apply several modifiers (Deleters, MetadataSetters and Adders) to
+    a directory in a single modification of its contents, and remember which
+    of them failed, so that each can be reported to its own caller."""
+
+    def __init__(self, node, modifiers):
+        self.node = node
+        self.modifiers = modifiers
+        # index of modifier -> Failure, for the most recent attempt
+        self.failures = {}
+
+    def modify(self, old_contents, servermap, first_time):
+        self.failures = {}
+        children = self.node._unpack_contents(old_contents)
+        changed = False
+        for (i, modifier) in enumerate(self.modifiers):
+            try:
+                if modifier.modify_children(children, first_time):
+                    changed = True
+            except Exception:
+                self.failures[i] = Failure()
+        if not changed:
+            return None
+        return self.node._pack_contents(children)
+
 
 def _encrypt_rw_uri(writekey, rw_uri):
     precondition(isinstance(rw_uri, bytes), rw_uri)
@@ -311,6 +388,146 @@ def _pack_normalized_children(children, writekey, deep_immutable=False):
         entries.append(netstring(entry))
     return b"".join(entries)
 
+def _load_metadata(metadata_s):
+    metadata = json.loads(metadata_s)
+    assert isinstance(metadata, dict)
+    return metadata
+
+
+class _ParsedDirectory(object):
+    """I am one version of the contents of a directory, unpacked only as
+    far as has been needed so far.
+
+    Unpacking every child of a directory with many children is expensive.
+    I start by finding where each child's entry is and what its name is,
+    and unpack each entry (decrypting its writecap) the first time it is
+    asked for, so that looking up one name costs about the same in a large
+    directory as in a small one. Nodes and metadata are made afresh for each
+    caller: callers are free to modify the metadata, and whether a node is
+    blacklisted can change.
+    """
+
+    def __init__(self, dirnode, data):
+        self.data = data
+        self._dirnode = dirnode
+        # name -> (start, end) of its entry in data
+        self._index = None
+        # name -> (rw_uri, ro_uri, serialized metadata)
+        self._entries = {}
+
+    def _get_index(self):
+        if self._index is None:
+            data = self.data
+            index = {}
+            position = 0
+            while position < len(data):
+                colon = data.index(b":", position)
+                start = colon + 1
+                end = start + int(data[position:colon])
+                if data[end:end+1] != b",":
+                    raise ValueError("malformed directory entry at %d" % position)
+                # the name is the first netstring of the entry
+                colon = data.index(b":", start)
+                name_start = colon + 1
+                name_end = name_start + int(data[start:colon])
+                if name_end > end:
+                    raise ValueError("malformed directory entry at %d" % position)
+                name = normalize(data[name_start:name_end].decode("utf-8"))
+                index[name] = (start, end)
+                position = end + 1
+            self._index = index
+        return self._index
+
+    def _get_entry(self, name):
+        (start, end) = self._get_index()[name]
+        return self.data[start:end]
+
+    def get(self, name):
+        """Return the (node, metadata) pair for the child called name (which
+        must be normalized), or None if there is no such child."""
+        if name not in self._get_index():
+            return None
+        if name not in self._entries:
+            self._entries[name] = self._dirnode._unpack_entry(
+                self._get_entry(name))[1:]
+        (rw_uri, ro_uri, metadata_s) = self._entries[name]
+        child = self._dirnode._create_child(rw_uri, ro_uri, name)
+        if child is None:
+            return None
+        return (child, _load_metadata(metadata_s))
+
+    def get_names(self):
+        """Return the names of all the children."""
+        return list(self._get_index())
+
+    def pack_children(self, names):
+        """Return the packed contents of a directory holding just the named
+        children, copied without unpacking them."""
+        return b"".join([netstring(self._get_entry(name))
+                         for name in sorted(names)])
+
+    def get_all(self):
+        """Return an AuxValueDict of all the children, in the same form as
+        DirectoryNode._unpack_contents."""
+        children = AuxValueDict()
+        for name in self._get_index():
+            child = self.get(name)
+            if child is not None:
+                children.set_with_aux(name, child,
+                                      auxilliary=self._get_entry(name))
+        return children
+
+
+class ParsedDirectoryCache(object):
+    """I remember the _ParsedDirectory of the directories that were read
+    most recently, so that reading the same version of a directory again
+    (walking the same path through it, for example) does not unpack its
+    children again.
+
+    Entries are keyed by storage index and by whether the directory was read
+    with a writecap (which decides whether the children's writecaps are
+    unpacked), and hold the latest version that was read. A version is
+    recognized by its contents, which is the one thing every reader of the
+    directory has in hand.
+    """
+
+    MAX_ENTRIES = 100
+    MAX_BYTES = 32*1024*1024
+
+    def __init__(self, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        # (storage index, readonly) -> _ParsedDirectory, least recently
+        # used first
+        self._entries = OrderedDict()
+        self._bytes = 0
+
+    def get(self, key, data):
+        parsed = self._entries.get(key)
+        if parsed is None or parsed.data != data:
+            return None
+        self._entries.move_to_end(key)
+        return parsed
+
+    def put(self, key, parsed):
+        self._remove(key)
+        self._entries[key] = parsed
+        self._bytes += len(parsed.data)
+        while (len(self._entries) > 1 and
+               (len(self._entries) > self._max_entries or
+                self._bytes > self._max_bytes)):
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        parsed = self._entries.pop(key, None)
+        if parsed is not None:
+            self._bytes -= len(parsed.data)
+
+
+class _IsSharded(Exception):
+    """The contents of a directory turned out to be sharded."""
+
+
 @implementer(IDirectoryNode, ICheckable, IDeepCheckable)
 class DirectoryNode(object):
     filenode_class = MutableFileNode
@@ -323,6 +540,13 @@ class DirectoryNode(object):
         self._uri = wrap_dirnode_cap(filenode_cap)
         self._nodemaker = nodemaker
         self._uploader = uploader
+        # the ShardedDirectory which reads and changes my contents, once
+        # they have been found to be sharded
+        self._shards = None
+        # (modifier, Deferred) for the changes waiting for the one being
+        # published to finish
+        self._pending_modifiers = []
+        self._modifying = False
 
     def __repr__(self):
         return "<%s %s-%s %s>" % (self.__class__.__name__,
@@ -340,15 +564,105 @@ class DirectoryNode(object):
         a Deferred that fires with the result."""
         return self._node.get_current_size()
 
-    def _read(self):
+    def _download(self, max_age=None):
         if self._node.is_mutable():
             # use the IMutableFileNode API.
-            d = self._node.download_best_version()
+            d = self._node.download_best_version(max_age=max_age)
         else:
             d = download_to_data(self._node)
-        d.addCallback(self._unpack_contents)
         return d
 
+    def _is_sharded(self, data):
+        return self._node.is_mutable() and is_sharded(data)
+
+    def _get_shards(self):
+        if self._shards is None:
+            self._shards = ShardedDirectory(self, self._nodemaker)
+        return self._shards
+
+    def _read(self, max_age=None):
+        d = self._download(max_age)
+        def _got(data):
+            if self._is_sharded(data):
+                return self._get_shards().list_children(data, max_age)
+            return self._parse_contents(data).get_all()
+        d.addCallback(_got)
+        return d
+
+    def _lookup(self, name, max_age=None):
+        """Fire with the (node, metadata) pair of the named child (which
+        must be normalized), or with None if there is no such child."""
+        d = self._download(max_age)
+        def _got(data):
+            if self._is_sharded(data):
+                return self._get_shards().get(name, data, max_age)
+            return self._parse_contents(data).get(name)
+        d.addCallback(_got)
+        return d
+
+    def _modify(self, modifier):
+        """Apply modifier (an Adder, Deleter or MetadataSetter) to my
+        contents, wherever they are kept. Modifiers which arrive while an
+        earlier change is being published are applied together, in one
+        change that follows it."""
+        if self._shards is not None:
+            d = self._shards.modify(modifier)
+        else:
+            d = defer.Deferred()
+            self._pending_modifiers.append((modifier, d))
+            if not self._modifying:
+                self._modify_pending()
+        d.addCallback(self._changed)
+        return d
+
+    def _changed(self, res):
+        # tell whoever remembers my children (the SFTP frontend, say) that
+        # they have changed
+        self._nodemaker.directory_changes.notify(self.get_storage_index())
+        return res
+
+    def _modify_pending(self):
+        pending, self._pending_modifiers = self._pending_modifiers, []
+        batch = _ModifierBatch(self, [modifier for (modifier, d) in pending])
+        def _modify_unsharded(old_contents, servermap, first_time):
+            if is_sharded(old_contents):
+                raise _IsSharded()
+            return batch.modify(old_contents, servermap, first_time)
+        self._modifying = True
+        d = defer.maybeDeferred(self._node.modify, _modify_unsharded)
+        def _done(res):
+            self._modifying = False
+            for (i, (modifier, waiter)) in enumerate(pending):
+                if isinstance(res, Failure) and res.check(_IsSharded):
+                    self._get_shards().modify(modifier).chainDeferred(waiter)
+                elif isinstance(res, Failure):
+                    waiter.errback(res)
+                elif i in batch.failures:
+                    waiter.errback(batch.failures[i])
+                else:
+                    waiter.callback(None)
+            if self._pending_modifiers and not self._modifying:
+                self._modify_pending()
+        d.addBoth(_done)
+
+    def _parse_contents(self, data, storage_index=None):
+        """Return a _ParsedDirectory of data, which are my contents or (if I
+        am sharded) those of one of my shards, whose storage index must then
+        be given."""
+        assert isinstance(data, bytes), (repr(data), type(data))
+        if storage_index is None:
+            storage_index = self.get_storage_index()
+        if storage_index is None:
+            # a literal directory: there is nothing to share it with
+            return _ParsedDirectory(self, data)
+        cache = self._nodemaker.parsed_directories
+        key = (storage_index, self.is_readonly())
+        parsed = cache.get(key, data)
+        if parsed is None:
+            parsed = _ParsedDirectory(self, data)
+            cache.put(key, parsed)
+        return parsed
+
     def _decrypt_rwcapdata(self, encwrcap):
         salt = encwrcap[:16]
         crypttext = encwrcap[16:-32]
@@ -382,55 +696,63 @@ class DirectoryNode(object):
         # an empty directory is serialized as an empty string
         if data == b"":
             return AuxValueDict()
-        writeable = not self.is_readonly()
-        mutable = self.is_mutable()
         children = AuxValueDict()
         position = 0
         while position < len(data):
             entries, position = split_netstring(data, 1, position)
             entry = entries[0]
-            (namex_utf8, ro_uri, rwcapdata, metadata_s), subpos = split_netstring(entry, 4)
-            if not mutable and len(rwcapdata) > 0:
-                raise ValueError("the rwcapdata field of a dirnode in an immutable directory was not empty")
-
-            # A name containing characters that are unassigned in one version of Unicode might
-            # not be normalized wrt a later version. See the note in section 'Normalization Stability'
-            # at <http://unicode.org/policies/stability_policy.html>.
-            # Therefore we normalize names going both in and out of directories.
-            name = normalize(namex_utf8.decode("utf-8"))
-
-            rw_uri = b""
-            if writeable:
-                rw_uri = self._decrypt_rwcapdata(rwcapdata)
-
-            # Since the encryption uses CTR mode, it currently leaks the length of the
-            # plaintext rw_uri -- and therefore whether it is present, i.e. whether the
-            # dirnode is writeable (ticket #925). By stripping trailing spaces in
-            # Tahoe >= 1.6.0, we may make it easier for future versions to plug this leak.
-            # ro_uri is treated in the same way for consistency.
-            # rw_uri and ro_uri will be either None or a non-empty string.
-
-            rw_uri = rw_uri.rstrip(b' ') or None
-            ro_uri = ro_uri.rstrip(b' ') or None
-
-            try:
-                child = self._create_and_validate_node(rw_uri, ro_uri, name)
-                if mutable or child.is_allowed_in_immutable_directory():
-                    metadata = json.loads(metadata_s)
-                    assert isinstance(metadata, dict)
-                    children[name] = (child, metadata)
-                    children.set_with_aux(name, (child, metadata), auxilliary=entry)
-                else:
-                    log.msg(format="mutable cap for child %(name)s unpacked from an immutable directory",
-                            name=quote_output(name, encoding='utf-8'),
-                            facility="tahoe.webish", level=log.UNUSUAL)
-            except CapConstraintError as e:
-                log.msg(format="unmet constraint on cap for child %(name)s unpacked from a directory:\n"
-                               "%(message)s", message=e.args[0], name=quote_output(name, encoding='utf-8'),
-                               facility="tahoe.webish", level=log.UNUSUAL)
+            (name, rw_uri, ro_uri, metadata_s) = self._unpack_entry(entry)
+            child = self._create_child(rw_uri, ro_uri, name)
+            if child is not None:
+                children.set_with_aux(name, (child, _load_metadata(metadata_s)),
+                                      auxilliary=entry)
 
         return children
 
+    def _unpack_entry(self, entry):
+        """Unpack the entry of one child, as described in _unpack_contents.
+        Return (name, rw_uri, ro_uri, serialized metadata)."""
+        (namex_utf8, ro_uri, rwcapdata, metadata_s), subpos = split_netstring(entry, 4)
+        if not self.is_mutable() and len(rwcapdata) > 0:
+            raise ValueError("the rwcapdata field of a dirnode in an immutable directory was not empty")
+
+        # A name containing characters that are unassigned in one version of Unicode might
+        # not be normalized wrt a later version. See the note in section 'Normalization Stability'
+        # at <http://unicode.org/policies/stability_policy.html>.
+        # Therefore we normalize names going both in and out of directories.
+        name = normalize(namex_utf8.decode("utf-8"))
+
+        rw_uri = b""
+        if not self.is_readonly():
+            rw_uri = self._decrypt_rwcapdata(rwcapdata)
+
+        # Since the encryption uses CTR mode, it currently leaks the length of the
+        # plaintext rw_uri -- and therefore whether it is present, i.e. whether the
+        # dirnode is writeable (ticket #925). By stripping trailing spaces in
+        # Tahoe >= 1.6.0, we may make it easier for future versions to plug this leak.
+        # ro_uri is treated in the same way for consistency.
+        # rw_uri and ro_uri will be either None or a non-empty string.
+
+        rw_uri = rw_uri.rstrip(b' ') or None
+        ro_uri = ro_uri.rstrip(b' ') or None
+        return (name, rw_uri, ro_uri, metadata_s)
+
+    def _create_child(self, rw_uri, ro_uri, name):
+        """Return the node for an unpacked child, or None if it may not be
+        used in this directory."""
+        try:
+            child = self._create_and_validate_node(rw_uri, ro_uri, name)
+            if self.is_mutable() or child.is_allowed_in_immutable_directory():
+                return child
+            log.msg(format="mutable cap for child %(name)s unpacked from an immutable directory",
+                    name=quote_output(name, encoding='utf-8'),
+                    facility="tahoe.webish", level=log.UNUSUAL)
+        except CapConstraintError as e:
+            log.msg(format="unmet constraint on cap for child %(name)s unpacked from a directory:\n"
+                           "%(message)s", message=e.args[0], name=quote_output(name, encoding='utf-8'),
+                           facility="tahoe.webish", level=log.UNUSUAL)
+        return None
+
     def _pack_contents(self, children):
         # expects children in the same format as _unpack_contents returns
         return _pack_normalized_children(children, self._node.get_writekey())
@@ -484,27 +806,27 @@ class DirectoryNode(object):
     def check_and_repair(self, monitor, verify=False, add_lease=False):
         return self._node.check_and_repair(monitor, verify, add_lease)
 
-    def list(self):
+    def list(self, max_age=None):
         """I return a Deferred that fires with a dictionary mapping child
-        name to a tuple of (IFilesystemNode, metadata)."""
-        return self._read()
+        name to a tuple of (IFilesystemNode, metadata). If max_age is
+        provided, it limits how old (in seconds) a cached servermap of a
+        mutable directory may be."""
+        return self._read(max_age)
 
     def has_child(self, namex):
         """I return a Deferred that fires with a boolean, True if there
         exists a child of the given name, False if not."""
         name = normalize(namex)
-        d = self._read()
-        d.addCallback(lambda children: name in children)
+        d = self._lookup(name)
+        d.addCallback(lambda child: child is not None)
         return d
 
-    def _get(self, children, name):
-        child = children.get(name)
+    def _get(self, child, name):
         if child is None:
             raise NoSuchChildError(name)
         return child[0]
 
-    def _get_with_metadata(self, children, name):
-        child = children.get(name)
+    def _get_with_metadata(self, child, name):
         if child is None:
             raise NoSuchChildError(name)
         return child
@@ -513,7 +835,7 @@ class DirectoryNode(object):
         """I return a Deferred that fires with the named child node,
         which is an IFilesystemNode."""
         name = normalize(namex)
-        d = self._read()
+        d = self._lookup(name)
         d.addCallback(self._get, name)
         return d
 
@@ -522,14 +844,18 @@ class DirectoryNode(object):
         the named child. The node is an IFilesystemNode, and the metadata
         is a dictionary."""
         name = normalize(namex)
-        d = self._read()
+        d = self._lookup(name)
         d.addCallback(self._get_with_metadata, name)
         return d
 
     def get_metadata_for(self, namex):
         name = normalize(namex)
-        d = self._read()
-        d.addCallback(lambda children: children[name][1])
+        d = self._lookup(name)
+        def _got(child):
+            if child is None:
+                raise KeyError(name)
+            return child[1]
+        d.addCallback(_got)
         return d
 
     def set_metadata_for(self, namex, metadata):
@@ -539,7 +865,7 @@ class DirectoryNode(object):
         assert isinstance(metadata, dict)
         s = MetadataSetter(self, name, metadata,
                            create_readonly_node=self._create_readonly_node)
-        d = self._node.modify(s.modify)
+        d = self._modify(s)
         d.addCallback(lambda res: self)
         return d
 
@@ -610,7 +936,7 @@ class DirectoryNode(object):
             # for this type of directory.
             child_node = self._create_and_validate_node(writecap, readcap, namex)
             a.set_node(namex, child_node, metadata)
-        d = self._node.modify(a.modify)
+        d = self._modify(a)
         d.addCallback(lambda ign: self)
         return d
 
@@ -631,7 +957,7 @@ class DirectoryNode(object):
         a = Adder(self, overwrite=overwrite,
                   create_readonly_node=self._create_readonly_node)
         a.set_node(namex, child, metadata)
-        d = self._node.modify(a.modify)
+        d = self._modify(a)
         d.addCallback(lambda res: child)
         return d
 
@@ -641,7 +967,7 @@ class DirectoryNode(object):
             return defer.fail(NotWriteableError())
         a = Adder(self, entries, overwrite=overwrite,
                   create_readonly_node=self._create_readonly_node)
-        d = self._node.modify(a.modify)
+        d = self._modify(a)
         d.addCallback(lambda res: self)
         return d
 
@@ -673,7 +999,7 @@ class DirectoryNode(object):
             return defer.fail(NotWriteableError())
         deleter = Deleter(self, namex, must_exist=must_exist,
                           must_be_directory=must_be_directory, must_be_file=must_be_file)
-        d = self._node.modify(deleter.modify)
+        d = self._modify(deleter)
         d.addCallback(lambda res: deleter.old_child)
         return d
 
@@ -697,7 +1023,7 @@ class DirectoryNode(object):
             entries = {name: (child, metadata)}
             a = Adder(self, entries, overwrite=overwrite,
                       create_readonly_node=self._create_readonly_node)
-            d = self._node.modify(a.modify)
+            d = self._modify(a)
             d.addCallback(lambda res: child)
             return d
         d.addCallback(_created)
@@ -739,6 +1065,26 @@ class DirectoryNode(object):
         d.addCallback(lambda child: self.delete(current_child_name))
         return d
 
+    def make_sharded(self):
+        if self.is_readonly():
+            return defer.fail(NotWriteableError())
+        shards = ShardedDirectory(self, self._nodemaker)
+        d = shards.convert()
+        def _converted(ign):
+            self._shards = shards
+            return self
+        d.addCallback(_converted)
+        return d
+
+    def get_most_recent_seqnum(self):
+        if not self._node.is_mutable():
+            return None
+        return self._node.get_most_recent_seqnum()
+
+    def get_shard_nodes(self):
+        if self._shards is None:
+            return []
+        return list(self._shards.shard_nodes)
 
     def deep_traverse(self, walker):
         """Perform a recursive walk, using this dirnode as a root, notifying
@@ -754,6 +1100,10 @@ class DirectoryNode(object):
         I call walker.add_node(node, path) for each node (both files and
         directories) I can reach. Most work should be done here.
 
+        I call walker.add_shard(shard, path) for each of the mutable files
+        which hold the children of a sharded directory (other than the
+        directory's own), right after calling enter_directory() for it.
+
         I avoid loops by keeping track of verifier-caps and refusing to call
         walker.add_node() or traverse a node that I've seen before. This
         means that any file or directory will only be given to the walker
@@ -761,82 +1111,38 @@ class DirectoryNode(object):
         directory structure, this may appear to under-count or miss some of
         them.
 
+        I visit several directories at once (see DeepTraversal), so the
+        walker may hear about the children of one directory in between
+        those of another. The number of directories visited at once is set
+        by the nodemaker's traversal parameters.
+
         I return a Monitor which can be used to wait for the operation to
         finish, learn about its progress, or cancel the operation.
         """
 
         # this is just a tree-walker, except that following each edge
-        # requires a Deferred. We used to use a ConcurrencyLimiter to limit
+        # requires a Deferred. We once used a ConcurrencyLimiter to limit
         # fanout to 10 simultaneous operations, but the memory load of the
         # queued operations was excessive (in one case, with 330k dirnodes,
         # it caused the process to run into the 3.0GB-ish per-process 32bit
-        # linux memory limit, and crashed). So we use a single big Deferred
-        # chain, and do a strict depth-first traversal, one node at a time.
-        # This can be slower, because we aren't pipelining directory reads,
-        # but it brought the memory footprint down by roughly 50%.
+        # linux memory limit, and crashed). Then we did a strict depth-first
+        # traversal, one node at a time, which was slow because no directory
+        # reads were pipelined. DeepTraversal visits a bounded number of
+        # directories at once from an explicit frontier, and falls back to
+        # one at a time when that frontier grows too large.
 
         monitor = Monitor()
         walker.set_monitor(monitor)
 
-        found = set([self.get_verify_cap()])
-        d = self._deep_traverse_dirnode(self, [], walker, monitor, found)
+        params = self._nodemaker.traversal_parameters or {}
+        traversal = DeepTraversal(self, walker, monitor, **params)
+        d = traversal.run()
         d.addCallback(lambda ignored: walker.finish())
         d.addBoth(monitor.finish)
         d.addErrback(lambda f: None)
 
         return monitor
 
-    def _deep_traverse_dirnode(self, node, path, walker, monitor, found):
-        # process this directory, then walk its children
-        monitor.raise_if_cancelled()
-        d = defer.maybeDeferred(walker.add_node, node, path)
-        d.addCallback(lambda ignored: node.list())
-        d.addCallback(self._deep_traverse_dirnode_children, node, path,
-                      walker, monitor, found)
-        return d
-
-    def _deep_traverse_dirnode_children(self, children, parent, path,
-                                        walker, monitor, found):
-        monitor.raise_if_cancelled()
-        d = defer.maybeDeferred(walker.enter_directory, parent, children)
-        # we process file-like children first, so we can drop their FileNode
-        # objects as quickly as possible. Tests suggest that a FileNode (held
-        # in the client's nodecache) consumes about 2440 bytes. dirnodes (not
-        # in the nodecache) seem to consume about 2000 bytes.
-        dirkids = []
-        filekids = []
-        for name, (child, metadata) in sorted(children.items()):
-            childpath = path + [name]
-            if isinstance(child, UnknownNode):
-                walker.add_node(child, childpath)
-                continue
-            verifier = child.get_verify_cap()
-            # allow LIT files (for which verifier==None) to be processed
-            if (verifier is not None) and (verifier in found):
-                continue
-            found.add(verifier)
-            if IDirectoryNode.providedBy(child):
-                dirkids.append( (child, childpath) )
-            else:
-                filekids.append( (child, childpath) )
-        for i, (child, childpath) in enumerate(filekids):
-            d.addCallback(lambda ignored, child=child, childpath=childpath:
-                          walker.add_node(child, childpath))
-            # to work around the Deferred tail-recursion problem
-            # (specifically the defer.succeed flavor) requires us to avoid
-            # doing more than 158 LIT files in a row. We insert a turn break
-            # once every 100 files (LIT or CHK) to preserve some stack space
-            # for other code. This is a different expression of the same
-            # Twisted problem as in #237.
-            if i % 100 == 99:
-                d.addCallback(lambda ignored: fireEventually())
-        for (child, childpath) in dirkids:
-            d.addCallback(lambda ignored, child=child, childpath=childpath:
-                          self._deep_traverse_dirnode(child, childpath,
-                                                      walker, monitor,
-                                                      found))
-        return d
-
 
     def build_manifest(self):
         """Return a Monitor, with a ['status'] that will be a list of (path,
@@ -850,11 +1156,17 @@ class DirectoryNode(object):
         # children for which we've got both a write-cap and a read-cap
         return self.deep_traverse(DeepStats(self))
 
-    def start_deep_check(self, verify=False, add_lease=False):
-        return self.deep_traverse(DeepChecker(self, verify, repair=False, add_lease=add_lease))
+    def start_deep_check(self, verify=False, add_lease=False,
+                         recheck_age=None):
+        return self.deep_traverse(DeepChecker(self, verify, repair=False, add_lease=add_lease,
+                                              check_index=self._nodemaker.check_index,
+                                              recheck_age=recheck_age))
 
-    def start_deep_check_and_repair(self, verify=False, add_lease=False):
-        return self.deep_traverse(DeepChecker(self, verify, repair=True, add_lease=add_lease))
+    def start_deep_check_and_repair(self, verify=False, add_lease=False,
+                                    recheck_age=None):
+        return self.deep_traverse(DeepChecker(self, verify, repair=True, add_lease=add_lease,
+                                              check_index=self._nodemaker.check_index,
+                                              recheck_age=recheck_age))
 
 
 class ManifestWalker(DeepStats):
@@ -874,6 +1186,10 @@ class ManifestWalker(DeepStats):
             self.verifycaps.add(v.to_string())
         return DeepStats.add_node(self, node, path)
 
+    def add_shard(self, shard, path):
+        self.storage_index_strings.add(base32.b2a(shard.get_storage_index()))
+        self.verifycaps.add(shard.get_verify_cap().to_string())
+
     def get_results(self):
         stats = DeepStats.get_results(self)
         return {"manifest": self.manifest,
@@ -884,7 +1200,8 @@ class ManifestWalker(DeepStats):
 
 
 class DeepChecker(object):
-    def __init__(self, root, verify, repair, add_lease):
+    def __init__(self, root, verify, repair, add_lease, check_index=None,
+                 recheck_age=None):
         root_si = root.get_storage_index()
         if root_si:
             root_si_base32 = base32.b2a(root_si)
@@ -893,9 +1210,11 @@ class DeepChecker(object):
         self._lp = log.msg(format="deep-check starting (%(si)s),"
                            " verify=%(verify)s, repair=%(repair)s",
                            si=root_si_base32, verify=verify, repair=repair)
-        self._verify = verify
         self._repair = repair
-        self._add_lease = add_lease
+        self._checker = IncrementalChecker(check_index, verify, repair,
+                                           add_lease, recheck_age)
+        # directories whose check waits for their contents -> path
+        self._waiting = {}
         if repair:
             self._results = DeepCheckAndRepairResults(root_si)
         else:
@@ -906,21 +1225,41 @@ class DeepChecker(object):
         self.monitor = monitor
         monitor.set_status(self._results)
 
-    def add_node(self, node, childpath):
+    def _check(self, node, path):
+        d = self._checker.check(node, self.monitor)
         if self._repair:
-            d = node.check_and_repair(self.monitor, self._verify, self._add_lease)
-            d.addCallback(self._results.add_check_and_repair, childpath)
+            d.addCallback(self._results.add_check_and_repair, path)
         else:
-            d = node.check(self.monitor, self._verify, self._add_lease)
-            d.addCallback(self._results.add_check, childpath)
+            d.addCallback(self._results.add_check, path)
+        return d
+
+    def add_node(self, node, childpath):
+        if self._checker.must_wait_for_contents(node):
+            self._waiting[node] = childpath
+            d = defer.succeed(None)
+        else:
+            d = self._check(node, childpath)
         d.addCallback(lambda ignored: self._stats.add_node(node, childpath))
         return d
 
     def enter_directory(self, parent, children):
-        return self._stats.enter_directory(parent, children)
+        d = defer.succeed(None)
+        if parent in self._waiting:
+            d.addCallback(lambda ignored:
+                          self._check(parent, self._waiting.pop(parent)))
+        d.addCallback(lambda ignored:
+                      self._stats.enter_directory(parent, children))
+        return d
+
+    def add_shard(self, shard, path):
+        # the results for a shard are filed under a pseudo-child of its
+        # directory, which names the shard
+        return self._check(shard, list(path) + [shard_path_name(shard)])
 
     def finish(self):
-        log.msg("deep-check done", parent=self._lp)
+        self._checker.flush()
+        log.msg(format="deep-check done, %(skipped)d objects not re-checked",
+                skipped=self._checker.objects_skipped, parent=self._lp)
         self._results.update_stats(self._stats.get_results())
         return self._results
 
@@ -11,7 +11,8 @@ if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
 import six
-import heapq, traceback, stat, struct
+import heapq, traceback, stat, struct, weakref
+from collections import OrderedDict
 from stat import S_IFREG, S_IFDIR
 from time import time, strftime, localtime
 
@@ -39,9 +40,11 @@ from allmydata.util import deferredutil
 
 from allmydata.util.assertutil import _assert, precondition
 from allmydata.util.consumer import download_to_data
+from allmydata.util.observer import OneShotObserverList
 from allmydata.util.encodingutil import get_filesystem_encoding
 from allmydata.interfaces import IFileNode, IDirectoryNode, ExistingChildError, \
-     NoSuchChildError, ChildOfWrongTypeError
+     NoSuchChildError, ChildOfWrongTypeError, IStatsProducer, \
+     DEFAULT_MAX_SEGMENT_SIZE
 from allmydata.mutable.common import NotWriteableError
 from allmydata.mutable.publish import MutableFileHandle
 from allmydata.immutable.upload import FileHandle
@@ -655,6 +658,158 @@ class ShortReadOnlySFTPFile(PrefixingLogMixin):
         return defer.execute(_denied)
 
 
+@implementer(ISFTPFile)
+class RandomAccessReadOnlySFTPFile(PrefixingLogMixin):
+    """I represent a file handle to a particular file on an SFTP connection.
+    I am used for the files opened in read-only mode that are too big for
+    ShortReadOnlySFTPFile, and for mutable files. Rather than downloading
+    the whole file before the first read, I read the blocks (segments) that
+    each read request covers from the version that was current when I was
+    opened. I keep the most recently used blocks, and when the reads are
+    sequential I fetch the next few blocks before they are asked for."""
+
+    # the size of a block until the file tells us its real segment size
+    BLOCK_SIZE = DEFAULT_MAX_SEGMENT_SIZE
+    CACHE_BLOCKS = 8
+    READ_AHEAD_BLOCKS = 2
+
+    def __init__(self, userpath, filenode, metadata):
+        PrefixingLogMixin.__init__(self, facility="tahoe.sftp", prefix=userpath)
+        if noisy: self.log(".__init__(%r, %r, %r)" % (userpath, filenode, metadata), level=NOISY)
+
+        precondition(isinstance(userpath, bytes) and IFileNode.providedBy(filenode),
+                     userpath=userpath, filenode=filenode)
+        self.filenode = filenode
+        self.metadata = metadata
+        self.closed = False
+        self.version = None
+        self._block_size = self.BLOCK_SIZE
+        self._block_size_known = False
+        # (offset, length) -> data, least recently used first
+        self._blocks = OrderedDict()
+        # (offset, length) -> OneShotObserverList, for blocks being fetched
+        self._fetching = {}
+        # where the next read starts if the reads are sequential
+        self._next_offset = None
+        self._got_version = OneShotObserverList()
+        d = filenode.get_best_readable_version()
+        def _got(version):
+            self.version = version
+            return version
+        d.addCallback(_got)
+        d.addBoth(self._got_version.fire)
+
+    def readChunk(self, offset, length):
+        request = ".readChunk(%r, %r)" % (offset, length)
+        self.log(request, level=OPERATIONAL)
+
+        if self.closed:
+            def _closed(): raise createSFTPError(FX_BAD_MESSAGE, "cannot read from a closed file handle")
+            return defer.execute(_closed)
+
+        d = self._got_version.when_fired()
+        d.addCallback(lambda version: self._read(version, offset, length))
+        d.addBoth(_convert_error, request)
+        return d
+
+    def _read(self, version, offset, length):
+        size = version.get_size()
+        # We respond with an EOF error iff offset is already at EOF (see
+        # ShortReadOnlySFTPFile.readChunk).
+        if offset >= size:
+            raise createSFTPError(FX_EOF, "read at or past end of file")
+        end = min(offset + length, size)
+        if end <= offset:
+            return b""
+
+        block_size = self._block_size
+        first = offset // block_size
+        last = (end - 1) // block_size
+        ds = [self._get_block(version, n * block_size, block_size)
+              for n in range(first, last + 1)]
+
+        if offset == self._next_offset:
+            last_block = (size - 1) // block_size
+            for n in range(last + 1, min(last + self.READ_AHEAD_BLOCKS, last_block) + 1):
+                self._fetch_block(version, n * block_size, block_size)
+        self._next_offset = end
+
+        d = defer.gatherResults(ds, consumeErrors=True)
+        start = first * block_size
+        d.addCallback(lambda blocks: b"".join(blocks)[offset - start:end - start])
+        return d
+
+    def _block_key(self, version, offset, block_size):
+        return (offset, min(block_size, version.get_size() - offset))
+
+    def _get_block(self, version, offset, block_size):
+        key = self._block_key(version, offset, block_size)
+        if key in self._blocks:
+            self._blocks.move_to_end(key)
+            return defer.succeed(self._blocks[key])
+        self._fetch_block(version, offset, block_size)
+        return self._fetching[key].when_fired()
+
+    def _fetch_block(self, version, offset, block_size):
+        key = self._block_key(version, offset, block_size)
+        if key in self._blocks or key in self._fetching:
+            return
+        if noisy: self.log("fetching block %r" % (key,), level=NOISY)
+        self._fetching[key] = OneShotObserverList()
+        d = download_to_data(version, *key)
+        d.addBoth(self._fetched, version, key)
+
+    def _fetched(self, res, version, key):
+        observer = self._fetching.pop(key)
+        if not isinstance(res, Failure) and not self.closed:
+            self._blocks[key] = res
+            while len(self._blocks) > self.CACHE_BLOCKS:
+                self._blocks.popitem(last=False)
+            if not self._block_size_known:
+                # reading a block has taught the downloader the real
+                # segment size, so asking for it now costs nothing
+                self._block_size_known = True
+                d = version.get_segment_size()
+                d.addCallbacks(self._got_segment_size, lambda f: None)
+        observer.fire(res)
+
+    def _got_segment_size(self, segment_size):
+        if segment_size > 0:
+            self._block_size = segment_size
+
+    def writeChunk(self, offset, data):
+        self.log(".writeChunk(%r, <data of length %r>) denied" % (offset, len(data)), level=OPERATIONAL)
+
+        def _denied(): raise createSFTPError(FX_PERMISSION_DENIED, "file handle was not opened for writing")
+        return defer.execute(_denied)
+
+    def close(self):
+        self.log(".close()", level=OPERATIONAL)
+
+        self.closed = True
+        self._blocks.clear()
+        return defer.succeed(None)
+
+    def getAttrs(self):
+        request = ".getAttrs()"
+        self.log(request, level=OPERATIONAL)
+
+        if self.closed:
+            def _closed(): raise createSFTPError(FX_BAD_MESSAGE, "cannot get attributes for a closed file handle")
+            return defer.execute(_closed)
+
+        d = self._got_version.when_fired()
+        d.addCallback(lambda version: _populate_attrs(self.filenode, self.metadata,
+                                                      size=version.get_size()))
+        d.addBoth(_convert_error, request)
+        return d
+
+    def setAttrs(self, attrs):
+        self.log(".setAttrs(%r) denied" % (attrs,), level=OPERATIONAL)
+        def _denied(): raise createSFTPError(FX_PERMISSION_DENIED, "file handle was not opened for writing")
+        return defer.execute(_denied)
+
+
 @implementer(ISFTPFile)
 class GeneralSFTPFile(PrefixingLogMixin):
     """I represent a file handle to a particular file on an SFTP connection.
@@ -989,6 +1144,191 @@ class Reason(object):
         self.value = value
 
 
+class DirectoryCache(object):
+    """
+    I remember the children of the directories that one SFTP session (or
+    every session of one user) has looked up or listed, so that resolving
+    a path, getting the attributes of the files in a directory one after
+    another, and listing the same directory again, as sshfs and many other
+    clients do, need not read the directories from the grid each time.
+
+    Entries are used for at most max_age seconds, and are forgotten as soon
+    as their directory is modified through this gateway, so only changes
+    made through other gateways can be missed, and only for max_age
+    seconds. With a max_age of 0 nothing is remembered.
+    """
+
+    MAX_DIRECTORIES = 1000
+
+    def __init__(self, max_age, stats, max_directories=MAX_DIRECTORIES):
+        self._max_age = max_age
+        self._stats = stats
+        self._max_directories = max_directories
+        # (storage index, readonly) -> [(time, children) or None,
+        #                               {childname: (time, (node, metadata))}]
+        # least recently used first
+        self._directories = OrderedDict()
+        # counts invalidations, so that a read which was already under way
+        # when its directory changed is not remembered
+        self._generation = 0
+
+    def _now(self):
+        return time()
+
+    def _key(self, dirnode):
+        if self._max_age <= 0 or not IDirectoryNode.providedBy(dirnode):
+            return None
+        storage_index = dirnode.get_storage_index()
+        if storage_index is None:
+            # a literal directory is read without asking the grid
+            return None
+        return (storage_index, dirnode.is_readonly())
+
+    def _fresh(self, entry):
+        if entry is None or self._now() - entry[0] > self._max_age:
+            return None
+        return entry[1]
+
+    def _entry(self, key):
+        entry = self._directories.get(key)
+        if entry is None:
+            entry = self._directories[key] = [None, {}]
+            while len(self._directories) > self._max_directories:
+                self._directories.popitem(last=False)
+        self._directories.move_to_end(key)
+        return entry
+
+    def list(self, dirnode):
+        """Like dirnode.list(). The caller may modify the metadata it gets."""
+        key = self._key(dirnode)
+        if key is None:
+            return dirnode.list()
+        entry = self._directories.get(key)
+        children = self._fresh(entry and entry[0])
+        if children is not None:
+            self._stats.hit()
+            self._directories.move_to_end(key)
+            return defer.succeed(_copy_children(children))
+        self._stats.miss()
+        generation = self._generation
+        d = dirnode.list()
+        def _got(children):
+            if self._generation == generation:
+                self._entry(key)[0] = (self._now(), children)
+            return _copy_children(children)
+        d.addCallback(_got)
+        return d
+
+    def get_child_and_metadata(self, dirnode, name):
+        """Like dirnode.get_child_and_metadata(name)."""
+        key = self._key(dirnode)
+        if key is None:
+            return defer.maybeDeferred(dirnode.get_child_and_metadata, name)
+        entry = self._directories.get(key)
+        if entry is not None:
+            children = self._fresh(entry[0])
+            if children is not None:
+                self._stats.hit()
+                self._directories.move_to_end(key)
+                if name not in children:
+                    return defer.fail(NoSuchChildError(name))
+                return defer.succeed(_copy_child(children[name]))
+            child = self._fresh(entry[1].get(name))
+            if child is not None:
+                self._stats.hit()
+                self._directories.move_to_end(key)
+                return defer.succeed(_copy_child(child))
+        self._stats.miss()
+        generation = self._generation
+        d = dirnode.get_child_and_metadata(name)
+        def _got(child):
+            if self._generation == generation:
+                self._entry(key)[1][name] = (self._now(), child)
+            return _copy_child(child)
+        d.addCallback(_got)
+        return d
+
+    def get(self, dirnode, name):
+        """Like dirnode.get(name)."""
+        d = self.get_child_and_metadata(dirnode, name)
+        d.addCallback(lambda node_and_metadata: node_and_metadata[0])
+        return d
+
+    def get_child_at_path(self, node, path):
+        """Like node.get_child_at_path(path), for a list of child names."""
+        if not path:
+            return defer.succeed(node)
+        d = self.get(node, path[0])
+        d.addCallback(self.get_child_at_path, path[1:])
+        return d
+
+    def invalidate(self, storage_index):
+        """Forget what I know about the directory with storage_index."""
+        self._generation += 1
+        for readonly in (False, True):
+            if self._directories.pop((storage_index, readonly), None) is not None:
+                self._stats.invalidated()
+
+
+def _copy_child(node_and_metadata):
+    (node, metadata) = node_and_metadata
+    return (node, metadata.copy())
+
+def _copy_children(children):
+    return dict((name, _copy_child(child)) for (name, child) in children.items())
+
+
+@implementer(IStatsProducer)
+class DirectoryCaches(object):
+    """
+    I give each SFTP session the DirectoryCache it should use (one shared
+    by all of the sessions of its user if per_user is true), forward the
+    changes to directories made through this gateway to all of them, and
+    count how useful they are for the stats.
+    """
+
+    def __init__(self, nodemaker, max_age, per_user=False):
+        self._max_age = max_age
+        self._per_user = per_user
+        self._user_caches = {}
+        self._caches = weakref.WeakSet()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+        nodemaker.directory_changes.subscribe(self._directory_changed)
+
+    def get_cache(self, username):
+        if self._per_user and username in self._user_caches:
+            return self._user_caches[username]
+        cache = DirectoryCache(self._max_age, self)
+        self._caches.add(cache)
+        if self._per_user:
+            self._user_caches[username] = cache
+        return cache
+
+    def _directory_changed(self, storage_index):
+        if storage_index is None:
+            return
+        for cache in list(self._caches):
+            cache.invalidate(storage_index)
+
+    def hit(self):
+        self._hits += 1
+    def miss(self):
+        self._misses += 1
+    def invalidated(self):
+        self._invalidations += 1
+
+    def get_stats(self):
+        lookups = self._hits + self._misses
+        return {
+            'sftp.cache.hits': self._hits,
+            'sftp.cache.misses': self._misses,
+            'sftp.cache.hit_rate': self._hits / lookups if lookups else 0.0,
+            'sftp.cache.invalidations': self._invalidations,
+        }
+
+
 # A "heisenfile" is a file that has been opened with write flags
 # (FXF_WRITE and/or FXF_CREAT) and not yet close-notified.
 # 'all_heisenfiles' maps from a direntry string to a list of
@@ -1006,7 +1346,7 @@ def _reload():
 
 @implementer(ISFTPServer)
 class SFTPUserHandler(ConchUser, PrefixingLogMixin):
-    def __init__(self, client, rootnode, username):
+    def __init__(self, client, rootnode, username, directory_cache=None):
         ConchUser.__init__(self)
         PrefixingLogMixin.__init__(self, facility="tahoe.sftp", prefix=username)
         if noisy: self.log(".__init__(%r, %r, %r)" % (client, rootnode, username), level=NOISY)
@@ -1018,6 +1358,9 @@ class SFTPUserHandler(ConchUser, PrefixingLogMixin):
         self._root = rootnode
         self._username = username
         self._convergence = client.convergence
+        if directory_cache is None:
+            directory_cache = DirectoryCache(0, None)
+        self._directory_cache = directory_cache
 
         # maps from UTF-8 paths for this user, to files written and still open
         self._heisenfiles = {}
@@ -1280,6 +1623,8 @@ class SFTPUserHandler(ConchUser, PrefixingLogMixin):
 
         if not writing and (flags & FXF_READ) and filenode and not filenode.is_mutable() and filenode.get_size() <= SIZE_THRESHOLD:
             d.addCallback(lambda ign: ShortReadOnlySFTPFile(userpath, filenode, metadata))
+        elif not writing and (flags & FXF_READ) and filenode and not existing_file:
+            d.addCallback(lambda ign: RandomAccessReadOnlySFTPFile(userpath, filenode, metadata))
         else:
             close_notify = None
             if writing:
@@ -1408,7 +1753,7 @@ class SFTPUserHandler(ConchUser, PrefixingLogMixin):
 
                 if noisy: self.log("case 2: root = %r, childname = %r, desired_metadata = %r, path[:-1] = %r" %
                                    (root, childname, desired_metadata, path[:-1]), level=NOISY)
-                d2 = root.get_child_at_path(path[:-1])
+                d2 = self._directory_cache.get_child_at_path(root, path[:-1])
                 def _got_parent(parent):
                     if noisy: self.log("_got_parent(%r)" % (parent,), level=NOISY)
                     if parent.is_unknown():
@@ -1655,7 +2000,7 @@ class SFTPUserHandler(ConchUser, PrefixingLogMixin):
             if childname is None:
                 return parent_or_node
             else:
-                return parent_or_node.get(childname)
+                return self._directory_cache.get(parent_or_node, childname)
         d.addCallback(_got_parent_or_node)
         def _list(dirnode):
             if dirnode.is_unknown():
@@ -1666,7 +2011,7 @@ class SFTPUserHandler(ConchUser, PrefixingLogMixin):
                 raise createSFTPError(FX_PERMISSION_DENIED,
                                 "cannot list a file as if it were a directory")
 
-            d2 = dirnode.list()
+            d2 = self._directory_cache.list(dirnode)
             def _render(children):
                 parent_readonly = dirnode.is_readonly()
                 results = []
@@ -1716,7 +2061,7 @@ class SFTPUserHandler(ConchUser, PrefixingLogMixin):
                                _populate_attrs(node, {'no-write': node.is_unknown() or node.is_readonly()}, size=size))
             else:
                 parent = parent_or_node
-                d2.addCallback(lambda ign: parent.get_child_and_metadata_at_path([childname]))
+                d2.addCallback(lambda ign: self._directory_cache.get_child_and_metadata(parent, childname))
                 def _got(child_and_metadata):
                     (child, metadata) = child_and_metadata
                     if noisy: self.log("_got( (%r, %r) )" % (child, metadata), level=NOISY)
@@ -1907,7 +2252,7 @@ class SFTPUserHandler(ConchUser, PrefixingLogMixin):
             if not remaining_path:
                 return (root, None)
             else:
-                d2 = root.get_child_at_path(remaining_path[:-1])
+                d2 = self._directory_cache.get_child_at_path(root, remaining_path[:-1])
                 d2.addCallback(lambda parent: (parent, remaining_path[-1]))
                 return d2
         d.addCallback(_got_root)
@@ -1987,13 +2332,18 @@ from allmydata.frontends.auth import AccountFileChecker, NeedRootcapLookupScheme
 
 @implementer(portal.IRealm)
 class Dispatcher(object):
-    def __init__(self, client):
+    def __init__(self, client, directory_caches=None):
         self._client = client
+        self._directory_caches = directory_caches
 
     def requestAvatar(self, avatarID, mind, interface):
         _assert(interface == IConchUser, interface=interface)
         rootnode = self._client.create_node_from_uri(avatarID.rootcap)
-        handler = SFTPUserHandler(self._client, rootnode, avatarID.username)
+        directory_cache = None
+        if self._directory_caches is not None:
+            directory_cache = self._directory_caches.get_cache(avatarID.username)
+        handler = SFTPUserHandler(self._client, rootnode, avatarID.username,
+                                  directory_cache)
         return (interface, handler, handler.logout)
 
 
@@ -2001,13 +2351,16 @@ class SFTPServer(service.MultiService):
     name = "frontend:sftp"
 
     def __init__(self, client, accountfile,
-                 sftp_portstr, pubkey_file, privkey_file):
+                 sftp_portstr, pubkey_file, privkey_file,
+                 cache_max_age=0, cache_per_user=False):
         precondition(isinstance(accountfile, (str, type(None))), accountfile)
         precondition(isinstance(pubkey_file, str), pubkey_file)
         precondition(isinstance(privkey_file, str), privkey_file)
         service.MultiService.__init__(self)
 
-        r = Dispatcher(client)
+        self.directory_caches = DirectoryCaches(client.nodemaker, cache_max_age,
+                                                cache_per_user)
+        r = Dispatcher(client, self.directory_caches)
         p = portal.Portal(r)
 
         if accountfile:
@@ -0,0 +1,470 @@
+"""
+A gateway which serves its web API from several processes.
+
+With ``[node]web.workers = N`` (N > 1), the node process starts N-1 gateway
+worker processes. All N of them accept connections on the web port, which
+each one opens with ``SO_REUSEPORT`` so that the kernel shares the
+connections out among them. Each worker is a client node of its own, with
+its own connections to the storage servers, but it runs no storage server,
+helper or SFTP server, and does not listen on the node's Tub port.
+
+The node process runs a GatewayCoordinator, which the workers reach over a
+localhost-only Tub, for the things that the processes must not do
+independently:
+
+* operation handles (``ophandle=``): a later request for an operation may
+  arrive at any process, so each process records the handles it holds, and
+  forwards requests for handles held elsewhere to the holder;
+
+* writes to mutable files and directories: two processes publishing the
+  same mutable file at once would make uncoordinated writes, so each write
+  takes a lock on the file's storage index first;
+
+* the status pages: each process keeps its own History, and the links on
+  them name the worker which holds the operation, so that any process can
+  forward the request there.
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os, sys, socket
+from collections import deque
+from functools import partial
+
+import attr
+from zope.interface import implementer
+from twisted.application import service
+from twisted.internet import defer, protocol
+from twisted.internet.error import ProcessExitedAlready
+from twisted.python import log as twlog
+from foolscap.api import Referenceable, Tub
+
+from allmydata.interfaces import IGateway, RIGatewayCoordinator
+from allmydata.node import _Config
+from allmydata.util import configutil, fileutil, iputil, log
+
+
+def reuseport_supported():
+    """
+    Return True if this platform lets several processes listen on the same
+    TCP port.
+    """
+    return hasattr(socket, "SO_REUSEPORT")
+
+
+def parse_tcp_port(webport):
+    """
+    Parse a web.port value of the forms ``3456``, ``tcp:3456`` and
+    ``tcp:3456:interface=127.0.0.1``, returning ``(port, interface)``. The
+    interface is "" for all of them. Raise ValueError for anything else,
+    since only plain TCP ports can be shared among gateway workers.
+    """
+    parts = webport.split(":")
+    if parts[0] == "tcp":
+        parts = parts[1:]
+    port = None
+    interface = ""
+    for part in parts:
+        if part.startswith("interface="):
+            interface = part[len("interface="):]
+        elif part.startswith("port="):
+            port = part[len("port="):]
+        elif port is None:
+            port = part
+        else:
+            port = None
+            break
+    try:
+        return int(port), interface
+    except (TypeError, ValueError):
+        raise ValueError("config error: web.workers needs a web.port of the"
+                         " form tcp:PORT[:interface=ADDRESS], not %r"
+                         % (webport,))
+
+
+def listen_reuseport(reactor, port, factory, interface="", backlog=50):
+    """
+    Listen on the given TCP port with SO_REUSEPORT set, so that other
+    processes (which also set it) may listen on the same port. Return the
+    IListeningPort.
+    """
+    family = socket.AF_INET6 if ":" in interface else socket.AF_INET
+    s = socket.socket(family, socket.SOCK_STREAM)
+    try:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind((interface, port))
+        s.listen(backlog)
+        s.setblocking(False)
+        # the reactor makes its own copy of the descriptor
+        return reactor.adoptStreamPort(s.fileno(), family, factory)
+    finally:
+        s.close()
+
+
+class ReusePortServer(service.Service):
+    """
+    I listen on a TCP port which other gateway workers share, like
+    twisted.application.internet.TCPServer does on one of its own.
+    """
+
+    def __init__(self, port, factory, interface="", reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self._portnum = port
+        self._factory = factory
+        self._interface = interface
+        self._reactor = reactor
+        self._port = None
+
+    def startService(self):
+        service.Service.startService(self)
+        self._port = listen_reuseport(self._reactor, self._portnum,
+                                      self._factory, self._interface)
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self._port is not None:
+            d = defer.maybeDeferred(self._port.stopListening)
+            self._port = None
+            return d
+
+
+@implementer(RIGatewayCoordinator)
+class GatewayCoordinator(Referenceable):
+    """
+    I keep the state that the processes of a multi-process gateway share:
+    where each worker accepts forwarded requests, which worker holds each
+    operation handle, and which worker may write each mutable file.
+    """
+
+    def __init__(self):
+        self._workers = {} # index -> (private port, worker Referenceable)
+        self._ophandles = {} # ophandle -> index
+        # storage index -> [holder index, deque of (index, Deferred)]
+        self._locks = {}
+
+    def remote_register_worker(self, index, private_port, worker):
+        self._workers[index] = (private_port, worker)
+        if worker is not None:
+            worker.notifyOnDisconnect(self._worker_lost, index, worker)
+        log.msg("gateway worker %d is serving (private port %d)"
+                % (index, private_port), facility="tahoe.gateway")
+
+    def remote_find_worker(self, index):
+        if index not in self._workers:
+            return None
+        return self._workers[index][0]
+
+    def remote_claim_ophandle(self, ophandle, index):
+        self._ophandles[ophandle] = index
+
+    def remote_release_ophandle(self, ophandle, index):
+        if self._ophandles.get(ophandle) == index:
+            del self._ophandles[ophandle]
+
+    def remote_find_ophandle(self, ophandle):
+        return self._ophandles.get(ophandle)
+
+    def remote_lock_mutable(self, storage_index, index):
+        if storage_index not in self._locks:
+            self._locks[storage_index] = [index, deque()]
+            return None
+        d = defer.Deferred()
+        self._locks[storage_index][1].append((index, d))
+        return d
+
+    def remote_unlock_mutable(self, storage_index, index):
+        lock = self._locks.get(storage_index)
+        if lock is not None and lock[0] == index:
+            self._pass_lock(storage_index)
+
+    def _pass_lock(self, storage_index):
+        lock = self._locks[storage_index]
+        if not lock[1]:
+            del self._locks[storage_index]
+            return
+        (lock[0], d) = lock[1].popleft()
+        d.callback(None)
+
+    def _worker_lost(self, index, worker):
+        log.msg("gateway worker %d has gone" % (index,),
+                facility="tahoe.gateway", level=log.UNUSUAL)
+        if self._workers.get(index, (None, None))[1] is worker:
+            del self._workers[index]
+        for (ophandle, holder) in list(self._ophandles.items()):
+            if holder == index:
+                del self._ophandles[ophandle]
+        for (storage_index, lock) in list(self._locks.items()):
+            lock[1] = deque((i, d) for (i, d) in lock[1] if i != index)
+            if lock[0] == index:
+                self._pass_lock(storage_index)
+
+
+@implementer(IGateway)
+class _Gateway(object):
+    """
+    I am one process's view of a multi-process gateway. By myself I use a
+    GatewayCoordinator in this process, which is what the node process does;
+    the worker processes reach theirs over foolscap.
+
+    :ivar int index: this process's number. The node process is worker 0.
+
+    :ivar int workers: how many processes serve the web port.
+    """
+
+    def __init__(self, index, workers, coordinator=None):
+        self.index = index
+        self.workers = workers
+        if coordinator is None:
+            coordinator = GatewayCoordinator()
+        self.coordinator = coordinator
+
+    def _call(self, methname, *args):
+        """Call a method of the GatewayCoordinator, returning a Deferred."""
+        return defer.maybeDeferred(getattr(self.coordinator, "remote_" + methname),
+                                   *args)
+
+    def _call_and_log(self, methname, *args):
+        d = self._call(methname, *args)
+        d.addErrback(log.err, "gateway coordinator call %s failed" % (methname,),
+                     facility="tahoe.gateway", level=log.WEIRD,
+                     umid="Wq3r1A")
+        return d
+
+    def web_listening(self, public_port, private_port):
+        """
+        The web server of this process is listening on the shared public
+        port, and on localhost:private_port, where other workers forward
+        requests to it.
+        """
+        return self._call_and_log("register_worker", self.index,
+                                  private_port, self._get_handle())
+
+    def _get_handle(self):
+        return None
+
+    def find_worker(self, index):
+        """Fire with the private port of the given worker, or None."""
+        return self._call("find_worker", index)
+
+    def claim_ophandle(self, ophandle):
+        """Fire when the coordinator knows that I hold the ophandle."""
+        return self._call("claim_ophandle", ophandle, self.index)
+
+    def release_ophandle(self, ophandle):
+        self._call_and_log("release_ophandle", ophandle, self.index)
+
+    def find_ophandle(self, ophandle):
+        """Fire with the index of the worker which holds the ophandle, or
+        None."""
+        return self._call("find_ophandle", ophandle)
+
+    # these two are the interface that MutableFileNode uses to serialize
+    # the writes of all the processes of the gateway
+
+    def lock_mutable(self, storage_index):
+        """Fire when this process may write the mutable file."""
+        return self._call("lock_mutable", storage_index, self.index)
+
+    def unlock_mutable(self, storage_index):
+        self._call_and_log("unlock_mutable", storage_index, self.index)
+
+
+class _WorkerProcessProtocol(protocol.ProcessProtocol):
+    """
+    I watch one gateway worker process, copying its output to our log.
+    """
+
+    def __init__(self, gateway, index):
+        self._gateway = gateway
+        self._index = index
+        self.ended = defer.Deferred()
+
+    def _log_lines(self, data):
+        for line in data.decode("utf-8", "replace").splitlines():
+            twlog.msg("gateway worker %d: %s" % (self._index, line))
+
+    outReceived = _log_lines
+    errReceived = _log_lines
+
+    def processEnded(self, reason):
+        self._gateway._worker_ended(self._index, reason)
+        self.ended.callback(None)
+
+
+class GatewayPrimary(_Gateway, service.MultiService):
+    """
+    I am the node process's side of a multi-process gateway (it is worker
+    0). I run the GatewayCoordinator, and start the other workers once the
+    web port is listening, starting them again if they exit.
+    """
+    name = "gateway"
+    RESTART_DELAY = 5.0
+
+    def __init__(self, config, workers, reactor=None):
+        _Gateway.__init__(self, 0, workers, GatewayCoordinator())
+        service.MultiService.__init__(self)
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._basedir = config.get_config_path()
+        self._processes = {} # index -> (IProcessTransport, protocol)
+        self._web_port = None
+        # like the log Tub, this one only listens on localhost
+        self._tub = Tub()
+        iputil.listenOnUnused(self._tub)
+        self._tub.setServiceParent(self)
+        furl_file = config.get_private_path("gateway.furl")
+        if os.path.exists(furl_file):
+            # it names the ephemeral Tub of a previous run
+            os.remove(furl_file)
+        self._tub.registerReference(self.coordinator, furlFile=furl_file)
+
+    def web_listening(self, public_port, private_port):
+        d = _Gateway.web_listening(self, public_port, private_port)
+        self._web_port = public_port
+        for index in range(1, self.workers):
+            self._start_worker(index)
+        return d
+
+    def _start_worker(self, index):
+        if not self.running or index in self._processes:
+            return
+        p = _WorkerProcessProtocol(self, index)
+        args = [sys.executable, "-m", "allmydata.gateway", self._basedir,
+                str(index), str(self.workers), str(self._web_port)]
+        transport = self._reactor.spawnProcess(p, sys.executable, args,
+                                               env=os.environ,
+                                               path=self._basedir)
+        self._processes[index] = (transport, p)
+
+    def _worker_ended(self, index, reason):
+        self._processes.pop(index, None)
+        if self.running:
+            log.msg("gateway worker %d exited (%s), restarting it in %ds"
+                    % (index, reason.getErrorMessage(), self.RESTART_DELAY),
+                    facility="tahoe.gateway", level=log.WEIRD, umid="pQ1BfA")
+            self._reactor.callLater(self.RESTART_DELAY, self._start_worker,
+                                    index)
+
+    def stopService(self):
+        # stop first, so that _worker_ended does not restart them
+        d = service.MultiService.stopService(self)
+        ended = []
+        for (transport, p) in list(self._processes.values()):
+            try:
+                transport.signalProcess("TERM")
+            except ProcessExitedAlready:
+                pass
+            ended.append(p.ended)
+        d.addCallback(lambda ign: defer.DeferredList(ended))
+        return d
+
+
+class GatewayWorker(_Gateway):
+    """
+    I am a gateway worker process's side of a multi-process gateway, talking
+    to the GatewayCoordinator of the node process.
+    """
+
+    def __init__(self, index, workers, coordinator):
+        _Gateway.__init__(self, index, workers, coordinator)
+        # the coordinator forgets my state when this is disconnected
+        self._handle = Referenceable()
+
+    def _call(self, methname, *args):
+        return self.coordinator.callRemote(methname, *args)
+
+    def _get_handle(self):
+        return self._handle
+
+
+@attr.s
+class _GatewayWorkerConfig(_Config):
+    """
+    The configuration of a gateway worker: that of its node, except that
+    the worker must not write the node's files, and keeps its own copy of
+    the few private files which belong to one process.
+    """
+    worker_index = attr.ib(default=0)
+
+    PER_PROCESS_FILES = ("node.pem", "logport.furl", "spare-rsa-keys")
+
+    def get_private_path(self, *args):
+        if len(args) == 1 and args[0] in self.PER_PROCESS_FILES:
+            args = ("gateway-worker-%d" % (self.worker_index,),) + args
+        return _Config.get_private_path(self, *args)
+
+    def write_config_file(self, name, value, mode="w"):
+        # my_nodeid and the like describe the node process
+        pass
+
+
+def worker_config(config, index, web_port):
+    """
+    Return the configuration of gateway worker number 'index', given that of
+    its node and the port number that the node's web server is listening on.
+    """
+    (_, interface) = parse_tcp_port(config.get_config("node", "web.port"))
+    webport = "tcp:%d" % (web_port,)
+    if interface:
+        webport += ":interface=%s" % (interface,)
+    parser = configutil.copy_config(config.config)
+    for (section, option, value) in [("node", "web.port", webport),
+                                     ("node", "tub.port", "disabled"),
+                                     ("node", "tub.location", "disabled"),
+                                     ("storage", "enabled", "false"),
+                                     ("helper", "enabled", "false"),
+                                     ("sftpd", "enabled", "false")]:
+        configutil.set_config(parser, section, option, value)
+    fileutil.make_dirs(config.get_private_path("gateway-worker-%d" % (index,)),
+                       0o700)
+    return _GatewayWorkerConfig(parser, config.portnum_fname,
+                                config.get_config_path(), None,
+                                config.valid_config_sections,
+                                worker_index=index)
+
+
+@defer.inlineCallbacks
+def run_worker(reactor, basedir, index, workers, web_port):
+    """
+    Run gateway worker number 'index' of the node in basedir, until it is
+    told to stop or loses its connection to the node process.
+    """
+    from allmydata import client
+    config = client.read_config(basedir, "client.port")
+    tub = Tub()
+    tub.startService()
+    furl = config.get_private_config("gateway.furl")
+    coordinator = yield tub.getReference(furl)
+    done = defer.Deferred()
+    coordinator.notifyOnDisconnect(done.callback, None)
+    gateway = GatewayWorker(index, workers, coordinator)
+    node = yield client.create_client_from_config(
+        worker_config(config, index, web_port),
+        _client_factory=partial(client._Client, gateway=gateway),
+    )
+    node.startService()
+    reactor.addSystemEventTrigger("before", "shutdown", node.stopService)
+    yield done
+
+
+def main(argv=None):
+    """python -m allmydata.gateway BASEDIR INDEX WORKERS WEB_PORT"""
+    from twisted.internet import task
+    (basedir, index, workers, web_port) = (argv or sys.argv)[1:]
+    twlog.startLogging(sys.stdout, setStdout=False)
+    task.react(run_worker, (basedir, int(index), int(workers), int(web_port)))
+
+
+if __name__ == "__main__":
+    main()
@@ -484,3 +484,40 @@ class IncompleteHashTree(CompleteBinaryTreeMixin, list):
             for i in remove_upon_failure:
                 self[i] = None
             raise
+
+    def replace_leaves(self, leaves):
+        """Replace the hashes of some leaves, and recompute every hash above
+        them, as when some blocks of a file are rewritten in place.
+
+        'leaves' is a dictionary mapping leaf index to the new leaf hash. I
+        need the hash of each sibling of the nodes between those leaves and
+        the root (except for siblings that are themselves recomputed), which
+        is what needed_hashes() asks for. If one of those is missing I raise
+        NotEnoughHashesError, and change nothing.
+
+        I return a dictionary mapping hash index to new hash for every node
+        that changed: the replaced leaves, their ancestors, and the root.
+        """
+        assert isinstance(leaves, dict)
+        changed = {}
+        for leafnum,leafhash in leaves.items():
+            assert isinstance(leafhash, bytes)
+            changed[self.first_leaf_num + leafnum] = leafhash
+        # all the leaves are at the same depth, so we can work up the tree
+        # one level at a time
+        this_level = set(changed)
+        while this_level and this_level != set([0]):
+            parents = set([self.parent(i) for i in this_level])
+            for parentnum in parents:
+                leftnum = self.lchild(parentnum)
+                rightnum = self.rchild(parentnum)
+                left = changed.get(leftnum, self[leftnum])
+                right = changed.get(rightnum, self[rightnum])
+                if left is None or right is None:
+                    raise NotEnoughHashesError("unable to recompute [%d]"
+                                               % parentnum)
+                changed[parentnum] = pair_hash(left, right)
+            this_level = parents
+        for i,h in changed.items():
+            self[i] = h
+        return changed
@@ -12,6 +12,7 @@ if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
 from twisted.python.failure import Failure
+from twisted.internet import reactor
 from foolscap.api import eventually
 from allmydata.interfaces import NotEnoughSharesError, NoSharesError
 from allmydata.util import log
@@ -32,12 +33,27 @@ class SegmentFetcher(object):
     If I am unable to provide enough blocks, I will call my parent's
     fetch_failed() method with (self, f). After either of these events, I
     will shut down and do no further work. My parent can also call my stop()
-    method to have me shut down early."""
+    method to have me shut down early.
 
-    def __init__(self, node, segnum, k, logparent):
+    To reduce tail latency, I can be asked to hedge my bets. With
+    extra_requests=e, I will try to keep k+e block requests in flight (using
+    only shares that are already known and that respect the per-server
+    diversity limit), and decode from the first k valid blocks to arrive.
+    With hedge_delay=t, if the segment is not complete t seconds after the
+    first k requests were sent, I will send one more request as a backup.
+    Any requests which are still outstanding when I finish are cancelled."""
+
+    def __init__(self, node, segnum, k, logparent,
+                 extra_requests=0, hedge_delay=None):
         self._node = node # _Node
         self.segnum = segnum
         self._k = k
+        self._extra_requests = extra_requests
+        self._hedge_delay = hedge_delay
+        self._hedge_timer = None
+        self._hedged_shares = set() # Shares requested beyond the first k
+        self.hedges_sent = 0
+        self.hedge_wins = 0 # hedged blocks among the k we decode from
         self._shares = [] # unused Share instances, sorted by "goodness"
                           # (RTT), then shnum. This is populated when DYHB
                           # responses arrive, or (for later segments) at
@@ -66,10 +82,14 @@ class SegmentFetcher(object):
         log.msg("SegmentFetcher(%r).stop" % self._node._si_prefix,
                 level=log.NOISY, parent=self._lp, umid="LWyqpg")
         self._cancel_all_requests()
+        if self._hedge_timer is not None:
+            if self._hedge_timer.active():
+                self._hedge_timer.cancel()
+            self._hedge_timer = None
         self._running = False
         # help GC ??? XXX
         del self._shares, self._shares_from_server, self._active_share_map
-        del self._share_observers
+        del self._share_observers, self._hedged_shares
 
 
     # called by our parent _Node
@@ -112,6 +132,13 @@ class SegmentFetcher(object):
             self._node.fetch_failed(self, f)
             return
 
+        # are we done?
+        if len(set(self._blocks.keys())) >= k:
+            # yay!
+            self.stop()
+            self._node.process_blocks(self.segnum, self._blocks)
+            return
+
         #print("LOOP", self._blocks.keys(), "active:", self._active_share_map, "overdue:", self._overdue_share_map, "unused:", self._shares)
         # Should we sent out more requests?
         while len(set(self._blocks.keys())
@@ -152,12 +179,28 @@ class SegmentFetcher(object):
             # more shares may be coming. Wait until then.
             return
 
-        # are we done?
-        if len(set(self._blocks.keys())) >= k:
-            # yay!
-            self.stop()
-            self._node.process_blocks(self.segnum, self._blocks)
-            return
+        # We have enough requests in flight to finish the segment. Hedged
+        # requests are opportunistic: we only use shares we already know
+        # about, and we don't relax the diversity limit to send them.
+        while len(set(self._blocks.keys())
+                  | set(self._active_share_map.keys())
+                  ) < k + self._extra_requests:
+            (sent_something, ign) = self._find_and_use_share(hedge=True)
+            if not sent_something:
+                break
+
+        if (self._hedge_delay is not None and self._hedge_timer is None):
+            self._hedge_timer = reactor.callLater(self._hedge_delay,
+                                                  self._hedge)
+
+    def _hedge(self):
+        # the segment is taking longer than we expected: allow one more
+        # request beyond what we've already sent
+        log.msg("SegmentFetcher(%r) sending backup request after %.3fs"
+                % (self._node._si_prefix, self._hedge_delay),
+                level=log.NOISY, parent=self._lp, umid="Hd9kQw")
+        self._extra_requests += 1
+        eventually(self.loop)
 
     def _no_shares_error(self):
         if not (self._shares or self._active_share_map or
@@ -197,7 +240,7 @@ class SegmentFetcher(object):
         self.stop()
         self._node.fetch_failed(self, f)
 
-    def _find_and_use_share(self):
+    def _find_and_use_share(self, hedge=False):
         sent_something = False
         want_more_diversity = False
         for sh in self._shares: # find one good share to fetch
@@ -217,6 +260,9 @@ class SegmentFetcher(object):
             self._shares.remove(sh)
             self._active_share_map[shnum] = sh
             self._shares_from_server.add(server, sh)
+            if hedge:
+                self._hedged_shares.add(sh)
+                self.hedges_sent += 1
             self._start_share(sh, shnum)
             sent_something = True
             break
@@ -254,9 +300,13 @@ class SegmentFetcher(object):
                 del self._active_share_map[shnum]
             self._overdue_share_map.discard(shnum, share)
 
-        if state is COMPLETE:
-            # 'block' is fully validated and complete
+        if state is COMPLETE and len(self._blocks) < self._k:
+            # 'block' is fully validated and complete. When hedging, more
+            # than k blocks may arrive before our loop runs: we only keep
+            # the first k.
             self._blocks[shnum] = block
+            if share in self._hedged_shares:
+                self.hedge_wins += 1
 
         if state is OVERDUE:
             # no longer active, but still might complete
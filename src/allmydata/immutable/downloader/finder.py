@@ -74,8 +74,7 @@ class ShareFinder(object):
         # test_dirnode, which creates us with storage_broker=None
         if not self._started:
             si = self.verifycap.storage_index
-            servers = self._storage_broker.get_servers_for_psi(si)
-            self._servers = iter(servers)
+            self._servers = self._storage_broker.iter_servers_for_psi(si)
             self._started = True
 
     def log(self, *args, **kwargs):
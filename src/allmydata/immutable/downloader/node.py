@@ -12,6 +12,7 @@ if PY2:
 
 import time
 now = time.time
+from collections import deque
 from zope.interface import Interface
 from twisted.python.failure import Failure
 from twisted.internet import defer
@@ -49,9 +50,14 @@ class DownloadNode(object):
     """Internal class which manages downloads and holds state. External
     callers use CiphertextFileNode instead."""
 
+    # how many recent segment fetch times we remember, and how many we need
+    # before we trust them enough to compute a hedging delay
+    HEDGE_LATENCY_SAMPLES = 50
+    HEDGE_MIN_SAMPLES = 3
+
     # Share._node points to me
     def __init__(self, verifycap, storage_broker, secret_holder,
-                 terminator, history, download_status):
+                 terminator, history, download_status, download_params=None):
         assert isinstance(verifycap, uri.CHKFileVerifierURI)
         self._verifycap = verifycap
         self._storage_broker = storage_broker
@@ -68,6 +74,12 @@ class DownloadNode(object):
         self._secret_holder = secret_holder
         self._history = history
         self._download_status = download_status
+        # a dict with "hedge_extra_requests" and "hedge_percentile", see
+        # Client.DEFAULT_DOWNLOAD_PARAMETERS. We consult it each time we
+        # start a segment.
+        self._download_params = download_params or {}
+        self._segment_fetch_times = deque(maxlen=self.HEDGE_LATENCY_SAMPLES)
+        self._segment_started = None
 
         self.share_hash_tree = IncompleteHashTree(self._verifycap.total_shares)
 
@@ -244,11 +256,35 @@ class DownloadNode(object):
             log.msg(format="%(node)s._start_new_segment: segnum=%(segnum)d",
                     node=repr(self), segnum=segnum,
                     level=log.NOISY, parent=lp, umid="wAlnHQ")
-            self._active_segment = fetcher = SegmentFetcher(self, segnum, k, lp)
-            seg_ev.activate(now())
+            extra = self._download_params.get("hedge_extra_requests", 0)
+            self._active_segment = fetcher = SegmentFetcher(
+                self, segnum, k, lp,
+                extra_requests=extra, hedge_delay=self._get_hedge_delay())
+            self._segment_started = now()
+            seg_ev.activate(self._segment_started)
             active_shares = [s for s in self._shares if s.is_alive()]
             fetcher.add_shares(active_shares) # this triggers the loop
 
+    def _get_hedge_delay(self):
+        """Return the number of seconds after which a slow segment fetch
+        should send a backup block request, or None to disable backup
+        requests. This is the configured percentile of our recent segment
+        fetch times, so we don't hedge until we've seen a few segments."""
+        percentile = self._download_params.get("hedge_percentile")
+        if percentile is None:
+            return None
+        samples = sorted(self._segment_fetch_times)
+        if len(samples) < self.HEDGE_MIN_SAMPLES:
+            return None
+        index = min(int(percentile / 100.0 * len(samples)), len(samples) - 1)
+        return samples[index]
+
+    def _retire_fetcher(self, sf, success):
+        # record how the fetch went, for hedging and for DownloadStatus
+        if success and self._segment_started is not None:
+            self._segment_fetch_times.append(now() - self._segment_started)
+        self._download_status.add_hedge_results(sf.hedges_sent, sf.hedge_wins)
+
 
     # called by our child ShareFinder
     def got_shares(self, shares):
@@ -408,6 +444,7 @@ class DownloadNode(object):
 
     def fetch_failed(self, sf, f):
         assert sf is self._active_segment
+        self._retire_fetcher(sf, False)
         # deliver error upwards
         for (d,c,seg_ev) in self._extract_requests(sf.segnum):
             seg_ev.error(now())
@@ -417,6 +454,7 @@ class DownloadNode(object):
 
     def process_blocks(self, segnum, blocks):
         start = now()
+        self._retire_fetcher(self._active_segment, True)
         d = defer.maybeDeferred(self._decode_blocks, segnum, blocks)
         d.addCallback(self._check_ciphertext_hash, segnum)
         def _deliver(result):
@@ -155,6 +155,13 @@ class DownloadStatus(object):
         self.known_shares = [] # (server, shnum)
         self.problems = []
 
+        # hedged block requests (sent beyond the k we need, to cut tail
+        # latency), and how many of them supplied a block we decoded from.
+        # segments_fetched counts the SegmentFetchers that reported in.
+        self.segments_fetched = 0
+        self.hedge_requests = 0
+        self.hedge_wins = 0
+
         self.misc_events = []
 
     def add_misc_event(self, what, start, finish=None):
@@ -225,6 +232,25 @@ class DownloadStatus(object):
     def add_problem(self, p):
         self.problems.append(p)
 
+    def add_hedge_results(self, sent, wins):
+        self.segments_fetched += 1
+        self.hedge_requests += sent
+        self.hedge_wins += wins
+
+    def get_hedge_rate(self):
+        """Return the average number of hedged block requests sent per
+        segment fetch, or None if no segments have been fetched."""
+        if not self.segments_fetched:
+            return None
+        return self.hedge_requests / self.segments_fetched
+
+    def get_hedge_win_rate(self):
+        """Return the fraction of hedged block requests whose block was
+        used to decode a segment, or None if no hedges were sent."""
+        if not self.hedge_requests:
+            return None
+        return self.hedge_wins / self.hedge_requests
+
     # IDownloadStatus methods
     def get_counter(self):
         return self.counter
@@ -51,9 +51,13 @@ log(number of segments)).
 Each segment (A,B,C) is read into memory, encrypted, and encoded into
 blocks. The 'share' (say, share #1) that makes it out to a host is a
 collection of these blocks (block A1, B1, C1), plus some hash-tree
-information necessary to validate the data upon retrieval. Only one segment
-is handled at a time: all blocks for segment A are delivered before any
-work is begun on segment B.
+information necessary to validate the data upon retrieval. Segments are
+read and encoded one at a time, in order, but several of them may be in
+flight at once: we can begin work on segment B while the blocks for segment
+A are still on their way to the shareholders. The number of segments in
+flight is bounded (to bound our memory footprint), and grows while the
+shareholders keep up, up to the configured maximum. Each shareholder still
+receives its blocks in segment order.
 
 As blocks are created, we retain the hash of each one. The list of block hashes
 for a single share (say, hash(A1), hash(B1), hash(C1)) is used to form the base
@@ -90,8 +94,25 @@ PiB=1024*TiB
 @implementer(IEncoder)
 class Encoder(object):
 
-    def __init__(self, log_parent=None, upload_status=None):
+    # how many segments may be encoded and handed to the shareholders before
+    # the oldest one has been accepted by all of them
+    MAX_SEGMENTS_IN_FLIGHT = 4
+
+    def __init__(self, log_parent=None, upload_status=None,
+                 max_segments_in_flight=None, keep_resumable_shares=False):
         object.__init__(self)
+        if max_segments_in_flight is None:
+            max_segments_in_flight = self.MAX_SEGMENTS_IN_FLIGHT
+        precondition(max_segments_in_flight >= 1, max_segments_in_flight)
+        self._max_window = max_segments_in_flight
+        # the window starts small and grows as the shareholders acknowledge
+        # segments while we are waiting for them
+        self._window = 1
+        self._window_stalled = False
+        self._max_segments_in_flight_achieved = 0
+        # shareid -> Deferred for the most recent block sent to that
+        # shareholder
+        self._last_block_sent = {}
         self.uri_extension_data = {}
         self._codec = None
         self._status = None
@@ -102,6 +123,9 @@ class Encoder(object):
         self._log_number = log.msg("creating Encoder %s" % self,
                                    facility="tahoe.encoder", parent=log_parent)
         self._aborted = False
+        # if the upload fails, leave partial shares that a later upload could
+        # resume in place, rather than aborting them
+        self._keep_resumable_shares = keep_resumable_shares
 
     def __repr__(self):
         if hasattr(self, "_storage_index"):
@@ -247,18 +271,7 @@ class Encoder(object):
 
         d.addCallback(lambda res: self.start_all_shareholders())
 
-        for i in range(self.num_segments-1):
-            # note to self: this form doesn't work, because lambda only
-            # captures the slot, not the value
-            #d.addCallback(lambda res: self.do_segment(i))
-            # use this form instead:
-            d.addCallback(lambda res, i=i: self._encode_segment(i, is_tail=False))
-            d.addCallback(self._send_segment, i)
-            d.addCallback(self._turn_barrier)
-        last_segnum = self.num_segments - 1
-        d.addCallback(lambda res: self._encode_segment(last_segnum, is_tail=True))
-        d.addCallback(self._send_segment, last_segnum)
-        d.addCallback(self._turn_barrier)
+        d.addCallback(lambda res: self._encode_and_send_all_segments())
 
         d.addCallback(lambda res: self.finish_hashing())
 
@@ -304,6 +317,60 @@ class Encoder(object):
         return fireEventually(res)
 
 
+    @defer.inlineCallbacks
+    def _encode_and_send_all_segments(self):
+        # segments are read and encoded in order, so the crypttext hashes
+        # and block hashes are accumulated in order too. We hold on to the
+        # blocks of at most self._window segments that are still on their
+        # way to the shareholders.
+        in_flight = [] # Deferreds, oldest segment first
+        try:
+            for segnum in range(self.num_segments):
+                while len(in_flight) >= self._window:
+                    self._window_stalled = True
+                    yield in_flight.pop(0)
+                is_tail = (segnum == self.num_segments - 1)
+                shares_and_shareids = yield self._encode_segment(segnum,
+                                                                 is_tail)
+                d = self._send_segment(shares_and_shareids, segnum)
+                d.addCallback(self._segment_acknowledged)
+                in_flight.append(d)
+                self._note_segments_in_flight(len(in_flight))
+                yield self._turn_barrier(None)
+            while in_flight:
+                yield in_flight.pop(0)
+        except Exception:
+            # the upload has failed, and err() will report the first
+            # problem. Don't let the other segments complain about theirs.
+            for d in in_flight:
+                d.addErrback(lambda f: None)
+            raise
+        finally:
+            self._last_block_sent.clear()
+
+    def _segment_acknowledged(self, res):
+        # a segment's blocks have been accepted by every shareholder. If we
+        # had to wait for that before encoding more, the window was what
+        # held us back, so open it up a bit.
+        if self._window_stalled and self._window < self._max_window:
+            self._window += 1
+            self.log("segment window grown to %d" % self._window,
+                     level=log.NOISY)
+        self._window_stalled = False
+        return res
+
+    def _note_segments_in_flight(self, count):
+        if count > self._max_segments_in_flight_achieved:
+            self._max_segments_in_flight_achieved = count
+            if self._status:
+                self._status.set_segments_in_flight(count)
+
+    def get_segment_window(self):
+        """Return a tuple of (current window, most segments we have had in
+        flight at once, configured maximum)."""
+        return (self._window, self._max_segments_in_flight_achieved,
+                self._max_window)
+
     def start_all_shareholders(self):
         self.log("starting shareholders", level=log.NOISY)
         self.set_status("Starting shareholders")
@@ -446,7 +513,7 @@ class Encoder(object):
         for i in range(len(shares)):
             block = shares[i]
             shareid = shareids[i]
-            d = self.send_block(shareid, segnum, block, lognum)
+            d = self._send_block_in_order(shareid, segnum, block, lognum)
             dl.append(d)
 
             block_hash = hashutil.block_hash(block)
@@ -455,6 +522,8 @@ class Encoder(object):
             #        "len=%d %r .. %r: %s" %
             #        (shareid, segnum, len(block),
             #         block[:50], block[-50:], base32.b2a(block_hash)))
+            _assert(len(self.block_hashes[shareid]) == segnum,
+                    shareid=shareid, segnum=segnum)
             self.block_hashes[shareid].append(block_hash)
 
         dl = self._gather_responses(dl)
@@ -473,6 +542,24 @@ class Encoder(object):
         dl.addCallback(_logit)
         return dl
 
+    def _send_block_in_order(self, shareid, segment_num, block, lognum):
+        # The bucket writer only accepts one put_block() at a time (it
+        # pipelines them itself), and when several segments are in flight
+        # the next block for a shareholder may be ready before the previous
+        # one was accepted. Queue it behind that one.
+        prev = self._last_block_sent.get(shareid)
+        if prev is None:
+            d = self.send_block(shareid, segment_num, block, lognum)
+        else:
+            d = defer.Deferred()
+            def _send_next(res):
+                d2 = self.send_block(shareid, segment_num, block, lognum)
+                d2.chainDeferred(d)
+                return res
+            prev.addBoth(_send_next)
+        self._last_block_sent[shareid] = d
+        return d
+
     def send_block(self, shareid, segment_num, block, lognum):
         if shareid not in self.landlords:
             return defer.succeed(None)
@@ -492,6 +579,9 @@ class Encoder(object):
         ln = self.log(format="error while sending %(method)s to shareholder=%(shnum)d",
                       method=where, shnum=shareid,
                       level=log.UNUSUAL, failure=why)
+        if self._window > 1:
+            # back off: the remaining shareholders may be struggling too
+            self._window = max(1, self._window // 2)
         if shareid in self.landlords:
             self.landlords[shareid].abort()
             peerid = self.landlords[shareid].get_peerid()
@@ -676,7 +766,10 @@ class Encoder(object):
         # we need to abort any remaining shareholders, so they'll delete the
         # partial share, allowing someone else to upload it again.
         self.log("aborting shareholders", level=log.UNUSUAL)
+        keep = self._keep_resumable_shares and not f.check(UploadAborted)
         for shareid in list(self.landlords):
+            if keep and self.landlords[shareid].is_resumable():
+                continue
             self.landlords[shareid].abort()
         if f.check(defer.FirstError):
             return f.value.subFailure
@@ -36,13 +36,14 @@ from allmydata.immutable.downloader.status import DownloadStatus
 
 class CiphertextFileNode(object):
     def __init__(self, verifycap, storage_broker, secret_holder,
-                 terminator, history):
+                 terminator, history, download_params=None):
         assert isinstance(verifycap, uri.CHKFileVerifierURI)
         self._verifycap = verifycap
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
         self._terminator = terminator
         self._history = history
+        self._download_params = download_params
         self._download_status = None
         self._node = None # created lazily, on read()
 
@@ -57,7 +58,8 @@ class CiphertextFileNode(object):
             self._node = DownloadNode(self._verifycap, self._storage_broker,
                                       self._secret_holder,
                                       self._terminator,
-                                      self._history, self._download_status)
+                                      self._history, self._download_status,
+                                      self._download_params)
 
     def read(self, consumer, offset=0, size=None):
         """I am the main entry point, from which FileNode.read() can get
@@ -245,11 +247,12 @@ class ImmutableFileNode(object):
 
     # I wrap a CiphertextFileNode with a decryption key
     def __init__(self, filecap, storage_broker, secret_holder, terminator,
-                 history):
+                 history, download_params=None):
         assert isinstance(filecap, uri.CHKFileURI)
         verifycap = filecap.get_verify_cap()
         self._cnode = CiphertextFileNode(verifycap, storage_broker,
-                                         secret_holder, terminator, history)
+                                         secret_holder, terminator, history,
+                                         download_params)
         assert isinstance(filecap, uri.CHKFileURI)
         self.u = filecap
         self._readkey = filecap.key
@@ -277,6 +280,12 @@ class ImmutableFileNode(object):
         d.addCallback(lambda dc: consumer)
         return d
 
+    def get_segment_size(self):
+        """Return a Deferred that fires with the file's real segment size.
+        This is free once any part of the file has been read; before that,
+        it reads the first segment."""
+        return self._cnode.get_segment_size()
+
     def raise_error(self):
         pass
 
@@ -0,0 +1,156 @@
+"""
+Journals for resumable immutable uploads.
+
+An upload that is given a resume token keeps a journal of its progress in
+the client's private/upload-journals/ directory: the storage index, the
+encoding parameters, the server that each share was placed on, and the byte
+ranges of each share that its server has acknowledged. If the upload is
+interrupted (the gateway restarts, or too many servers go away) and is later
+started again with the same token and the same file, the uploader reuses the
+journaled encoding parameters (so that a convergent upload arrives at the
+same storage index), and for every share that lands on the same server as
+before it skips the writes that the server says it already has.
+
+The journal is only a hint. What a server holds is taken from the server
+itself: storage servers that speak HTTP report the ranges of a share that
+are still required after every write (see BucketWriter.required_ranges).
+A journal whose storage index does not match the new upload (because the
+file has changed, or because it is being uploaded with a random key) is
+discarded.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os, re, json
+
+from allmydata.util import base32, fileutil, log
+
+_TOKEN_RE = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+def is_valid_resume_token(token):
+    """Resume tokens are chosen by the client, and name a file in the
+    journal directory, so they are limited to 64 letters, digits, dashes
+    and underscores."""
+    return bool(_TOKEN_RE.match(token))
+
+
+class UploadJournal(object):
+    """I record the progress of a single upload. I am only written to disk
+    when save() is called."""
+
+    VERSION = 1
+
+    def __init__(self, filename, token):
+        self._filename = filename
+        self.token = token
+        self._reset()
+
+    def _reset(self):
+        self.storage_index = None
+        self.size = None
+        # (k, happy, n, segment_size), as chosen by the uploadable
+        self.encoding_parameters = None
+        # shnum -> (serverid, [(start, stop), ..])
+        self._shares = {}
+
+    def load(self):
+        if not os.path.exists(self._filename):
+            return
+        try:
+            with open(self._filename, "r") as f:
+                data = json.load(f)
+            if data["version"] != self.VERSION:
+                raise ValueError("unknown journal version %r" % (data["version"],))
+            self.storage_index = base32.a2b(data["storage_index"].encode("ascii"))
+            self.size = data["size"]
+            self.encoding_parameters = tuple(data["encoding_parameters"])
+            for shnum, share in data["shares"].items():
+                ranges = [tuple(r) for r in share["acked"]]
+                serverid = base32.a2b(share["server"].encode("ascii"))
+                self._shares[int(shnum)] = (serverid, ranges)
+        except (EnvironmentError, ValueError, KeyError, TypeError) as e:
+            log.msg("unable to read upload journal %s (%r), starting afresh"
+                    % (self._filename, e), level=log.UNUSUAL, umid="IfNh5A")
+            self._reset()
+
+    def get_encoding_parameters(self, size):
+        """Return the (k, happy, n, segment_size) tuple used by the
+        interrupted upload, if it was of a file of this size, else None."""
+        if self.size == size:
+            return self.encoding_parameters
+        return None
+
+    def start(self, storage_index, size, encoding_parameters):
+        """Begin (or resume) an upload to storage_index. If the journal
+        describes a different upload, I forget about it."""
+        if (storage_index, size) != (self.storage_index, self.size):
+            if self.storage_index is not None:
+                log.msg("upload journal %s was for a different file, ignoring it"
+                        % self.token, level=log.UNUSUAL, umid="f2BKjg")
+            self._reset()
+        self.storage_index = storage_index
+        self.size = size
+        self.encoding_parameters = tuple(encoding_parameters)
+
+    def get_acked_ranges(self, shnum, serverid):
+        """Return the (start, stop) byte ranges of share shnum that serverid
+        acknowledged during an earlier attempt."""
+        if shnum in self._shares and self._shares[shnum][0] == serverid:
+            return self._shares[shnum][1]
+        return []
+
+    def set_placement(self, shnum, serverid):
+        """Record that share shnum is being uploaded to serverid."""
+        if shnum in self._shares and self._shares[shnum][0] == serverid:
+            return
+        self._shares[shnum] = (serverid, [])
+
+    def set_acked_ranges(self, shnum, ranges):
+        serverid = self._shares[shnum][0]
+        self._shares[shnum] = (serverid, list(ranges))
+
+    def get_placements(self):
+        """Return a dict mapping shnum to serverid."""
+        return dict((shnum, serverid)
+                    for (shnum, (serverid, ranges)) in self._shares.items())
+
+    def save(self):
+        data = {
+            "version": self.VERSION,
+            "token": self.token,
+            "storage_index": str(base32.b2a(self.storage_index), "ascii"),
+            "size": self.size,
+            "encoding_parameters": list(self.encoding_parameters),
+            "shares": dict((str(shnum), {"server": str(base32.b2a(serverid), "ascii"),
+                                         "acked": [list(r) for r in ranges]})
+                           for (shnum, (serverid, ranges)) in self._shares.items()),
+            }
+        fileutil.write_atomically(self._filename, json.dumps(data), mode="t")
+
+    def delete(self):
+        fileutil.remove_if_possible(self._filename)
+
+
+class UploadJournals(object):
+    """I manage the journals of resumable uploads, one file per resume
+    token, in a single directory."""
+
+    def __init__(self, basedir):
+        self._basedir = basedir
+
+    def get_journal(self, token):
+        """Return the UploadJournal for this resume token, loaded from disk
+        if an earlier upload left one behind."""
+        if not is_valid_resume_token(token):
+            raise ValueError("invalid resume token %r" % (token,))
+        fileutil.make_dirs(self._basedir, 0o700)
+        journal = UploadJournal(os.path.join(self._basedir, token), token)
+        journal.load()
+        return journal
@@ -11,6 +11,7 @@ if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
 import struct
+from collections_extended import RangeMap
 from zope.interface import implementer
 from twisted.internet import defer
 from allmydata.interfaces import IStorageBucketWriter, IStorageBucketReader, \
@@ -135,6 +136,14 @@ class WriteBucketProxy(object):
         # filled.
         self._pipeline = pipeline.Pipeline(pipeline_size)
 
+        # the ranges of the share that the server has acknowledged, and (for
+        # servers that tell us, which is the HTTP ones) the ranges that it
+        # still needs, as of its most recent reply
+        self._acked = RangeMap()
+        self._required = None
+        # set by resume()
+        self._resuming = None
+
     def get_allocated_size(self):
         return (self._offsets['uri_extension'] + self.fieldsize +
                 self._uri_extension_size_max)
@@ -238,15 +247,65 @@ class WriteBucketProxy(object):
         length = struct.pack(self.fieldstruct, len(data))
         return self._write(offset, length+data)
 
+    def resume(self):
+        """The server may already hold part of this share, from an earlier
+        upload that was interrupted. Hold back every write after the header
+        until the server has answered the header write, and then skip the
+        ones that its answer says it already has."""
+        self._resuming = observer.OneShotObserverList()
+
+    def is_resumable(self):
+        """Return True if the server has told us which parts of the share
+        it still needs, in which case a later upload could resume this one
+        rather than starting the share again."""
+        return self._required is not None
+
+    def get_acked_ranges(self):
+        """Return a list of the (start, stop) byte ranges of the share that
+        the server has acknowledged."""
+        return [(r.start, r.stop) for r in self._acked.ranges()]
+
     def _write(self, offset, data):
+        if self._resuming is not None and offset != 0:
+            d = self._resuming.when_fired()
+            d.addCallback(lambda ign: self._write_unless_present(offset, data))
+            return d
+        return self._write_unless_present(offset, data)
+
+    def _write_unless_present(self, offset, data):
+        if (self._resuming is not None and self._required is not None
+            and not list(self._required.ranges(offset, offset + len(data)))):
+            return defer.succeed(None)
+
         # use a Pipeline to pipeline several writes together. TODO: another
         # speedup would be to coalesce small writes into a single call: this
         # would reduce the foolscap CPU overhead per share, but wouldn't
         # reduce the number of round trips, so it might not be worth the
         # effort.
 
-        return self._pipeline.add(len(data),
-                                  self._rref.callRemote, "write", offset, data)
+        return self._pipeline.add(len(data), self._send, offset, data)
+
+    def _send(self, offset, data):
+        d = self._rref.callRemote("write", offset, data)
+        d.addCallback(self._written, offset, len(data))
+        if self._resuming is not None and offset == 0:
+            def _answered(res):
+                self._resuming.fire_if_not_fired(None)
+                return res
+            d.addBoth(_answered)
+        return d
+
+    def _written(self, required, offset, length):
+        # foolscap servers answer writes with None, HTTP ones with the
+        # ranges of the share they still need
+        if required is None:
+            self._acked.set(True, offset, offset + length)
+        else:
+            self._required = required
+            self._acked = RangeMap()
+            self._acked.set(True, 0, self.get_allocated_size())
+            for r in required.ranges():
+                self._acked.empty(r.start, r.stop)
 
     def close(self):
         d = self._pipeline.add(0, self._rref.callRemote, "close")
@@ -0,0 +1,114 @@
+"""
+Choosing the segment size for immutable uploads.
+
+Every immutable file used to be cut into segments of the same configured
+size (``DEFAULT_MAX_SEGMENT_SIZE``, 128KiB). That is a good fit for the
+files most people upload, but not for very large ones, or for unusual
+encodings, or for slow links:
+
+ * a 50GB file becomes 400,000 segments. Each share then carries a block
+   hash tree with a million 32-byte nodes, and every segment costs a round
+   of put_block() messages on upload and a round of block requests on
+   download.
+
+ * each share holds segment_size/k bytes of every segment. With a wide
+   encoding (say 25-of-40) the blocks are only a few KiB each, so the
+   per-message overhead dominates.
+
+ * a WriteBucketProxy keeps only about one block (or 50KB, whichever is
+   larger) in flight to each server, so on a link with a long round-trip
+   time small blocks leave most of the bandwidth unused.
+
+SegmentSizePolicy starts from the configured segment size and doubles it
+while any of these apply, within limits that every downloader handles (1MiB
+is the segment size Tahoe-LAFS used by default before 1.8), and so that the
+encoded form of a segment (which the uploader holds in memory, once per
+segment in flight) stays modest. Files that fit in a handful of segments
+(of the default size, or the configured size if that is larger) are left
+alone: they have little to gain, and a downloader that guesses the default
+segment size gets their offsets right on the first try.
+
+The policy also keeps a running estimate of the servers' round-trip time,
+fed by the uploader from the allocate_buckets() queries of earlier uploads.
+
+The uploader only asks the policy about files with a random encryption key.
+A convergent key is a hash of the segment size along with the file, so a
+convergent upload keeps the configured segment size: anything else would
+give a file a different cap than the one it has always had (and, with the
+round-trip time, a different cap each time it was uploaded).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from allmydata.interfaces import DEFAULT_MAX_SEGMENT_SIZE
+
+KiB = 1024
+MiB = 1024*KiB
+
+
+class SegmentSizePolicy(object):
+    # never choose segments larger than this
+    MAX_SEGMENT_SIZE = 1*MiB
+    # nor segments whose encoded form (all N blocks) is larger than this
+    MAX_ENCODED_SEGMENT_SIZE = 4*MiB
+    # files with no more than this many segments (of the default size, or
+    # the configured size if that is larger) are left alone
+    MIN_SEGMENTS = 16
+    # try to keep files at no more than this many segments
+    TARGET_SEGMENTS = 2048
+    # try to send each server at least this much per put_block()
+    MIN_BLOCK_SIZE = 16*KiB
+    # and enough to keep this many bytes per second flowing to each server
+    # when we wait a full round trip for every block
+    TARGET_SERVER_RATE = 1*MiB
+    # weight given to each new round-trip time sample
+    RTT_ALPHA = 0.2
+
+    def __init__(self):
+        self.rtt = None
+
+    def observe_rtt(self, rtt):
+        """Record the round-trip time (in seconds) of a query to a storage
+        server."""
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt = (1 - self.RTT_ALPHA) * self.rtt + self.RTT_ALPHA * rtt
+
+    def get_max_segment_size(self, k, n):
+        """Return the largest segment size I will choose for k-of-n
+        encoding."""
+        return min(self.MAX_SEGMENT_SIZE,
+                   self.MAX_ENCODED_SEGMENT_SIZE * k // n)
+
+    def get_segment_size(self, file_size, k, n, segment_size):
+        """Return the segment size to use for a file of file_size bytes,
+        encoded k-of-n, when the configured segment size is segment_size.
+        This is never smaller than segment_size. The caller still shrinks
+        it for files smaller than one segment, and rounds it up to a
+        multiple of k."""
+        small = max(segment_size, DEFAULT_MAX_SEGMENT_SIZE) * self.MIN_SEGMENTS
+        if file_size <= small:
+            return segment_size
+        want = segment_size
+        # fewer segments: smaller block hash trees, fewer messages
+        want = max(want, file_size // self.TARGET_SEGMENTS)
+        # big enough blocks to make each message (and round trip) count
+        block_size = self.MIN_BLOCK_SIZE
+        if self.rtt is not None:
+            block_size = max(block_size,
+                             int(self.rtt * self.TARGET_SERVER_RATE))
+        want = max(want, block_size * k)
+
+        ceiling = max(segment_size, self.get_max_segment_size(k, n))
+        size = segment_size
+        while size < want and size < ceiling:
+            size = min(size * 2, ceiling)
+        return size
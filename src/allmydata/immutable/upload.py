@@ -24,7 +24,7 @@ import attr
 
 from zope.interface import implementer
 from twisted.python import failure
-from twisted.internet import defer
+from twisted.internet import defer, task
 from twisted.application import service
 from foolscap.api import Referenceable, Copyable, RemoteCopy
 
@@ -276,6 +276,8 @@ class ServerTracker(object):
 
         self.renew_secret = bucket_renewal_secret
         self.cancel_secret = bucket_cancel_secret
+        # how long our last allocate_buckets() query took, in seconds
+        self.rtt = None
 
     def __repr__(self):
         return ("<ServerTracker for server %r and SI %r>"
@@ -290,6 +292,7 @@ class ServerTracker(object):
 
     def query(self, sharenums):
         storage_server = self._server.get_storage_server()
+        started = time.time()
         d = storage_server.allocate_buckets(
             self.storage_index,
             self.renew_secret,
@@ -298,6 +301,10 @@ class ServerTracker(object):
             self.allocated_size,
             canary=Referenceable(),
         )
+        def _answered(res):
+            self.rtt = time.time() - started
+            return res
+        d.addCallback(_answered)
         d.addCallback(self._buckets_allocated)
         return d
 
@@ -1188,6 +1195,7 @@ class UploadStatus(object):
         self.results = None
         self.counter = next(self.statusid_counter)
         self.started = time.time()
+        self.segments_in_flight = None
 
     def get_started(self):
         return self.started
@@ -1207,6 +1215,8 @@ class UploadStatus(object):
         return self.results
     def get_counter(self):
         return self.counter
+    def get_segments_in_flight(self):
+        return self.segments_in_flight
 
     def set_storage_index(self, si):
         self.storage_index = si
@@ -1223,10 +1233,17 @@ class UploadStatus(object):
         self.active = value
     def set_results(self, value):
         self.results = value
+    def set_segments_in_flight(self, value):
+        self.segments_in_flight = value
 
 class CHKUploader(object):
 
-    def __init__(self, storage_broker, secret_holder, reactor=None):
+    # how often (in seconds) to write out the journal of a resumable upload
+    JOURNAL_SAVE_INTERVAL = 10
+
+    def __init__(self, storage_broker, secret_holder, reactor=None,
+                 max_segments_in_flight=None, segment_size_policy=None,
+                 journal=None):
         # server_selector needs storage_broker and secret_holder
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
@@ -1237,6 +1254,10 @@ class CHKUploader(object):
         self._upload_status.set_helper(False)
         self._upload_status.set_active(True)
         self._reactor = reactor
+        self._max_segments_in_flight = max_segments_in_flight
+        self._segment_size_policy = segment_size_policy
+        self._journal = journal
+        self._journal_saver = None
 
         # locate_all_shareholders() will create the following attribute:
         # self._server_trackers = {} # k: shnum, v: instance of ServerTracker
@@ -1290,17 +1311,66 @@ class CHKUploader(object):
         self._encoder = encode.Encoder(
             self._log_number,
             self._upload_status,
+            max_segments_in_flight=self._max_segments_in_flight,
+            keep_resumable_shares=self._journal is not None,
         )
         # this just returns itself
         yield self._encoder.set_encrypted_uploadable(eu)
+        if self._journal:
+            k, happy, n = self._encoder.get_param("share_counts")
+            self._journal.start(self._encoder.get_param("storage_index"),
+                                self._encoder.file_size,
+                                (k, happy, n,
+                                 self._encoder.get_param("segment_size")))
         with LOCATE_ALL_SHAREHOLDERS() as action:
             (upload_trackers, already_serverids) = yield self.locate_all_shareholders(self._encoder, started)
             action.add_success_fields(upload_trackers=upload_trackers, already_serverids=already_serverids)
         self.set_shareholders(upload_trackers, already_serverids, self._encoder)
-        verifycap = yield self._encoder.start()
+        if self._journal:
+            self._start_journal()
+        try:
+            verifycap = yield self._encoder.start()
+        finally:
+            if self._journal:
+                self._stop_journal()
+        if self._journal:
+            self._journal.delete()
         results = self._encrypted_done(verifycap)
         defer.returnValue(results)
 
+    def _start_journal(self):
+        """Resume the shares that are going back to the server that held
+        them during an interrupted upload, and start journaling."""
+        resumed = 0
+        for shnum, tracker in sorted(self._server_trackers.items()):
+            serverid = tracker.get_serverid()
+            if self._journal.get_acked_ranges(shnum, serverid):
+                tracker.buckets[shnum].resume()
+                resumed += 1
+            self._journal.set_placement(shnum, serverid)
+        if resumed:
+            self.log("resuming %d shares from upload journal %s"
+                     % (resumed, self._journal.token), level=log.OPERATIONAL)
+        self._journal.save()
+        reactor = self._reactor
+        if reactor is None:
+            from twisted.internet import reactor
+        self._journal_saver = task.LoopingCall(self._save_journal)
+        self._journal_saver.clock = reactor
+        self._journal_saver.start(self.JOURNAL_SAVE_INTERVAL, now=False)
+
+    def _save_journal(self):
+        for shnum, tracker in self._server_trackers.items():
+            self._journal.set_acked_ranges(
+                shnum, tracker.buckets[shnum].get_acked_ranges())
+        self._journal.save()
+
+    def _stop_journal(self):
+        if self._journal_saver:
+            self._journal_saver.stop()
+            self._journal_saver = None
+            self._save_journal()
+
     def locate_all_shareholders(self, encoder, started):
         server_selection_started = now = time.time()
         self._storage_index_elapsed = now - started
@@ -1354,6 +1424,8 @@ class CHKUploader(object):
         self._server_trackers = {} # k: shnum, v: instance of ServerTracker
         for tracker in upload_trackers:
             assert isinstance(tracker, ServerTracker)
+            if self._segment_size_policy and tracker.rtt is not None:
+                self._segment_size_policy.observe_rtt(tracker.rtt)
         buckets = {}
         servermap = already_serverids.copy()
         for tracker in upload_trackers:
@@ -1699,6 +1771,8 @@ class BaseUploadable(object):
     default_params_set = False
 
     max_segment_size = None
+    # set this to make the upload resumable (see allmydata.immutable.journal)
+    resume_token = None
     encoding_param_k = None
     encoding_param_happy = None
     encoding_param_n = None
@@ -1746,6 +1820,11 @@ class BaseUploadable(object):
         d.addCallback(_got_size)
         return d
 
+def _is_convergent(uploadable):
+    """Return False if the uploadable says that it uses a random encryption
+    key, and True otherwise: the segment size goes into a convergent key."""
+    return getattr(uploadable, "convergence", True) is not None
+
 @implementer(IUploadable)
 class FileHandle(BaseUploadable):
 
@@ -1849,6 +1928,118 @@ class Data(FileHandle):
         assert convergence is None or isinstance(convergence, bytes), (convergence, type(convergence))
         FileHandle.__init__(self, BytesIO(data), convergence=convergence)
 
+@implementer(IUploadable)
+class StreamingUploadable(BaseUploadable):
+    """
+    Upload data which is handed to me with write() as it arrives (from an
+    HTTP request body, say), so that it can be encoded and pushed to the
+    grid without first being spooled to disk. The size must be declared in
+    advance. A random encryption key is always used, since a convergent key
+    could only be computed once all of the data had been seen.
+
+    If a producer (an IPushProducer, such as the transport which is
+    delivering the data) is given, I pause it while at least buffer_size
+    bytes are waiting to be read, and resume it once they have been.
+    """
+    convergence = None
+
+    def __init__(self, size, producer=None, buffer_size=4*DEFAULT_MAX_SEGMENT_SIZE):
+        self._size = size
+        self._producer = producer
+        self._buffer_size = buffer_size
+        self._key = None
+        self._buffer = []
+        self._buffered = 0
+        self._received = 0
+        self._pending_read = None # (length, Deferred)
+        self._failure = None
+        self._paused = False
+
+    def is_complete(self):
+        """Return True once all of the declared data has been written."""
+        return self._received >= self._size
+
+    def write(self, data):
+        if self._failure is not None:
+            # nobody will read this
+            return
+        data = data[:self._size - self._received]
+        self._received += len(data)
+        if data:
+            self._buffer.append(data)
+            self._buffered += len(data)
+        if self._pending_read:
+            length, d = self._pending_read
+            if self._buffered >= length or self.is_complete():
+                self._pending_read = None
+                d.callback(self._take(length))
+        self._update_flow()
+
+    def abort(self, why):
+        """Discard what has been written, and anything written later. Any
+        read, now or later, fails with 'why' (a Failure or an exception)."""
+        if not isinstance(why, failure.Failure):
+            why = failure.Failure(why)
+        self._failure = why
+        self._buffer = []
+        self._buffered = 0
+        if self._pending_read:
+            length, d = self._pending_read
+            self._pending_read = None
+            d.errback(why)
+        self._update_flow()
+
+    def _take(self, length):
+        taken = []
+        while self._buffer and length > 0:
+            data = self._buffer.pop(0)
+            if len(data) > length:
+                self._buffer.insert(0, data[length:])
+                data = data[:length]
+            taken.append(data)
+            length -= len(data)
+            self._buffered -= len(data)
+        return taken
+
+    def _update_flow(self):
+        if self._producer is None:
+            return
+        # never hold up the data that a pending read is waiting for
+        want_pause = (self._failure is None and
+                      self._pending_read is None and
+                      not self.is_complete() and
+                      self._buffered >= self._buffer_size)
+        if want_pause and not self._paused:
+            self._paused = True
+            self._producer.pauseProducing()
+        elif not want_pause and self._paused:
+            self._paused = False
+            self._producer.resumeProducing()
+
+    def get_encryption_key(self):
+        if self._key is None:
+            self._key = os.urandom(16)
+        return defer.succeed(self._key)
+
+    def get_size(self):
+        return defer.succeed(self._size)
+
+    def read(self, length):
+        precondition(self._pending_read is None, self._pending_read)
+        if self._failure is not None:
+            return defer.fail(self._failure)
+        if self._buffered >= length or self.is_complete():
+            d = defer.succeed(self._take(length))
+        else:
+            d = defer.Deferred()
+            self._pending_read = (length, d)
+        self._update_flow()
+        return d
+
+    def close(self):
+        self._buffer = []
+        self._buffered = 0
+
 @implementer(IUploader)
 class Uploader(service.MultiService, log.PrefixingLogMixin):
     """I am a service that allows file uploading. I am a service-child of the
@@ -1857,10 +2048,13 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
     name = "uploader"
     URI_LIT_SIZE_THRESHOLD = 55
 
-    def __init__(self, helper_furl=None, stats_provider=None, history=None):
+    def __init__(self, helper_furl=None, stats_provider=None, history=None,
+                 segment_size_policy=None, journals=None):
         self._helper_furl = helper_furl
         self.stats_provider = stats_provider
         self._history = history
+        self._segment_size_policy = segment_size_policy
+        self._journals = journals
         self._helper = None
         self._all_uploads = weakref.WeakKeyDictionary() # for debugging
         log.PrefixingLogMixin.__init__(self, facility="tahoe.immutable.upload")
@@ -1904,11 +2098,31 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
         assert self.running
 
         uploadable = IUploadable(uploadable)
+        journal = None
+        if uploadable.resume_token is not None and self._journals:
+            try:
+                journal = self._journals.get_journal(uploadable.resume_token)
+            except ValueError:
+                uploadable.close()
+                return defer.fail()
         d = uploadable.get_size()
         def _got_size(size):
             default_params = self.parent.get_encoding_parameters()
             precondition(isinstance(default_params, dict), default_params)
             precondition("max_segment_size" in default_params, default_params)
+            if self._segment_size_policy and not _is_convergent(uploadable):
+                # a convergent upload keeps the configured segment size, so
+                # that it gets the same cap as it always has
+                segsize = self._segment_size_policy.get_segment_size(
+                    size, default_params["k"], default_params["n"],
+                    default_params["max_segment_size"])
+                default_params = dict(default_params, max_segment_size=segsize)
+            if journal and journal.get_encoding_parameters(size):
+                # resuming: use the same encoding, so that a convergent
+                # upload gets the same storage index as last time
+                (k, happy, n, segsize) = journal.get_encoding_parameters(size)
+                default_params = dict(default_params, k=k, happy=happy, n=n,
+                                      max_segment_size=segsize)
             uploadable.set_default_encoding_parameters(default_params)
 
             if self.stats_provider:
@@ -1929,7 +2143,12 @@ class Uploader(service.MultiService, log.PrefixingLogMixin):
                 else:
                     storage_broker = self.parent.get_storage_broker()
                     secret_holder = self.parent._secret_holder
-                    uploader = CHKUploader(storage_broker, secret_holder, reactor=reactor)
+                    uploader = CHKUploader(
+                        storage_broker, secret_holder, reactor=reactor,
+                        max_segments_in_flight=default_params.get("max_segments_in_flight"),
+                        segment_size_policy=self._segment_size_policy,
+                        journal=journal,
+                    )
                     d2.addCallback(lambda x: uploader.start(eu))
 
                 self._all_uploads[uploader] = None
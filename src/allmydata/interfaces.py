@@ -475,6 +475,11 @@ class IStorageBroker(Interface):
         """
         @return: list of IServer instances
         """
+    def iter_servers_for_psi(peer_selection_index):
+        """
+        @return: iterator of IServer instances, in the same order as
+        get_servers_for_psi(), computed lazily
+        """
     def get_connected_servers():
         """
         @return: frozenset of connected IServer instances
@@ -640,86 +645,11 @@ class IMutableSlotWriter(Interface):
         """
 
 
-class IURI(Interface):
-    def init_from_string(uri):
-        """Accept a string (as created by my to_string() method) and populate
-        this instance with its data. I am not normally called directly,
-        please use the module-level uri.from_string() function to convert
-        arbitrary URI strings into IURI-providing instances."""
-
-    def is_readonly():
-        """Return False if this URI be used to modify the data. Return True
-        if this URI cannot be used to modify the data."""
-
-    def is_mutable():
-        """Return True if the data can be modified by *somebody* (perhaps
-        someone who has a more powerful URI than this one)."""
-
-    # TODO: rename to get_read_cap()
-    def get_readonly():
-        """Return another IURI instance that represents a read-only form of
-        this one. If is_readonly() is True, this returns self."""
-
-    def get_verify_cap():
-        """Return an instance that provides IVerifierURI, which can be used
-        to check on the availability of the file or directory, without
-        providing enough capabilities to actually read or modify the
-        contents. This may return None if the file does not need checking or
-        verification (e.g. LIT URIs).
-        """
-
-    def to_string():
-        """Return a string of printable ASCII characters, suitable for
-        passing into init_from_string."""
-
-
-class IVerifierURI(IURI):
-    def init_from_string(uri):
-        """Accept a string (as created by my to_string() method) and populate
-        this instance with its data. I am not normally called directly,
-        please use the module-level uri.from_string() function to convert
-        arbitrary URI strings into IURI-providing instances."""
-
-    def to_string():
-        """Return a string of printable ASCII characters, suitable for
-        passing into init_from_string."""
-
-
-class IDirnodeURI(Interface):
-    """I am a URI that represents a dirnode."""
-
-
-class IFileURI(Interface):
-    """I am a URI that represents a filenode."""
-    def get_size():
-        """Return the length (in bytes) of the file that I represent."""
-
-
-class IImmutableFileURI(IFileURI):
-    pass
-
-class IMutableFileURI(Interface):
-    pass
-
-class IDirectoryURI(Interface):
-    pass
-
-class IReadonlyDirectoryURI(Interface):
-    pass
-
-
-class CapConstraintError(Exception):
-    """A constraint on a cap was violated."""
-
-class MustBeDeepImmutableError(CapConstraintError):
-    """Mutable children cannot be added to an immutable directory.
-    Also, caps obtained from an immutable directory can trigger this error
-    if they are later found to refer to a mutable object and then used."""
-
-class MustBeReadonlyError(CapConstraintError):
-    """Known write caps cannot be specified in a ro_uri field. Also,
-    caps obtained from a ro_uri field can trigger this error if they
-    are later found to be write caps and then used."""
+from allmydata._uri_interfaces import (  # noqa: F401
+    IURI, IVerifierURI, IDirnodeURI, IFileURI, IImmutableFileURI,
+    IMutableFileURI, IDirectoryURI, IReadonlyDirectoryURI,
+    CapConstraintError, MustBeDeepImmutableError, MustBeReadonlyError,
+)
 
 class MustNotBeUnknownRWError(CapConstraintError):
     """Cannot add an unknown child cap specified in a rw_uri field."""
@@ -875,6 +805,11 @@ class IMutableFileVersion(IReadable):
     def get_sequence_number():
         """Return the sequence number of this version."""
 
+    def get_root_hash():
+        """Return the root hash of this version: the root of the share hash
+        tree, which is signed along with the sequence number, and which
+        differs between any two versions."""
+
     def get_servermap():
         """Return the IMutableFileServerMap instance that was used to create
         this object.
@@ -1197,9 +1132,14 @@ class IMutableFileNode(IFileNode):
         errback.
         """
 
-    def get_servermap(mode):
+    def get_servermap(mode, max_age=None):
         """Return a Deferred that fires with an IMutableFileServerMap
         instance, updated using the given mode.
+
+        The servermap may be a copy of one that was updated recently, if the
+        client is configured to cache them. max_age (in seconds), if given,
+        overrides the client's limit on how old such a copy may be. Updates
+        in MODE_CHECK and MODE_REPAIR always query the servers.
         """
 
     def download_version(servermap, version):
@@ -1313,11 +1253,15 @@ class IDirectoryNode(IFilesystemNode):
         protocol.
         """
 
-    def list():
+    def list(max_age=None):
         """I return a Deferred that fires with a dictionary mapping child
         name (a unicode string) to (node, metadata_dict) tuples, in which
         'node' is an IFilesystemNode and 'metadata_dict' is a dictionary of
-        metadata."""
+        metadata.
+
+        If max_age is given, and this is a mutable directory, it overrides
+        the client's limit on how old (in seconds) a cached servermap of it
+        may be."""
 
     def has_child(name):
         """I return a Deferred that fires with a boolean, True if there
@@ -1461,6 +1405,31 @@ class IDirectoryNode(IFilesystemNode):
         operation finishes. The child name must be a unicode string. I raise
         NoSuchChildError if I do not have a child by that name."""
 
+    def make_sharded():
+        """I convert this (mutable) directory, in place, into a sharded
+        directory, which spreads its children over a tree of mutable files
+        so that changing one child of a very large directory only rewrites a
+        small part of it. My caps stay the same, and all other methods work
+        as before, but clients which do not know about sharded directories
+        cannot read it any more. I return a Deferred that fires (with this
+        directory node) when the conversion is done. Converting a directory
+        that is already sharded does nothing.
+
+        If this directory node is read-only, the Deferred will errback with
+        a NotWriteableError."""
+
+    def get_shard_nodes():
+        """Return a list of the mutable filenodes below the root of this
+        sharded directory, as found by the most recent list(). This is
+        empty for an ordinary directory. Deep-check uses it to check (and
+        renew the leases of) the whole tree."""
+
+    def get_most_recent_seqnum():
+        """Return the sequence number of the version of this directory
+        which was most recently read, or None if it is immutable or has not
+        been read. Incremental deep-check uses it to notice directories
+        which have changed since they were last checked."""
+
     def build_manifest():
         """I generate a table of everything reachable from this directory.
         I also compute deep-stats as described below.
@@ -2247,11 +2216,16 @@ class ICheckable(Interface):
 
 
 class IDeepCheckable(Interface):
-    def start_deep_check(verify=False, add_lease=False):
+    def start_deep_check(verify=False, add_lease=False, recheck_age=None):
         """Check upon the health of me and everything I can reach.
 
         This is a recursive form of check(), useable only on dirnodes.
 
+        If recheck_age is not None, objects which the client's check index
+        says were found healthy less than recheck_age seconds ago (and, for
+        mutable directories, have not changed since) are not checked again:
+        the results of that earlier check are reported instead.
+
         I return a Monitor, with results that are an IDeepCheckResults
         object.
 
@@ -2262,12 +2236,13 @@ class IDeepCheckable(Interface):
         failure.
         """
 
-    def start_deep_check_and_repair(verify=False, add_lease=False):
+    def start_deep_check_and_repair(verify=False, add_lease=False,
+                                    recheck_age=None):
         """Check upon the health of me and everything I can reach. Repair
         anything that isn't healthy.
 
         This is a recursive form of check_and_repair(), useable only on
-        dirnodes.
+        dirnodes. recheck_age is as for start_deep_check().
 
         I return a Monitor, with results that are an
         IDeepCheckAndRepairResults object.
@@ -2711,6 +2686,12 @@ class IUploadStatus(Interface):
         sharemap information). Might return None if the upload is not yet
         finished."""
 
+    def get_segments_in_flight():
+        """Return the largest number of segments the encoder has had on their
+        way to the storage servers at once, or None if this is not known
+        (e.g. the upload has not reached the encoder yet, or is being done
+        by a Helper)."""
+
     def get_counter():
         """Each upload status gets a unique number: this method returns that
         number. This provides a handle to this particular upload, so a web
@@ -2872,6 +2853,82 @@ class RIHelper(RemoteInterface):
         return (UploadResults, ChoiceOf(RICHKUploadHelper, None))
 
 
+class RIGatewayCoordinator(RemoteInterface):
+    """
+    The node process of a multi-process gateway offers this (on a
+    localhost-only Tub) to its worker processes, so that they can share the
+    things that must not be done independently by each process.
+    """
+    __remote_name__ = native_str("RIGatewayCoordinator.tahoe.allmydata.com")
+
+    def register_worker(index=int, private_port=int, worker=Any()):
+        """Record that worker number 'index' is serving, and also accepts
+        forwarded web requests on localhost:private_port. 'worker' is a
+        Referenceable whose disconnection means that the worker has gone,
+        along with its ophandles and mutable-file locks."""
+        return None
+
+    def find_worker(index=int):
+        """Return the private port of the given worker, or None if it is not
+        serving."""
+        return ChoiceOf(int, None)
+
+    def claim_ophandle(ophandle=bytes, index=int):
+        """Record that the given worker holds the operation handle."""
+        return None
+
+    def release_ophandle(ophandle=bytes, index=int):
+        return None
+
+    def find_ophandle(ophandle=bytes):
+        """Return the index of the worker which holds the operation handle,
+        or None."""
+        return ChoiceOf(int, None)
+
+    def lock_mutable(storage_index=StorageIndex, index=int):
+        """Return when the given worker holds the write lock for the mutable
+        file with the given storage index. Writers are served in order."""
+        return None
+
+    def unlock_mutable(storage_index=StorageIndex, index=int):
+        return None
+
+
+class IGateway(Interface):
+    """
+    One process's view of a multi-process gateway (see allmydata.gateway).
+    """
+    index = Attribute("This process's number. The node process is 0.")
+    workers = Attribute("How many processes serve the web port.")
+
+    def web_listening(public_port, private_port):
+        """The web server of this process is listening on the shared public
+        port, and on localhost:private_port, where the other processes
+        forward requests to it."""
+
+    def find_worker(index):
+        """Return a Deferred that fires with the private port of the given
+        worker, or None if it is not serving."""
+
+    def claim_ophandle(ophandle):
+        """Return a Deferred that fires when the other processes will know
+        that this one holds the operation handle."""
+
+    def release_ophandle(ophandle):
+        """This process no longer holds the operation handle."""
+
+    def find_ophandle(ophandle):
+        """Return a Deferred that fires with the index of the process which
+        holds the operation handle, or None."""
+
+    def lock_mutable(storage_index):
+        """Return a Deferred that fires when this process may write the
+        mutable file with the given storage index."""
+
+    def unlock_mutable(storage_index):
+        """This process has finished writing the mutable file."""
+
+
 class IStatsProducer(Interface):
     def get_stats():
         """
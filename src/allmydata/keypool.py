@@ -0,0 +1,345 @@
+"""
+A pool of spare RSA keypairs for new mutable files and directories.
+
+Every mutable file and directory needs a fresh 2048-bit RSA keypair, and
+generating one takes between 0.8 and 3.2 seconds of CPU. KeyGenerator does
+that on the reactor, which stalls every other operation in the gateway for
+the duration; a workload that creates many directories (such as "tahoe
+backup") keeps it frozen.
+
+KeyPool generates keys in a pool of worker processes instead, and keeps up
+to a configured number of them in reserve, so that a new mutable file or
+directory usually gets its key without waiting at all. When the reserve
+runs dry, callers wait for the workers rather than blocking the reactor.
+If the worker processes die, or fail to make a key, the pool is replaced
+after a delay (which grows while it keeps failing), and keys are generated
+on the reactor, the slow way, until then.
+
+The worker processes (and multiprocessing's tracker process, which they
+need) are started with /dev/null for their stdin, stdout and stderr, so
+that they never hold on to the node's own, and the workers are shut down
+before the node stops.
+
+Spare keys are private keys, so they live only in memory while the node
+runs. When the node stops they are written to a file in its private/
+directory (readable only by the node's owner), and when it starts again
+that file is read and removed, before any key is handed out, so that a key
+can never be used for two mutable files even if the node crashes.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os, sys
+import multiprocessing
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+
+from zope.interface import implementer
+from twisted.internet import defer, threads
+from twisted.application import service
+from twisted.python.failure import Failure
+
+from allmydata.crypto import rsa
+from allmydata.interfaces import IStatsProducer
+from allmydata.util import base32, fileutil, log
+
+
+def _generate_signing_key(key_size):
+    """
+    Run in a worker process: create a new RSA signing key and return it
+    serialized, since key objects cannot be sent between processes.
+    """
+    signer, _ = rsa.create_signing_keypair(key_size)
+    return rsa.der_string_from_signing_key(signer)
+
+
+@contextmanager
+def _null_stdio():
+    """
+    Point our stdin, stdout and stderr at /dev/null while new processes are
+    started, since they inherit those three descriptors whatever else they
+    are given. A process which holds on to the node's stdio keeps whoever
+    is reading it (a terminal, or "tahoe run" under a supervisor) waiting
+    after the node itself has gone.
+    """
+    if os.name != "posix":
+        yield None
+        return
+    with open(os.devnull, "r+b") as null:
+        saved = [os.dup(fd) for fd in (0, 1, 2)]
+        try:
+            for fd in (0, 1, 2):
+                os.dup2(null.fileno(), fd)
+            yield null
+        finally:
+            for fd, copy in zip((0, 1, 2), saved):
+                os.dup2(copy, fd)
+                os.close(copy)
+
+
+def _start_tracker():
+    """
+    Start multiprocessing's tracker process, which the worker pool needs.
+    It is also handed sys.stderr, so make that /dev/null too: under twistd,
+    sys.stderr is a log file whose fileno() is -1, and multiprocessing
+    cannot hand that on to the tracker.
+    """
+    if os.name != "posix":
+        return
+    try:
+        from multiprocessing import resource_tracker as tracker
+    except ImportError:
+        # Python 3.7
+        from multiprocessing import semaphore_tracker as tracker
+    stderr = sys.stderr
+    with _null_stdio() as null:
+        sys.stderr = null
+        try:
+            tracker.ensure_running()
+        finally:
+            sys.stderr = stderr
+
+
+def _keypair_from_der(der):
+    """Return the (verifyingkey, signingkey) pair for a serialized key."""
+    signer, verifier = rsa.create_signing_keypair_from_string(der)
+    return (verifier, signer)
+
+
+@implementer(IStatsProducer)
+class KeyPool(service.Service):
+    """I create RSA keys for mutable files, like KeyGenerator, but in the
+    background. Each call to generate() returns a single keypair, from my
+    reserve of spare keys if there are any.
+
+    :param int size: how many spare keys to keep in reserve
+    :param spares_file: where to keep the spare keys while the node is not
+        running
+    :param int workers: how many worker processes to generate keys in
+    :param executor: a ``concurrent.futures.Executor`` to generate keys
+        with, instead of a pool of ``workers`` processes
+    """
+
+    name = "keypool"
+    KEY_SIZE = 2048
+    # how long to wait before replacing a broken pool of workers, doubling
+    # (up to the maximum) each time the new one breaks too
+    RETRY_DELAY = 1.0
+    MAX_RETRY_DELAY = 300.0
+
+    def __init__(self, size, spares_file, workers=1, executor=None,
+                 reactor=None):
+        service.Service.__init__(self)
+        if reactor is None:
+            from twisted.internet import reactor
+        self._reactor = reactor
+        self._size = size
+        self._spares_file = spares_file
+        self._workers = workers
+        self._executor = executor
+        self._own_executor = executor is None
+        # serialized signing keys, oldest first
+        self._spares = deque()
+        # (Deferred, time when generate() was called), for callers who are
+        # waiting for a key
+        self._waiting = deque()
+        self._in_progress = set()
+        self._generated = 0
+        self._requests = 0
+        self._waits = 0
+        self._wait_time = 0.0
+        self._max_wait_time = 0.0
+        self._retry_delay = self.RETRY_DELAY
+        # the DelayedCall which will replace a broken pool of workers
+        self._restart = None
+
+    def _make_executor(self):
+        # worker processes are spawned rather than forked: the reactor has
+        # threads of its own, and forking a process with threads is not
+        # safe.
+        _start_tracker()
+        return ProcessPoolExecutor(
+            max_workers=self._workers,
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+
+    def startService(self):
+        service.Service.startService(self)
+        self._load_spares()
+        if self._executor is None:
+            self._executor = self._make_executor()
+        self._fill()
+
+    def stopService(self):
+        if self._restart is not None:
+            self._restart.cancel()
+            self._restart = None
+        for future in list(self._in_progress):
+            future.cancel()
+        d = defer.succeed(None)
+        if self._own_executor and self._executor is not None:
+            # wait (in a thread, since a key may be half made) until the
+            # workers have exited, so that none of them outlives the node
+            executor, self._executor = self._executor, None
+            d = threads.deferToThreadPool(
+                self._reactor, self._reactor.getThreadPool(),
+                executor.shutdown, wait=True, cancel_futures=True)
+        self._save_spares()
+        self._spares.clear()
+        waiting, self._waiting = self._waiting, deque()
+        for (d2, started) in waiting:
+            d2.errback(Failure(defer.CancelledError("key pool stopped")))
+        d.addBoth(lambda ign: service.Service.stopService(self))
+        return d
+
+    def generate(self):
+        """I return a Deferred that fires with a (verifyingkey, signingkey)
+        pair. The returned key will be 2048 bit"""
+        self._requests += 1
+        if not self.running or (self._executor is None and not self._spares):
+            # nobody is generating keys in the background (not yet, or not
+            # until the workers are replaced), so make one the slow way
+            return defer.succeed(_keypair_from_der(
+                _generate_signing_key(self.KEY_SIZE)))
+        if self._spares:
+            d = defer.succeed(self._spares.popleft())
+        else:
+            self._waits += 1
+            d = defer.Deferred()
+            self._waiting.append((d, self._reactor.seconds()))
+        self._fill()
+        d.addCallback(_keypair_from_der)
+        return d
+
+    def _fill(self):
+        """Make sure there are enough keys on the way to satisfy everybody
+        who is waiting, and to refill the reserve."""
+        executor = self._executor
+        if executor is None:
+            return
+        wanted = (self._size + len(self._waiting)
+                  - len(self._spares) - len(self._in_progress))
+        for i in range(wanted):
+            try:
+                # submit() is where the workers are started
+                with _null_stdio():
+                    future = executor.submit(_generate_signing_key,
+                                             self.KEY_SIZE)
+            except Exception:
+                self._failed(Failure(), executor)
+                return
+            self._in_progress.add(future)
+            future.add_done_callback(
+                lambda future: self._reactor.callFromThread(
+                    self._key_generated, future, executor))
+
+    def _key_generated(self, future, executor):
+        self._in_progress.discard(future)
+        if not self.running or future.cancelled():
+            return
+        try:
+            der = future.result()
+        except Exception:
+            self._failed(Failure(), executor)
+            return
+        self._generated += 1
+        self._retry_delay = self.RETRY_DELAY
+        if self._waiting:
+            (d, started) = self._waiting.popleft()
+            elapsed = self._reactor.seconds() - started
+            self._wait_time += elapsed
+            self._max_wait_time = max(self._max_wait_time, elapsed)
+            d.callback(der)
+        else:
+            self._spares.append(der)
+
+    def _failed(self, f, executor):
+        """Key generation is broken (perhaps the worker processes could not
+        be started, or died): make the keys for everybody who is waiting the
+        slow way, and stop using the executor rather than trying it again
+        forever. A pool of workers of our own is replaced later."""
+        log.msg("unable to generate RSA keys in the background", failure=f,
+                level=log.WEIRD, umid="wGq8cA")
+        if executor is self._executor:
+            # an executor we were given cannot be replaced, so then the
+            # keys are made the slow way from now on
+            self._executor = None
+            if self._own_executor:
+                executor.shutdown(wait=False, cancel_futures=True)
+                self._schedule_restart()
+        waiting, self._waiting = self._waiting, deque()
+        for (d, started) in waiting:
+            d.callback(_generate_signing_key(self.KEY_SIZE))
+
+    def _schedule_restart(self):
+        log.msg("replacing the RSA key workers in %d seconds"
+                % (self._retry_delay,), level=log.UNUSUAL, umid="b7KpVQ")
+        self._restart = self._reactor.callLater(self._retry_delay,
+                                                self._replace_executor)
+        self._retry_delay = min(self._retry_delay * 2, self.MAX_RETRY_DELAY)
+
+    def _replace_executor(self):
+        self._restart = None
+        try:
+            self._executor = self._make_executor()
+        except Exception:
+            log.msg("unable to start the RSA key workers", failure=Failure(),
+                    level=log.WEIRD, umid="Jc0RkA")
+            self._schedule_restart()
+            return
+        self._fill()
+
+    def _load_spares(self):
+        if not os.path.exists(self._spares_file):
+            return
+        try:
+            with open(self._spares_file, "rb") as f:
+                lines = f.read().split()
+        except EnvironmentError as e:
+            log.msg("unable to read spare RSA keys from %s: %r"
+                    % (self._spares_file, e), level=log.UNUSUAL, umid="Xq3Vbg")
+            lines = []
+        # remove them from disk before any of them can be used, so that a
+        # crash cannot cause one to be handed out again
+        fileutil.remove_if_possible(self._spares_file)
+        for line in lines:
+            try:
+                der = base32.a2b(line)
+                _keypair_from_der(der)
+            except Exception as e:
+                log.msg("ignoring a bad spare RSA key: %r" % (e,),
+                        level=log.UNUSUAL, umid="m5Ywzw")
+                continue
+            self._spares.append(der)
+
+    def _save_spares(self):
+        if not self._spares:
+            return
+        tmpfile = self._spares_file + ".tmp"
+        fd = os.open(tmpfile, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as f:
+            for der in self._spares:
+                f.write(base32.b2a(der) + b"\n")
+        fileutil.move_into_place(tmpfile, self._spares_file)
+
+    def get_stats(self):
+        stats = {
+            'keypool.spares': len(self._spares),
+            'keypool.generating': len(self._in_progress),
+            'keypool.waiting': len(self._waiting),
+            'keypool.generated': self._generated,
+            'keypool.requests': self._requests,
+            'keypool.waits': self._waits,
+            'keypool.wait_time': self._wait_time,
+            'keypool.max_wait_time': self._max_wait_time,
+        }
+        if self._waits:
+            stats['keypool.average_wait_time'] = self._wait_time / self._waits
+        return stats
@@ -21,6 +21,7 @@ from allmydata.crypto import rsa
 from allmydata.interfaces import IMutableFileNode, ICheckable, ICheckResults, \
      NotEnoughSharesError, MDMF_VERSION, SDMF_VERSION, IMutableUploadable, \
      IMutableFileVersion, IWriteable
+from allmydata import hashtree
 from allmydata.util import hashutil, log, consumer, deferredutil, mathutil
 from allmydata.util.assertutil import precondition
 from allmydata.uri import WriteableSSKFileURI, ReadonlySSKFileURI, \
@@ -31,6 +32,7 @@ from allmydata.mutable.publish import Publish, MutableData,\
 from allmydata.mutable.common import MODE_READ, MODE_WRITE, MODE_CHECK, UnrecoverableFileError, \
      UncoordinatedWriteError
 from allmydata.mutable.servermap import ServerMap, ServermapUpdater
+from allmydata.mutable.layout import mdmf_layout_is_unchanged
 from allmydata.mutable.retrieve import Retrieve
 from allmydata.mutable.checker import MutableChecker, MutableCheckAndRepairer
 from allmydata.mutable.repairer import Repairer
@@ -64,11 +66,19 @@ class BackoffAgent(object):
 class MutableFileNode(object):
 
     def __init__(self, storage_broker, secret_holder,
-                 default_encoding_parameters, history):
+                 default_encoding_parameters, history, servermap_cache=None,
+                 download_params=None, write_lock=None):
         self._storage_broker = storage_broker
         self._secret_holder = secret_holder
         self._default_encoding_parameters = default_encoding_parameters
         self._history = history
+        # a ServermapCache shared by all the nodes of this gateway, or None
+        self._servermap_cache = servermap_cache
+        self._download_params = download_params or {}
+        # in a multi-process gateway, something with lock_mutable(si) and
+        # unlock_mutable(si), which keeps the processes from publishing the
+        # same file at once
+        self._write_lock = write_lock
         self._pubkey = None # filled in upon first read
         self._privkey = None # filled in if we're mutable
         # we keep track of the last encoding parameters that we use. These
@@ -78,6 +88,7 @@ class MutableFileNode(object):
         self._total_shares = default_encoding_parameters["n"]
         self._sharemap = {} # known shares, shnum-to-[nodeids]
         self._most_recent_size = None
+        self._most_recent_seqnum = None
         # filled in after __init__ if we're being created for the first time;
         # filled in by the servermap updater before publishing, otherwise.
         # set to this default value in case neither of those things happen,
@@ -271,7 +282,9 @@ class MutableFileNode(object):
         if self.is_readonly():
             return self
         ro = MutableFileNode(self._storage_broker, self._secret_holder,
-                             self._default_encoding_parameters, self._history)
+                             self._default_encoding_parameters, self._history,
+                             self._servermap_cache, self._download_params,
+                             self._write_lock)
         ro.init_from_cap(self._uri.get_readonly())
         return ro
 
@@ -328,16 +341,17 @@ class MutableFileNode(object):
     #################################
     # IFileNode
 
-    def get_best_readable_version(self):
+    def get_best_readable_version(self, max_age=None):
         """
         I return a Deferred that fires with a MutableFileVersion
         representing the best readable version of the file that I
         represent
         """
-        return self.get_readable_version()
+        return self.get_readable_version(max_age=max_age)
 
 
-    def get_readable_version(self, servermap=None, version=None):
+    def get_readable_version(self, servermap=None, version=None,
+                             max_age=None):
         """
         I return a Deferred that fires with an MutableFileVersion for my
         version argument, if there is a recoverable file of that version
@@ -350,8 +364,12 @@ class MutableFileNode(object):
 
         If no version is provided, then I return a MutableFileVersion
         representing the best recoverable version of the file.
+
+        If max_age is provided, it overrides the gateway's limit on how old
+        (in seconds) a cached servermap may be.
         """
-        d = self._get_version_from_servermap(MODE_READ, servermap, version)
+        d = self._get_version_from_servermap(MODE_READ, servermap, version,
+                                             max_age)
         def _build_version(servermap_and_their_version):
             (servermap, their_version) = servermap_and_their_version
             assert their_version in servermap.recoverable_versions()
@@ -375,7 +393,8 @@ class MutableFileNode(object):
     def _get_version_from_servermap(self,
                                     mode,
                                     servermap=None,
-                                    version=None):
+                                    version=None,
+                                    max_age=None):
         """
         I return a Deferred that fires with (servermap, version).
 
@@ -404,7 +423,7 @@ class MutableFileNode(object):
         if servermap and servermap.get_last_update()[0] == mode:
             d = defer.succeed(servermap)
         else:
-            d = self._get_servermap(mode)
+            d = self._get_servermap(mode, max_age)
 
         def _get_version(servermap, v):
             if v and v not in servermap.recoverable_versions():
@@ -418,19 +437,21 @@ class MutableFileNode(object):
         return d.addCallback(_get_version, version)
 
 
-    def download_best_version(self):
+    def download_best_version(self, max_age=None):
         """
         I return a Deferred that fires with the contents of the best
-        version of this mutable file.
+        version of this mutable file. If max_age is provided, it overrides
+        the gateway's limit on how old (in seconds) a cached servermap may
+        be.
         """
-        return self._do_serialized(self._download_best_version)
+        return self._do_serialized(self._download_best_version, max_age)
 
 
-    def _download_best_version(self):
+    def _download_best_version(self, max_age=None):
         """
         I am the serialized sibling of download_best_version.
         """
-        d = self.get_best_readable_version()
+        d = self.get_best_readable_version(max_age)
         d.addCallback(self._record_size)
         d.addCallback(lambda version: version.download_to_data())
 
@@ -445,6 +466,8 @@ class MutableFileNode(object):
         def _maybe_retry(failure):
             failure.trap(NotEnoughSharesError)
 
+            # the servermap may have come from the cache, and be stale
+            self._forget_cached_servermap()
             d = self.get_best_mutable_version()
             d.addCallback(self._record_size)
             d.addCallback(lambda version: version.download_to_data())
@@ -456,20 +479,28 @@ class MutableFileNode(object):
 
     def _record_size(self, mfv):
         """
-        I record the size of a mutable file version.
+        I record the size and sequence number of a mutable file version.
         """
         self._most_recent_size = mfv.get_size()
+        self._most_recent_seqnum = mfv.get_sequence_number()
         return mfv
 
+    def get_most_recent_seqnum(self):
+        """
+        I return the sequence number of the version that was most recently
+        downloaded through me, or None if there was none.
+        """
+        return self._most_recent_seqnum
+
 
-    def get_size_of_best_version(self):
+    def get_size_of_best_version(self, max_age=None):
         """
         I return the size of the best version of this mutable file.
 
         This is equivalent to calling get_size() on the result of
         get_best_readable_version().
         """
-        d = self.get_best_readable_version()
+        d = self.get_best_readable_version(max_age)
         return d.addCallback(lambda mfv: mfv.get_size())
 
 
@@ -572,7 +603,8 @@ class MutableFileNode(object):
         fires with the results of my upload.
         """
         # TODO: Update downloader hints
-        return self._do_serialized(self._upload, new_contents, servermap)
+        return self._do_serialized(self._write_locked, self._upload,
+                                   new_contents, servermap)
 
 
     def modify(self, modifier, backoffer=None):
@@ -606,22 +638,31 @@ class MutableFileNode(object):
         return d.addCallback(lambda mfv: mfv.download_to_data(fetch_privkey))
 
 
-    def get_servermap(self, mode):
+    def get_servermap(self, mode, max_age=None):
         """
         I return a servermap that has been updated in mode.
 
         mode should be one of MODE_READ, MODE_WRITE, MODE_CHECK or
         MODE_ANYTHING. See servermap.py for more on what these mean.
+
+        The servermap may come from the gateway's ServermapCache, if it
+        holds one that is recent enough. max_age, if provided, overrides
+        the gateway's limit on how old (in seconds) that may be.
         """
-        return self._do_serialized(self._get_servermap, mode)
+        return self._do_serialized(self._get_servermap, mode, max_age)
 
 
-    def _get_servermap(self, mode):
+    def _get_servermap(self, mode, max_age=None):
         """
         I am a serialized twin to get_servermap.
         """
-        servermap = ServerMap()
-        d = self._update_servermap(servermap, mode)
+        servermap = self._get_cached_servermap(mode, max_age)
+        if servermap is not None:
+            d = defer.succeed(servermap)
+        else:
+            servermap = ServerMap()
+            d = self._update_servermap(servermap, mode)
+            d.addCallback(self._cache_servermap)
         # The servermap will tell us about the most recent size of the
         # file, so we may as well set that so that callers might get
         # more data about us.
@@ -651,6 +692,48 @@ class MutableFileNode(object):
         return u.update()
 
 
+    def _get_cached_servermap(self, mode, max_age):
+        """
+        I return a servermap for this file from the gateway's
+        ServermapCache, or None. A cached servermap is only used if it
+        leaves me with the keys that a real update would have given me.
+        """
+        if self._servermap_cache is None:
+            return None
+        if mode == MODE_WRITE and not self._privkey:
+            return None
+        cached = self._servermap_cache.get(self._storage_index, mode, max_age)
+        if cached is None:
+            return None
+        (servermap, pubkey) = cached
+        if not self._pubkey:
+            # the cached key was checked against the fingerprint of whichever
+            # node cached it, so check it against mine too
+            pubkey_s = rsa.der_string_from_verifying_key(pubkey)
+            if hashutil.ssk_pubkey_fingerprint_hash(pubkey_s) != self._fingerprint:
+                return None
+            self._populate_pubkey(pubkey)
+        return servermap
+
+
+    def _cache_servermap(self, servermap):
+        if self._servermap_cache is not None and self._pubkey:
+            self._servermap_cache.put(self._storage_index, servermap,
+                                      self._pubkey)
+        return servermap
+
+
+    def _forget_cached_servermap(self, res=None):
+        """
+        I drop any cached servermap for this file, after a publish from
+        this gateway (which makes it stale) or when it has proved to be
+        wrong. I return res, so I can be used as a Deferred callback.
+        """
+        if self._servermap_cache is not None:
+            self._servermap_cache.invalidate(self._storage_index)
+        return res
+
+
     #def set_version(self, version):
         # I can be set in two ways:
         #  1. When the node is created.
@@ -683,6 +766,24 @@ class MutableFileNode(object):
         return d
 
 
+    def _write_locked(self, cb, *args, **kwargs):
+        """
+        I call cb while holding the gateway's write lock for this file, if
+        it has one. Another process of the gateway may have published since I
+        last looked, so I forget any cached servermap first.
+        """
+        if self._write_lock is None:
+            return cb(*args, **kwargs)
+        d = self._write_lock.lock_mutable(self._storage_index)
+        d.addCallback(self._forget_cached_servermap)
+        d.addCallback(lambda ign: cb(*args, **kwargs))
+        def _unlock(res):
+            self._write_lock.unlock_mutable(self._storage_index)
+            return res
+        d.addBoth(_unlock)
+        return d
+
+
     def _upload(self, new_contents, servermap):
         """
         A MutableFileNode still has to have some way of getting
@@ -699,6 +800,7 @@ class MutableFileNode(object):
             self._history.notify_publish(p.get_status(),
                                          new_contents.get_size())
         d = p.publish(new_contents)
+        d.addBoth(self._forget_cached_servermap)
         d.addCallback(self._did_upload, new_contents.get_size())
         return d
 
@@ -759,6 +861,13 @@ class MutableFileVersion(object):
         return self._version[0] # verinfo[0] == the sequence number
 
 
+    def get_root_hash(self):
+        """
+        Get the root hash of the mutable version that I represent.
+        """
+        return self._version[1] # verinfo[1] == the root hash
+
+
     # TODO: Terminology?
     def get_writekey(self):
         """
@@ -790,7 +899,8 @@ class MutableFileVersion(object):
         """
         assert not self.is_readonly()
 
-        return self._do_serialized(self._overwrite, new_contents)
+        return self._do_serialized(self._node._write_locked, self._overwrite,
+                                   new_contents)
 
 
     def _overwrite(self, new_contents):
@@ -842,7 +952,8 @@ class MutableFileVersion(object):
         """
         assert not self.is_readonly()
 
-        return self._do_serialized(self._modify, modifier, backoffer)
+        return self._do_serialized(self._node._write_locked, self._modify,
+                                   modifier, backoffer)
 
 
     def _modify(self, modifier, backoffer):
@@ -951,6 +1062,14 @@ class MutableFileVersion(object):
         return self._servermap.size_of_version(self._version)
 
 
+    def get_segment_size(self):
+        """
+        I return a Deferred that fires with the segment size of this
+        version, so that readers can ask for whole segments.
+        """
+        return defer.succeed(self._version[3])
+
+
     def download_to_data(self, fetch_privkey=False):  # type: ignore # fixme
         """
         I return a Deferred that fires with the contents of this
@@ -989,8 +1108,11 @@ class MutableFileVersion(object):
         """
         I am the serialized companion of read.
         """
+        segments_in_flight = self._node._download_params.get(
+            "mutable_segments_in_flight", 1)
         r = Retrieve(self._node, self._storage_broker, self._servermap,
-                     self._version, fetch_privkey)
+                     self._version, fetch_privkey,
+                     segments_in_flight=segments_in_flight)
         if self._history:
             self._history.notify_retrieve(r.get_status())
         d = r.download(consumer, offset, size)
@@ -1023,6 +1145,7 @@ class MutableFileVersion(object):
             self._history.notify_publish(p.get_status(),
                                          new_contents.get_size())
         d = p.publish(new_contents)
+        d.addBoth(self._node._forget_cached_servermap)
         d.addCallback(self._did_upload, new_contents.get_size())
         return d
 
@@ -1044,8 +1167,15 @@ class MutableFileVersion(object):
         O(data.get_size()) memory/bandwidth/CPU to perform the update.
         Otherwise, it must download, re-encode, and upload the entire
         file again, which will use O(filesize) resources.
+
+        If the update leaves the number of segments and the size of the
+        last block as they are, only the changed blocks and O(log(number
+        of segments)) hashes of each share are read and written. An update
+        that does change them (most appends do) must also read and rewrite
+        the whole block hash tree of each share, since it moves.
         """
-        return self._do_serialized(self._update, data, offset)
+        return self._do_serialized(self._node._write_locked, self._update,
+                                   data, offset)
 
 
     def _update(self, data, offset):
@@ -1070,11 +1200,21 @@ class MutableFileVersion(object):
             log.msg("doing re-encode instead of in-place update")
             return self._do_modify_update(data, offset)
 
-        # Otherwise, we can replace just the parts that are changing.
-        log.msg("updating in place")
-        d = self._do_update_update(data, offset)
-        d.addCallback(self._decode_and_decrypt_segments, data, offset)
-        d.addCallback(self._build_uploadable_and_finish, data, offset)
+        # Otherwise, we can replace just the parts that are changing. If
+        # the shares keep their layout, that is just the changed blocks and
+        # the hashes above them.
+        k = self._version[5]
+        delta = (data.get_size() > 0 and
+                 offset // segment_size < num_old_segments and
+                 mdmf_layout_is_unchanged(segment_size, k, old_size,
+                                          max(old_size, new_size)))
+        if delta:
+            log.msg("updating in place, writing only the changes")
+        else:
+            log.msg("updating in place")
+        d = self._do_update_update(data, offset, delta)
+        d.addCallback(self._decode_and_decrypt_segments, data, offset, delta)
+        d.addCallback(self._build_uploadable_and_finish, data, offset, delta)
         return d
 
 
@@ -1094,7 +1234,7 @@ class MutableFileVersion(object):
         return self._modify(m, None)
 
 
-    def _do_update_update(self, data, offset):
+    def _do_update_update(self, data, offset, delta=False):
         """
         I start the Servermap update that gets us the data we need to
         continue the update process. I return a Deferred that fires when
@@ -1120,6 +1260,10 @@ class MutableFileVersion(object):
             # byte end_data - 1 because bytes are zero-indexed.
             end_data -= 1
             end_segment = end_data // segsize
+        elif delta:
+            # Every segment up to the last one is rewritten, so the last
+            # one bounds the hashes that will change.
+            end_segment = mathutil.div_ceil(self.get_size(), segsize) - 1
 
         self._start_segment = start_segment
         self._end_segment = end_segment
@@ -1127,10 +1271,12 @@ class MutableFileVersion(object):
         # Now ask for the servermap to be updated in MODE_WRITE with
         # this update range.
         return self._update_servermap(update_range=(start_segment,
-                                                    end_segment))
+                                                    end_segment),
+                                      delta_update=delta)
 
 
-    def _decode_and_decrypt_segments(self, ignored, data, offset):
+    def _decode_and_decrypt_segments(self, ignored, data, offset,
+                                     delta=False):
         """
         After the servermap update, I take the encrypted and encoded
         data that the servermap fetched while doing its update and
@@ -1164,7 +1310,10 @@ class MutableFileVersion(object):
             assert [x for x in data if x != datum] == []
 
             # datum is (blockhashes,start,end)
-            blockhashes[shnum] = datum[0]
+            if delta:
+                blockhashes[shnum] = self._old_block_hash_tree(*datum)
+            else:
+                blockhashes[shnum] = datum[0]
             start_segments[shnum] = datum[1] # (block,salt) bytestrings
             end_segments[shnum] = datum[2]
 
@@ -1174,7 +1323,26 @@ class MutableFileVersion(object):
         return deferredutil.gatherResults([d1, d2, d3])
 
 
-    def _build_uploadable_and_finish(self, segments_and_bht, data, offset):
+    def _old_block_hash_tree(self, hashes, start, end):
+        """
+        For a delta update, I check the old blocks of the first and last
+        segments of the update against the block hashes that were fetched
+        with them, raising BadHashError if they do not match. I return an
+        IncompleteHashTree holding those hashes, from which Publish can
+        recompute the root of the tree.
+        """
+        num_segments = mathutil.div_ceil(self._version[4], self._version[3])
+        t = hashtree.IncompleteHashTree(num_segments)
+        leaves = {}
+        for (segnum, (block, salt)) in [(self._start_segment, start),
+                                        (self._end_segment, end)]:
+            leaves[segnum] = hashutil.block_hash(salt + block)
+        t.set_hashes(hashes, leaves=leaves)
+        return t
+
+
+    def _build_uploadable_and_finish(self, segments_and_bht, data, offset,
+                                     delta=False):
         """
         After the process has the plaintext segments, I build the
         TransformingUploadable that the publisher will eventually
@@ -1187,10 +1355,13 @@ class MutableFileVersion(object):
                                    segments_and_bht[0],
                                    segments_and_bht[1])
         p = Publish(self._node, self._storage_broker, self._servermap)
-        return p.update(u, offset, segments_and_bht[2], self._version)
+        d = p.update(u, offset, segments_and_bht[2], self._version, delta)
+        d.addBoth(self._node._forget_cached_servermap)
+        return d
 
 
-    def _update_servermap(self, mode=MODE_WRITE, update_range=None):
+    def _update_servermap(self, mode=MODE_WRITE, update_range=None,
+                          delta_update=False):
         """
         I update the servermap. I return a Deferred that fires when the
         servermap update is done.
@@ -1199,7 +1370,8 @@ class MutableFileVersion(object):
             u = ServermapUpdater(self._node, self._storage_broker, Monitor(),
                                  self._servermap,
                                  mode=mode,
-                                 update_range=update_range)
+                                 update_range=update_range,
+                                 delta_update=delta_update)
         else:
             u = ServermapUpdater(self._node, self._storage_broker, Monitor(),
                                  self._servermap,
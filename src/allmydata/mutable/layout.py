@@ -17,6 +17,7 @@ from allmydata.mutable.common import NeedMoreDataError, UnknownVersionError, \
      BadShareError
 from allmydata.interfaces import HASH_SIZE, SALT_SIZE, SDMF_VERSION, \
                                  MDMF_VERSION, IMutableSlotWriter
+from allmydata import hashtree
 from allmydata.util import mathutil
 from twisted.python import failure
 from twisted.internet import defer
@@ -580,6 +581,38 @@ VERIFICATION_KEY_SIZE = 292
 # bound. Each node requires 2 bytes of node-number plus 32 bytes of hash.
 SHARE_HASH_CHAIN_SIZE = (2+HASH_SIZE)*mathutil.log_ceil(256, 2)
 
+def mdmf_layout_is_unchanged(segment_size, required_shares,
+                              old_data_length, new_data_length):
+    """
+    Return True if an MDMF share of a file of new_data_length bytes is laid
+    out just like a share of old_data_length bytes: it has as many segments,
+    and as long a tail block, so that changing one into the other leaves
+    the block hash tree where it is.
+    """
+    def _blocks(data_length):
+        num_segments = mathutil.div_ceil(data_length, segment_size)
+        tail_size = data_length % segment_size or segment_size
+        return (num_segments, mathutil.div_ceil(tail_size, required_shares))
+    if not old_data_length:
+        return False
+    return _blocks(old_data_length) == _blocks(new_data_length)
+
+
+def _hash_runs(indices):
+    """
+    Group the given hash indices into runs of consecutive ones, so that
+    each run can be read or written with one vector. Return a list of
+    (first index, number of hashes).
+    """
+    runs = []
+    for i in sorted(indices):
+        if runs and runs[-1][0] + runs[-1][1] == i:
+            runs[-1][1] += 1
+        else:
+            runs.append([i, 1])
+    return [tuple(run) for run in runs]
+
+
 @implementer(IMutableSlotWriter)
 class MDMFSlotWriteProxy(object):
 
@@ -1191,6 +1224,67 @@ class MDMFSlotWriteProxy(object):
         d.addBoth(_result)
         return d
 
+class MDMFSlotUpdateProxy(MDMFSlotWriteProxy):
+    """
+    I am an MDMFSlotWriteProxy for an update which rewrites some of the
+    segments of an existing MDMF share, and leaves its layout as it is (see
+    mdmf_layout_is_unchanged). I only write what such an update changes:
+    the new blocks, the nodes of the block hash tree above them, the share
+    hash chain, the root hash, the signature, and the header. The encrypted
+    private key and the verification key are already on the server, where
+    they stay.
+    """
+
+    def __repr__(self):
+        return "MDMFSlotUpdateProxy for share %d" % self.shnum
+
+
+    def put_encprivkey(self, encprivkey):
+        """
+        I note where the share hash chain starts, after the encrypted
+        private key that is already on the server.
+        """
+        if "signature" in self._offsets:
+            raise LayoutInvalid("You can't put the encrypted private key "
+                                "after putting the share hash chain")
+        self._offsets['share_hash_chain'] = self._offsets['enc_privkey'] + \
+                len(encprivkey)
+
+
+    def put_blockhashes(self, blockhashes):
+        """
+        I queue write vectors for some of the nodes of the block hash tree.
+        blockhashes is a dict mapping hash index to the new hash of that
+        node; the other nodes are left as they are on the server.
+        """
+        assert self._offsets
+        assert "block_hash_tree" in self._offsets
+
+        assert isinstance(blockhashes, dict)
+
+        base = self._offsets['block_hash_tree']
+        num_hashes = 2 * hashtree.roundup_pow2(self._num_segments) - 1
+        self._offsets['EOF'] = base + num_hashes * HASH_SIZE
+        for (first, count) in _hash_runs(blockhashes):
+            data = b"".join([blockhashes[i]
+                             for i in range(first, first + count)])
+            self._writevs.append(tuple([base + first * HASH_SIZE, data]))
+
+
+    def put_verification_key(self, verification_key):
+        """
+        I note where the verification key, which is already on the server,
+        ends.
+        """
+        if "verification_key" not in self._offsets:
+            raise LayoutInvalid("You must put the signature before you "
+                                "can put the verification key")
+
+        self._offsets['verification_key_end'] = \
+            self._offsets['verification_key'] + len(verification_key)
+        assert self._offsets['verification_key_end'] <= self._offsets['share_data']
+
+
 def _handle_bad_struct(f):
     # struct.unpack errors mean the server didn't give us enough data, so
     # this share is bad
@@ -1495,6 +1589,47 @@ class MDMFSlotReadProxy(object):
         return d
 
 
+    def get_some_blockhashes(self, needed, force_remote=False):
+        """
+        I return a dict mapping each hash index in needed to that node of
+        the block hash tree. Unlike get_blockhashes, I read only those
+        hashes rather than the whole tree, which is what an in-place update
+        of a few segments wants. I only work on MDMF shares.
+        """
+        if not needed:
+            return defer.succeed({})
+        d = self._maybe_fetch_offsets_and_header()
+        def _then(ignored):
+            if self._version_number != 1:
+                raise LayoutInvalid("only MDMF shares store their block "
+                                    "hashes separately")
+            base = self._offsets['block_hash_tree']
+            runs = _hash_runs(needed)
+            readvs = [(base + first * HASH_SIZE, count * HASH_SIZE)
+                      for (first, count) in runs]
+            d2 = self._read(readvs, force_remote=force_remote)
+            d2.addCallback(lambda results: (runs, results))
+            return d2
+        d.addCallback(_then)
+        def _build_hashes(runs_and_results):
+            (runs, results) = runs_and_results
+            if self.shnum not in results:
+                raise BadShareError("no data for shnum %d" % self.shnum)
+            datavs = results[self.shnum]
+            if len(datavs) != len(runs):
+                raise BadShareError("got %d vectors, not %d"
+                                    % (len(datavs), len(runs)))
+            hashes = {}
+            for ((first, count), data) in zip(runs, datavs):
+                if len(data) != count * HASH_SIZE:
+                    raise BadShareError("block hash tree is too short")
+                for j in range(count):
+                    hashes[first + j] = data[j*HASH_SIZE:(j+1)*HASH_SIZE]
+            return hashes
+        d.addCallback(_build_hashes)
+        return d
+
+
     def get_sharehashes(self, needed=None, force_remote=False):
         """
         I return the part of the share hash chain placed to validate
@@ -29,10 +29,12 @@ from foolscap.api import eventually, fireEventually
 from allmydata.mutable.common import MODE_WRITE, MODE_CHECK, MODE_REPAIR, \
      UncoordinatedWriteError, NotEnoughServersError
 from allmydata.mutable.servermap import ServerMap
+from allmydata.mutable import signatures
 from allmydata.mutable.layout import get_version_from_checkstring,\
                                      unpack_mdmf_checkstring, \
                                      unpack_sdmf_checkstring, \
                                      MDMFSlotWriteProxy, \
+                                     MDMFSlotUpdateProxy, \
                                      SDMFSlotWriteProxy
 
 KiB = 1024
@@ -140,6 +142,9 @@ class Publish(object):
         self._status.set_active(True)
         self._version = self._node.get_version()
         assert self._version in (SDMF_VERSION, MDMF_VERSION)
+        # set by update() when only the changed parts of each share are
+        # written
+        self._delta = False
 
 
     def get_status(self):
@@ -153,13 +158,23 @@ class Publish(object):
         return log.msg(*args, **kwargs)
 
 
-    def update(self, data, offset, blockhashes, version):
+    def update(self, data, offset, blockhashes, version, delta=False):
         """
         I replace the contents of this file with the contents of data,
         starting at offset. I return a Deferred that fires with None
         when the replacement has been completed, or with an error if
         something went wrong during the process.
 
+        blockhashes maps each share number to the whole block hash tree
+        of that share (a list of hashes). If delta is True, the update
+        leaves the layout of the shares as it is (see
+        layout.mdmf_layout_is_unchanged), and blockhashes instead maps
+        each share number to an IncompleteHashTree which holds just the
+        hashes needed to recompute its root once the updated segments
+        are rewritten. Then only the changed blocks and hashes are
+        written, rather than the whole block hash tree and everything
+        that follows it.
+
         Note that this process will not upload new shares. If the file
         being updated is in need of repair, callers will have to repair
         it on their own.
@@ -270,7 +285,11 @@ class Publish(object):
 
         # SDMF files are updated differently.
         self._version = MDMF_VERSION
-        writer_class = MDMFSlotWriteProxy
+        self._delta = delta
+        if delta:
+            writer_class = MDMFSlotUpdateProxy
+        else:
+            writer_class = MDMFSlotWriteProxy
 
         # For each (server, shnum) in self.goal, we make a
         # write proxy for that server. We'll use this to write
@@ -317,6 +336,14 @@ class Publish(object):
         # Our update process fetched these for us. We need to update
         # them in place as publishing happens.
         self.blockhashes = {} # (shnum, [blochashes])
+        if delta:
+            # We only learn the hashes of the segments we rewrite: they
+            # are recorded as {segnum: hash}, and the old trees are kept
+            # to recompute the nodes above them.
+            self._old_block_hash_trees = blockhashes
+            blockhashes = {}
+            for i in self._old_block_hash_trees:
+                self.blockhashes[i] = {}
         for (i, bht) in list(blockhashes.items()):
             # We need to extract the leaves from our old hash tree.
             old_segcount = mathutil.div_ceil(version[4],
@@ -787,8 +814,8 @@ class Publish(object):
         self.push_encprivkey()
         self.push_blockhashes()
         self.push_sharehashes()
-        self.push_toplevel_hashes_and_signature()
-        d = self.finish_publishing()
+        d = self.push_toplevel_hashes_and_signature()
+        d.addCallback(lambda ignored: self.finish_publishing())
         def _change_state(ignored):
             self._state = DONE_STATE
         d.addCallback(_change_state)
@@ -808,8 +835,13 @@ class Publish(object):
         self.sharehash_leaves = [None] * len(self.blockhashes)
         self._status.set_status("Building and pushing block hash tree")
         for shnum, blockhashes in list(self.blockhashes.items()):
-            t = hashtree.HashTree(blockhashes)
-            self.blockhashes[shnum] = list(t)
+            if self._delta:
+                t = self._old_block_hash_trees[shnum]
+                # only the nodes that changed are written
+                self.blockhashes[shnum] = t.replace_leaves(blockhashes)
+            else:
+                t = hashtree.HashTree(blockhashes)
+                self.blockhashes[shnum] = list(t)
             # set the leaf for future use.
             self.sharehash_leaves[shnum] = t[0]
 
@@ -842,7 +874,7 @@ class Publish(object):
             for writer in writers:
                 writer.put_root_hash(self.root_hash)
         self._update_checkstring()
-        self._make_and_place_signature()
+        return self._make_and_place_signature()
 
 
     def _update_checkstring(self):
@@ -858,17 +890,21 @@ class Publish(object):
 
     def _make_and_place_signature(self):
         """
-        I create and place the signature.
+        I create and place the signature. The signing happens in a worker
+        thread, so I return a Deferred.
         """
         started = time.time()
         self._status.set_status("Signing prefix")
         signable = self._get_some_writer().get_signable()
-        self.signature = rsa.sign_data(self._privkey, signable)
-
-        for (shnum, writers) in self.writers.items():
-            for writer in writers:
-                writer.put_signature(self.signature)
-        self._status.timings['sign'] = time.time() - started
+        d = signatures.sign_data(self._privkey, signable)
+        def _signed(signature):
+            self.signature = signature
+            for (shnum, writers) in self.writers.items():
+                for writer in writers:
+                    writer.put_signature(self.signature)
+            self._status.timings['sign'] = time.time() - started
+        d.addCallback(_signed)
+        return d
 
 
     def finish_publishing(self):
@@ -15,7 +15,7 @@ import time
 
 from itertools import count
 from zope.interface import implementer
-from twisted.internet import defer
+from twisted.internet import defer, threads
 from twisted.python import failure
 from twisted.internet.interfaces import IPushProducer, IConsumer
 from foolscap.api import eventually, fireEventually, DeadReferenceError, \
@@ -114,7 +114,7 @@ class Retrieve(object):
     # will use a single ServerMap instance.
 
     def __init__(self, filenode, storage_broker, servermap, verinfo,
-                 fetch_privkey=False, verify=False):
+                 fetch_privkey=False, verify=False, segments_in_flight=1):
         self._node = filenode
         _assert(self._node.get_pubkey())
         self._storage_broker = storage_broker
@@ -170,6 +170,12 @@ class Retrieve(object):
         self._pause_deferred = None
         self._offset = None
         self._read_length = None
+        # how many segments we fetch at once: the one we are working on, and
+        # the ones after it. Segments are still decoded, decrypted and
+        # delivered to the consumer one at a time, in order.
+        precondition(segments_in_flight >= 1, segments_in_flight)
+        self._segments_in_flight = segments_in_flight
+        self._readahead = {} # segnum -> Deferred, from _fetch_segment()
         self.log("got seqnum %d" % self.verinfo[0])
 
 
@@ -359,12 +365,10 @@ class Retrieve(object):
         self._read_length = self._data_length
         self._setup_encoding_parameters()
 
-        # _decode_blocks() expects the output of a gatherResults that
-        # contains the outputs of _validate_block() (each of which is a dict
-        # mapping shnum to (block,salt) bytestrings).
-        d = self._decode_blocks([blocks_and_salts], segnum)
-        d.addCallback(self._decrypt_segment)
-        return d
+        # _decode_and_decrypt_blocks() expects the output of a
+        # gatherResults that contains the outputs of _validate_block() (each
+        # of which is a dict mapping shnum to (block,salt) bytestrings).
+        return self._decode_and_decrypt_blocks([blocks_and_salts], segnum)
 
 
     def _setup_encoding_parameters(self):
@@ -582,8 +586,10 @@ class Retrieve(object):
         self._status.add_problem(server, f)
         self._last_failure = f
 
-        # Remove the reader from _active_readers
-        self._active_readers.remove(reader)
+        # Remove the reader from _active_readers. It may have been removed
+        # already, if it failed while fetching more than one segment.
+        if reader in self._active_readers:
+            self._active_readers.remove(reader)
         for shnum in list(self.remaining_sharemap.keys()):
             self.remaining_sharemap.discard(shnum, reader.server)
 
@@ -622,6 +628,47 @@ class Retrieve(object):
         # TODO: The old code uses a marker. Should this code do that
         # too? What did the Marker do?
 
+        dl = self._readahead.pop(segnum, None)
+        if dl is None:
+            dl = self._fetch_segment(segnum)
+        self._start_readahead(segnum)
+        if self._verify:
+            dl.addCallback(lambda ignored: "")
+            dl.addCallback(self._set_segment)
+        else:
+            dl.addCallback(self._maybe_decode_and_decrypt_segment, segnum)
+        return dl
+
+    def _start_readahead(self, segnum):
+        """
+        I start fetching the segments after segnum, so that up to
+        segments_in_flight segments are on their way at once. Their blocks
+        are fetched (and validated) using the readers that are active now. If
+        one of those readers fails, the segments that needed it are fetched
+        again when their turn comes.
+        """
+        last = min(segnum + self._segments_in_flight - 1, self._last_segment)
+        for s in range(segnum + 1, last + 1):
+            if s not in self._readahead:
+                self._readahead[s] = self._fetch_segment(s)
+
+    def _discard_readahead(self):
+        """
+        I drop the segments that were fetched ahead but are no longer
+        needed, because the download is over.
+        """
+        for d in self._readahead.values():
+            d.addErrback(lambda f: self.log("unused segment fetch failed",
+                                            failure=f, level=log.UNUSUAL))
+        self._readahead.clear()
+
+    def _fetch_segment(self, segnum):
+        """
+        I fetch and validate a block of the given segment from each active
+        reader. I return a Deferred that fires with a list of the results of
+        _validate_block(), with None in place of each block that could not be
+        fetched or validated.
+        """
         # We need to ask each of our active readers for its block and
         # salt. We will then validate those. If validation is
         # successful, we will assemble the results into plaintext.
@@ -637,13 +684,7 @@ class Retrieve(object):
             # bugs) are passed through and cause the retrieve to fail.
             d.addErrback(self._handle_bad_share, [reader])
             ds.append(d)
-        dl = deferredutil.gatherResults(ds)
-        if self._verify:
-            dl.addCallback(lambda ignored: "")
-            dl.addCallback(self._set_segment)
-        else:
-            dl.addCallback(self._maybe_decode_and_decrypt_segment, segnum)
-        return dl
+        return deferredutil.gatherResults(ds)
 
 
     def _maybe_decode_and_decrypt_segment(self, results, segnum):
@@ -666,8 +707,7 @@ class Retrieve(object):
             self.log("some validation operations failed; not proceeding")
             return defer.succeed(None)
         self.log("everything looks ok, building segment %d" % segnum)
-        d = self._decode_blocks(results, segnum)
-        d.addCallback(self._decrypt_segment)
+        d = self._decode_and_decrypt_blocks(results, segnum)
         # check to see whether we've been paused before writing
         # anything.
         d.addCallback(self._check_for_paused)
@@ -842,10 +882,12 @@ class Retrieve(object):
         return d1,d2
 
 
-    def _decode_blocks(self, results, segnum):
+    def _decode_and_decrypt_blocks(self, results, segnum):
         """
-        I take a list of k blocks and salts, and decode that into a
-        single encrypted segment.
+        I take a list of k blocks and salts, and decode and decrypt that
+        into a single plaintext segment. The work is done in a worker
+        thread, so that the reactor can carry on fetching the next segments
+        meanwhile.
         """
         # 'results' is one or more dicts (each {shnum:(block,salt)}), and we
         # want to merge them all
@@ -872,52 +914,35 @@ class Retrieve(object):
             shares.append(share)
 
         self._set_current_status("decoding")
-        started = time.time()
         _assert(len(shareids) >= self._required_shares, len(shareids))
         # zfec really doesn't want extra shares
         shareids = shareids[:self._required_shares]
         shares = shares[:self._required_shares]
         self.log("decoding segment %d" % segnum)
         if segnum == self._num_segments - 1:
-            d = defer.maybeDeferred(self._tail_decoder.decode, shares, shareids)
+            decoder = self._tail_decoder
+            size_to_use = self._tail_data_size
         else:
-            d = defer.maybeDeferred(self._segment_decoder.decode, shares, shareids)
-        def _process(buffers):
-            segment = b"".join(buffers)
-            self.log(format="now decoding segment %(segnum)s of %(numsegs)s",
+            decoder = self._segment_decoder
+            size_to_use = self._segment_size
+        key = hashutil.ssk_readkey_data_hash(salt, self._node.get_readkey())
+        d = threads.deferToThread(_decode_and_decrypt, decoder, shares,
+                                  shareids, size_to_use, key)
+        def _done(res):
+            (plaintext, decode_time, decrypt_time) = res
+            self.log(format="decoded and decrypted segment %(segnum)s of "
+                            "%(numsegs)s, length %(length)d",
                      segnum=segnum,
                      numsegs=self._num_segments,
+                     length=len(plaintext),
                      level=log.NOISY)
-            self.log(" joined length %d, datalength %d" %
-                     (len(segment), self._data_length))
-            if segnum == self._num_segments - 1:
-                size_to_use = self._tail_data_size
-            else:
-                size_to_use = self._segment_size
-            segment = segment[:size_to_use]
-            self.log(" segment len=%d" % len(segment))
-            self._status.accumulate_decode_time(time.time() - started)
-            return segment, salt
-        d.addCallback(_process)
+            self._status.accumulate_decode_time(decode_time)
+            self._status.accumulate_decrypt_time(decrypt_time)
+            return plaintext
+        d.addCallback(_done)
         return d
 
 
-    def _decrypt_segment(self, segment_and_salt):
-        """
-        I take a single segment and its salt, and decrypt it. I return
-        the plaintext of the segment that is in my argument.
-        """
-        segment, salt = segment_and_salt
-        self._set_current_status("decrypting")
-        self.log("decrypting segment %d" % self._current_segment)
-        started = time.time()
-        key = hashutil.ssk_readkey_data_hash(salt, self._node.get_readkey())
-        decryptor = aes.create_decryptor(key)
-        plaintext = aes.decrypt_data(decryptor, segment)
-        self._status.accumulate_decrypt_time(time.time() - started)
-        return plaintext
-
-
     def notify_server_corruption(self, server, shnum, reason):
         if isinstance(reason, str):
             reason = reason.encode("utf-8")
@@ -976,6 +1001,7 @@ class Retrieve(object):
         self._node._populate_required_shares(k)
         self._node._populate_total_shares(N)
 
+        self._discard_readahead()
         if self._verify:
             ret = self._bad_shares
             self.log("done verifying, found %d bad shares" % len(ret))
@@ -1011,6 +1037,7 @@ class Retrieve(object):
 
     def _error(self, f):
         # all errors, including NotEnoughSharesError, land here
+        self._discard_readahead()
         self._running = False
         self._status.set_active(False)
         now = time.time()
@@ -1018,3 +1045,21 @@ class Retrieve(object):
         self._status.timings['fetch'] = now - self._started_fetching
         self._status.set_status("Failed")
         eventually(self._done_deferred.errback, f)
+
+
+def _decode_and_decrypt(decoder, shares, shareids, size, key):
+    """
+    Decode a segment from its blocks with the given CRSDecoder, and decrypt
+    it with the given key. I run in a worker thread, so I must not log or
+    touch the Retrieve. I return (plaintext, decode time, decrypt time).
+    """
+    started = time.time()
+    # CRSDecoder.decode() checks its arguments, decodes, and returns a
+    # Deferred which has already fired, so it is safe to call here
+    buffers = []
+    decoder.decode(shares, shareids).addCallback(buffers.extend)
+    segment = b"".join(buffers)[:size]
+    decoded = time.time()
+    decryptor = aes.create_decryptor(key)
+    plaintext = aes.decrypt_data(decryptor, segment)
+    return (plaintext, decoded - started, time.time() - decoded)
@@ -16,21 +16,23 @@ from six import ensure_str
 import sys, time, copy
 from zope.interface import implementer
 from itertools import count
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from twisted.internet import defer
 from twisted.python import failure
 from foolscap.api import DeadReferenceError, RemoteException, eventually, \
                          fireEventually
 from allmydata.crypto.error import BadSignature
 from allmydata.crypto import rsa
-from allmydata.util import base32, hashutil, log, deferredutil
+from allmydata import hashtree
+from allmydata.util import base32, hashutil, log, deferredutil, mathutil
 from allmydata.util.dictutil import DictOfSets
 from allmydata.storage.server import si_b2a
-from allmydata.interfaces import IServermapUpdaterStatus
+from allmydata.interfaces import IServermapUpdaterStatus, IStatsProducer
 
 from allmydata.mutable.common import MODE_CHECK, MODE_ANYTHING, MODE_WRITE, \
      MODE_READ, MODE_REPAIR, CorruptShareError
 from allmydata.mutable.layout import SIGNED_PREFIX_LENGTH, MDMFSlotReadProxy
+from allmydata.mutable.signatures import verified_signatures
 
 @implementer(IServermapUpdaterStatus)
 class UpdateStatus(object):
@@ -136,8 +138,10 @@ class ServerMap(object):
         self.proxies = {}
         self.update_data = {} # shnum -> [(verinfo,(blockhashes,start,end)),..]
         # where blockhashes is a list of bytestrings (the result of
-        # layout.MDMFSlotReadProxy.get_blockhashes), and start/end are both
-        # (block,salt) tuple-of-bytestrings from get_block_and_salt()
+        # layout.MDMFSlotReadProxy.get_blockhashes), or for a delta update
+        # a dict of just the hashes that the update needs (from
+        # get_some_blockhashes), and start/end are both (block,salt)
+        # tuple-of-bytestrings from get_block_and_salt()
 
     def copy(self):
         s = ServerMap()
@@ -393,12 +397,121 @@ class ServerMap(object):
         self.update_data.setdefault(shnum , []).append((verinfo, data))
 
 
+@implementer(IStatsProducer)
+class ServermapCache(object):
+    """
+    I remember the most recent servermap of each mutable file (and
+    directory) that this gateway has looked at, keyed by storage index, so
+    that operations which happen close together can share one servermap
+    update instead of each one querying every server. A web client that
+    lists the same directory many times a second, for example, only causes
+    one round of queries per max_age seconds.
+
+    A cached servermap may be out of date: another client may have
+    published a newer version since it was made. Reads from such a map get
+    the older version, and writes from it fail with
+    UncoordinatedWriteError and are retried with a fresh map, as they
+    would be if the other client had published a moment later. Publishing
+    through this gateway forgets the servermap of the file being published.
+
+    max_age (in seconds) is how old a servermap may be and still be used.
+    Callers can override it for a single operation. With a max_age of 0
+    servermaps are still remembered (so that such an override has
+    something to use) but never used otherwise.
+    """
+
+    MAX_ENTRIES = 1000
+
+    # the update modes whose servermaps are good enough for an operation
+    # that wants a servermap updated in a given mode. MODE_CHECK and
+    # MODE_REPAIR always query the servers.
+    USABLE_MODES = {
+        MODE_ANYTHING: (MODE_ANYTHING, MODE_READ, MODE_WRITE, MODE_CHECK),
+        MODE_READ: (MODE_READ, MODE_WRITE, MODE_CHECK),
+        MODE_WRITE: (MODE_WRITE,),
+    }
+
+    def __init__(self, max_age=0, max_entries=MAX_ENTRIES):
+        self.max_age = max_age
+        self._max_entries = max_entries
+        # storage index -> (ServerMap, verification key), least recently
+        # used first
+        self._entries = OrderedDict()
+        self._hits = 0
+        self._misses = 0
+        self._invalidations = 0
+
+    def _now(self):
+        return time.time()
+
+    def get(self, storage_index, mode, max_age=None):
+        """
+        Return a copy of the servermap for storage_index, if I have one that
+        was updated in a mode that will do for mode and is no older than
+        max_age seconds (my own max_age if that is None), and that found a
+        recoverable version. Otherwise return None.
+
+        :returns: (ServerMap, verification key) or None
+        """
+        if max_age is None:
+            max_age = self.max_age
+        entry = self._entries.get(storage_index)
+        if entry is None or max_age <= 0:
+            self._misses += 1
+            return None
+        (servermap, pubkey) = entry
+        (update_mode, when) = servermap.get_last_update()
+        if (update_mode not in self.USABLE_MODES.get(mode, ())
+            or self._now() - when > max_age
+            or not servermap.recoverable_versions()):
+            self._misses += 1
+            return None
+        self._hits += 1
+        self._entries.move_to_end(storage_index)
+        return (self._copy(servermap), pubkey)
+
+    def put(self, storage_index, servermap, pubkey):
+        """Remember (a copy of) a servermap that was just updated, and the
+        verification key of its file."""
+        self._entries[storage_index] = (self._copy(servermap), pubkey)
+        self._entries.move_to_end(storage_index)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, storage_index):
+        """Forget the servermap for storage_index."""
+        if self._entries.pop(storage_index, None) is not None:
+            self._invalidations += 1
+
+    def _copy(self, servermap):
+        # the read proxies hold the share data fetched by the update, which
+        # lets a small file be retrieved without asking the servers again
+        s = servermap.copy()
+        s.proxies = servermap.proxies.copy()
+        return s
+
+    def get_stats(self):
+        return {
+            'mutable.servermap_cache.entries': len(self._entries),
+            'mutable.servermap_cache.hits': self._hits,
+            'mutable.servermap_cache.misses': self._misses,
+            'mutable.servermap_cache.invalidations': self._invalidations,
+        }
+
+
 class ServermapUpdater(object):
     def __init__(self, filenode, storage_broker, monitor, servermap,
-                 mode=MODE_READ, add_lease=False, update_range=None):
+                 mode=MODE_READ, add_lease=False, update_range=None,
+                 delta_update=False):
         """I update a servermap, locating a sufficient number of useful
         shares and remembering where they are located.
 
+        If update_range is (start_segment, end_segment), I also fetch those
+        two segments of each share, and its block hash tree, for an
+        in-place update. If delta_update is True, the update will rewrite
+        just the segments from start_segment to end_segment, so I only
+        fetch the block hashes needed to validate those two segments and
+        to recompute the root of the tree (see Publish.update).
         """
 
         self._node = filenode
@@ -459,6 +572,7 @@ class ServermapUpdater(object):
             self.start_segment = update_range[0]
             self.end_segment = update_range[1]
             self.fetch_update_data = True
+        self.delta_update = delta_update
 
         prefix = si_b2a(self._storage_index)[:5]
         self._log_number = log.msg(format="SharemapUpdater(%(si)s): starting (%(mode)s)",
@@ -758,7 +872,12 @@ class ServermapUpdater(object):
                 # make the two routines share the value without
                 # introducing more roundtrips?
                 ds.append(reader.get_verinfo())
-                ds.append(reader.get_blockhashes())
+                if self.delta_update:
+                    d6 = reader.get_verinfo()
+                    d6.addCallback(self._fetch_update_blockhashes, reader)
+                    ds.append(d6)
+                else:
+                    ds.append(reader.get_blockhashes())
                 ds.append(reader.get_block_and_salt(self.start_segment))
                 ds.append(reader.get_block_and_salt(self.end_segment))
                 d5 = deferredutil.gatherResults(ds)
@@ -866,15 +985,39 @@ class ServermapUpdater(object):
          offsets_tuple) = verinfo
 
 
-        if verinfo not in self._valid_versions:
-            # This is a new version tuple, and we need to validate it
-            # against the public key before keeping track of it.
-            assert self._node.get_pubkey()
-            try:
-                rsa.verify_signature(self._node.get_pubkey(), signature[1], prefix)
-            except BadSignature:
-                raise CorruptShareError(server, shnum,
-                                        "signature is invalid")
+        if verinfo in self._valid_versions:
+            return self._got_valid_version(verinfo, shnum, server, lp)
+
+        # This is a new version tuple, and we need to validate it
+        # against the public key before keeping track of it. Signatures
+        # that have been checked before (by this or an earlier update) are
+        # not checked again.
+        assert self._node.get_pubkey()
+        d = verified_signatures.verify(self._node.get_fingerprint(),
+                                       self._node.get_pubkey(),
+                                       signature[1], prefix)
+        def _bad_signature(f):
+            f.trap(BadSignature)
+            raise CorruptShareError(server, shnum,
+                                    "signature is invalid")
+        d.addErrback(_bad_signature)
+        d.addCallback(lambda ignored:
+                      self._got_valid_version(verinfo, shnum, server, lp))
+        return d
+
+    def _got_valid_version(self, verinfo, shnum, server, lp):
+        if not self._running:
+            self.log("but we're not running anymore.")
+            return None
+        (seqnum,
+         root_hash,
+         saltish,
+         segsize,
+         datalen,
+         k,
+         n,
+         prefix,
+         offsets_tuple) = verinfo
 
         # ok, it's a valid verinfo. Add it to the list of validated
         # versions.
@@ -929,6 +1072,22 @@ class ServermapUpdater(object):
                    offsets_tuple)
         return verinfo
 
+    def _fetch_update_blockhashes(self, verinfo, reader):
+        """
+        For a delta update, I fetch the hashes that validate the first and
+        last segments of the update against the root of the block hash
+        tree. Since the segments between them are contiguous, these also
+        include every hash that is needed to recompute the root once all
+        of those segments have been rewritten.
+        """
+        segsize, datalen = verinfo[3], verinfo[4]
+        num_segments = mathutil.div_ceil(datalen, segsize)
+        t = hashtree.IncompleteHashTree(num_segments)
+        needed = t.needed_hashes(self.start_segment)
+        needed |= t.needed_hashes(self.end_segment)
+        needed.add(0)
+        return reader.get_some_blockhashes(needed)
+
     def _got_update_results_one_share(self, results, share):
         """
         I record the update results in results.
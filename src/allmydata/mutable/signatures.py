@@ -0,0 +1,99 @@
+"""
+RSA signatures for mutable files, made and checked off the reactor.
+
+Publishing a mutable file signs its prefix with the file's RSA signing key,
+and every servermap update checks the signature on each new version it
+sees. Both are done in the reactor's thread pool rather than on the reactor
+itself.
+
+Checking the same signature over and over is wasted work: reading a
+directory that is listed many times a second updates its servermap each
+time, and finds the same version, with the same signature, every time. A
+VerifiedSignatures instance remembers which (verification key, signed
+data, signature) triples it has already checked (as hashes, and only a
+bounded number of them), and checks each of them only once even when
+several shares carrying it arrive together.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from collections import OrderedDict
+
+from twisted.internet import defer, threads
+
+from allmydata.crypto import rsa
+from allmydata.util import hashutil, observer
+
+# not part of any protocol: this only names cache entries
+_VERIFIED_SIGNATURE_TAG = b"allmydata_mutable_verified_signature_v1"
+
+
+def sign_data(privkey, data):
+    """
+    Sign data with an RSA signing key, in a worker thread.
+
+    :returns: a Deferred that fires with the signature
+    """
+    return threads.deferToThread(rsa.sign_data, privkey, data)
+
+
+class VerifiedSignatures(object):
+    """I check RSA signatures in a worker thread, and remember the ones that
+    were valid."""
+
+    MAX_ENTRIES = 10000
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self._max_entries = max_entries
+        # (verification key hash, hash of data and signature) -> None, least
+        # recently used first
+        self._verified = OrderedDict()
+        # the same -> OneShotObserverList, for checks still in progress
+        self._pending = {}
+        self.hits = 0
+        self.verifications = 0
+
+    def verify(self, verification_key_hash, pubkey, signature, data):
+        """
+        Check that signature is a valid signature of data by pubkey.
+
+        :param bytes verification_key_hash: the fingerprint of pubkey (a
+            mutable file's fingerprint), which identifies it in the cache
+
+        :returns: a Deferred that fires with None if the signature is
+            valid, or fails with BadSignature if it is not
+        """
+        key = (verification_key_hash,
+               hashutil.tagged_pair_hash(_VERIFIED_SIGNATURE_TAG, data, signature))
+        if key in self._verified:
+            self.hits += 1
+            self._verified.move_to_end(key)
+            return defer.succeed(None)
+        if key in self._pending:
+            self.hits += 1
+            return self._pending[key].when_fired()
+        self.verifications += 1
+        waiting = self._pending[key] = observer.OneShotObserverList()
+        d = threads.deferToThread(rsa.verify_signature, pubkey, signature, data)
+        def _verified(res):
+            self._verified[key] = None
+            while len(self._verified) > self._max_entries:
+                self._verified.popitem(last=False)
+            return None
+        d.addCallback(_verified)
+        def _done(res):
+            del self._pending[key]
+            waiting.fire(res)
+        d.addBoth(_done)
+        return waiting.when_fired()
+
+
+# All mutable files share this cache: a signature that has been checked once
+# is valid for everybody.
+verified_signatures = VerifiedSignatures()
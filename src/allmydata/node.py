@@ -72,6 +72,7 @@ def _common_valid_config():
             "tub.port",
             "web.port",
             "web.static",
+            "web.workers",
         ),
         "i2p": (
             "enabled",
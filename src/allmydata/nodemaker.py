@@ -13,13 +13,15 @@ if PY2:
 import weakref
 from zope.interface import implementer
 from allmydata.util.assertutil import precondition
+from allmydata.util.observer import ObserverList
 from allmydata.interfaces import INodeMaker
 from allmydata.immutable.literal import LiteralFileNode
 from allmydata.immutable.filenode import ImmutableFileNode, CiphertextFileNode
 from allmydata.immutable.upload import Data
 from allmydata.mutable.filenode import MutableFileNode
 from allmydata.mutable.publish import MutableData
-from allmydata.dirnode import DirectoryNode, pack_children
+from allmydata.dirnode import DirectoryNode, ParsedDirectoryCache, \
+     pack_children
 from allmydata.unknown import UnknownNode
 from allmydata.blacklist import ProhibitedNode
 from allmydata import uri
@@ -31,7 +33,9 @@ class NodeMaker(object):
     def __init__(self, storage_broker, secret_holder, history,
                  uploader, terminator,
                  default_encoding_parameters, mutable_file_default,
-                 key_generator, blacklist=None):
+                 key_generator, blacklist=None, download_parameters=None,
+                 servermap_cache=None, traversal_parameters=None,
+                 check_index=None, write_lock=None):
         self.storage_broker = storage_broker
         self.secret_holder = secret_holder
         self.history = history
@@ -41,21 +45,34 @@ class NodeMaker(object):
         self.mutable_file_default = mutable_file_default
         self.key_generator = key_generator
         self.blacklist = blacklist
+        self.download_parameters = download_parameters
+        self.servermap_cache = servermap_cache
+        self.traversal_parameters = traversal_parameters
+        self.check_index = check_index
+        # serializes the mutable-file writes of a multi-process gateway
+        self.write_lock = write_lock
 
         self._node_cache = weakref.WeakValueDictionary() # uri -> node
+        self.parsed_directories = ParsedDirectoryCache()
+        # notified with the storage index of each directory that is
+        # modified through this gateway
+        self.directory_changes = ObserverList()
 
     def _create_lit(self, cap):
         return LiteralFileNode(cap)
     def _create_immutable(self, cap):
         return ImmutableFileNode(cap, self.storage_broker, self.secret_holder,
-                                 self.terminator, self.history)
+                                 self.terminator, self.history,
+                                 self.download_parameters)
     def _create_immutable_verifier(self, cap):
         return CiphertextFileNode(cap, self.storage_broker, self.secret_holder,
-                                  self.terminator, self.history)
+                                  self.terminator, self.history,
+                                  self.download_parameters)
     def _create_mutable(self, cap):
         n = MutableFileNode(self.storage_broker, self.secret_holder,
                             self.default_encoding_parameters,
-                            self.history)
+                            self.history, self.servermap_cache,
+                            self.download_parameters, self.write_lock)
         return n.init_from_cap(cap)
     def _create_dirnode(self, filenode):
         return DirectoryNode(filenode, self, self.uploader)
@@ -130,7 +147,9 @@ class NodeMaker(object):
         if version is None:
             version = self.mutable_file_default
         n = MutableFileNode(self.storage_broker, self.secret_holder,
-                            self.default_encoding_parameters, self.history)
+                            self.default_encoding_parameters, self.history,
+                            self.servermap_cache, self.download_parameters,
+                            self.write_lock)
         d = self.key_generator.generate()
         d.addCallback(n.create_with_keys, contents, version=version)
         d.addCallback(lambda res: n)
@@ -25,10 +25,6 @@ from allmydata.scripts.common import (
     BaseOptions,
     BasedirOptions,
 )
-from allmydata.storage import (
-    crawler,
-    expirer,
-)
 
 class GenerateKeypairOptions(BaseOptions):
 
@@ -95,6 +91,7 @@ class MigrateCrawlerOptions(BasedirOptions):
 
 
 def migrate_crawler(options):
+    from allmydata.storage import crawler, expirer
     out = options.stdout
     storage = FilePath(options['basedir']).child("storage")
 
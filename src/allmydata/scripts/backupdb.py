@@ -13,7 +13,7 @@ if PY2:
 import os.path, sys, time, random, stat
 
 from allmydata.util.netstring import netstring
-from allmydata.util.hashutil import backupdb_dirhash
+from allmydata.util.hashutil import backupdb_dirhash, backupdb_chunkhash
 from allmydata.util import base32
 from allmydata.util.fileutil import abspath_expanduser_unicode
 from allmydata.util.encodingutil import to_bytes
@@ -26,7 +26,7 @@ MONTH = 30*DAY
 SCHEMA_v1 = """
 CREATE TABLE version -- added in v1
 (
- version INTEGER  -- contains one row, set to 2
+ version INTEGER  -- contains one row, set to 3
 );
 
 CREATE TABLE local_files -- added in v1
@@ -71,18 +71,37 @@ UPDATE_v1_to_v2 = TABLE_DIRECTORY + """
 UPDATE version SET version=2;
 """
 
+TABLE_CHUNKS = """
+
+CREATE TABLE chunks -- added in v3
+(
+ chunkhash varchar(256) PRIMARY KEY, -- base32(chunkhash)
+ chunkcap varchar(256),              -- URI:CHK:... or URI:LIT:...
+ last_uploaded TIMESTAMP,
+ last_checked TIMESTAMP
+);
+
+"""
+
+SCHEMA_v3 = SCHEMA_v2 + TABLE_CHUNKS
+
+UPDATE_v2_to_v3 = TABLE_CHUNKS + """
+UPDATE version SET version=3;
+"""
+
 UPDATERS = {
     2: UPDATE_v1_to_v2,
+    3: UPDATE_v2_to_v3,
 }
 
 def get_backupdb(dbfile, stderr=sys.stderr,
-                 create_version=(SCHEMA_v2, 2), just_create=False):
+                 create_version=(SCHEMA_v3, 3), just_create=False):
     # Open or create the given backupdb file. The parent directory must
     # exist.
     try:
         (sqlite3, db) = get_db(dbfile, stderr, create_version, updaters=UPDATERS,
                                just_create=just_create, dbname="backupdb")
-        return BackupDB_v2(sqlite3, db)
+        return BackupDB_v3(sqlite3, db)
     except DBError as e:
         print(e, file=stderr)
         return None
@@ -138,15 +157,105 @@ class DirectoryResult(object):
         self.bdb.did_check_directory_healthy(self.dircap, results)
 
 
-class BackupDB_v2(object):
-    VERSION = 2
+class ChunkResult(object):
+    def __init__(self, bdb, chunkhash, chunkcap, should_check):
+        self.bdb = bdb
+        self.chunkhash = chunkhash
+        self.chunkcap = chunkcap
+        self.should_check_p = should_check
+
+    def was_uploaded(self):
+        if self.chunkcap:
+            return self.chunkcap
+        return False
+
+    def did_upload(self, chunkcap):
+        self.bdb.did_upload_chunk(chunkcap, self.chunkhash)
+
+    def should_check(self):
+        return self.should_check_p
+
+    def did_check_healthy(self, results):
+        self.bdb.did_check_chunk_healthy(self.chunkcap, results)
+
+
+class BackupDB_v3(object):
+    VERSION = 3
     NO_CHECK_BEFORE = 1*MONTH
     ALWAYS_CHECK_AFTER = 2*MONTH
 
+    # changes are committed in batches, of at most this many changes and
+    # at most this many seconds apart. Call commit() when you are done.
+    COMMIT_EVERY = 1000
+    COMMIT_INTERVAL = 10
+
+    # sqlite limits the number of parameters of a statement (to 999 in
+    # older versions)
+    LOOKUP_BATCH = 500
+
     def __init__(self, sqlite_module, connection):
         self.sqlite_module = sqlite_module
         self.connection = connection
         self.cursor = connection.cursor()
+        # with a write-ahead log, a commit appends to the log instead of
+        # rewriting the database, and need not wait for the disk twice
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        self.cursor.execute("PRAGMA synchronous=NORMAL")
+        self._uncommitted = 0
+        self._last_commit = time.time()
+        # absolute path -> local_files row joined with its cap and
+        # last_upload rows (or None), looked up ahead of check_file()
+        self._prefetched = {}
+
+    def _changed(self):
+        self._uncommitted += 1
+        if (self._uncommitted >= self.COMMIT_EVERY
+            or time.time() - self._last_commit >= self.COMMIT_INTERVAL):
+            self.commit()
+
+    def commit(self):
+        """Commit the changes I have not committed yet."""
+        self.connection.commit()
+        self._uncommitted = 0
+        self._last_commit = time.time()
+
+    def _should_check(self, age):
+        # something uploaded or checked this many seconds ago is checked
+        # with a probability that grows from 0 to 1 between NO_CHECK_BEFORE
+        # and ALWAYS_CHECK_AFTER
+        probability = ((age - self.NO_CHECK_BEFORE) /
+                       (self.ALWAYS_CHECK_AFTER - self.NO_CHECK_BEFORE))
+        probability = min(max(probability, 0.0), 1.0)
+        return bool(random.random() < probability)
+
+    def _lookup_files(self, paths):
+        # return a dict that maps each of the absolute paths I know about
+        # to (size, mtime, ctime, filecap, last_checked). filecap and
+        # last_checked are None if I have forgotten where the file went.
+        found = {}
+        paths = list(paths)
+        for i in range(0, len(paths), self.LOOKUP_BATCH):
+            batch = paths[i:i+self.LOOKUP_BATCH]
+            self.cursor.execute(
+                "SELECT local_files.path, local_files.size, local_files.mtime,"
+                " local_files.ctime, caps.filecap, last_upload.last_checked"
+                " FROM local_files"
+                " LEFT JOIN caps ON caps.fileid=local_files.fileid"
+                " LEFT JOIN last_upload ON last_upload.fileid=local_files.fileid"
+                " WHERE local_files.path IN (%s)" % ",".join("?" * len(batch)),
+                batch)
+            for row in self.cursor.fetchall():
+                found[row[0]] = row[1:]
+        return found
+
+    def prefetch_files(self, paths):
+        """Look up what I know about all of the given local files (typically
+        those of one directory) at once, so that the check_file() calls for
+        them need not query the database one at a time."""
+        paths = [abspath_expanduser_unicode(path) for path in paths]
+        found = self._lookup_files(paths)
+        for path in paths:
+            self._prefetched[path] = found.get(path)
 
     def check_file(self, path, use_timestamps=True):
         """I will tell you if a given local file needs to be uploaded or not,
@@ -192,48 +301,36 @@ class BackupDB_v2(object):
         mtime = s[stat.ST_MTIME]
 
         now = time.time()
-        c = self.cursor
 
-        c.execute("SELECT size,mtime,ctime,fileid"
-                  " FROM local_files"
-                  " WHERE path=?",
-                  (path,))
-        row = self.cursor.fetchone()
+        if path in self._prefetched:
+            row = self._prefetched.pop(path)
+        else:
+            row = self._lookup_files([path]).get(path)
         if not row:
             return FileResult(self, None, False, path, mtime, ctime, size)
-        (last_size,last_mtime,last_ctime,last_fileid) = row
-
-        c.execute("SELECT caps.filecap, last_upload.last_checked"
-                  " FROM caps,last_upload"
-                  " WHERE caps.fileid=? AND last_upload.fileid=?",
-                  (last_fileid, last_fileid))
-        row2 = c.fetchone()
+        (last_size, last_mtime, last_ctime, filecap, last_checked) = row
 
         if ((last_size != size
              or not use_timestamps
              or last_mtime != mtime
              or last_ctime != ctime) # the file has been changed
-            or (not row2) # we somehow forgot where we put the file last time
+            or None in (filecap, last_checked) # we somehow forgot where we
+                                               # put the file last time
             ):
-            c.execute("DELETE FROM local_files WHERE path=?", (path,))
-            self.connection.commit()
+            self.cursor.execute("DELETE FROM local_files WHERE path=?", (path,))
+            self._changed()
             return FileResult(self, None, False, path, mtime, ctime, size)
 
         # at this point, we're allowed to assume the file hasn't been changed
-        (filecap, last_checked) = row2
         age = now - last_checked
-
-        probability = ((age - self.NO_CHECK_BEFORE) /
-                       (self.ALWAYS_CHECK_AFTER - self.NO_CHECK_BEFORE))
-        probability = min(max(probability, 0.0), 1.0)
-        should_check = bool(random.random() < probability)
+        should_check = self._should_check(age)
 
         return FileResult(self, to_bytes(filecap), should_check,
                           path, mtime, ctime, size)
 
     def get_or_allocate_fileid_for_cap(self, filecap):
         # find an existing fileid for this filecap, or insert a new one. The
-        # caller is required to commit() afterwards.
+        # caller is required to call _changed() afterwards.
 
         # mysql has "INSERT ... ON DUPLICATE KEY UPDATE", but not sqlite
         # sqlite has "INSERT ON CONFLICT REPLACE", but not mysql
@@ -270,7 +367,7 @@ class BackupDB_v2(object):
                                 " SET size=?, mtime=?, ctime=?, fileid=?"
                                 " WHERE path=?",
                                 (size, mtime, ctime, fileid, path))
-        self.connection.commit()
+        self._changed()
 
     def did_check_file_healthy(self, filecap, results):
         now = time.time()
@@ -279,7 +376,7 @@ class BackupDB_v2(object):
                             " SET last_checked=?"
                             " WHERE fileid=?",
                             (now, fileid))
-        self.connection.commit()
+        self._changed()
 
     def check_directory(self, contents):
         """I will tell you if a new directory needs to be created for a given
@@ -325,11 +422,7 @@ class BackupDB_v2(object):
             return DirectoryResult(self, dirhash_s, None, False)
         (dircap, last_checked) = row
         age = now - last_checked
-
-        probability = ((age - self.NO_CHECK_BEFORE) /
-                       (self.ALWAYS_CHECK_AFTER - self.NO_CHECK_BEFORE))
-        probability = min(max(probability, 0.0), 1.0)
-        should_check = bool(random.random() < probability)
+        should_check = self._should_check(age)
 
         return DirectoryResult(self, dirhash_s, to_bytes(dircap), should_check)
 
@@ -340,7 +433,7 @@ class BackupDB_v2(object):
         # update the record in place. Otherwise create a new record.)
         self.cursor.execute("REPLACE INTO directories VALUES (?,?,?,?)",
                             (dirhash, dircap, now, now))
-        self.connection.commit()
+        self._changed()
 
     def did_check_directory_healthy(self, dircap, results):
         now = time.time()
@@ -348,4 +441,42 @@ class BackupDB_v2(object):
                             " SET last_checked=?"
                             " WHERE dircap=?",
                             (now, dircap))
-        self.connection.commit()
+        self._changed()
+
+    def check_chunk(self, data):
+        """I will tell you if a chunk of a large file (see
+        allmydata.util.chunking) needs to be uploaded, or if I know of an
+        immutable file which holds the same bytes.
+
+        I return a ChunkResult object, synchronously, which is used like the
+        FileResult of check_file(): upload the chunk if r.was_uploaded()
+        returns False (and call r.did_upload(chunkcap) afterwards), check
+        the chunkcap it returns if r.should_check() says so (and call
+        r.did_check_healthy(checker_results) if it is healthy), and reuse it
+        otherwise.
+        """
+        now = time.time()
+        chunkhash_s = base32.b2a(backupdb_chunkhash(data))
+        c = self.cursor
+        c.execute("SELECT chunkcap, last_checked"
+                  " FROM chunks WHERE chunkhash=?", (chunkhash_s,))
+        row = c.fetchone()
+        if not row:
+            return ChunkResult(self, chunkhash_s, None, False)
+        (chunkcap, last_checked) = row
+        should_check = self._should_check(now - last_checked)
+        return ChunkResult(self, chunkhash_s, to_bytes(chunkcap), should_check)
+
+    def did_upload_chunk(self, chunkcap, chunkhash):
+        now = time.time()
+        self.cursor.execute("REPLACE INTO chunks VALUES (?,?,?,?)",
+                            (chunkhash, chunkcap, now, now))
+        self._changed()
+
+    def did_check_chunk_healthy(self, chunkcap, results):
+        now = time.time()
+        self.cursor.execute("UPDATE chunks"
+                            " SET last_checked=?"
+                            " WHERE chunkcap=?",
+                            (now, chunkcap))
+        self._changed()
@@ -0,0 +1,98 @@
+"""
+Files that 'tahoe backup --chunk-above' split into chunks.
+
+Such a file is stored as an immutable directory with one child per chunk (see
+allmydata.util.chunking), each of them an immutable file whose metadata
+gives the offset of the chunk in the file. The children are named after the
+position of their chunk, but it is the offsets that put them in order.
+"""
+
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from collections import deque
+from urllib.parse import quote as url_quote
+
+from allmydata.scripts.common_http import do_http, HTTPError
+from allmydata.util.encodingutil import to_bytes
+from allmydata.util import jsonbytes as json
+
+CHUNK_OFFSET = "chunk_offset"
+
+
+def chunk_name(index):
+    return "%08d" % (index,)
+
+def is_chunked_file(children):
+    """Return whether the children of a directory, as given by t=json, are
+    the chunks of a file."""
+    return bool(children) and all(
+        ctype == "filenode" and CHUNK_OFFSET in propdict.get("metadata", {})
+        for (ctype, propdict) in children.values())
+
+def chunked_file_size(children):
+    return sum(propdict.get("size") or 0
+               for (ctype, propdict) in children.values())
+
+def get_chunked_file(url):
+    """Return the children of the directory at url (as given by t=json) if
+    it is a chunked file, or None if there is something else there."""
+    resp = do_http("GET", url + "?t=json")
+    if resp.status != 200:
+        return None
+    nodetype, d = json.loads(resp.read())
+    if nodetype == "dirnode" and is_chunked_file(d["children"]):
+        return d["children"]
+    return None
+
+
+class ChunkedFileReader(object):
+    """
+    I read the contents of a chunked file, one chunk after another, like
+    the response to a GET of an ordinary file.
+    """
+
+    def __init__(self, nodeurl, children):
+        self._nodeurl = nodeurl
+        chunks = sorted(children.values(),
+                        key=lambda child: child[1]["metadata"][CHUNK_OFFSET])
+        self._caps = deque(to_bytes(propdict["ro_uri"])
+                           for (ctype, propdict) in chunks)
+        self._resp = None
+
+    def _next_chunk(self):
+        url = self._nodeurl + "uri/" + url_quote(self._caps.popleft())
+        resp = do_http("GET", url)
+        if resp.status != 200:
+            raise HTTPError("Error during GET", resp)
+        return resp
+
+    def read(self, size=-1):
+        pieces = []
+        while size != 0:
+            if self._resp is None:
+                if not self._caps:
+                    break
+                self._resp = self._next_chunk()
+            if size < 0:
+                data = self._resp.read()
+            else:
+                data = self._resp.read(size)
+                size -= len(data)
+            if not data:
+                self._resp.close()
+                self._resp = None
+            pieces.append(data)
+        return b"".join(pieces)
+
+    def close(self):
+        if self._resp is not None:
+            self._resp.close()
+            self._resp = None
+        self._caps.clear()
@@ -22,6 +22,7 @@ from twisted.python import usage
 from allmydata.scripts.common import get_aliases, get_default_nodedir, \
      DEFAULT_ALIAS, BaseOptions
 from allmydata.util.encodingutil import argv_to_unicode, argv_to_abspath, quote_local_unicode_path
+from allmydata.util.abbreviate import parse_abbreviated_size
 from .tahoe_status import TahoeStatusCommand
 
 NODEURL_RE=re.compile("http(s?)://([^:]*)(:([1-9][0-9]*))?")
@@ -183,6 +184,7 @@ class PutOptions(FileStoreOptions):
         ]
     optParameters = [
         ("format", None, None, "Create a file with the given format: SDMF and MDMF for mutable, CHK (default) for immutable. (case-insensitive)"),
+        ("resume-token", None, None, "Make an immutable upload resumable: if it is interrupted, running the same command again with the same token carries on where it left off. (up to 64 letters, digits, '-' and '_')"),
         ]
 
     def parseArgs(self, arg1=None, arg2=None):
@@ -197,6 +199,12 @@ class PutOptions(FileStoreOptions):
         if self['format']:
             if self['format'].upper() not in ("SDMF", "MDMF", "CHK"):
                 raise usage.UsageError("%s is an invalid format" % self['format'])
+        if self['resume-token']:
+            if self['mutable'] or (self['format'] or "CHK").upper() != "CHK":
+                raise usage.UsageError("--resume-token only applies to immutable uploads")
+            from allmydata.immutable.journal import is_valid_resume_token
+            if not is_valid_resume_token(self['resume-token']):
+                raise usage.UsageError("%s is an invalid resume token" % self['resume-token'])
 
     synopsis = "[options] LOCAL_FILE REMOTE_FILE"
 
@@ -221,6 +229,7 @@ class PutOptions(FileStoreOptions):
      % tahoe put bar FOO                   # copy local 'bar' to tahoe:FOO
      % tahoe put bar tahoe:FOO             # same
      % tahoe put bar MUTABLE-FILE-WRITECAP # modify the mutable file in-place
+     % tahoe put --resume-token=bar-1 bar FOO  # can be re-run if interrupted
     """
 
 class CpOptions(FileStoreOptions):
@@ -231,10 +240,15 @@ class CpOptions(FileStoreOptions):
          "When copying to local files, write out filecaps instead of actual "
          "data (only useful for debugging and tree-comparison purposes)."),
         ]
+    optParameters = [
+        ("jobs", "j", 1, "Copy this many files at once.", int),
+        ]
 
     def parseArgs(self, *args):
         if len(args) < 2:
             raise usage.UsageError("cp requires at least two arguments")
+        if self["jobs"] < 1:
+            raise usage.UsageError("--jobs must be at least 1")
         self.sources = [argv_to_unicode(arg) for arg in args[:-1]]
         self.destination = argv_to_unicode(args[-1])
 
@@ -268,6 +282,11 @@ class CpOptions(FileStoreOptions):
     directories with names are referring to the directory as a whole, and
     source directories without names (e.g. a raw dircap) are referring to the
     contents.
+
+    When copying many files, --jobs=N copies N of them at once, which is
+    much faster when the files are small. New Tahoe-side directories are
+    created together with their contents, once all of the files have been
+    copied.
     """
 
 class UnlinkOptions(FileStoreOptions):
@@ -277,6 +296,21 @@ class UnlinkOptions(FileStoreOptions):
     synopsis = "[options] REMOTE_FILE"
     description = "Remove a named file from its parent directory."
 
+class ShardDirectoryOptions(FileStoreOptions):
+    def parseArgs(self, where):
+        self.where = argv_to_unicode(where)
+
+    synopsis = "[options] REMOTE_DIR"
+    description = """
+    Convert a (mutable) directory into a sharded directory, in place. A
+    sharded directory spreads its children over a tree of mutable files, so
+    that adding, changing or removing one child of a directory with very many
+    children only rewrites a small part of it. The directory keeps its caps.
+
+    Clients which do not know about sharded directories (Tahoe-LAFS 1.17 and
+    earlier) cannot read the directory once it has been converted, and there
+    is no way to convert it back."""
+
 class MvOptions(FileStoreOptions):
     def parseArgs(self, frompath, topath):
         self.from_file = argv_to_unicode(frompath)
@@ -333,6 +367,10 @@ class BackupOptions(FileStoreOptions):
         ("verbose", "v", "Be noisy about what is happening."),
         ("ignore-timestamps", None, "Do not use backupdb timestamps to decide whether a local file is unchanged."),
         ]
+    optParameters = [
+        ("jobs", "j", 1, "Upload (or check) this many files at once.", int),
+        ("chunk-above", None, None, "Split files larger than this (e.g. 100MiB) into content-defined chunks, and upload only the chunks that changed.", parse_abbreviated_size),
+        ]
 
     vcs_patterns = ('CVS', 'RCS', 'SCCS', '.git', '.gitignore', '.cvsignore',
                     '.svn', '.arch-ids','{arch}', '=RELEASE-ID',
@@ -344,6 +382,8 @@ class BackupOptions(FileStoreOptions):
         self['exclude'] = set()
 
     def parseArgs(self, localdir, topath):
+        if self["jobs"] < 1:
+            raise usage.UsageError("--jobs must be at least 1")
         self.from_dir = argv_to_abspath(localdir)
         self.to_dir = argv_to_unicode(topath)
 
@@ -396,7 +436,11 @@ class BackupOptions(FileStoreOptions):
     files and directories as possible with earlier backups. Create TO/Latest
     as a reference to the latest backup. Behaves somewhat like 'rsync -a
     --link-dest=TO/Archives/(previous) FROM TO/Archives/(new); ln -sf
-    TO/Archives/(new) TO/Latest'."""
+    TO/Archives/(new) TO/Latest'.
+
+    With --chunk-above, a large file is stored as an immutable directory of
+    its chunks, so that a small change to it costs a small upload. 'tahoe
+    get' and 'tahoe cp' put the chunks back together."""
 
 class WebopenOptions(FileStoreOptions):
     optFlags = [
@@ -463,6 +507,9 @@ class DeepCheckOptions(FileStoreOptions):
         ("add-lease", None, "Add/renew lease on all shares."),
         ("verbose", "v", "Be noisy about what is happening."),
         ]
+    optParameters = [
+        ("recheck-age", None, None, "Do not check again objects that were found healthy less than this many seconds ago (and, for directories, have not changed since). Their earlier results are reported instead.", int),
+        ]
     def parseArgs(self, *locations):
         self.locations = list(map(argv_to_unicode, locations))
 
@@ -470,7 +517,13 @@ class DeepCheckOptions(FileStoreOptions):
     description = """
     Check all files and directories reachable from the given starting point
     (which must be a directory), like 'tahoe check' but for multiple files.
-    Optionally repair any problems found."""
+    Optionally repair any problems found.
+
+    The gateway remembers the results of every check. With --recheck-age,
+    objects that were found healthy recently are not checked again, which
+    makes regular deep-checks of large, mostly unchanging trees much faster.
+    Their leases are not renewed either, so --recheck-age should be well
+    below the lease duration when used with --add-lease."""
 
 subCommands = [
     ("mkdir", None, MakeDirectoryOptions, "Create a new directory."),
@@ -483,6 +536,7 @@ subCommands = [
     ("cp", None, CpOptions, "Copy one or more files or directories."),
     ("unlink", None, UnlinkOptions, "Unlink a file or directory on the grid."),
     ("mv", None, MvOptions, "Move a file within the grid."),
+    ("shard-directory", None, ShardDirectoryOptions, "Convert a large directory into a sharded directory."),
     ("ln", None, LnOptions, "Make an additional link to an existing file or directory."),
     ("backup", None, BackupOptions, "Make target dir look like local dir."),
     ("webopen", None, WebopenOptions, "Open a web browser to a grid file or directory."),
@@ -550,6 +604,11 @@ def unlink(options, command="unlink"):
 def rm(options):
     return unlink(options, command="rm")
 
+def shard_directory(options):
+    from allmydata.scripts import tahoe_shard
+    rc = tahoe_shard.shard_directory(options)
+    return rc
+
 def mv(options):
     from allmydata.scripts import tahoe_mv
     rc = tahoe_mv.mv(options, mode="move")
@@ -606,6 +665,7 @@ dispatch = {
     "unlink": unlink,
     "rm": rm,
     "mv": mv,
+    "shard-directory": shard_directory,
     "ln": ln,
     "backup": backup,
     "webopen": webopen,
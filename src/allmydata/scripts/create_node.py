@@ -21,7 +21,7 @@ try:
 except ImportError:
     pass
 
-from twisted.internet import reactor, defer
+from twisted.internet import defer
 from twisted.python.usage import UsageError
 from twisted.python.filepath import (
     FilePath,
@@ -35,7 +35,11 @@ from allmydata.scripts.common import (
 from allmydata.scripts.default_nodedir import _default_nodedir
 from allmydata.util.assertutil import precondition
 from allmydata.util.encodingutil import listdir_unicode, argv_to_unicode, quote_local_unicode_path, get_io_encoding
-from allmydata.util import fileutil, i2p_provider, iputil, tor_provider, jsonbytes as json
+from allmydata.util import fileutil, jsonbytes as json
+
+# tor_provider, i2p_provider and iputil bring in much of Foolscap and
+# Twisted, which the other commands need not wait for, so they are only
+# imported when a node is being created.
 
 dummy_tac = """
 import sys
@@ -120,6 +124,7 @@ def validate_where_options(o):
                 raise UsageError("--listen= must be tcp to use --hostname")
 
 def validate_tor_options(o):
+    from allmydata.util import tor_provider
     use_tor = "tor" in o["listen"].split(",")
     if use_tor or any((o["tor-launch"], o["tor-control-port"])):
         if tor_provider._import_txtorcon() is None:
@@ -135,6 +140,7 @@ def validate_tor_options(o):
         raise UsageError("use either --tor-launch or --tor-control-port=, not both")
 
 def validate_i2p_options(o):
+    from allmydata.util import i2p_provider
     use_i2p = "i2p" in o["listen"].split(",")
     if use_i2p or any((o["i2p-launch"], o["i2p-sam-port"])):
         if i2p_provider._import_txi2p() is None:
@@ -159,6 +165,7 @@ class _CreateBaseOptions(BasedirOptions):
     def postOptions(self):
         super(_CreateBaseOptions, self).postOptions()
         if self['hide-ip']:
+            from allmydata.util import i2p_provider, tor_provider
             if tor_provider._import_txtorcon() is None and i2p_provider._import_txi2p() is None:
                 raise UsageError(
                     "--hide-ip was specified but neither 'txtorcon' nor 'txi2p' "
@@ -234,6 +241,7 @@ class CreateIntroducerOptions(NoDefaultBasedirOptions):
 
 @defer.inlineCallbacks
 def write_node_config(c, config):
+    from allmydata.util import i2p_provider, iputil, tor_provider
     # this is shared between clients and introducers
     c.write("# -*- mode: conf; coding: {c.encoding} -*-\n".format(c=c))
     c.write("\n")
@@ -277,6 +285,7 @@ def write_node_config(c, config):
         c.write("tub.port = disabled\n")
         c.write("tub.location = disabled\n")
     else:
+        from twisted.internet import reactor
         if "tor" in listeners:
             (tor_config, tor_port, tor_location) = \
                          yield tor_provider.create_config(reactor, config)
@@ -369,6 +378,7 @@ def write_client_config(c, config):
 
 @defer.inlineCallbacks
 def _get_config_via_wormhole(config):
+    from twisted.internet import reactor
     out = config.stdout
     print("Opening wormhole with code '{}'".format(config['join']), file=out)
     relay_url = config.parent['wormhole-server']
@@ -15,22 +15,15 @@ try:
 except ImportError:
     pass
 
-import struct, time, os, sys
+import struct, time, os
 
 from twisted.python import usage, failure
-from twisted.internet import defer
-from foolscap.logging import cli as foolscap_cli
 
 from allmydata.scripts.common import BaseOptions
-from allmydata import uri
-from allmydata.storage.mutable import MutableShareFile
-from allmydata.storage.immutable import ShareFile
-from allmydata.mutable.layout import unpack_share
-from allmydata.mutable.layout import MDMFSlotReadProxy
-from allmydata.mutable.common import NeedMoreDataError
-from allmydata.immutable.layout import ReadBucketProxy
 from allmydata.util import base32
-from allmydata.util.encodingutil import quote_output
+
+# The share formats, the caps and foolscap.logging take a while to import,
+# so the commands below import what they need when they are run.
 
 class DumpOptions(BaseOptions):
     def getSynopsis(self):
@@ -332,6 +325,7 @@ def dump_SDMF_share(m, length, options):
     print(file=out)
 
 def dump_MDMF_share(m, length, options):
+    from twisted.internet import defer
     from allmydata.mutable.layout import MDMFSlotReadProxy
     from allmydata.util import base32, hashutil
     from allmydata.uri import MDMFVerifierURI
@@ -708,6 +702,7 @@ useful for purpose.
 def call(c, *args, **kwargs):
     # take advantage of the fact that ImmediateReadBucketProxy returns
     # Deferreds that are already fired
+    from twisted.internet import defer
     results = []
     failures = []
     d = defer.maybeDeferred(c, *args, **kwargs)
@@ -717,6 +712,9 @@ def call(c, *args, **kwargs):
     return results[0]
 
 def describe_share(abs_sharefile, si_s, shnum_s, now, out):
+    from allmydata.storage.mutable import MutableShareFile
+    from allmydata.storage.immutable import ShareFile
+    from allmydata.util.encodingutil import quote_output
     with open(abs_sharefile, "rb") as f:
         prefix = f.read(32)
         if MutableShareFile.is_valid_header(prefix):
@@ -727,6 +725,11 @@ def describe_share(abs_sharefile, si_s, shnum_s, now, out):
             print("UNKNOWN really-unknown %s" % quote_output(abs_sharefile), file=out)
 
 def _describe_mutable_share(abs_sharefile, f, now, si_s, out):
+    from twisted.internet import defer
+    from allmydata.storage.mutable import MutableShareFile
+    from allmydata.mutable.layout import unpack_share, MDMFSlotReadProxy
+    from allmydata.mutable.common import NeedMoreDataError
+    from allmydata.util.encodingutil import quote_output
     # mutable share
     m = MutableShareFile(abs_sharefile)
     WE, nodeid = m._read_write_enabler_and_nodeid(f)
@@ -804,6 +807,12 @@ def _describe_mutable_share(abs_sharefile, f, now, si_s, out):
 
 
 def _describe_immutable_share(abs_sharefile, now, si_s, out):
+    from twisted.internet import defer
+    from allmydata import uri
+    from allmydata.storage.immutable import ShareFile
+    from allmydata.immutable.layout import ReadBucketProxy
+    from allmydata.util.encodingutil import quote_output
+
     class ImmediateReadBucketProxy(ReadBucketProxy):
         def __init__(self, sf):
             self.sf = sf
@@ -986,48 +995,14 @@ def trial(config):
     print("'tahoe debug trial' is obsolete. Please run 'tox', or use 'trial' in a virtualenv.", file=config.stderr)
     return 1
 
-def fixOptionsClass(args):
-    (subcmd, shortcut, OptionsClass, desc) = args
-    class FixedOptionsClass(OptionsClass):
-        def getSynopsis(self):
-            t = OptionsClass.getSynopsis(self)
-            i = t.find("Usage: flogtool ")
-            if i >= 0:
-                return "Usage: tahoe [global-options] debug flogtool " + t[i+len("Usage: flogtool "):]
-            else:
-                return "Usage: tahoe [global-options] debug flogtool %s [options]" % (subcmd,)
-    return (subcmd, shortcut, FixedOptionsClass, desc)
-
-class FlogtoolOptions(foolscap_cli.Options):
-    def __init__(self):
-        super(FlogtoolOptions, self).__init__()
-        self.subCommands = list(map(fixOptionsClass, self.subCommands))
-
-    def getSynopsis(self):
-        return "Usage: tahoe [global-options] debug flogtool COMMAND [flogtool-options]"
-
-    def parseOptions(self, all_subargs, *a, **kw):
-        self.flogtool_args = list(all_subargs)
-        return super(FlogtoolOptions, self).parseOptions(self.flogtool_args, *a, **kw)
-
-    def getUsage(self, width=None):
-        t = super(FlogtoolOptions, self).getUsage(width)
-        t += """
-The 'tahoe debug flogtool' command uses the correct imports for this instance
-of Tahoe-LAFS.
-
-Please run 'tahoe debug flogtool COMMAND --help' for more details on each
-subcommand.
-"""
-        return t
-
-    def opt_help(self):
-        print(str(self))
-        sys.exit(0)
+def FlogtoolOptions():
+    # foolscap.logging is only imported for 'tahoe debug flogtool'
+    from allmydata.scripts.flogtool import FlogtoolOptions
+    return FlogtoolOptions()
 
 def flogtool(config):
-    sys.argv = ['flogtool'] + config.flogtool_args
-    return foolscap_cli.run_flogtool()
+    from allmydata.scripts.flogtool import run_flogtool
+    return run_flogtool(config)
 
 
 class DebugCommand(BaseOptions):
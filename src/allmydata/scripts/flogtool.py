@@ -0,0 +1,62 @@
+"""
+The 'tahoe debug flogtool' command, which runs Foolscap's flogtool with the
+imports of this Tahoe-LAFS.
+"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import sys
+
+from foolscap.logging import cli as foolscap_cli
+
+
+def fixOptionsClass(args):
+    (subcmd, shortcut, OptionsClass, desc) = args
+    class FixedOptionsClass(OptionsClass):
+        def getSynopsis(self):
+            t = OptionsClass.getSynopsis(self)
+            i = t.find("Usage: flogtool ")
+            if i >= 0:
+                return "Usage: tahoe [global-options] debug flogtool " + t[i+len("Usage: flogtool "):]
+            else:
+                return "Usage: tahoe [global-options] debug flogtool %s [options]" % (subcmd,)
+    return (subcmd, shortcut, FixedOptionsClass, desc)
+
+class FlogtoolOptions(foolscap_cli.Options):
+    def __init__(self):
+        super(FlogtoolOptions, self).__init__()
+        self.subCommands = list(map(fixOptionsClass, self.subCommands))
+
+    def getSynopsis(self):
+        return "Usage: tahoe [global-options] debug flogtool COMMAND [flogtool-options]"
+
+    def parseOptions(self, all_subargs, *a, **kw):
+        self.flogtool_args = list(all_subargs)
+        return super(FlogtoolOptions, self).parseOptions(self.flogtool_args, *a, **kw)
+
+    def getUsage(self, width=None):
+        t = super(FlogtoolOptions, self).getUsage(width)
+        t += """
+The 'tahoe debug flogtool' command uses the correct imports for this instance
+of Tahoe-LAFS.
+
+Please run 'tahoe debug flogtool COMMAND --help' for more details on each
+subcommand.
+"""
+        return t
+
+    def opt_help(self):
+        print(str(self))
+        sys.exit(0)
+
+
+def run_flogtool(config):
+    sys.argv = ['flogtool'] + config.flogtool_args
+    return foolscap_cli.run_flogtool()
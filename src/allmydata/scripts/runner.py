@@ -7,7 +7,7 @@ from future.utils import PY2
 if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
-import os, sys
+import os, sys, traceback
 from six.moves import StringIO
 from past.builtins import unicode
 import six
@@ -18,11 +18,14 @@ except ImportError:
     pass
 
 from twisted.python import usage
-from twisted.internet import defer, task, threads
 
 from allmydata.scripts.common import get_default_nodedir
+# These modules define the options and the dispatch tables of the
+# subcommands. They import whatever else a subcommand needs only when it is
+# run, so that e.g. 'tahoe ls' does not wait for the reactor, Foolscap and
+# the storage code to be imported.
 from allmydata.scripts import debug, create_node, cli, \
-    admin, tahoe_run, tahoe_invite
+    admin, tahoe_invite
 from allmydata.util.encodingutil import quote_local_unicode_path, argv_to_unicode
 from allmydata.util.eliotutil import (
     opt_eliot_destination,
@@ -47,13 +50,22 @@ if _default_nodedir:
     NODEDIR_HELP += " [default for most commands: " + quote_local_unicode_path(_default_nodedir) + "]"
 
 
+def _run_options():
+    # twistd and the node code take a while to import
+    from allmydata.scripts import tahoe_run
+    return tahoe_run.RunOptions()
+
+def _run(config):
+    from allmydata.scripts import tahoe_run
+    return tahoe_run.run(config)
+
 # XXX all this 'dispatch' stuff needs to be unified + fixed up
 _control_node_dispatch = {
-    "run": tahoe_run.run,
+    "run": _run,
 }
 
 process_control_commands = [
-    ("run", None, tahoe_run.RunOptions, "run a node without daemonizing"),
+    ("run", None, _run_options, "run a node without daemonizing"),
 ]  # type: SubCommands
 
 
@@ -67,7 +79,19 @@ class Options(usage.Options):
     stdout = sys.stdout
     stderr = sys.stderr
 
-    from wormhole import wormhole
+    _wormhole = None
+
+    @property
+    def wormhole(self):
+        if self._wormhole is None:
+            # only 'tahoe invite' and 'tahoe create-client --join' use it
+            from wormhole import wormhole
+            return wormhole
+        return self._wormhole
+
+    @wormhole.setter
+    def wormhole(self, wormhole):
+        self._wormhole = wormhole
 
     subCommands = (     create_node.subCommands
                     +   admin.subCommands
@@ -194,15 +218,25 @@ def parse_or_exit(config, argv, stdout, stderr):
         sys.exit(1)
     return config
 
-def dispatch(config,
-             stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr):
-    command = config.subCommand
+def _sub_options(config, stdin, stdout, stderr):
+    """
+    Give the subcommand's options the streams it should use.
+
+    :return: The subcommand's options.
+    """
     so = config.subOptions
     if config['quiet']:
         stdout = StringIO()
     so.stdout = stdout
     so.stderr = stderr
     so.stdin = stdin
+    return so
+
+def dispatch(config,
+             stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr):
+    from twisted.internet import defer, threads
+    command = config.subCommand
+    so = _sub_options(config, stdin, stdout, stderr)
 
     if command in create_dispatch:
         f = create_dispatch[command]
@@ -232,6 +266,24 @@ def dispatch(config,
     d.addCallback(_raise_sys_exit)
     return d
 
+def _dispatch_blocking(config, stdout, stderr):
+    """
+    Run one of the blocking ``cli.dispatch`` commands directly, without
+    importing or starting the reactor.
+
+    :raise SystemExit: Always, with the command's exit code.
+    """
+    so = _sub_options(config, sys.stdin, stdout, stderr)
+    try:
+        rc = cli.dispatch[config.subCommand](so)
+    except SystemExit:
+        raise
+    except Exception:
+        # Print it the same way _show_exception does for the reactor path.
+        traceback.print_exc(file=stderr)
+        sys.exit(1)
+    sys.exit(rc)
+
 def _maybe_enable_eliot_logging(options, reactor):
     if options.get("destinations"):
         service = eliot_logging_service(reactor, options["destinations"])
@@ -260,12 +312,46 @@ def run(configFactory=Options, argv=sys.argv, stdout=sys.stdout, stderr=sys.stde
     if sys.platform == "win32":
         from allmydata.windows.fixups import initialize
         initialize()
+    # ensure_str() only necessary on Python 2.
+    if six.ensure_str('--coverage') in sys.argv:
+        # Coverage measurement hooks into reactor shutdown.
+        from twisted.internet import task
+        # doesn't return: calls sys.exit(rc)
+        task.react(
+            lambda reactor: _run_with_reactor(
+                reactor,
+                configFactory(),
+                argv,
+                stdout,
+                stderr,
+            ),
+        )
+
+    from twisted.internet import defer
+    try:
+        config = parse_or_exit(
+            configFactory(),
+            list(map(argv_to_unicode, argv)),
+            stdout,
+            stderr,
+        )
+    except SystemExit:
+        raise
+    except Exception:
+        # Report it from the reactor like any other unhandled exception.
+        parsed = defer.fail()
+    else:
+        if config.subCommand in cli.dispatch and not config.get("destinations"):
+            # The blocking commands only talk HTTP to a node, so they need
+            # neither the reactor nor a thread to run in.
+            _dispatch_blocking(config, stdout, stderr)
+        parsed = defer.succeed(config)
+    from twisted.internet import task
     # doesn't return: calls sys.exit(rc)
     task.react(
-        lambda reactor: _run_with_reactor(
+        lambda reactor: _dispatch_with_reactor(
             reactor,
-            configFactory(),
-            argv,
+            parsed,
             stdout,
             stderr,
         ),
@@ -350,6 +436,7 @@ def _run_with_reactor(reactor, config, argv, stdout, stderr):
 
     :return: A ``Deferred`` that fires when the run is complete.
     """
+    from twisted.internet import defer
     _setup_coverage(reactor, argv)
 
     argv = list(map(argv_to_unicode, argv))
@@ -360,6 +447,22 @@ def _run_with_reactor(reactor, config, argv, stdout, stderr):
         stdout,
         stderr,
     )
+    return _dispatch_with_reactor(reactor, d, stdout, stderr)
+
+def _dispatch_with_reactor(reactor, d, stdout, stderr):
+    """
+    Dispatch a command using the given reactor.
+
+    :param reactor: The reactor to use.
+
+    :param Deferred d: Fires with the ``twisted.python.usage.Options`` the
+        argument list was parsed into, or fails if parsing it failed.
+
+    :param stdout: See ``run``.
+    :param stderr: See ``run``.
+
+    :return: A ``Deferred`` that fires when the run is complete.
+    """
     d.addCallback(_maybe_enable_eliot_logging, reactor)
     d.addCallback(dispatch, stdout=stdout, stderr=stderr)
     def _show_exception(f):
@@ -13,6 +13,8 @@ if PY2:
 import os.path
 import time
 from urllib.parse import quote as url_quote
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
 import datetime
 
 from allmydata.scripts.common import get_alias, escape_path, DEFAULT_ALIAS, \
@@ -20,6 +22,8 @@ from allmydata.scripts.common import get_alias, escape_path, DEFAULT_ALIAS, \
 from allmydata.scripts.common_http import do_http, HTTPError, format_http_error
 from allmydata.util import time_format, jsonbytes as json
 from allmydata.scripts import backupdb
+from allmydata.scripts.chunked import CHUNK_OFFSET, chunk_name
+from allmydata.util.chunking import Chunker, AVERAGE_CHUNK_SIZE
 from allmydata.util.encodingutil import listdir_unicode, quote_output, \
      quote_local_unicode_path, to_bytes, FilenameEncodingError, unicode_to_url
 from allmydata.util.assertutil import precondition
@@ -59,6 +63,26 @@ def mkdir(contents, options):
     dircap = to_bytes(resp.read().strip())
     return dircap
 
+def put_data(data, options):
+    url = options['node-url'] + "uri"
+    resp = do_http("PUT", url, data)
+    if resp.status not in (200, 201):
+        raise HTTPError("Error during file PUT", resp)
+    return resp.read().strip()
+
+def check_cap(cap, options):
+    """Check the file or directory, and return the de-JSONized results if
+    it is healthy, or None if it is not (or could not be checked)."""
+    checkurl = options['node-url'] + "uri/%s?t=check&output=JSON" % url_quote(cap)
+    resp = do_http("POST", checkurl)
+    if resp.status != 200:
+        # can't check, so we must assume it's bad
+        return None
+    cr = json.loads(resp.read())
+    if not cr["results"]["healthy"]:
+        return None
+    return cr
+
 def put_child(dirurl, childname, childcap):
     assert dirurl[-1] != "/"
     url = dirurl + "/" + url_quote(unicode_to_url(childname)) + "?t=uri"
@@ -80,6 +104,14 @@ class BackerUpper(object):
         self.options = options
         self._files_checked = 0
         self._directories_checked = 0
+        # the paths of the files still to be backed up, in order, and by
+        # directory (until the backupdb has been asked about them)
+        self._upcoming = deque()
+        self._files_by_directory = {}
+        # (FileUpload, Future) for the files being uploaded or checked
+        # ahead of their turn, in order
+        self._started = deque()
+        self._pool = None
 
     def run(self):
         options = self.options
@@ -132,14 +164,19 @@ class BackerUpper(object):
             listdir_unicode,
             self.options.filter_listdir,
         ))
-        completed = run_backup(
-            warn=self.warn,
-            upload_file=self.upload,
-            upload_directory=self.upload_directory,
-            targets=targets,
-            start_timestamp=start_timestamp,
-            stdout=stdout,
-        )
+        self.start_uploads(targets)
+        try:
+            completed = run_backup(
+                warn=self.warn,
+                upload_file=self.upload,
+                upload_directory=self.upload_directory,
+                targets=targets,
+                start_timestamp=start_timestamp,
+                stdout=stdout,
+            )
+        finally:
+            self.stop_uploads()
+            self.backupdb.commit()
         new_backup_dircap = completed.dircap
 
         # third: attach the new backup to the list
@@ -183,40 +220,6 @@ class BackerUpper(object):
             return False, r.was_created()
 
 
-    def check_backupdb_file(self, childpath):
-        if not self.backupdb:
-            return True, None
-        use_timestamps = not self.options["ignore-timestamps"]
-        r = self.backupdb.check_file(childpath, use_timestamps)
-
-        if not r.was_uploaded():
-            return True, r
-
-        if not r.should_check():
-            # the file was uploaded or checked recently, so we can just use
-            # it
-            return False, r
-
-        # we must check the file before using the results
-        filecap = r.was_uploaded()
-        self.verboseprint("checking %s" % quote_output(filecap))
-        nodeurl = self.options['node-url']
-        checkurl = nodeurl + "uri/%s?t=check&output=JSON" % url_quote(filecap)
-        self._files_checked += 1
-        resp = do_http("POST", checkurl)
-        if resp.status != 200:
-            # can't check, so we must assume it's bad
-            return True, r
-
-        cr = json.loads(resp.read())
-        healthy = cr["results"]["healthy"]
-        if not healthy:
-            # must upload
-            return True, r
-        # file is healthy, no need to upload
-        r.did_check_healthy(cr)
-        return False, r
-
     def check_backupdb_directory(self, compare_contents):
         if not self.backupdb:
             return True, None
@@ -250,37 +253,227 @@ class BackerUpper(object):
         r.did_check_healthy(cr)
         return False, r
 
+    def start_uploads(self, targets):
+        """Get ready to back up the files among targets, in order. With
+        more than one job, the files are uploaded (or checked) in threads,
+        some way ahead of the calls to upload() which ask for them."""
+        by_directory = defaultdict(list)
+        for target in targets:
+            if isinstance(target, FileTarget):
+                self._upcoming.append(target._path)
+                by_directory[os.path.dirname(target._path)].append(target._path)
+        self._files_by_directory = dict(by_directory)
+        if self.options["jobs"] > 1:
+            self._pool = ThreadPoolExecutor(max_workers=self.options["jobs"])
+
+    def stop_uploads(self):
+        for (upload, future) in self._started:
+            future.cancel()
+        self._started.clear()
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+            self._pool = None
+
+    def submit(self, f, *args):
+        """Call f(*args) in a thread of the pool if there is one, or at once
+        if not, and return a Future for the result."""
+        if self._pool is not None:
+            return self._pool.submit(f, *args)
+        future = Future()
+        try:
+            future.set_result(f(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def _prefetch(self, childpath):
+        # ask the backupdb about all of the files in a directory at once
+        paths = self._files_by_directory.pop(os.path.dirname(childpath), None)
+        if paths and self.backupdb:
+            self.backupdb.prefetch_files(paths)
+
+    def _start_more(self):
+        while self._upcoming and len(self._started) < 2 * self.options["jobs"]:
+            path = self._upcoming.popleft()
+            self._prefetch(path)
+            upload = FileUpload(self, path)
+            self._started.append((upload, self._pool.submit(upload.run)))
+
     # This function will raise an IOError exception when called on an unreadable file
     def upload(self, childpath):
         precondition_abspath(childpath)
+        if self._pool is not None:
+            self._start_more()
+        if self._started and self._started[0][0].path == childpath:
+            (upload, future) = self._started.popleft()
+            future.result()
+        else:
+            if self._upcoming and self._upcoming[0] == childpath:
+                self._upcoming.popleft()
+            self._prefetch(childpath)
+            upload = FileUpload(self, childpath)
+            upload.run()
+        return upload.finish()
 
-        #self.verboseprint("uploading %s.." % quote_local_unicode_path(childpath))
-        metadata = get_local_metadata(childpath)
 
-        # we can use the backupdb here
-        must_upload, bdb_results = self.check_backupdb_file(childpath)
+class FileUpload(object):
+    """
+    I back up one file: I look it up in the backupdb, and then reuse it,
+    check it, or upload it. run() does the checking or uploading, and can
+    be called in a thread of its own. The rest uses the backupdb and the
+    output, so it must happen in the thread that made me, one file after
+    another: I am made, and finish() is called, in the order of the backup.
+
+    A file larger than the --chunk-above option is split into chunks, which
+    are looked up in the backupdb one by one, so finish() does the work of
+    uploading it (using the thread pool of the BackerUpper for the chunks).
+    """
 
-        if must_upload:
-            self.verboseprint("uploading %s.." % quote_local_unicode_path(childpath))
-            infileobj = open(childpath, "rb")
-            url = self.options['node-url'] + "uri"
+    REUSE, CHECK, UPLOAD = range(3)
+
+    AVERAGE_CHUNK_SIZE = AVERAGE_CHUNK_SIZE
+
+    def __init__(self, backerupper, path):
+        self.path = path
+        self._backerupper = backerupper
+        self._options = backerupper.options
+        self._error = None
+        self._action = None
+        self._bdb_results = None
+        self._check_results = None
+        self._filecap = None
+        self._checked = False
+        self._chunked = False
+        try:
+            self._metadata = get_local_metadata(path)
+            threshold = self._options["chunk-above"]
+            self._chunked = (threshold is not None
+                             and os.path.getsize(path) > threshold)
+            self._action = self._check_backupdb(backerupper.backupdb)
+        except EnvironmentError as e:
+            self._error = e
+
+    def _check_backupdb(self, bdb):
+        if not bdb:
+            return self.UPLOAD
+        use_timestamps = not self._options["ignore-timestamps"]
+        r = self._bdb_results = bdb.check_file(self.path, use_timestamps)
+        if not r.was_uploaded():
+            return self.UPLOAD
+        if not r.should_check():
+            # the file was uploaded or checked recently, so we can just use
+            # it
+            return self.REUSE
+        if r.was_uploaded().startswith(b"URI:DIR2-CHK:"):
+            # the file was stored in chunks. Splitting it again checks
+            # those of them that are due for it.
+            return self.UPLOAD
+        # we must check the file before using the results
+        return self.CHECK
+
+    def run(self):
+        if self._error is not None:
+            return
+        try:
+            if self._action == self.CHECK:
+                self._check()
+            if self._action == self.UPLOAD and not self._chunked:
+                self._upload()
+        except Exception as e:
+            self._error = e
+
+    def _check(self):
+        self._checked = True
+        self._check_results = check_cap(self._bdb_results.was_uploaded(),
+                                        self._options)
+        if self._check_results is None:
+            # must upload
+            self._action = self.UPLOAD
+
+    def _upload(self):
+        with open(self.path, "rb") as infileobj:
+            url = self._options['node-url'] + "uri"
             resp = do_http("PUT", url, infileobj)
             if resp.status not in (200, 201):
                 raise HTTPError("Error during file PUT", resp)
-
-            filecap = resp.read().strip()
-            self.verboseprint(" %s -> %s" % (quote_local_unicode_path(childpath, quotemarks=False),
-                                             quote_output(filecap, quotemarks=False)))
-            #self.verboseprint(" metadata: %s" % (quote_output(metadata, quotemarks=False),))
-
-            if bdb_results:
-                bdb_results.did_upload(filecap)
-
-            return True, filecap, metadata
-
-        else:
-            self.verboseprint("skipping %s.." % quote_local_unicode_path(childpath))
-            return False, bdb_results.was_uploaded(), metadata
+            self._filecap = resp.read().strip()
+
+    def _upload_chunks(self):
+        bu = self._backerupper
+        bdb = bu.backupdb
+        chunks = [] # (index, offset, chunkcap or Future of it)
+        in_flight = deque() # (ChunkResult, Future), in order
+        uploading = {} # chunkhash -> Future, for repeated chunks
+        uploaded = 0
+        offset = 0
+        with open(self.path, "rb") as f:
+            for (index, data) in enumerate(Chunker(self.AVERAGE_CHUNK_SIZE).chunks(f)):
+                r = bdb.check_chunk(data) if bdb else None
+                chunkcap = r.was_uploaded() if r else False
+                if chunkcap and r.should_check() and not self._check_chunk(r):
+                    chunkcap = False
+                if not chunkcap and r and r.chunkhash in uploading:
+                    chunkcap = uploading[r.chunkhash]
+                elif not chunkcap:
+                    chunkcap = bu.submit(put_data, data, self._options)
+                    in_flight.append((r, chunkcap))
+                    if r:
+                        uploading[r.chunkhash] = chunkcap
+                    uploaded += 1
+                    while len(in_flight) > 2 * self._options["jobs"]:
+                        self._chunk_uploaded(*in_flight.popleft())
+                chunks.append((index, offset, chunkcap))
+                offset += len(data)
+        while in_flight:
+            self._chunk_uploaded(*in_flight.popleft())
+
+        contents = {}
+        for (index, offset, chunkcap) in chunks:
+            if isinstance(chunkcap, Future):
+                chunkcap = chunkcap.result()
+            contents[chunk_name(index)] = ("filenode", chunkcap,
+                                           {CHUNK_OFFSET: offset})
+        bu.verboseprint(" uploaded %d of %d chunks" % (uploaded, len(chunks)))
+        return mkdir(contents, self._options)
+
+    def _chunk_uploaded(self, r, future):
+        chunkcap = future.result()
+        if r:
+            r.did_upload(chunkcap)
+
+    def _check_chunk(self, r):
+        bu = self._backerupper
+        bu.verboseprint("checking %s" % quote_output(r.was_uploaded()))
+        bu._files_checked += 1
+        cr = check_cap(r.was_uploaded(), self._options)
+        if cr is None:
+            return False
+        r.did_check_healthy(cr)
+        return True
+
+    def finish(self):
+        """Return (created, filecap, metadata), or raise the exception
+        that backing up the file ran into."""
+        bu = self._backerupper
+        if self._checked:
+            bu.verboseprint("checking %s" % quote_output(self._bdb_results.was_uploaded()))
+            bu._files_checked += 1
+        if self._action == self.UPLOAD:
+            bu.verboseprint("uploading %s.." % quote_local_unicode_path(self.path))
+        if self._error is not None:
+            raise self._error
+        if self._action == self.UPLOAD and self._chunked:
+            self._filecap = self._upload_chunks()
+        if self._action == self.UPLOAD:
+            bu.verboseprint(" %s -> %s" % (quote_local_unicode_path(self.path, quotemarks=False),
+                                           quote_output(self._filecap, quotemarks=False)))
+            if self._bdb_results:
+                self._bdb_results.did_upload(self._filecap)
+            return True, self._filecap, self._metadata
+        if self._check_results is not None:
+            self._bdb_results.did_check_healthy(self._check_results)
+        bu.verboseprint("skipping %s.." % quote_local_unicode_path(self.path))
+        return False, self._bdb_results.was_uploaded(), self._metadata
 
 
 def backup(options):
@@ -485,8 +678,9 @@ class BackupProgress(object):
         self._directories_reused = 0
         self._directories_skipped = 0
         self.last_dircap = None
-        self._create_contents = {}
-        self._compare_contents = {}
+        # parent directory path -> {childname: contents}
+        self._create_contents = defaultdict(dict)
+        self._compare_contents = defaultdict(dict)
 
     def report(self, now):
         report_format = (
@@ -531,41 +725,34 @@ class BackupProgress(object):
         )
 
     def consume_directory(self, dirpath):
-        return self, {
-            os.path.basename(create_path): create_value
-            for (create_path, create_value)
-            in list(self._create_contents.items())
-            if os.path.dirname(create_path) == dirpath
-        }, {
-            os.path.basename(compare_path): compare_value
-            for (compare_path, compare_value)
-            in list(self._compare_contents.items())
-            if os.path.dirname(compare_path) == dirpath
-        }
+        return (self,
+                self._create_contents.pop(dirpath, {}),
+                self._compare_contents.pop(dirpath, {}))
+
+    def _add_child(self, path, create_value, compare_value):
+        (dirpath, name) = os.path.split(path)
+        self._create_contents[dirpath][name] = create_value
+        self._compare_contents[dirpath][name] = compare_value
 
     def created_directory(self, path, dircap, metadata):
-        self._create_contents[path] = ("dirnode", dircap, metadata)
-        self._compare_contents[path] = dircap
+        self._add_child(path, ("dirnode", dircap, metadata), dircap)
         self._directories_created += 1
         self.last_dircap = dircap
         return self
 
     def reused_directory(self, path, dircap, metadata):
-        self._create_contents[path] = ("dirnode", dircap, metadata)
-        self._compare_contents[path] = dircap
+        self._add_child(path, ("dirnode", dircap, metadata), dircap)
         self._directories_reused += 1
         self.last_dircap = dircap
         return self
 
     def created_file(self, path, cap, metadata):
-        self._create_contents[path] = ("filenode", cap, metadata)
-        self._compare_contents[path] = cap
+        self._add_child(path, ("filenode", cap, metadata), cap)
         self._files_created += 1
         return self
 
     def reused_file(self, path, cap, metadata):
-        self._create_contents[path] = ("filenode", cap, metadata)
-        self._compare_contents[path] = cap
+        self._add_child(path, ("filenode", cap, metadata), cap)
         self._files_reused += 1
         return self
 
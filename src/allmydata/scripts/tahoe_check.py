@@ -326,6 +326,8 @@ class DeepCheckStreamer(LineOnlyReceiver, object):
             output = DeepCheckOutput(self, options)
         if options["add-lease"]:
             url += "&add-lease=true"
+        if options["recheck-age"] is not None:
+            url += "&recheck-age=%d" % (options["recheck-age"],)
         resp = do_http("POST", url)
         if resp.status not in (200, 302):
             print(format_http_error("ERROR", resp), file=stderr)
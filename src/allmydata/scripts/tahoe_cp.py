@@ -11,20 +11,26 @@ if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
 import os.path
+import time
 from urllib.parse import quote as url_quote
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from io import BytesIO
 
 from twisted.python.failure import Failure
 from allmydata.scripts.common import get_alias, escape_path, \
                                      DefaultAliasMarker, TahoeError
 from allmydata.scripts.common_http import do_http, HTTPError
+from allmydata.scripts.chunked import is_chunked_file, chunked_file_size, \
+     ChunkedFileReader
 from allmydata import uri
 from allmydata.util import fileutil
 from allmydata.util.fileutil import abspath_expanduser_unicode, precondition_abspath
 from allmydata.util.encodingutil import unicode_to_url, listdir_unicode, quote_output, \
     quote_local_unicode_path, to_bytes
 from allmydata.util.assertutil import precondition, _assert
+from allmydata.util.abbreviate import abbreviate_space
 from allmydata.util import jsonbytes as json
 
 
@@ -70,15 +76,9 @@ def mkdir(targeturl):
         return resp.read().strip()
     raise HTTPError("Error during mkdir", resp)
 
-def make_tahoe_subdirectory(nodeurl, parent_writecap, name):
-    url = nodeurl + "/".join(["uri",
-                              url_quote(parent_writecap),
-                              url_quote(unicode_to_url(name)),
-                              ]) + "?t=mkdir"
-    resp = do_http("POST", url)
-    if resp.status in (200, 201):
-        return resp.read().strip()
-    raise HTTPError("Error during mkdir", resp)
+def mkdir_with_children(nodeurl, children):
+    url = nodeurl + "uri?t=mkdir-with-children"
+    return POST(url, json.dumps_bytes(children)).strip()
 
 
 class LocalFileSource(object):
@@ -93,6 +93,9 @@ class LocalFileSource(object):
     def need_to_copy_bytes(self):
         return True
 
+    def get_size(self):
+        return os.path.getsize(self.pathname)
+
     def open(self, caps_only):
         return open(self.pathname, "rb")
 
@@ -187,17 +190,22 @@ class LocalDirectoryTarget(object):
         pathname = os.path.join(self.pathname, name)
         fileutil.put_file(pathname, inf)
 
+    def create_subdirs(self):
+        pass
+
     def set_children(self):
         pass
 
 
 class TahoeFileSource(object):
-    def __init__(self, nodeurl, mutable, writecap, readcap, basename):
+    def __init__(self, nodeurl, mutable, writecap, readcap, basename,
+                 size=None):
         self.nodeurl = nodeurl
         self.mutable = mutable
         self.writecap = writecap
         self.readcap = readcap
         self._basename = basename # unicode, or None for raw filecaps
+        self._size = size # None if the gateway did not say
 
     def basename(self):
         return self._basename
@@ -207,6 +215,9 @@ class TahoeFileSource(object):
             return True
         return False
 
+    def get_size(self):
+        return self._size or 0
+
     def open(self, caps_only):
         if caps_only:
             return BytesIO(self.readcap)
@@ -217,6 +228,36 @@ class TahoeFileSource(object):
         return self.writecap or self.readcap
 
 
+class TahoeChunkedFileSource(object):
+    """A file that 'tahoe backup' stored in chunks, in an immutable
+    directory."""
+    def __init__(self, nodeurl, readcap, children, basename):
+        self.nodeurl = nodeurl
+        self.mutable = False
+        self.writecap = None
+        self.readcap = readcap
+        self.children = children
+        self._basename = basename
+
+    def basename(self):
+        return self._basename
+
+    def need_to_copy_bytes(self):
+        # copying the directory would not copy the file
+        return True
+
+    def get_size(self):
+        return chunked_file_size(self.children)
+
+    def open(self, caps_only):
+        if caps_only:
+            return BytesIO(self.readcap)
+        return ChunkedFileReader(self.nodeurl, self.children)
+
+    def bestcap(self):
+        return self.readcap
+
+
 def seekable(file_like):
     """Return whether the file-like object is seekable."""
     return hasattr(file_like, "seek") and (
@@ -292,7 +333,8 @@ class TahoeDirectorySource(object):
                 writecap = to_bytes(data[1].get("rw_uri"))
                 readcap = to_bytes(data[1].get("ro_uri"))
                 self.children[name] = TahoeFileSource(self.nodeurl, mutable,
-                                                      writecap, readcap, name)
+                                                      writecap, readcap, name,
+                                                      data[1].get("size"))
             elif data[0] == "dirnode":
                 writecap = to_bytes(data[1].get("rw_uri"))
                 readcap = to_bytes(data[1].get("ro_uri"))
@@ -304,11 +346,14 @@ class TahoeDirectorySource(object):
                     child = TahoeDirectorySource(self.nodeurl, self.cache,
                                                  self.progressfunc, name)
                     child.init_from_grid(writecap, readcap)
+                    if is_chunked_file(child.children_d):
+                        child = TahoeChunkedFileSource(self.nodeurl, readcap,
+                                                       child.children_d, name)
                     if writecap:
                         self.cache[writecap] = child
                     if readcap:
                         self.cache[readcap] = child
-                    if recurse:
+                    if recurse and isinstance(child, TahoeDirectorySource):
                         child.populate(recurse=True)
                 self.children[name] = child
             else:
@@ -340,6 +385,10 @@ class TahoeDirectoryTarget(object):
         self.cache = cache
         self.progressfunc = progressfunc
         self.new_children = {}
+        # name -> TahoeDirectoryTarget, for the subdirectories that
+        # create_subdirs() will create
+        self.new_subdirs = {}
+        self.made_by_parent = False
 
     def init_from_parsed(self, parsed):
         nodetype, d = parsed
@@ -376,6 +425,16 @@ class TahoeDirectoryTarget(object):
         self.children_d = {}
         self.children = {}
 
+    def to_be_created(self):
+        # I will be created, with my children, by the create_subdirs() of
+        # the nearest directory above me that already exists
+        self.made_by_parent = True
+        self.writecap = None
+        self.readcap = None
+        self.mutable = True
+        self.children_d = {}
+        self.children = {}
+
     def populate(self, recurse):
         if self.children is not None:
             return
@@ -424,11 +483,11 @@ class TahoeDirectoryTarget(object):
             self.populate(recurse=False)
         if name in self.children:
             return self.children[name]
-        writecap = make_tahoe_subdirectory(self.nodeurl, self.writecap, name)
         child = TahoeDirectoryTarget(self.nodeurl, self.cache,
                                      self.progressfunc)
-        child.just_created(writecap)
+        child.to_be_created()
         self.children[name] = child
+        self.new_subdirs[name] = child
         return child
 
     def put_file(self, name, inf):
@@ -455,11 +514,31 @@ class TahoeDirectoryTarget(object):
         precondition(isinstance(name, str), name)
         self.new_children[name] = filecap
 
+    def create_subdirs(self):
+        if self.made_by_parent:
+            return # see to_be_created()
+        self._create_subdirs()
+
     def set_children(self):
-        if not self.new_children:
+        if self.made_by_parent:
+            return # my children went into my mkdir-with-children
+        if not self.new_children and not self.new_subdirs:
             return
         url = (self.nodeurl + "uri/" + url_quote(self.writecap)
                + "?t=set_children")
+        body = json.dumps_bytes(self._new_children_data())
+        POST(url, body)
+
+    def _create_subdirs(self):
+        # each new directory is made in one mkdir-with-children request,
+        # after the ones inside it
+        for (name, child) in sorted(self.new_subdirs.items()):
+            child._create_subdirs()
+            writecap = mkdir_with_children(self.nodeurl,
+                                           child._new_children_data())
+            child.just_created(writecap)
+
+    def _new_children_data(self):
         set_data = {}
         for (name, filecap) in list(self.new_children.items()):
             # it just so happens that ?t=set_children will accept both file
@@ -469,10 +548,11 @@ class TahoeDirectoryTarget(object):
             # TODO: think about how this affects forward-compatibility for
             # unknown caps
             set_data[name] = ["filenode", {"rw_uri": filecap}]
-        body = json.dumps_bytes(set_data)
-        POST(url, body)
+        for (name, child) in list(self.new_subdirs.items()):
+            set_data[name] = ["dirnode", {"rw_uri": child.writecap}]
+        return set_data
 
-FileSources = (LocalFileSource, TahoeFileSource)
+FileSources = (LocalFileSource, TahoeFileSource, TahoeChunkedFileSource)
 DirectorySources = (LocalDirectorySource, TahoeDirectorySource)
 FileTargets = (LocalFileTarget, TahoeFileTarget)
 DirectoryTargets = (LocalDirectoryTarget, TahoeDirectoryTarget)
@@ -503,7 +583,11 @@ class Copier(object):
                 print(message, file=self.stderr)
             self.progressfunc = progress
         self.caps_only = options["caps-only"]
+        self.jobs = options["jobs"]
         self.cache = {}
+        # the directory targets in which get_child_target() was called, in
+        # order (this is a dict only to find them quickly)
+        self.parent_targets = {}
         try:
             status = self.try_copy()
             return status
@@ -694,7 +778,13 @@ class Copier(object):
                                 resp)
             parsed = json.loads(resp.read())
             nodetype, d = parsed
-            if nodetype == "dirnode":
+            if nodetype == "dirnode" and is_chunked_file(d["children"]):
+                if had_trailing_slash:
+                    raise FilenameWithTrailingSlashError(source_spec)
+                t = TahoeChunkedFileSource(self.nodeurl,
+                                           to_bytes(d.get("ro_uri")),
+                                           d["children"], name)
+            elif nodetype == "dirnode":
                 t = TahoeDirectorySource(self.nodeurl, self.cache,
                                          self.progress, name)
                 t.init_from_parsed(parsed)
@@ -704,7 +794,8 @@ class Copier(object):
                 writecap = to_bytes(d.get("rw_uri"))
                 readcap = to_bytes(d.get("ro_uri"))
                 mutable = d.get("mutable", False) # older nodes don't provide it
-                t = TahoeFileSource(self.nodeurl, mutable, writecap, readcap, name)
+                t = TahoeFileSource(self.nodeurl, mutable, writecap, readcap, name,
+                                    d.get("size"))
         return t
 
 
@@ -740,6 +831,7 @@ class Copier(object):
         return self.announce_success("file linked")
 
     def copy_things_to_directory(self, sources, target):
+        started = time.time()
         # step one: if the target is missing, we should mkdir it
         target = self.maybe_create_target(target)
         target.populate(recurse=False)
@@ -775,12 +867,17 @@ class Copier(object):
             #    self.to_stderr(source1.basename())
             return 1
 
-        # step four: walk through the list of targets. For each one, copy all
-        # the files. If the target is a TahoeDirectory, upload and create
-        # read-caps, then do a set_children to the target directory.
-        self.copy_to_targetmap(targetmap)
+        # step four: copy all of the files. If the target is a
+        # TahoeDirectory, upload and create read-caps, then do a set_children
+        # to the target directory (which also creates any new directories
+        # below it, with their children).
+        files_copied, bytes_copied = self.copy_to_targetmap(targetmap)
 
-        return self.announce_success("files copied")
+        elapsed = time.time() - started
+        return self.announce_success(
+            "files copied (%d files, %s in %.1fs, %s/s)"
+            % (files_copied, abbreviate_space(bytes_copied), elapsed,
+               abbreviate_space(bytes_copied / max(elapsed, 0.001))))
 
     def maybe_create_target(self, target):
         if isinstance(target, LocalMissingTarget):
@@ -816,7 +913,7 @@ class Copier(object):
                 name = s.basename()
                 if name is not None:
                     # named sources get a new directory. see #2329
-                    new_target = target.get_child_target(name)
+                    new_target = self.get_child_target(target, name)
                 else:
                     # unnamed sources have their contents copied directly
                     new_target = target
@@ -832,32 +929,77 @@ class Copier(object):
         for name, child in list(source.children.items()):
             if isinstance(child, DirectorySources):
                 # we will need a target directory for this one
-                subtarget = target.get_child_target(name)
+                subtarget = self.get_child_target(target, name)
                 self.assign_targets(targetmap, child, subtarget)
             else:
                 _assert(isinstance(child, FileSources), child)
                 targetmap[target].append(child)
 
+    def get_child_target(self, target, name):
+        self.parent_targets[target] = None
+        return target.get_child_target(name)
+
     def copy_to_targetmap(self, targetmap):
+        """Copy all of the files, self.jobs at a time, and then finish
+        their target directories. Return the number of files and of bytes
+        copied."""
         files_to_copy = self.count_files_to_copy(targetmap)
         self.progress("starting copy, %d files, %d directories" %
                       (files_to_copy, len(targetmap)))
         files_copied = 0
-        targets_finished = 0
+        bytes_copied = 0
 
+        copies = []
         for target, sources in list(targetmap.items()):
             _assert(isinstance(target, DirectoryTargets), target)
+            if isinstance(target, TahoeDirectoryTarget):
+                # look for existing mutable files now, rather than in
+                # the copies
+                target.populate(recurse=False)
             for source in sources:
                 _assert(isinstance(source, FileSources), source)
-                self.copy_file_into_dir(source, source.basename(), target)
-                files_copied += 1
-                self.progress("%d/%d files, %d/%d directories" %
-                              (files_copied, files_to_copy,
-                               targets_finished, len(targetmap)))
-            target.set_children()
+                copies.append(partial(self.copy_file_into_dir,
+                                      source, source.basename(), target))
+        targets = list(targetmap)
+        targets.extend(t for t in self.parent_targets if t not in targetmap)
+        targets_finished = 0
+
+        for copied in self.run_jobs(copies):
+            files_copied += 1
+            bytes_copied += copied
+            self.progress("%d/%d files, %d/%d directories" %
+                          (files_copied, files_to_copy,
+                           targets_finished, len(targets)))
+        # the new directories are made one after another, each by the
+        # nearest existing directory above it, and before any of the
+        # set_children requests which link them in
+        for t in targets:
+            t.create_subdirs()
+        for ign in self.run_jobs([t.set_children for t in targets]):
             targets_finished += 1
             self.progress("%d/%d directories" %
-                          (targets_finished, len(targetmap)))
+                          (targets_finished, len(targets)))
+        return (files_copied, bytes_copied)
+
+    def run_jobs(self, jobs):
+        """Call each of jobs (functions that take no arguments), self.jobs
+        of them at a time, and yield their results in the order of jobs.
+        If one of them fails, the ones that have not started yet are not
+        called, and its exception is raised once the ones that have started
+        have finished, so the error reported is always that of the first
+        job that failed, in the order of jobs."""
+        if self.jobs == 1:
+            for job in jobs:
+                yield job()
+            return
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            futures = [pool.submit(job) for job in jobs]
+            try:
+                for future in futures:
+                    yield future.result()
+            finally:
+                for future in futures:
+                    future.cancel()
 
     def count_files_to_copy(self, targetmap):
         return sum([len(sources) for sources in targetmap.values()])
@@ -872,10 +1014,13 @@ class Copier(object):
             # data, and stash the new filecap for a later set_children call.
             f = source.open(self.caps_only)
             target.put_file(name, f)
-            return
+            if self.caps_only:
+                return 0
+            return source.get_size()
         # otherwise we're copying tahoe to tahoe, and using immutable files,
         # so we can just make a link
         target.put_uri(name, source.bestcap())
+        return 0
 
 
     def progress(self, message):
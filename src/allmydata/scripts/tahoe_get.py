@@ -13,7 +13,8 @@ if PY2:
 from urllib.parse import quote as url_quote
 from allmydata.scripts.common import get_alias, DEFAULT_ALIAS, escape_path, \
                                      UnknownAliasError
-from allmydata.scripts.common_http import do_http, format_http_error
+from allmydata.scripts.common_http import do_http, format_http_error, HTTPError
+from allmydata.scripts.chunked import get_chunked_file, ChunkedFileReader
 
 def get(options):
     nodeurl = options['node-url']
@@ -36,6 +37,12 @@ def get(options):
 
     resp = do_http("GET", url)
     if resp.status in (200, 201,):
+        if (resp.getheader("content-type") or "").startswith("text/html"):
+            # a directory, or perhaps a file that was backed up in chunks
+            children = get_chunked_file(url)
+            if children is not None:
+                resp.close()
+                resp = ChunkedFileReader(nodeurl, children)
         if to_file:
             outf = open(to_file, "wb")
         else:
@@ -44,14 +51,19 @@ def get(options):
             # default.
             if PY3 and getattr(outf, "encoding", None) is not None:
                 outf = outf.buffer
-        while True:
-            data = resp.read(4096)
-            if not data:
-                break
-            outf.write(data)
+        rc = 0
+        try:
+            while True:
+                data = resp.read(4096)
+                if not data:
+                    break
+                outf.write(data)
+        except HTTPError as e:
+            # one of the chunks could not be read
+            e.display(stderr)
+            rc = 1
         if to_file:
             outf.close()
-        rc = 0
     else:
         print(format_http_error("Error during GET", resp), file=stderr)
         rc = 1
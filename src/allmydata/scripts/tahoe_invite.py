@@ -16,12 +16,11 @@ except ImportError:
     pass
 
 from twisted.python import usage
-from twisted.internet import defer, reactor
+from twisted.internet import defer
 
 from allmydata.util.encodingutil import argv_to_abspath
 from allmydata.util import jsonbytes as json
 from allmydata.scripts.common import get_default_nodedir, get_introducer_furl
-from allmydata.client import read_config
 
 
 class InviteOptions(usage.Options):
@@ -44,6 +43,7 @@ class InviteOptions(usage.Options):
 
 @defer.inlineCallbacks
 def _send_config_via_wormhole(options, config):
+    from twisted.internet import reactor
     out = options.stdout
     err = options.stderr
     relay_url = options.parent['wormhole-server']
@@ -84,6 +84,7 @@ def _send_config_via_wormhole(options, config):
 
 @defer.inlineCallbacks
 def invite(options):
+    from allmydata.client import read_config
     if options.parent['node-directory']:
         basedir = argv_to_abspath(options.parent['node-directory'])
     else:
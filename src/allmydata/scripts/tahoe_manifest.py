@@ -109,6 +109,13 @@ class ManifestStreamer(LineOnlyReceiver, object):
                     print(ensure_str("%s %s") % (
                         quote_output(d["cap"], quotemarks=False),
                         quote_path(d["path"], quotemarks=False)), file=stdout)
+            elif d["type"] == "directory-shard":
+                # the files which hold a sharded directory have no path of
+                # their own, but do need their leases renewed
+                if self.options["storage-index"]:
+                    print(quote_output(d["storage-index"], quotemarks=False), file=stdout)
+                elif self.options["verify-cap"]:
+                    print(quote_output(d["verifycap"], quotemarks=False), file=stdout)
 
 def manifest(options):
     return ManifestStreamer().run(options)
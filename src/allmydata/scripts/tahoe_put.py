@@ -81,6 +81,8 @@ def put(options):
         queryargs.append("mutable=true")
     if format:
         queryargs.append("format=%s" % format)
+    if options['resume-token']:
+        queryargs.append("resume-token=%s" % options['resume-token'])
     if queryargs:
         url += "?" + "&".join(queryargs)
 
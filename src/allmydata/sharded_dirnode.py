@@ -0,0 +1,332 @@
+"""
+Sharded directories.
+
+A directory with very many children is expensive to change: every change
+re-packs, re-encrypts and re-publishes all of its children. A sharded
+directory spreads its children over a tree of mutable files instead, chosen
+by a hash of each child's name, so that a change only re-publishes the one
+small file (the "leaf") that holds that child.
+
+The directory's own mutable file is the root of the tree. Every file in the
+tree starts with a header which says what it holds:
+
+* a leaf (LEAF_HEADER) holds children, packed exactly like the contents of
+  an ordinary directory.
+* a table (TABLE_HEADER) holds the FANOUT subtrees one level down, also
+  packed like an ordinary directory, with children named "0" to "f".
+
+The child called NAME is found, at depth N of the tree, in the subtree named
+by the N'th hex digit of a hash of NAME (see bucket_for). Writecaps in
+leaves and tables are encrypted with the writekey of the root, so one
+directory writecap (or readcap) gives access to the whole tree.
+
+A leaf that grows beyond MAX_LEAF_ENTRIES children is split into a table of
+new leaves. Leaves are never merged again.
+
+Ported to Python 3.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from twisted.internet import defer
+
+from allmydata.util import base32, hashutil, log
+from allmydata.util.deferredutil import gatherResults
+from allmydata.util.dictutil import AuxValueDict
+
+LEAF_HEADER = b"tahoe-sharded-directory-v1:leaf\n"
+TABLE_HEADER = b"tahoe-sharded-directory-v1:table\n"
+
+# each level of the tree uses one hex digit of a SHA-256d hash, reduced
+# modulo FANOUT (which must divide 16: tests use fewer subtrees, to make
+# fewer mutable files)
+FANOUT = 16
+MAX_DEPTH = 64
+
+SHARD_NAME_TAG = b"allmydata_sharded_dirnode_name_v1"
+
+
+def is_sharded(data):
+    """Return True if data is the contents of the root of a sharded
+    directory (rather than of an ordinary one, which always starts with a
+    digit)."""
+    return data.startswith(LEAF_HEADER) or data.startswith(TABLE_HEADER)
+
+
+def bucket_for(storage_index, name, depth):
+    """Return the name of the subtree which holds the child called name (a
+    normalized unicode string) at the given depth of the tree of the
+    directory with the given storage index."""
+    h = hashutil.tagged_pair_hash(SHARD_NAME_TAG, storage_index,
+                                  name.encode("utf-8"))
+    byte = h[depth // 2]
+    if depth % 2 == 0:
+        digit = byte >> 4
+    else:
+        digit = byte & 0x0f
+    return "%x" % (digit % FANOUT)
+
+
+def shard_path_name(shard):
+    """Return the name under which deep-check reports on a shard of a
+    directory, alongside the directory's children."""
+    return "<shard %s>" % (str(base32.b2a(shard.get_storage_index()), "ascii"),)
+
+
+class _LeafWasSplit(Exception):
+    """A leaf was replaced by a table while it was being changed."""
+
+
+class ShardedDirectory(object):
+    """I read and change the tree of a sharded directory, on behalf of its
+    DirectoryNode. I use the DirectoryNode to parse and pack the contents of
+    each leaf and table, and apply its usual Adder, Deleter and
+    MetadataSetter modifiers to the leaves."""
+
+    MAX_LEAF_ENTRIES = 1000
+    MAX_RETRIES = 5
+
+    def __init__(self, dirnode, nodemaker):
+        self._dirnode = dirnode
+        self._nodemaker = nodemaker
+        self._root = dirnode._node
+        self._storage_index = dirnode.get_storage_index()
+        # the filenodes of the tables and leaves below the root, as seen by
+        # the most recent list()
+        self.shard_nodes = []
+
+    def _bucket(self, name, depth):
+        return bucket_for(self._storage_index, name, depth)
+
+    def _download(self, filenode, max_age=None):
+        return filenode.download_best_version(max_age=max_age)
+
+    def _parse(self, filenode, data):
+        if data.startswith(LEAF_HEADER):
+            body = data[len(LEAF_HEADER):]
+        elif data.startswith(TABLE_HEADER):
+            body = data[len(TABLE_HEADER):]
+        else:
+            raise ValueError("shard %r of a sharded directory has no header"
+                             % (filenode,))
+        return self._dirnode._parse_contents(body,
+                                             filenode.get_storage_index())
+
+    def _get_subtree(self, filenode, data, bucket):
+        child = self._parse(filenode, data).get(bucket)
+        if child is None:
+            raise ValueError("table %r of a sharded directory has no entry %s"
+                             % (filenode, bucket))
+        return child[0]
+
+    def _find_leaf(self, filenode, data, name, depth, max_age):
+        # fires with (filenode, contents) of the leaf that holds name
+        if data.startswith(LEAF_HEADER):
+            return (filenode, data)
+        if not data.startswith(TABLE_HEADER) or depth >= MAX_DEPTH:
+            raise ValueError("shard %r of a sharded directory is corrupt"
+                             % (filenode,))
+        shard = self._get_subtree(filenode, data, self._bucket(name, depth))
+        d = self._download(shard, max_age)
+        d.addCallback(lambda data: self._find_leaf(shard, data, name,
+                                                   depth+1, max_age))
+        return d
+
+    def get(self, name, root_data, max_age=None):
+        """Fire with the (node, metadata) pair of the named child, or with
+        None if there is no such child."""
+        d = defer.maybeDeferred(self._find_leaf, self._root, root_data, name,
+                                0, max_age)
+        d.addCallback(lambda leaf: self._parse(*leaf).get(name))
+        return d
+
+    def list_children(self, root_data, max_age=None):
+        """Fire with an AuxValueDict of all the children, like
+        DirectoryNode._unpack_contents."""
+        children = AuxValueDict()
+        shard_nodes = []
+        d = defer.maybeDeferred(self._list, self._root, root_data, 0, max_age,
+                                children, shard_nodes)
+        def _done(ign):
+            self.shard_nodes = shard_nodes
+            return children
+        d.addCallback(_done)
+        return d
+
+    def _list(self, filenode, data, depth, max_age, children, shard_nodes):
+        parsed = self._parse(filenode, data)
+        if data.startswith(LEAF_HEADER):
+            leaf_children = parsed.get_all()
+            for name in leaf_children:
+                children.set_with_aux(name, leaf_children[name],
+                                      leaf_children.get_aux(name))
+            return None
+        if depth >= MAX_DEPTH:
+            raise ValueError("sharded directory is too deep")
+        dl = []
+        for (bucket, (shard, metadata)) in sorted(parsed.get_all().items()):
+            shard_nodes.append(shard)
+            d = self._download(shard, max_age)
+            d.addCallback(lambda data, shard=shard:
+                          self._list(shard, data, depth+1, max_age,
+                                     children, shard_nodes))
+            dl.append(d)
+        return gatherResults(dl)
+
+    def _find_leaves(self, filenode, data, names, depth):
+        # fires with a list of (filenode, depth, names), one for each leaf
+        # that holds some of the names
+        if data.startswith(LEAF_HEADER):
+            return [(filenode, depth, names)]
+        if not data.startswith(TABLE_HEADER) or depth >= MAX_DEPTH:
+            raise ValueError("shard %r of a sharded directory is corrupt"
+                             % (filenode,))
+        groups = {}
+        for name in names:
+            groups.setdefault(self._bucket(name, depth), []).append(name)
+        dl = []
+        for (bucket, group) in sorted(groups.items()):
+            shard = self._get_subtree(filenode, data, bucket)
+            d = self._download(shard)
+            d.addCallback(lambda data, shard=shard, group=group:
+                          self._find_leaves(shard, data, group, depth+1))
+            dl.append(d)
+        d = gatherResults(dl)
+        d.addCallback(lambda leaves: sum(leaves, []))
+        return d
+
+    def modify(self, modifier):
+        """Apply a modifier (an Adder, Deleter or MetadataSetter) to the
+        leaves which hold the children it names. Each leaf is changed
+        separately, so a change to several children is not atomic."""
+        remaining = set(modifier.get_names())
+        attempts = [0]
+        def _attempt(ign=None):
+            attempts[0] += 1
+            d = self._download(self._root)
+            d.addCallback(lambda data: self._find_leaves(self._root, data,
+                                                         sorted(remaining), 0))
+            d.addCallback(_modify_leaves)
+            d.addErrback(_maybe_retry)
+            return d
+        def _modify_leaves(leaves):
+            d = defer.succeed(None)
+            for (filenode, depth, names) in leaves:
+                d.addCallback(lambda ign, filenode=filenode, depth=depth,
+                                     names=names:
+                              self._modify_leaf(filenode, depth,
+                                                modifier.for_names(names)))
+                d.addCallback(lambda ign, names=names:
+                              remaining.difference_update(names))
+            return d
+        def _maybe_retry(f):
+            f.trap(_LeafWasSplit)
+            if attempts[0] >= self.MAX_RETRIES:
+                return f
+            return _attempt()
+        if not remaining:
+            return defer.succeed(None)
+        return _attempt()
+
+    def _modify_leaf(self, filenode, depth, modifier):
+        new = {}
+        def _modify(old_contents, servermap, first_time):
+            if not old_contents.startswith(LEAF_HEADER):
+                raise _LeafWasSplit()
+            body = modifier.modify(old_contents[len(LEAF_HEADER):],
+                                   servermap, first_time)
+            if body is None:
+                new.pop("data", None)
+                return None
+            new["data"] = LEAF_HEADER + body
+            return new["data"]
+        d = filenode.modify(_modify)
+        d.addCallback(lambda ign: self._maybe_split(filenode, depth,
+                                                    new.get("data")))
+        return d
+
+    def _maybe_split(self, filenode, depth, data):
+        if data is None or depth + 1 >= MAX_DEPTH:
+            return None
+        parsed = self._parse(filenode, data)
+        if len(parsed.get_names()) <= self.MAX_LEAF_ENTRIES:
+            return None
+        d = self._split(filenode, depth, data, parsed)
+        # the change itself has been made: a leaf that could not be split
+        # will be split by a later change
+        def _failed(f):
+            log.msg("unable to split a leaf of a sharded directory",
+                    failure=f, level=log.WEIRD, umid="zRLx4w")
+        d.addErrback(_failed)
+        return d
+
+    def _split(self, filenode, depth, data, parsed):
+        d = self._build_table(parsed, parsed.get_names(), depth)
+        def _replace(table):
+            replaced = []
+            def _modify(old_contents, servermap, first_time):
+                if old_contents != data:
+                    # the leaf has changed since we read it: leave it alone
+                    return None
+                replaced.append(True)
+                return table
+            d = filenode.modify(_modify)
+            def _done(ign):
+                if not replaced:
+                    log.msg("leaf of a sharded directory changed while it "
+                            "was being split", level=log.UNUSUAL)
+            d.addCallback(_done)
+            return d
+        d.addCallback(_replace)
+        return d
+
+    def _build_table(self, parsed, names, depth):
+        # fires with the contents of a table of new subtrees for the given
+        # children (found in parsed), which belong at the given depth
+        groups = dict(("%x" % i, []) for i in range(FANOUT))
+        for name in names:
+            groups[self._bucket(name, depth)].append(name)
+        subtrees = {}
+        # the subtrees are made one at a time, to bound the work of
+        # converting a very large directory
+        d = defer.succeed(None)
+        for (bucket, group) in sorted(groups.items()):
+            d.addCallback(lambda ign, group=group:
+                          self._build(parsed, group, depth+1))
+            d.addCallback(lambda node, bucket=bucket:
+                          subtrees.__setitem__(bucket, (node, {})))
+        d.addCallback(lambda ign: TABLE_HEADER +
+                      self._dirnode._pack_contents(subtrees))
+        return d
+
+    def _build(self, parsed, names, depth):
+        # fires with a new mutable file holding the given children
+        if len(names) <= self.MAX_LEAF_ENTRIES or depth + 1 >= MAX_DEPTH:
+            d = defer.succeed(LEAF_HEADER + parsed.pack_children(names))
+        else:
+            d = self._build_table(parsed, names, depth)
+        d.addCallback(self._nodemaker.create_mutable_file,
+                      version=self._root.get_version())
+        return d
+
+    def convert(self):
+        """Turn the ordinary directory of my DirectoryNode into a sharded
+        one, in place: the writecap and readcap of the directory stay the
+        same. Converting a directory that is already sharded does nothing."""
+        new = {}
+        def _modify(old_contents, servermap, first_time):
+            if is_sharded(old_contents):
+                new.pop("data", None)
+                return None
+            new["data"] = LEAF_HEADER + old_contents
+            return new["data"]
+        d = self._root.modify(_modify)
+        d.addCallback(lambda ign: self._maybe_split(self._root, 0,
+                                                    new.get("data")))
+        return d
@@ -185,6 +185,25 @@ class UploadsInProgress(object):
         except (KeyError, IndexError):
             raise _HTTPError(http.NOT_FOUND)
 
+    def get_resumable_buckets(
+        self, storage_index: bytes, share_numbers, upload_secret: bytes
+    ) -> Set[int]:
+        """
+        Return those of the given share numbers whose in-progress upload was
+        started with this upload secret, and so may be resumed.
+        """
+        if storage_index not in self._uploads:
+            return set()
+        in_progress = self._uploads[storage_index]
+        return {
+            share_number
+            for share_number in share_numbers
+            if share_number in in_progress.upload_secrets
+            and timing_safe_compare(
+                in_progress.upload_secrets[share_number], upload_secret
+            )
+        }
+
     def remove_write_bucket(self, bucket: BucketWriter):
         """Stop tracking the given ``BucketWriter``."""
         storage_index, share_number = self._bucketwriters.pop(bucket)
@@ -387,11 +406,19 @@ class HTTPServer(object):
                 storage_index, share_number, upload_secret, bucket
             )
 
+        # A client that presents the same upload secret as an upload that is
+        # still in progress (typically because the client was restarted) is
+        # allowed to carry on with it.  It learns which parts of the share
+        # are still required from the response to its next write.
+        resumed = self._uploads.get_resumable_buckets(
+            storage_index, info["share-numbers"], upload_secret
+        )
+
         return self._send_encoded(
             request,
             {
                 "already-have": set(already_got),
-                "allocated": set(sharenum_to_bucket),
+                "allocated": set(sharenum_to_bucket) | resumed,
             },
         )
 
@@ -32,8 +32,8 @@ Ported to Python 3.
 
 from six import ensure_text
 from typing import Union
-import re, time, hashlib
-from os import urandom
+import re, time, hashlib, heapq
+from collections import OrderedDict
 from configparser import NoSectionError
 
 import attr
@@ -66,7 +66,7 @@ from allmydata.util import log, base32, connection_status
 from allmydata.util.assertutil import precondition
 from allmydata.util.observer import ObserverList
 from allmydata.util.rrefutil import add_version_to_remote_reference
-from allmydata.util.hashutil import permute_server_hash
+from allmydata.util.hashutil import permute_server_hash, bucket_upload_secret_hash
 from allmydata.util.dictutil import BytesKeyDict, UnicodeKeyDict
 from allmydata.util.deferredutil import async_to_deferred
 from allmydata.storage.http_client import (
@@ -160,6 +160,10 @@ class StorageFarmBroker(service.MultiService):
         configuration file relating to storage behavior.
     """
 
+    # how many recently-used server permutations get_servers_for_psi
+    # remembers. Each entry is a tuple of (connected) servers.
+    PERMUTATION_CACHE_SIZE = 1000
+
     @property
     def preferred_peers(self):
         return self.storage_client_config.preferred_peers
@@ -192,6 +196,16 @@ class StorageFarmBroker(service.MultiService):
         self._threshold_listeners = [] # tuples of (threshold, Deferred)
         self._connected_high_water_mark = 0
 
+        # Permuting the server list is on the path of every upload, download,
+        # servermap update, and check. The set of connected servers changes
+        # rarely, so we remember the permutation seeds (and preference) of
+        # the connected servers, and a bounded number of recent permutations
+        # keyed by peer selection index. All of this is thrown away whenever
+        # the set of connected servers changes.
+        self._permutation_connected = frozenset()
+        self._permutation_seeds = () # (is_unpreferred, seed, server)
+        self._permuted = OrderedDict() # peer selection index -> servers
+
     @log_call(action_type=u"storage-client:broker:set-static-servers")
     def set_static_servers(self, servers):
         # Sorting the items gives us a deterministic processing order.  This
@@ -418,17 +432,73 @@ class StorageFarmBroker(service.MultiService):
         for dsc in list(self.servers.values()):
             dsc.try_to_connect()
 
+    def _get_permutation_seeds(self):
+        """
+        Return a tuple of ``(is_unpreferred, permutation_seed, server)`` for
+        each connected server, rebuilding it (and forgetting any cached
+        permutations) if the set of connected servers has changed since the
+        last call.
+        """
+        connected = self.get_connected_servers()
+        if connected != self._permutation_connected:
+            preferred_peers = self.preferred_peers
+            self._permutation_connected = connected
+            self._permutation_seeds = tuple(
+                (s.get_longname() not in preferred_peers,
+                 s.get_permutation_seed(),
+                 s)
+                for s in connected
+            )
+            self._permuted.clear()
+        return self._permutation_seeds
+
+    def _permutation_keys(self, peer_selection_index):
+        # (sort key, server) pairs: preferred servers first, then by hash
+        return [((is_unpreferred, permute_server_hash(peer_selection_index, seed)),
+                 server)
+                for (is_unpreferred, seed, server)
+                in self._get_permutation_seeds()]
+
     def get_servers_for_psi(self, peer_selection_index):
         # return a list of server objects (IServers)
         assert self.permute_peers == True
-        connected_servers = self.get_connected_servers()
-        preferred_servers = frozenset(s for s in connected_servers if s.get_longname() in self.preferred_peers)
-        def _permuted(server):
-            seed = server.get_permutation_seed()
-            is_unpreferred = server not in preferred_servers
-            return (is_unpreferred,
-                    permute_server_hash(peer_selection_index, seed))
-        return sorted(connected_servers, key=_permuted)
+        self._get_permutation_seeds()
+        try:
+            servers = self._permuted.pop(peer_selection_index)
+        except KeyError:
+            keyed = self._permutation_keys(peer_selection_index)
+            keyed.sort(key=lambda key_and_server: key_and_server[0])
+            servers = tuple(server for (key, server) in keyed)
+            if len(self._permuted) >= self.PERMUTATION_CACHE_SIZE:
+                self._permuted.popitem(last=False)
+        # (re-)insert as the most recently used entry
+        self._permuted[peer_selection_index] = servers
+        return list(servers)
+
+    def iter_servers_for_psi(self, peer_selection_index):
+        """
+        Yield the connected servers in the same order as
+        ``get_servers_for_psi``, but without sorting all of them up front.
+        Callers which usually only need the first few servers (like the
+        downloader's ShareFinder) pay O(log n) for each server they actually
+        consume instead of O(n log n) for the whole list.
+
+        The ordering is computed from the servers which are connected when
+        iteration starts.
+        """
+        assert self.permute_peers == True
+        self._get_permutation_seeds()
+        if peer_selection_index in self._permuted:
+            for server in self.get_servers_for_psi(peer_selection_index):
+                yield server
+            return
+        heap = [(key, i, server)
+                for i, (key, server)
+                in enumerate(self._permutation_keys(peer_selection_index))]
+        heapq.heapify(heap)
+        while heap:
+            (key, i, server) = heapq.heappop(heap)
+            yield server
 
     def get_all_serverids(self):
         return frozenset(self.servers.keys())
@@ -1059,12 +1129,17 @@ class _HTTPBucketWriter(object):
 
     @defer.inlineCallbacks
     def write(self, offset, data):
+        """
+        Write some share data.  Unlike a Foolscap ``RIBucketWriter``, this
+        fires with the ``RangeMap`` of the parts of the share that the server
+        still needs, which lets an interrupted upload be resumed.
+        """
         result = yield self.client.write_share_chunk(
             self.storage_index, self.share_number, self.upload_secret, offset, data
         )
         if result.finished:
             self.finished = True
-        defer.returnValue(None)
+        defer.returnValue(result.required)
 
     def close(self):
         # A no-op in HTTP protocol.
@@ -1124,7 +1199,10 @@ class _HTTPStorageServer(object):
             allocated_size,
             canary
     ):
-        upload_secret = urandom(20)
+        # The upload secret is derived from the (per-server, per-file) lease
+        # renewal secret, so that if this client is restarted it can resume
+        # writing to any shares it left half-written.
+        upload_secret = bucket_upload_secret_hash(renew_secret)
         immutable_client = StorageClientImmutables(self._http_client)
         result = immutable_client.create(
             storage_index, sharenums, allocated_size, upload_secret, renew_secret,
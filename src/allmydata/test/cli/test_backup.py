@@ -22,7 +22,7 @@ from allmydata.util import fileutil
 from allmydata.util.fileutil import abspath_expanduser_unicode
 from allmydata.util.encodingutil import get_io_encoding, unicode_to_argv
 from allmydata.util.namespace import Namespace
-from allmydata.scripts import cli, backupdb
+from allmydata.scripts import cli, backupdb, tahoe_backup
 from ..common_util import StallMixin
 from ..no_network import GridTestMixin
 from .common import (
@@ -317,6 +317,37 @@ class Backup(GridTestMixin, CLITestMixin, StallMixin, unittest.TestCase):
 
         return d
 
+    def test_backup_jobs(self):
+        self.basedir = "cli/Backup/backup_jobs"
+        self.set_up_grid(oneshare=True)
+
+        source = os.path.join(self.basedir, "home")
+        for i in range(4):
+            self.writeto("a/file%d" % (i,), "a%d" % (i,))
+            self.writeto("a/b/file%d" % (i,), "b%d" % (i,) * 1000)
+        fileutil.make_dirs(os.path.join(source, "empty"))
+
+        def do_backup():
+            return self.do_cli("backup", "--jobs=4", source, "tahoe:backups")
+
+        d = self.do_cli("create-alias", "tahoe")
+        d.addCallback(lambda res: do_backup())
+        def _check_first(args):
+            (rc, out, err) = args
+            self.failUnlessReallyEqual((rc, err), (0, ""))
+            # home, a, a/b, empty
+            self.failUnlessReallyEqual(self.count_output(out), [8, 0, 0, 4, 0, 0])
+        d.addCallback(_check_first)
+        d.addCallback(lambda res: do_backup())
+        def _check_second(args):
+            (rc, out, err) = args
+            self.failUnlessReallyEqual((rc, err), (0, ""))
+            self.failUnlessReallyEqual(self.count_output(out), [0, 8, 0, 0, 4, 0])
+        d.addCallback(_check_second)
+        d.addCallback(lambda res: self.do_cli("get", "tahoe:backups/Latest/a/b/file3"))
+        d.addCallback(lambda args: self.failUnlessReallyEqual(args[1], "b3" * 1000))
+        return d
+
     def _check_filtering(self, filtered, all, included, excluded):
         filtered = set(filtered)
         all = set(all)
@@ -325,6 +356,73 @@ class Backup(GridTestMixin, CLITestMixin, StallMixin, unittest.TestCase):
         self.failUnlessReallyEqual(filtered, included)
         self.failUnlessReallyEqual(all.difference(filtered), excluded)
 
+    def test_backup_chunked(self):
+        self.basedir = "cli/Backup/backup_chunked"
+        self.set_up_grid(oneshare=True)
+        self.patch(tahoe_backup.FileUpload, "AVERAGE_CHUNK_SIZE", 16384)
+
+        source = os.path.join(self.basedir, "home")
+        data = os.urandom(200000)
+        self.writeto("big", data)
+        self.writeto("small", "small")
+
+        def do_backup():
+            return self.do_cli("backup", "--verbose", "--chunk-above=50kB",
+                               source, "tahoe:backups")
+
+        def chunks_uploaded(out):
+            mo = re.search(r"uploaded (\d+) of (\d+) chunks", out)
+            return (int(mo.group(1)), int(mo.group(2)))
+
+        d = self.do_cli("create-alias", "tahoe")
+        d.addCallback(lambda res: do_backup())
+        def _check_first(args):
+            (rc, out, err) = args
+            self.failUnlessReallyEqual((rc, err), (0, ""))
+            self.failUnlessReallyEqual(self.count_output(out), [2, 0, 0, 1, 0, 0])
+            (uploaded, chunks) = chunks_uploaded(out)
+            self.failUnless(chunks > 2, out)
+            self.failUnlessReallyEqual(uploaded, chunks)
+            self.chunks = chunks
+        d.addCallback(_check_first)
+
+        # get and cp put the chunks back together
+        got = os.path.join(self.basedir, "got")
+        d.addCallback(lambda res: self.do_cli("get", "tahoe:backups/Latest/big", got))
+        d.addCallback(lambda res: self.failUnlessReallyEqual(fileutil.read(got), data))
+        restored = os.path.join(self.basedir, "restored")
+        d.addCallback(lambda res: self.do_cli("cp", "-r", "tahoe:backups/Latest", restored))
+        def _check_cp(args):
+            (rc, out, err) = args
+            self.failUnlessReallyEqual(rc, 0, err)
+            self.failUnlessReallyEqual(
+                fileutil.read(os.path.join(restored, "Latest", "big")), data)
+            self.failUnlessReallyEqual(
+                fileutil.read(os.path.join(restored, "Latest", "small")), b"small")
+        d.addCallback(_check_cp)
+        d.addCallback(lambda res: self.do_cli("cp", "tahoe:backups/Latest/big",
+                                              os.path.join(self.basedir, "big")))
+        d.addCallback(lambda res: self.failUnlessReallyEqual(
+            fileutil.read(os.path.join(self.basedir, "big")), data))
+
+        # after a small change in the middle, most of the chunks are reused
+        def _change(res):
+            self.writeto("big", data[:100000] + b"change" + data[100000:])
+            return do_backup()
+        d.addCallback(_change)
+        def _check_second(args):
+            (rc, out, err) = args
+            self.failUnlessReallyEqual((rc, err), (0, ""))
+            self.failUnlessReallyEqual(self.count_output(out), [1, 1, 0, 1, 0, 0])
+            (uploaded, chunks) = chunks_uploaded(out)
+            self.failUnless(uploaded <= 2, out)
+            self.failUnless(chunks - self.chunks in (-1, 0, 1), out)
+        d.addCallback(_check_second)
+        d.addCallback(lambda res: self.do_cli("get", "tahoe:backups/Latest/big", got))
+        d.addCallback(lambda res: self.failUnlessReallyEqual(
+            fileutil.read(got), data[:100000] + b"change" + data[100000:]))
+        return d
+
     def test_exclude_options(self):
         root_listdir = (u'lib.a', u'_darcs', u'subdir', u'nice_doc.lyx')
         subdir_listdir = (u'another_doc.lyx', u'run_snake_run.py', u'CVS', u'.svn', u'_darcs')
@@ -11,7 +11,7 @@ if PY2:
     # Don't import future bytes so we don't break a couple of tests
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, dict, list, object, range, str, max, min  # noqa: F401
 
-import sys
+import sys, sqlite3
 import os.path, time
 from six.moves import cStringIO as StringIO
 from twisted.trial import unittest
@@ -33,7 +33,7 @@ class BackupDB(unittest.TestCase):
         fileutil.make_dirs(basedir)
         dbfile = os.path.join(basedir, "dbfile")
         bdb = self.create(dbfile)
-        self.failUnlessEqual(bdb.VERSION, 2)
+        self.failUnlessEqual(bdb.VERSION, 3)
 
     def test_upgrade_v1_v2(self):
         self.basedir = basedir = os.path.join("backupdb", "upgrade_v1_v2")
@@ -46,7 +46,21 @@ class BackupDB(unittest.TestCase):
         self.failUnless(created, "unable to create v1 backupdb")
         # now we should have a v1 database on disk
         bdb = self.create(dbfile)
-        self.failUnlessEqual(bdb.VERSION, 2)
+        self.failUnlessEqual(bdb.VERSION, 3)
+
+    def test_upgrade_v2_v3(self):
+        self.basedir = basedir = os.path.join("backupdb", "upgrade_v2_v3")
+        fileutil.make_dirs(basedir)
+        dbfile = os.path.join(basedir, "dbfile")
+        stderr = StringIO()
+        created = backupdb.get_backupdb(dbfile, stderr=stderr,
+                                        create_version=(backupdb.SCHEMA_v2, 2),
+                                        just_create=True)
+        self.failUnless(created, "unable to create v2 backupdb")
+        bdb = self.create(dbfile)
+        self.failUnlessEqual(bdb.VERSION, 3)
+        r = bdb.check_chunk(b"chunk")
+        self.failIf(r.was_uploaded())
 
     def test_fail(self):
         self.basedir = basedir = os.path.join("backupdb", "fail")
@@ -151,6 +165,36 @@ class BackupDB(unittest.TestCase):
         r = bdb.check_file(foo_fn)
         self.failUnlessEqual(r.was_uploaded(), False)
 
+    def test_prefetch_and_batched_commits(self):
+        self.basedir = basedir = os.path.join("backupdb", "prefetch")
+        fileutil.make_dirs(basedir)
+        dbfile = os.path.join(basedir, "dbfile")
+        bdb = self.create(dbfile)
+        bdb.cursor.execute("PRAGMA journal_mode")
+        self.failUnlessEqual(bdb.cursor.fetchone()[0], "wal")
+
+        foo_fn = self.writeto("dir/foo.txt", "foo")
+        bar_fn = self.writeto("dir/bar.txt", "bar")
+        bdb.check_file(foo_fn).did_upload(b"foo-cap")
+        bdb.check_file(bar_fn).did_upload(b"bar-cap")
+
+        # the changes are not committed one at a time
+        other = sqlite3.connect(dbfile)
+        def _count():
+            return other.execute("SELECT COUNT(*) FROM local_files").fetchone()[0]
+        self.failUnlessEqual(_count(), 0)
+        bdb.commit()
+        self.failUnlessEqual(_count(), 2)
+        other.close()
+
+        # the files of a directory can be looked up at once
+        bdb.prefetch_files([foo_fn, bar_fn])
+        bdb.cursor.execute("DELETE FROM local_files")
+        self.failUnlessEqual(bdb.check_file(foo_fn).was_uploaded(), b"foo-cap")
+        self.failUnlessEqual(bdb.check_file(bar_fn).was_uploaded(), b"bar-cap")
+        # but only once
+        self.failUnlessEqual(bdb.check_file(foo_fn).was_uploaded(), False)
+
     def test_wrong_version(self):
         self.basedir = basedir = os.path.join("backupdb", "wrong_version")
         fileutil.make_dirs(basedir)
@@ -229,6 +273,39 @@ class BackupDB(unittest.TestCase):
         r = bdb.check_directory(contents3)
         self.failIf(r.was_created())
 
+    def test_chunk(self):
+        self.basedir = basedir = os.path.join("backupdb", "chunk")
+        fileutil.make_dirs(basedir)
+        dbfile = os.path.join(basedir, "dbfile")
+        bdb = self.create(dbfile)
+
+        r = bdb.check_chunk(b"some bytes")
+        self.failUnless(isinstance(r, backupdb.ChunkResult))
+        self.failIf(r.was_uploaded())
+        chunkcap = b"URI:CHK:chunk1"
+        r.did_upload(chunkcap)
+
+        r = bdb.check_chunk(b"some bytes")
+        self.failUnlessEqual(r.was_uploaded(), chunkcap)
+        self.failUnlessEqual(type(r.was_uploaded()), bytes)
+        self.failUnlessEqual(r.should_check(), False)
+        self.failIf(bdb.check_chunk(b"some other bytes").was_uploaded())
+
+        bdb.NO_CHECK_BEFORE = 0
+        bdb.ALWAYS_CHECK_AFTER = 0.1
+        time.sleep(1.0)
+
+        r = bdb.check_chunk(b"some bytes")
+        self.failUnlessEqual(r.should_check(), True)
+        r.did_check_healthy("results")
+
+        bdb.NO_CHECK_BEFORE = 200
+        bdb.ALWAYS_CHECK_AFTER = 400
+
+        r = bdb.check_chunk(b"some bytes")
+        self.failUnlessEqual(r.was_uploaded(), chunkcap)
+        self.failUnlessEqual(r.should_check(), False)
+
     def test_unicode(self):
         skip_if_cannot_represent_filename(u"f\u00f6\u00f6.txt")
         skip_if_cannot_represent_filename(u"b\u00e5r.txt")
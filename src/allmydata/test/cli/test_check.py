@@ -221,6 +221,22 @@ class Check(GridTestMixin, CLITestMixin, unittest.TestCase):
                             in lines, out)
         d.addCallback(_check2)
 
+        # the gateway remembered those checks
+        d.addCallback(lambda ign: self.do_cli("deep-check", "--verbose",
+                                              "--recheck-age=3600",
+                                              self.rooturi))
+        def _check_recheck_age(args):
+            (rc, out, err) = args
+            self.assertEqual(len(err), 0, err)
+            self.failUnlessReallyEqual(rc, 0)
+            out = ensure_text(out)
+            lines = out.splitlines()
+            self.failUnlessIn("'<root>': Healthy (last checked ", out)
+            self.failUnlessIn("'mutable': Healthy (last checked ", out)
+            self.failUnless("done: 4 objects checked, 4 healthy, 0 unhealthy"
+                            in lines, out)
+        d.addCallback(_check_recheck_age)
+
         d.addCallback(lambda ign: self.do_cli("stats", self.rooturi))
         def _check_stats(args):
             (rc, out, err) = args
@@ -424,7 +440,7 @@ class Check(GridTestMixin, CLITestMixin, unittest.TestCase):
         def _stash_uri(n):
             self.uriList.append(n.get_uri())
         d.addCallback(_stash_uri)
-        d = c0.create_dirnode()
+        d.addCallback(lambda ign: c0.create_dirnode())
         d.addCallback(_stash_uri)
 
         d.addCallback(lambda ign: self.do_cli("check", self.uriList[0], self.uriList[1]))
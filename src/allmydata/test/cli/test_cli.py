@@ -577,6 +577,10 @@ class Help(unittest.TestCase):
         help = str(cli.UnlinkOptions())
         self.failUnlessIn("[options] REMOTE_FILE", help)
 
+    def test_shard_directory(self):
+        help = str(cli.ShardDirectoryOptions())
+        self.failUnlessIn("[options] REMOTE_DIR", help)
+
     def test_mv(self):
         help = str(cli.MvOptions())
         self.failUnlessIn("[options] FROM TO", help)
@@ -1073,6 +1077,42 @@ class Unlink(GridTestMixin, CLITestMixin, unittest.TestCase):
         return d
 
 
+class ShardDirectory(GridTestMixin, CLITestMixin, unittest.TestCase):
+    def test_shard_directory(self):
+        self.basedir = "cli/ShardDirectory/shard_directory"
+        self.set_up_grid(oneshare=True)
+        d = self.do_cli("create-alias", "tahoe")
+        d.addCallback(lambda ign: self.do_cli("mkdir", "tahoe:big"))
+        d.addCallback(lambda ign: self.do_cli("put", "-", "tahoe:big/file",
+                                              stdin="contents"))
+        d.addCallback(lambda ign: self.do_cli("shard-directory", "tahoe:big"))
+        def _check_shard(args):
+            (rc, out, err) = args
+            self.assertEqual(err, "")
+            self.failUnlessReallyEqual(rc, 0)
+            self.failUnlessIn("200 OK", out)
+        d.addCallback(_check_shard)
+        d.addCallback(lambda ign: self.do_cli("ls", "tahoe:big"))
+        def _check_ls(args):
+            (rc, out, err) = args
+            self.failUnlessReallyEqual(rc, 0)
+            self.assertEqual(out.splitlines(), ["file"])
+        d.addCallback(_check_ls)
+        return d
+
+    def test_shard_directory_with_nonexistent_alias(self):
+        self.basedir = "cli/ShardDirectory/shard_directory_with_nonexistent_alias"
+        self.set_up_grid(oneshare=True)
+        d = self.do_cli("shard-directory", "havasu:")
+        def _check(args):
+            (rc, out, err) = args
+            self.failUnlessReallyEqual(rc, 1)
+            self.failUnlessIn("error:", err)
+            self.assertEqual(out, "")
+        d.addCallback(_check)
+        return d
+
+
 class Stats(GridTestMixin, CLITestMixin, unittest.TestCase):
     def test_empty_directory(self):
         self.basedir = "cli/Stats/empty_directory"
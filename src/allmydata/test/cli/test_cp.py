@@ -10,7 +10,7 @@ from future.utils import PY2
 if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
-import os.path, json
+import os.path, json, threading
 from twisted.trial import unittest
 from twisted.python import usage
 from twisted.internet import defer
@@ -692,6 +692,97 @@ starting copy, 2 files, 1 directories
         d.addCallback(_check)
         return d
 
+    @defer.inlineCallbacks
+    def test_cp_jobs(self):
+        self.basedir = "cli/Cp/cp_jobs"
+        self.set_up_grid(oneshare=True)
+        self.failUnlessRaises(usage.UsageError, cli.CpOptions().parseOptions,
+                              ["--jobs=0", "a", "b"])
+
+        source = os.path.join(self.basedir, "src")
+        files = {
+            "a": b"a" * 100,
+            os.path.join("sub", "b"): b"b" * 1000,
+            os.path.join("sub", "deep", "c"): b"c" * 10,
+            os.path.join("sub", "deep", "d"): b"",
+        }
+        for (name, data) in files.items():
+            fileutil.make_dirs(os.path.dirname(os.path.join(source, name)))
+            fileutil.write(os.path.join(source, name), data)
+        fileutil.make_dirs(os.path.join(source, "empty"))
+
+        yield self.do_cli("create-alias", "tahoe")
+        (rc, out, err) = yield self.do_cli("mkdir", "tahoe:dest")
+        self.assertEqual(rc, 0, (rc, err))
+        (rc, out, err) = yield self.do_cli("cp", "-r", "--jobs=3", source, "tahoe:dest")
+        self.assertEqual((rc, err), (0, ""))
+        self.assertIn("Success: files copied (4 files, 1.11 kB in ", out)
+        (rc, out, err) = yield self.do_cli("ls", "tahoe:dest/src/sub/deep")
+        self.assertEqual(sorted(out.split()), ["c", "d"])
+        (rc, out, err) = yield self.do_cli("ls", "tahoe:dest/src/empty")
+        self.assertEqual((rc, out), (0, ""))
+
+        # and back again
+        copy = os.path.join(self.basedir, "copy")
+        (rc, out, err) = yield self.do_cli("cp", "-r", "-j", "2", "tahoe:dest/src", copy)
+        self.assertEqual((rc, err), (0, ""))
+        for (name, data) in files.items():
+            self.assertEqual(fileutil.read(os.path.join(copy, "src", name)), data)
+        self.assertEqual(os.listdir(os.path.join(copy, "src", "empty")), [])
+
+    @defer.inlineCallbacks
+    def test_cp_jobs_new_subdirs(self):
+        # each new directory is made exactly once, even when an existing
+        # directory with files of its own comes first
+        from allmydata.scripts import tahoe_cp
+        self.basedir = "cli/Cp/cp_jobs_new_subdirs"
+        self.set_up_grid(oneshare=True)
+        made = []
+        mkdir_with_children = tahoe_cp.mkdir_with_children
+        def counting_mkdir(nodeurl, children):
+            made.append(sorted(children))
+            return mkdir_with_children(nodeurl, children)
+        self.patch(tahoe_cp, "mkdir_with_children", counting_mkdir)
+
+        a = os.path.join(self.basedir, "a.txt")
+        fileutil.write(a, b"a")
+        source = os.path.join(self.basedir, "src")
+        fileutil.make_dirs(os.path.join(source, "sub", "deeper"))
+        fileutil.write(os.path.join(source, "sub", "deeper", "c.txt"), b"c")
+
+        yield self.do_cli("create-alias", "tahoe")
+        for (jobs, dest) in [("1", "tahoe:one"), ("3", "tahoe:three")]:
+            (rc, out, err) = yield self.do_cli("mkdir", dest)
+            self.assertEqual(rc, 0, (rc, err))
+            del made[:]
+            (rc, out, err) = yield self.do_cli("cp", "-r", "--jobs=" + jobs,
+                                               a, source, dest)
+            self.assertEqual((rc, err), (0, ""))
+            self.assertEqual(sorted(made), [["c.txt"], ["deeper"], ["sub"]])
+            (rc, out, err) = yield self.do_cli("ls", dest + "/src/sub/deeper")
+            self.assertEqual(out.split(), ["c.txt"])
+
+    def test_run_jobs_reports_first_error(self):
+        # with several jobs at once, the error reported is still that of
+        # the first job that failed, in order, not the first to fail
+        from allmydata.scripts.tahoe_cp import Copier
+        started = threading.Event()
+        def slow_failure():
+            started.wait(10)
+            raise ValueError("first")
+        def quick_failure():
+            started.set()
+            raise ValueError("second")
+        copier = Copier()
+        copier.jobs = 3
+        results = []
+        with self.assertRaises(ValueError) as ctx:
+            for result in copier.run_jobs([lambda: 1, slow_failure,
+                                           quick_failure, lambda: 4]):
+                results.append(result)
+        self.assertEqual(str(ctx.exception), "first")
+        self.assertEqual(results, [1])
+
     def test_cp_copies_dir(self):
         # This test ensures that a directory is copied using
         # tahoe cp -r. Refer to ticket #712:
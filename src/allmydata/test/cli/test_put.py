@@ -438,6 +438,37 @@ class Put(GridTestMixin, CLITestMixin, unittest.TestCase):
                               o.parseOptions,
                               ["--format=LDMF"])
 
+    def test_resume_token_invalid(self):
+        o = cli.PutOptions()
+        self.failUnlessRaises(usage.UsageError,
+                              o.parseOptions,
+                              ["--resume-token=../x"])
+        o = cli.PutOptions()
+        self.failUnlessRaises(usage.UsageError,
+                              o.parseOptions,
+                              ["--resume-token=x", "--mutable"])
+
+    def test_resume_token(self):
+        # tahoe put --resume-token=TOKEN file.txt
+        self.basedir = "cli/Put/resume_token"
+        self.set_up_grid(oneshare=True)
+        DATA = b"data" * 1000
+        fn = os.path.join(self.basedir, "DATAFILE")
+        fileutil.write(fn, DATA)
+        d = self.do_cli("put", "--resume-token=datafile-1", fn)
+        def _uploaded(args):
+            (rc, out, err) = args
+            self.failUnlessEqual(rc, 0, err)
+            self.failUnless(out.startswith("URI:CHK:"), out)
+            # a finished upload leaves no journal behind
+            journals = self.g.clients[0].config.get_private_path("upload-journals")
+            self.failUnlessEqual(os.listdir(journals), [])
+            return self.do_cli("get", out.strip(), return_bytes=True)
+        d.addCallback(_uploaded)
+        d.addCallback(lambda rc_out_err:
+                      self.failUnlessReallyEqual(rc_out_err[1], DATA))
+        return d
+
     def test_put_with_nonexistent_alias(self):
         # when invoked with an alias that doesn't exist, 'tahoe put'
         # should output a useful error message, not a stack trace
@@ -725,7 +725,12 @@ class FakeMutableFileNode(object):  # type: ignore # incomplete implementation
     def get_storage_index(self):
         return self.storage_index
 
-    def get_servermap(self, mode):
+    def get_root_hash(self):
+        # like a real root hash, this changes whenever the contents do
+        return hashutil.tagged_hash(b"fake root hash",
+                                    self.all_contents[self.storage_index])
+
+    def get_servermap(self, mode, max_age=None):
         return defer.succeed(None)
 
     def get_version(self):
@@ -783,7 +788,7 @@ class FakeMutableFileNode(object):  # type: ignore # incomplete implementation
         d.addCallback(_done)
         return d
 
-    def download_best_version(self):
+    def download_best_version(self, max_age=None):
         return defer.succeed(self._download_best_version())
 
 
@@ -808,7 +813,9 @@ class FakeMutableFileNode(object):  # type: ignore # incomplete implementation
         assert not self.is_readonly()
         old_contents = self.all_contents[self.storage_index]
         new_data = modifier(old_contents, None, True)
-        self.all_contents[self.storage_index] = new_data
+        if new_data is not None:
+            # like the real one, None means "no change"
+            self.all_contents[self.storage_index] = new_data
         return None
 
     # As actually implemented, MutableFilenode and MutableFileVersion
@@ -36,6 +36,32 @@ from .util import (
     make_peer,
 )
 
+class RecordingWriteLock(object):
+    """
+    I stand in for the write lock of a multi-process gateway, recording
+    its use, and granting it when told to.
+    """
+    def __init__(self):
+        self.events = []
+        self.waiting = None
+        self.requested = defer.Deferred()
+        self.granting = False
+
+    def lock_mutable(self, storage_index):
+        self.events.append(("lock", storage_index))
+        if self.granting:
+            return defer.succeed(None)
+        self.waiting = defer.Deferred()
+        self.requested.callback(None)
+        return self.waiting
+
+    def grant(self):
+        self.waiting.callback(None)
+
+    def unlock_mutable(self, storage_index):
+        self.events.append(("unlock", storage_index))
+
+
 class Filenode(AsyncBrokenTestCase, testutil.ShouldFailMixin):
     # this used to be in Publish, but we removed the limit. Some of
     # these tests test whether the new code correctly allows files
@@ -306,6 +332,33 @@ class Filenode(AsyncBrokenTestCase, testutil.ShouldFailMixin):
         return d
 
 
+    @defer.inlineCallbacks
+    def test_write_lock(self):
+        # in a multi-process gateway, writes wait for the gateway's lock on
+        # the file, and reads do not take it
+        lock = RecordingWriteLock()
+        self.nodemaker.write_lock = lock
+        n = yield self.nodemaker.create_mutable_file(MutableData(b"contents 1"))
+        si = n.get_storage_index()
+        self.assertThat(lock.events, Equals([]))
+
+        d = n.overwrite(MutableData(b"contents 2"))
+        yield lock.requested
+        self.assertThat(lock.events, Equals([("lock", si)]))
+        self.assertFalse(d.called)
+        lock.grant()
+        yield d
+        self.assertThat(lock.events, Equals([("lock", si), ("unlock", si)]))
+
+        lock.granting = True
+        yield n.modify(lambda old, servermap, first_time: old + b" modified")
+        data = yield n.download_best_version()
+        self.assertThat(data, Equals(b"contents 2 modified"))
+        self.assertThat(lock.events, Equals([("lock", si), ("unlock", si)] * 2))
+        # the read-only node shares the lock
+        self.assertIs(n.get_readonly()._write_lock, lock)
+
+
     def test_retrieve_producer_mdmf(self):
         # We should make sure that the retriever is able to pause and stop
         # correctly.
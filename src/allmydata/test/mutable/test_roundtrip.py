@@ -15,12 +15,13 @@ from ..common import AsyncTestCase
 from testtools.matchers import Equals, HasLength, Contains
 from twisted.internet import defer
 
+from allmydata import codec
 from allmydata.util import base32, consumer
 from allmydata.interfaces import NotEnoughSharesError
 from allmydata.monitor import Monitor
 from allmydata.mutable.common import MODE_READ, UnrecoverableFileError
 from allmydata.mutable.servermap import ServerMap, ServermapUpdater
-from allmydata.mutable.retrieve import Retrieve
+from allmydata.mutable.retrieve import Retrieve, _decode_and_decrypt
 from .util import PublishMixin, make_storagebroker, corrupt
 from .. import common_util as testutil
 
@@ -421,3 +422,69 @@ class Roundtrip(AsyncTestCase, testutil.ShouldFailMixin, PublishMixin):
     def test_corrupt_some_mdmf(self):
         return self._test_corrupt_some(("share_data", 12 * 40),
                                        mdmf=True)
+
+
+    def _download_with_readahead(self, servermap, offset=0, size=None,
+                                 segments_in_flight=4):
+        ver = servermap.best_recoverable_version()
+        r = Retrieve(self._fn, self._storage_broker, servermap, ver,
+                     segments_in_flight=segments_in_flight)
+        # count the segments being fetched at once
+        self._in_flight = 0
+        self._max_in_flight = 0
+        original = r._fetch_segment
+        def _fetch_segment(segnum):
+            self._in_flight += 1
+            self._max_in_flight = max(self._max_in_flight, self._in_flight)
+            d = original(segnum)
+            def _fetched(res):
+                self._in_flight -= 1
+                return res
+            d.addBoth(_fetched)
+            return d
+        r._fetch_segment = _fetch_segment
+        c = consumer.MemoryConsumer()
+        d = r.download(c, offset, size)
+        d.addCallback(lambda mc: b"".join(mc.chunks))
+        return d
+
+    @defer.inlineCallbacks
+    def test_readahead_mdmf(self):
+        yield self.publish_mdmf()
+        servermap = yield self.make_servermap()
+        new_contents = yield self._download_with_readahead(servermap)
+        self.assertThat(new_contents, Equals(self.CONTENTS))
+        self.assertThat(self._max_in_flight, Equals(4))
+
+        # a range in the middle of the file
+        offset = 300000
+        size = 400000
+        new_contents = yield self._download_with_readahead(servermap, offset,
+                                                           size)
+        self.assertThat(new_contents,
+                        Equals(self.CONTENTS[offset:offset+size]))
+
+        # one segment at a time
+        new_contents = yield self._download_with_readahead(
+            servermap, segments_in_flight=1)
+        self.assertThat(new_contents, Equals(self.CONTENTS))
+        self.assertThat(self._max_in_flight, Equals(1))
+
+    @defer.inlineCallbacks
+    def test_readahead_corrupt_some_mdmf(self):
+        # shares which turn out to be bad halfway through the file are
+        # replaced, and the segments that were fetched ahead from them are
+        # fetched again
+        yield self.publish_mdmf()
+        corrupt(None, self._storage, ("share_data", 200000), [0, 1])
+        servermap = yield self.make_servermap()
+        new_contents = yield self._download_with_readahead(servermap)
+        self.assertThat(new_contents, Equals(self.CONTENTS))
+
+    def test_decode_and_decrypt_checks_shares(self):
+        # the worker thread goes through CRSDecoder.decode(), which refuses
+        # the wrong number of shares rather than handing them to zfec
+        decoder = codec.CRSDecoder()
+        decoder.set_params(30, 3, 10)
+        self.assertRaises(AssertionError, _decode_and_decrypt, decoder,
+                          [b"x" * 10] * 2, [0, 1], 30, b"k" * 16)
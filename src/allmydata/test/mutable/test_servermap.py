@@ -14,11 +14,16 @@ if PY2:
 from ..common import AsyncTestCase
 from testtools.matchers import Equals, NotEquals, HasLength
 from twisted.internet import defer
+from foolscap.api import flushEventualQueue
 from allmydata.monitor import Monitor
 from allmydata.mutable.common import \
      MODE_CHECK, MODE_ANYTHING, MODE_WRITE, MODE_READ
 from allmydata.mutable.publish import MutableData
-from allmydata.mutable.servermap import ServerMap, ServermapUpdater
+from allmydata.mutable.filenode import MutableFileNode
+from allmydata.mutable import servermap
+from allmydata.mutable.servermap import ServerMap, ServermapUpdater, \
+     ServermapCache
+from allmydata.mutable.signatures import VerifiedSignatures
 from .util import PublishMixin
 
 class Servermap(AsyncTestCase, PublishMixin):
@@ -88,6 +93,25 @@ class Servermap(AsyncTestCase, PublishMixin):
 
         return d
 
+    def test_signature_checked_once(self):
+        """
+        Repeated MODE_READ updates of the same version check its signature
+        only once.
+        """
+        cache = VerifiedSignatures()
+        self.patch(servermap, "verified_signatures", cache)
+        d = self.make_servermap(mode=MODE_READ)
+        d.addCallback(lambda sm: self.failUnlessOneRecoverable(sm, 6))
+        d.addCallback(lambda res: self.make_servermap(mode=MODE_READ))
+        d.addCallback(lambda sm: self.failUnlessOneRecoverable(sm, 6))
+        def _check(res):
+            self.assertThat(cache.verifications, Equals(1))
+            self.assertThat(cache.hits > 0, Equals(True))
+        d.addCallback(_check)
+        # MODE_READ stops before the last shares have been looked at
+        d.addCallback(lambda res: flushEventualQueue())
+        return d
+
     def test_fetch_privkey(self):
         d = defer.succeed(None)
         # use the sibling filenode (which hasn't been used yet), and make
@@ -247,3 +271,166 @@ class Servermap(AsyncTestCase, PublishMixin):
         d.addCallback(lambda servermap:
             self.assertThat(servermap.recoverable_versions(), HasLength(1)))
         return d
+
+
+class FakeServermapCache(ServermapCache):
+    def __init__(self, *args, **kwargs):
+        ServermapCache.__init__(self, *args, **kwargs)
+        self.now = 0
+
+    def _now(self):
+        return self.now
+
+
+class ServermapCaching(AsyncTestCase, PublishMixin):
+    def setUp(self):
+        super(ServermapCaching, self).setUp()
+        return self.publish_one()
+
+    def make_servermap(self, mode):
+        smu = ServermapUpdater(self._fn, self._storage_broker, Monitor(),
+                               ServerMap(), mode)
+        return smu.update()
+
+    def make_cache(self, max_age):
+        cache = FakeServermapCache(max_age)
+        d = self.make_servermap(MODE_READ)
+        def _cache(sm):
+            cache.now = sm.get_last_update()[1]
+            cache.put(self._fn.get_storage_index(), sm, self._fn.get_pubkey())
+            return cache
+        d.addCallback(_cache)
+        # MODE_READ stops before the last shares have been looked at
+        d.addCallback(lambda cache: flushEventualQueue().addCallback(
+            lambda ign: cache))
+        return d
+
+    def test_modes(self):
+        """
+        A cached MODE_READ servermap will do for reading, but not for
+        writing or checking.
+        """
+        si = self._fn.get_storage_index()
+        d = self.make_cache(60)
+        def _check(cache):
+            (sm, pubkey) = cache.get(si, MODE_READ)
+            self.assertThat(sm.recoverable_versions(), HasLength(1))
+            self.assertThat(pubkey, Equals(self._fn.get_pubkey()))
+            self.assertThat(cache.get(si, MODE_ANYTHING), NotEquals(None))
+            self.assertThat(cache.get(si, MODE_WRITE), Equals(None))
+            self.assertThat(cache.get(si, MODE_CHECK), Equals(None))
+            self.assertThat(cache.get(b"\x00" * 16, MODE_READ), Equals(None))
+            stats = cache.get_stats()
+            self.assertThat(stats["mutable.servermap_cache.hits"], Equals(2))
+            self.assertThat(stats["mutable.servermap_cache.misses"], Equals(3))
+        d.addCallback(_check)
+        return d
+
+    def test_max_age(self):
+        """
+        Cached servermaps expire after max_age seconds, which callers can
+        override. A max_age of 0 never uses them.
+        """
+        si = self._fn.get_storage_index()
+        d = self.make_cache(60)
+        def _check(cache):
+            cache.now += 61
+            self.assertThat(cache.get(si, MODE_READ), Equals(None))
+            self.assertThat(cache.get(si, MODE_READ, max_age=120), NotEquals(None))
+            cache.max_age = 0
+            cache.now -= 61
+            self.assertThat(cache.get(si, MODE_READ), Equals(None))
+            self.assertThat(cache.get(si, MODE_READ, max_age=10), NotEquals(None))
+        d.addCallback(_check)
+        return d
+
+    def test_copies(self):
+        """
+        Callers get their own copy of a cached servermap.
+        """
+        si = self._fn.get_storage_index()
+        d = self.make_cache(60)
+        def _check(cache):
+            (sm, pubkey) = cache.get(si, MODE_READ)
+            for server in list(sm.all_servers()):
+                sm.mark_server_reachable(server)
+                for shnum in list(sm.make_sharemap()):
+                    sm.mark_bad_share(server, shnum, b"")
+            self.assertThat(sm.recoverable_versions(), HasLength(0))
+            (sm, pubkey) = cache.get(si, MODE_READ)
+            self.assertThat(sm.recoverable_versions(), HasLength(1))
+        d.addCallback(_check)
+        return d
+
+    def test_invalidate_and_evict(self):
+        """
+        Servermaps can be forgotten, and the least recently used ones are
+        forgotten when there are too many.
+        """
+        si = self._fn.get_storage_index()
+        d = self.make_cache(60)
+        def _check(cache):
+            (sm, pubkey) = cache.get(si, MODE_READ)
+            cache.invalidate(si)
+            self.assertThat(cache.get(si, MODE_READ), Equals(None))
+            self.assertThat(cache.get_stats()["mutable.servermap_cache.invalidations"],
+                            Equals(1))
+            cache._max_entries = 2
+            for i in range(3):
+                cache.put((b"%d" % i) * 16, sm, pubkey)
+            self.assertThat(list(cache._entries), Equals([b"1" * 16, b"2" * 16]))
+        d.addCallback(_check)
+        return d
+
+    def test_node_uses_cache(self):
+        """
+        A MutableFileNode with a ServermapCache uses recent servermaps
+        instead of updating them, and forgets them when it publishes.
+        """
+        cache = ServermapCache(60)
+        def make_node():
+            # not from self._nodemaker, which has one of these already
+            n = MutableFileNode(self._storage_broker,
+                                self._nodemaker.secret_holder,
+                                self._nodemaker.default_encoding_parameters,
+                                None, cache)
+            return n.init_from_cap(self._fn.get_cap())
+        n = make_node()
+        updates = []
+        original = n._update_servermap
+        def _update_servermap(servermap, mode):
+            updates.append(mode)
+            return original(servermap, mode)
+        n._update_servermap = _update_servermap
+
+        d = n.download_best_version()
+        d.addCallback(lambda data: self.assertThat(data, Equals(self.CONTENTS)))
+        d.addCallback(lambda ign: n.download_best_version())
+        d.addCallback(lambda data: self.assertThat(data, Equals(self.CONTENTS)))
+        d.addCallback(lambda ign: n.get_servermap(MODE_CHECK))
+        def _check_updates(ign):
+            self.assertThat(updates, Equals([MODE_READ, MODE_CHECK]))
+            self.assertThat(cache.get_stats()["mutable.servermap_cache.hits"],
+                            Equals(1))
+        d.addCallback(_check_updates)
+
+        # a node that has never seen the file gets its pubkey from the cache
+        def _fresh_node(ign):
+            n2 = make_node()
+            self.assertThat(n2.get_pubkey(), Equals(None))
+            d2 = n2.download_best_version()
+            d2.addCallback(lambda data: self.assertThat(data, Equals(self.CONTENTS)))
+            d2.addCallback(lambda ign: self.assertThat(n2.get_pubkey(),
+                                                       NotEquals(None)))
+            return d2
+        d.addCallback(_fresh_node)
+
+        d.addCallback(lambda ign: n.overwrite(MutableData(b"new contents")))
+        def _check_invalidated(ign):
+            self.assertThat(cache.get_stats()["mutable.servermap_cache.invalidations"],
+                            Equals(1))
+        d.addCallback(_check_invalidated)
+        d.addCallback(lambda ign: n.download_best_version())
+        d.addCallback(lambda data: self.assertThat(data, Equals(b"new contents")))
+        d.addCallback(lambda res: flushEventualQueue())
+        return d
@@ -0,0 +1,84 @@
+"""
+Tests for allmydata.mutable.signatures.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from testtools.matchers import Equals
+from twisted.internet import defer
+
+from allmydata.crypto import rsa
+from allmydata.crypto.error import BadSignature
+from allmydata.mutable.signatures import VerifiedSignatures, sign_data
+from allmydata.util import hashutil
+from ..common import AsyncTestCase
+
+
+class VerifiedSignaturesTests(AsyncTestCase):
+    def setUp(self):
+        super(VerifiedSignaturesTests, self).setUp()
+        self.privkey, self.pubkey = rsa.create_signing_keypair(2048)
+        self.fingerprint = hashutil.ssk_pubkey_fingerprint_hash(
+            rsa.der_string_from_verifying_key(self.pubkey))
+
+    @defer.inlineCallbacks
+    def test_sign_and_verify(self):
+        """
+        A signature made by sign_data() verifies, and is only checked once.
+        """
+        signature = yield sign_data(self.privkey, b"prefix")
+        cache = VerifiedSignatures()
+        yield cache.verify(self.fingerprint, self.pubkey, signature, b"prefix")
+        yield cache.verify(self.fingerprint, self.pubkey, signature, b"prefix")
+        self.assertThat(cache.verifications, Equals(1))
+        self.assertThat(cache.hits, Equals(1))
+
+    @defer.inlineCallbacks
+    def test_concurrent(self):
+        """
+        Checks of the same signature that overlap share a single check.
+        """
+        signature = rsa.sign_data(self.privkey, b"prefix")
+        cache = VerifiedSignatures()
+        yield defer.gatherResults([
+            cache.verify(self.fingerprint, self.pubkey, signature, b"prefix")
+            for i in range(5)])
+        self.assertThat(cache.verifications, Equals(1))
+        self.assertThat(cache.hits, Equals(4))
+
+    @defer.inlineCallbacks
+    def test_bad_signature(self):
+        """
+        A bad signature fails with BadSignature every time it is checked.
+        """
+        signature = rsa.sign_data(self.privkey, b"prefix")
+        cache = VerifiedSignatures()
+        for i in range(2):
+            with self.assertRaises(BadSignature):
+                yield cache.verify(self.fingerprint, self.pubkey, signature,
+                                   b"other prefix")
+        self.assertThat(cache.verifications, Equals(2))
+
+    @defer.inlineCallbacks
+    def test_bounded(self):
+        """
+        Only the most recently used signatures are remembered.
+        """
+        cache = VerifiedSignatures(max_entries=2)
+        signatures = [(data, rsa.sign_data(self.privkey, data))
+                      for data in [b"one", b"two", b"three"]]
+        for (data, signature) in signatures:
+            yield cache.verify(self.fingerprint, self.pubkey, signature, data)
+        self.assertThat(cache.verifications, Equals(3))
+        # "two" and "three" are still known, "one" is not
+        for (data, signature) in signatures[1:] + signatures[:1]:
+            yield cache.verify(self.fingerprint, self.pubkey, signature, data)
+        self.assertThat(cache.verifications, Equals(4))
+        self.assertThat(cache.hits, Equals(2))
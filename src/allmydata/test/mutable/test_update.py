@@ -16,11 +16,18 @@ from testtools.matchers import (
     Equals,
     IsInstance,
     GreaterThan,
+    LessThan,
 )
 from twisted.internet import defer
-from allmydata.interfaces import MDMF_VERSION
+from allmydata.interfaces import MDMF_VERSION, SALT_SIZE, HASH_SIZE
+from allmydata.monitor import Monitor
+from allmydata import hashtree
+from allmydata.mutable import publish
 from allmydata.mutable.filenode import MutableFileNode
+from allmydata.mutable.layout import mdmf_layout_is_unchanged, \
+     PRIVATE_KEY_SIZE, VERIFICATION_KEY_SIZE
 from allmydata.mutable.publish import MutableData, DEFAULT_MAX_SEGMENT_SIZE
+from allmydata.util import mathutil
 from ..no_network import GridTestMixin
 from .. import common_util as testutil
 
@@ -251,3 +258,119 @@ class Update(GridTestMixin, AsyncTestCase, testutil.ShouldFailMixin):
             return d
         d0.addCallback(_run)
         return d0
+
+    def _count_bytes_written(self):
+        # returns a list, to which the length of every write vector sent to
+        # a storage server is appended
+        written = []
+        for ss in self.g.servers_by_number.values():
+            def _write(storage_index, secrets, tw_vectors, read_vector,
+                       renew_leases=True,
+                       original=ss.slot_testv_and_readv_and_writev):
+                for (testv, datav, new_length) in tw_vectors.values():
+                    written.extend([len(data) for (offset, data) in datav])
+                return original(storage_index, secrets, tw_vectors,
+                                read_vector, renew_leases)
+            self.patch(ss, "slot_testv_and_readv_and_writev", _write)
+        return written
+
+    def _most_written_for_one_block(self, node, segment_size=SEGSIZE):
+        # one block and its salt per share, plus a little for the hashes,
+        # the signature and the header, but not the encrypted private key
+        # or the verification key, which a delta update does not rewrite
+        k = node.get_required_shares()
+        n = node.get_total_shares()
+        block_size = mathutil.div_ceil(segment_size, k)
+        return n * (block_size + SALT_SIZE + 1000)
+
+    @defer.inlineCallbacks
+    def test_delta_replace(self):
+        # Replacing a few bytes in the middle of the file leaves the layout
+        # of the shares as it is, so only the changed blocks and hashes are
+        # written.
+        yield self.do_upload_mdmf()
+        expected = self.data[:SEGSIZE+100] + b"replaced" + \
+                   self.data[SEGSIZE+108:]
+        written = self._count_bytes_written()
+        mv = yield self.mdmf_node.get_best_mutable_version()
+        yield mv.update(MutableData(b"replaced"), SEGSIZE+100)
+        self.assertThat(sum(written),
+                        LessThan(self._most_written_for_one_block(
+                            self.mdmf_node)))
+        results = yield self.mdmf_node.download_best_version()
+        self._check_differences(results, expected)
+
+    @defer.inlineCallbacks
+    def test_delta_append(self):
+        # A short append which does not change the size of the last block
+        # is written as a delta, too.
+        self.data += b"x"
+        yield self.do_upload_mdmf()
+        k = self.mdmf_node.get_required_shares()
+        tail = len(self.data) % mathutil.next_multiple(SEGSIZE, k)
+        appended = b"y" * (mathutil.next_multiple(tail, k) - tail)
+        self.assertThat(len(appended), GreaterThan(0))
+        written = self._count_bytes_written()
+        mv = yield self.mdmf_node.get_best_mutable_version()
+        yield mv.update(MutableData(appended), len(self.data))
+        # only the last block, which is much shorter than the others
+        self.assertThat(sum(written),
+                        LessThan(self._most_written_for_one_block(
+                            self.mdmf_node, tail + len(appended))))
+        results = yield self.mdmf_node.download_best_version()
+        self.assertThat(results, Equals(self.data + appended))
+
+    @defer.inlineCallbacks
+    def test_delta_replace_across_segments(self):
+        # The nodes of the block hash tree above several rewritten segments
+        # are recomputed from the hashes of their neighbours.
+        yield self.do_upload_mdmf()
+        new_data = b"Z" * (SEGSIZE + 200)
+        offset = SEGSIZE - 100
+        expected = self.data[:offset] + new_data + \
+                   self.data[offset+len(new_data):]
+        mv = yield self.mdmf_node.get_best_mutable_version()
+        yield mv.update(MutableData(new_data), offset)
+        results = yield self.mdmf_node.download_best_version()
+        self._check_differences(results, expected)
+        # and the shares are still healthy
+        r = yield self.mdmf_node.check(Monitor(), verify=True)
+        self.assertThat(r.is_healthy(), Equals(True))
+
+    @defer.inlineCallbacks
+    def test_append_cost(self):
+        # An append that changes the size of the last block is not written
+        # as a delta: the block hash tree sits after the share data, so it
+        # moves, and every share gets all of it rewritten, along with the
+        # keys. What an append costs therefore grows with the number of
+        # segments in the file, not with the amount appended. Small
+        # segments make the tree big enough to see this.
+        self.patch(publish, "DEFAULT_MAX_SEGMENT_SIZE", 1024)
+        yield self.do_upload_mdmf()
+        k = self.mdmf_node.get_required_shares()
+        n = self.mdmf_node.get_total_shares()
+        segment_size = mathutil.next_multiple(1024, k)
+        appended = b"y" * 100
+        self.assertThat(mdmf_layout_is_unchanged(segment_size, k,
+                                                 len(self.data),
+                                                 len(self.data) + 100),
+                        Equals(False))
+        written = self._count_bytes_written()
+        mv = yield self.mdmf_node.get_best_mutable_version()
+        yield mv.update(MutableData(appended), len(self.data))
+
+        num_segments = mathutil.div_ceil(len(self.data) + 100, segment_size)
+        tree_size = (2 * hashtree.roundup_pow2(num_segments) - 1) * HASH_SIZE
+        # the whole tree, for every share
+        self.assertThat(sum(written), GreaterThan(n * tree_size))
+        # and besides it, the last two blocks at most, the keys, and a
+        # little for the other hashes, the signature and the header
+        block_size = segment_size // k
+        self.assertThat(sum(written),
+                        LessThan(n * (tree_size
+                                      + 2 * (block_size + SALT_SIZE)
+                                      + PRIVATE_KEY_SIZE
+                                      + VERIFICATION_KEY_SIZE
+                                      + 1000)))
+        results = yield self.mdmf_node.download_best_version()
+        self.assertThat(results, Equals(self.data + appended))
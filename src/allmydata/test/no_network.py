@@ -49,7 +49,7 @@ import treq
 from allmydata.util.assertutil import _assert
 
 from allmydata import uri as tahoe_uri
-from allmydata.client import _Client
+from allmydata.client import _Client, KeyGenerator
 from allmydata.storage.server import (
     StorageServer, storage_index_to_dir, FoolscapStorageServer,
 )
@@ -230,6 +230,8 @@ class NoNetworkStorageBroker(object):  # type: ignore # missing many methods
             seed = server.get_permutation_seed()
             return permute_server_hash(peer_selection_index, seed)
         return sorted(self.get_connected_servers(), key=_permuted)
+    def iter_servers_for_psi(self, peer_selection_index):
+        return iter(self.get_servers_for_psi(peer_selection_index))
     def get_connected_servers(self):
         return self.client._servers
     def get_nickname_for_serverid(self, serverid):
@@ -288,8 +290,9 @@ class _NoNetworkClient(_Client):  # type: ignore  # tahoe-lafs/ticket/3573
         return service.MultiService.stopService(self)
     def init_helper(self):
         pass
-    def init_key_gen(self):
-        pass
+    def init_key_generator(self):
+        # make keys in-process, rather than in a pool of worker processes
+        self._key_generator = KeyGenerator()
     def init_storage(self):
         pass
     def init_client_storage_broker(self):
@@ -0,0 +1,83 @@
+"""
+Tests for allmydata.util.chunking.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import random
+from io import BytesIO
+
+from twisted.trial import unittest
+
+from allmydata.util.chunking import Chunker
+
+
+def random_bytes(length, seed=0):
+    r = random.Random(seed)
+    return bytes(r.getrandbits(8) for i in range(length))
+
+
+class Chunking(unittest.TestCase):
+    def chunks(self, data, avg_size=1024):
+        return list(Chunker(avg_size).chunks(BytesIO(data)))
+
+    def test_sizes(self):
+        data = random_bytes(200000)
+        chunks = self.chunks(data)
+        self.assertEqual(b"".join(chunks), data)
+        for chunk in chunks[:-1]:
+            self.assertTrue(256 <= len(chunk) <= 4096, len(chunk))
+        self.assertTrue(0 < len(chunks[-1]) <= 4096)
+        # most chunks are close to the average size
+        average = len(data) / len(chunks)
+        self.assertTrue(768 < average < 2048, average)
+
+    def test_small(self):
+        self.assertEqual(self.chunks(b""), [])
+        self.assertEqual(self.chunks(b"tiny"), [b"tiny"])
+
+    def test_repetitive(self):
+        # without boundaries in the contents, chunks are as large as they
+        # can be
+        chunks = self.chunks(b"\x00" * 10000)
+        self.assertEqual([len(chunk) for chunk in chunks], [4096, 4096, 1808])
+
+    def test_deterministic(self):
+        data = random_bytes(50000, seed=1)
+        self.assertEqual(self.chunks(data), self.chunks(data))
+        # reading the file in small pieces does not change the chunks
+        class Trickle(BytesIO):
+            def read(self, size=-1):
+                return BytesIO.read(self, min(size, 1000))
+        self.assertEqual(list(Chunker(1024).chunks(Trickle(data))),
+                         self.chunks(data))
+
+    def test_insertion(self):
+        data = random_bytes(100000, seed=2)
+        changed = data[:50000] + b"inserted" + data[50000:]
+        before = self.chunks(data)
+        after = self.chunks(changed)
+        # only the chunks around the change are new
+        new = set(after) - set(before)
+        self.assertTrue(len(new) <= 2, len(new))
+        self.assertTrue(len(after) > 50)
+
+    def test_stable(self):
+        # the boundaries must not change from one version to the next, or
+        # every chunk of the next backup would be new
+        data = random_bytes(12000, seed=3)
+        self.assertEqual([len(chunk) for chunk in self.chunks(data)],
+                         [1222, 615, 314, 1158, 1264, 1556, 1210, 1241,
+                          1114, 1915, 391])
+
+    def test_bad_size(self):
+        self.assertRaises(ValueError, Chunker, 1000)
+        self.assertRaises(ValueError, Chunker, 128)
+        self.assertRaises(ValueError, Chunker, 8*1024*1024)
@@ -10,7 +10,7 @@ from future.utils import PY2
 if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
-import os, sys
+import os, sys, itertools
 from functools import (
     partial,
 )
@@ -62,6 +62,9 @@ from allmydata.nodemaker import (
     NodeMaker,
 )
 from allmydata.node import OldConfigError, UnescapedHashError, create_node_dir
+from allmydata.immutable.segsize import SegmentSizePolicy
+from allmydata.keypool import KeyPool
+from allmydata.gateway import GatewayPrimary, reuseport_supported
 from allmydata import client
 from allmydata.storage_client import (
     StorageClientConfig,
@@ -401,6 +404,224 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
         with self.assertRaises(ValueError):
             yield client.create_client(basedir)
 
+    @defer.inlineCallbacks
+    def test_download_hedging(self):
+        """
+        download.hedge.* options are propagated to the NodeMaker
+        """
+        basedir = "client.Basic.test_download_hedging"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "download.hedge.extra_requests = 2\n" +
+                       "download.hedge.percentile = 95\n")
+        c = yield client.create_client(basedir)
+        self.assertEqual(c.nodemaker.download_parameters,
+                         {"hedge_extra_requests": 2,
+                          "hedge_percentile": 95.0,
+                          "mutable_segments_in_flight": 4})
+
+    @defer.inlineCallbacks
+    def test_download_hedging_default(self):
+        """
+        hedged downloads are disabled by default
+        """
+        basedir = "client.Basic.test_download_hedging_default"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = yield client.create_client(basedir)
+        self.assertEqual(c.nodemaker.download_parameters,
+                         {"hedge_extra_requests": 0,
+                          "hedge_percentile": None,
+                          "mutable_segments_in_flight": 4})
+
+    @defer.inlineCallbacks
+    def test_download_hedging_bad(self):
+        """
+        download.hedge.percentile must be a percentage
+        """
+        basedir = "client.Basic.test_download_hedging_bad"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "download.hedge.percentile = 150\n")
+        with self.assertRaises(ValueError):
+            yield client.create_client(basedir)
+
+    @defer.inlineCallbacks
+    def test_mutable_segments_in_flight(self):
+        """
+        mutable.download.segments_in_flight is propagated to the NodeMaker,
+        and must be at least 1
+        """
+        basedir = "client.Basic.test_mutable_segments_in_flight"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "mutable.download.segments_in_flight = 8\n")
+        c = yield client.create_client(basedir)
+        self.assertEqual(
+            c.nodemaker.download_parameters["mutable_segments_in_flight"], 8)
+
+        basedir = "client.Basic.test_mutable_segments_in_flight_bad"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "mutable.download.segments_in_flight = 0\n")
+        with self.assertRaises(ValueError):
+            yield client.create_client(basedir)
+
+    @defer.inlineCallbacks
+    def test_deep_traverse(self):
+        """
+        deep_traverse.* options are propagated to the NodeMaker
+        """
+        basedir = "client.Basic.test_deep_traverse"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = yield client.create_client(basedir)
+        self.assertEqual(c.nodemaker.traversal_parameters,
+                         {"concurrency": 10,
+                          "max_frontier": 10000})
+
+        basedir = "client.Basic.test_deep_traverse_set"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "deep_traverse.concurrency = 4\n" +
+                       "deep_traverse.max_frontier = 500\n")
+        c = yield client.create_client(basedir)
+        self.assertEqual(c.nodemaker.traversal_parameters,
+                         {"concurrency": 4,
+                          "max_frontier": 500})
+
+    @defer.inlineCallbacks
+    def test_deep_traverse_bad(self):
+        """
+        deep_traverse.concurrency must be at least 1
+        """
+        basedir = "client.Basic.test_deep_traverse_bad"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "deep_traverse.concurrency = 0\n")
+        with self.assertRaises(ValueError):
+            yield client.create_client(basedir)
+
+    @defer.inlineCallbacks
+    def test_upload_segments_in_flight(self):
+        """
+        upload.max_segments_in_flight sets the uploader's segment window
+        """
+        basedir = "client.Basic.test_upload_segments_in_flight"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = yield client.create_client(basedir)
+        self.assertEqual(c.get_encoding_parameters()["max_segments_in_flight"], 4)
+
+        basedir = "client.Basic.test_upload_segments_in_flight_set"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "upload.max_segments_in_flight = 8\n")
+        c = yield client.create_client(basedir)
+        self.assertEqual(c.get_encoding_parameters()["max_segments_in_flight"], 8)
+
+    @defer.inlineCallbacks
+    def test_upload_adaptive_segment_size(self):
+        """
+        upload.adaptive_segment_size controls whether the uploader gets a
+        SegmentSizePolicy
+        """
+        basedir = "client.Basic.test_upload_adaptive_segment_size"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = yield client.create_client(basedir)
+        uploader = c.getServiceNamed("uploader")
+        self.assertIsInstance(uploader._segment_size_policy, SegmentSizePolicy)
+
+        basedir = "client.Basic.test_upload_adaptive_segment_size_off"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "upload.adaptive_segment_size = false\n")
+        c = yield client.create_client(basedir)
+        uploader = c.getServiceNamed("uploader")
+        self.assertIs(uploader._segment_size_policy, None)
+
+    @defer.inlineCallbacks
+    def test_upload_segments_in_flight_bad(self):
+        """
+        upload.max_segments_in_flight must be at least 1
+        """
+        basedir = "client.Basic.test_upload_segments_in_flight_bad"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "upload.max_segments_in_flight = 0\n")
+        with self.assertRaises(ValueError):
+            yield client.create_client(basedir)
+
+    @defer.inlineCallbacks
+    def test_keypool(self):
+        """
+        mutable.keypool.size sets how many spare RSA keys the client keeps,
+        and 0 makes keys on demand
+        """
+        basedir = "client.Basic.test_keypool"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = yield client.create_client(basedir)
+        pool = c.getServiceNamed("keypool")
+        self.assertIsInstance(pool, KeyPool)
+        self.assertEqual(pool._size, 4)
+        self.assertIs(c.nodemaker.key_generator, pool)
+        self.assertIn("keypool.spares", c.stats_provider.get_stats()["stats"])
+
+        basedir = "client.Basic.test_keypool_off"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "mutable.keypool.size = 0\n")
+        c = yield client.create_client(basedir)
+        self.assertIsInstance(c.nodemaker.key_generator, client.KeyGenerator)
+
+    @defer.inlineCallbacks
+    def test_keypool_bad(self):
+        """
+        mutable.keypool.workers must be at least 1
+        """
+        basedir = "client.Basic.test_keypool_bad"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "mutable.keypool.workers = 0\n")
+        with self.assertRaises(ValueError):
+            yield client.create_client(basedir)
+
+    @defer.inlineCallbacks
+    def test_servermap_cache(self):
+        """
+        mutable.servermap_cache.max_age sets how long the nodemaker's
+        mutable nodes may reuse a servermap, and defaults to 0
+        """
+        basedir = "client.Basic.test_servermap_cache"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = yield client.create_client(basedir)
+        self.assertEqual(c.servermap_cache.max_age, 0)
+        self.assertIs(c.nodemaker.servermap_cache, c.servermap_cache)
+        self.assertIn("mutable.servermap_cache.hits",
+                      c.stats_provider.get_stats()["stats"])
+
+        basedir = "client.Basic.test_servermap_cache_on"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "mutable.servermap_cache.max_age = 2.5\n")
+        c = yield client.create_client(basedir)
+        self.assertEqual(c.servermap_cache.max_age, 2.5)
+
     @defer.inlineCallbacks
     def test_web_apiauthtoken(self):
         """
@@ -436,6 +657,61 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
         expected = fileutil.abspath_expanduser_unicode(u"relative", abs_basedir)
         self.failUnlessReallyEqual(w.staticdir, expected)
 
+    @defer.inlineCallbacks
+    def test_web_workers(self):
+        """
+        web.workers greater than 1 makes the client the primary of a
+        multi-process gateway, whose mutable writes take its lock
+        """
+        basedir = u"client.Basic.test_web_workers"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "[node]\n" +
+                       "web.port = tcp:0:interface=127.0.0.1\n" +
+                       "web.workers = 2\n")
+        if not reuseport_supported():
+            with self.assertRaises(ValueError):
+                yield client.create_client(basedir)
+            return
+        c = yield client.create_client(basedir)
+        self.assertIsInstance(c.gateway, GatewayPrimary)
+        self.assertEqual(c.gateway.workers, 2)
+        self.assertIs(c.nodemaker.write_lock, c.gateway)
+        self.assertTrue(os.path.exists(os.path.join(basedir, "private",
+                                                    "gateway.furl")))
+
+        basedir = u"client.Basic.test_web_workers_one"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"), BASECONFIG)
+        c = yield client.create_client(basedir)
+        self.assertIs(c.gateway, None)
+        self.assertIs(c.nodemaker.write_lock, None)
+
+    @defer.inlineCallbacks
+    def test_web_workers_bad(self):
+        """
+        web.workers must be at least 1, and needs a plain TCP web.port
+        """
+        basedir = u"client.Basic.test_web_workers_bad"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "[node]\n" +
+                       "web.workers = 0\n")
+        with self.assertRaises(ValueError):
+            yield client.create_client(basedir)
+
+        basedir = u"client.Basic.test_web_workers_unix"
+        os.mkdir(basedir)
+        fileutil.write(os.path.join(basedir, "tahoe.cfg"),
+                       BASECONFIG +
+                       "[node]\n" +
+                       "web.port = unix:web.sock\n" +
+                       "web.workers = 2\n")
+        with self.assertRaises(ValueError):
+            yield client.create_client(basedir)
+
     # TODO: also test config options for SFTP. See Git history for deleted FTP
     # tests that could be used as basis for these tests.
 
@@ -588,6 +864,66 @@ class Basic(testutil.ReallyEqualMixin, unittest.TestCase):
         sb.servers.clear()
         self.failUnlessReallyEqual(self._permute(sb, b"one"), [])
 
+    def test_iter_permute(self):
+        """
+        ``iter_servers_for_psi`` yields servers in the same order as
+        ``get_servers_for_psi``, whether or not that order has been computed
+        before.
+        """
+        sb = StorageFarmBroker(
+            True,
+            None,
+            EMPTY_CLIENT_CONFIG,
+            StorageClientConfig(preferred_peers=[b'1',b'4']),
+        )
+        for k in [b"%d" % i for i in range(5)]:
+            ann = {"anonymous-storage-FURL": SOME_FURL,
+                   "permutation-seed-base32": base32.b2a(k) }
+            sb.test_add_rref(k, "rref", ann)
+
+        lazy = [s.get_longname() for s in sb.iter_servers_for_psi(b"one")]
+        self.assertEqual(b"".join(lazy), b'14302')
+        self.assertEqual(self._permute(sb, b"one"), lazy)
+        cached = [s.get_longname() for s in sb.iter_servers_for_psi(b"one")]
+        self.assertEqual(cached, lazy)
+        first_two = list(itertools.islice(sb.iter_servers_for_psi(b"two"), 2))
+        self.assertEqual([s.get_longname() for s in first_two], [b'4', b'1'])
+
+    def test_permute_tracks_connections(self):
+        """
+        Cached permutations are discarded when servers connect or disconnect.
+        """
+        sb = StorageFarmBroker(True, None, EMPTY_CLIENT_CONFIG)
+        for k in [b"%d" % i for i in range(5)]:
+            ann = {"anonymous-storage-FURL": SOME_FURL,
+                   "permutation-seed-base32": base32.b2a(k) }
+            sb.test_add_rref(k, "rref", ann)
+        self.assertEqual(self._permute(sb, b"one"), [b'3',b'1',b'0',b'4',b'2'])
+
+        sb.servers[b"0"]._is_connected = False
+        self.assertEqual(self._permute(sb, b"one"), [b'3',b'1',b'4',b'2'])
+        self.assertEqual(
+            [s.get_longname() for s in sb.iter_servers_for_psi(b"one")],
+            [b'3',b'1',b'4',b'2'],
+        )
+
+        sb.servers[b"0"]._is_connected = True
+        self.assertEqual(self._permute(sb, b"one"), [b'3',b'1',b'0',b'4',b'2'])
+
+    def test_permute_cache_is_bounded(self):
+        """
+        Only ``PERMUTATION_CACHE_SIZE`` permutations are remembered.
+        """
+        sb = StorageFarmBroker(True, None, EMPTY_CLIENT_CONFIG)
+        self.patch(sb, "PERMUTATION_CACHE_SIZE", 3)
+        for k in [b"%d" % i for i in range(5)]:
+            ann = {"anonymous-storage-FURL": SOME_FURL,
+                   "permutation-seed-base32": base32.b2a(k) }
+            sb.test_add_rref(k, "rref", ann)
+        for psi in [b"a", b"b", b"c", b"a", b"d"]:
+            sb.get_servers_for_psi(psi)
+        self.assertEqual(list(sb._permuted.keys()), [b"c", b"a", b"d"])
+
     @defer.inlineCallbacks
     def test_versions(self):
         """
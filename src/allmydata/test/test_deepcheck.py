@@ -29,6 +29,7 @@ from twisted.trial import unittest
 from twisted.internet import defer
 from twisted.internet.defer import inlineCallbacks, returnValue
 
+from allmydata import check_index
 from allmydata.immutable import upload
 from allmydata.mutable.common import UnrecoverableFileError
 from allmydata.mutable.publish import MutableData
@@ -1235,3 +1236,123 @@ class Large(DeepCheckBase, unittest.TestCase):
         d.addCallback(_check)
 
         return d
+
+
+class Incremental(DeepCheckBase, unittest.TestCase):
+
+    @inlineCallbacks
+    def set_up_tree(self):
+        c0 = self.g.clients[0]
+        self.root = yield c0.create_dirnode()
+        yield self.root.add_file(u"large",
+                                 upload.Data(b"large enough for CHK" * 100, b""))
+        self.subdir = yield self.root.create_subdirectory(u"subdir")
+        yield self.subdir.add_file(u"large",
+                                   upload.Data(b"another CHK file" * 100, b""))
+
+    def rechecked(self, results):
+        # the paths of the objects which were checked again
+        rechecked = []
+        for (path, r) in results.get_all_results().items():
+            if ICheckAndRepairResults.providedBy(r):
+                r = r.get_pre_repair_results()
+            if "last checked" not in r.get_summary():
+                rechecked.append(path)
+        return sorted(rechecked)
+
+    @inlineCallbacks
+    def test_recheck_age(self):
+        self.basedir = "deepcheck/Incremental/recheck_age"
+        self.set_up_grid()
+        yield self.set_up_tree()
+        everything = [(), (u"large",), (u"subdir",), (u"subdir", u"large")]
+
+        # a full deep-check records every result
+        r = yield self.root.start_deep_check().when_done()
+        self.failUnlessEqual(self.rechecked(r), everything)
+
+        # so that a later one can skip them, while still reporting on them
+        r = yield self.root.start_deep_check(recheck_age=3600).when_done()
+        self.failUnlessEqual(self.rechecked(r), [])
+        self.failUnlessEqual(r.get_counters()["count-objects-checked"], 4)
+        self.failUnlessEqual(r.get_counters()["count-objects-healthy"], 4)
+
+        # a directory which has changed is checked again
+        yield self.subdir.set_uri(u"small",
+                                  LiteralFileURI(b"small").to_string(), None)
+        r = yield self.root.start_deep_check(recheck_age=3600).when_done()
+        self.failUnlessEqual(self.rechecked(r), [(u"subdir",)])
+
+        # as is everything which was checked too long ago, or not verified
+        r = yield self.root.start_deep_check(recheck_age=0).when_done()
+        self.failUnlessEqual(self.rechecked(r), everything)
+        r = yield self.root.start_deep_check(verify=True,
+                                             recheck_age=3600).when_done()
+        self.failUnlessEqual(self.rechecked(r), everything)
+        r = yield self.root.start_deep_check_and_repair(
+            verify=True, recheck_age=3600).when_done()
+        self.failUnlessEqual(r.get_counters()["count-objects-checked"], 4)
+        self.failUnlessEqual(r.get_counters()["count-repairs-attempted"], 0)
+        self.failUnlessEqual(self.rechecked(r), [])
+
+    @inlineCallbacks
+    def test_unhealthy_is_rechecked(self):
+        self.basedir = "deepcheck/Incremental/unhealthy_is_rechecked"
+        self.set_up_grid()
+        yield self.set_up_tree()
+        filenode = yield self.root.get(u"large")
+        self.delete_shares_numbered(filenode.get_uri(), [0])
+        r = yield self.root.start_deep_check().when_done()
+        self.failUnlessEqual(r.get_counters()["count-objects-unhealthy"], 1)
+        r = yield self.root.start_deep_check(recheck_age=3600).when_done()
+        self.failUnlessEqual(self.rechecked(r), [(u"large",)])
+        self.failUnlessEqual(r.get_counters()["count-objects-unhealthy"], 1)
+
+    @inlineCallbacks
+    def test_stream(self):
+        self.basedir = "deepcheck/Incremental/stream"
+        self.set_up_grid()
+        yield self.set_up_tree()
+        yield self.root.start_deep_check().when_done()
+        (output, url) = yield self.web(self.root, method="POST",
+                                       t="stream-deep-check",
+                                       **{"recheck-age": "3600"})
+        units = list(self.parse_streamed_json(output))
+        self.failUnlessEqual(units[-1]["type"], "stats")
+        summaries = [u["check-results"]["summary"] for u in units[:-1]]
+        self.failUnlessEqual(len(summaries), 4)
+        for summary in summaries:
+            self.failUnlessIn("last checked", summary)
+
+    def test_index_is_persistent(self):
+        basedir = "deepcheck/Incremental/index_is_persistent"
+        os.makedirs(basedir)
+        dbfile = os.path.join(basedir, "check_index.sqlite")
+        index = check_index.get_check_index(dbfile)
+        results = FakeCheckResults()
+        index.did_check("URI:CHK-Verifier:a", results, verified=False,
+                        now=1000)
+        index.flush()
+        record = check_index.get_check_index(dbfile).get("URI:CHK-Verifier:a")
+        self.failUnlessEqual(record.last_checked, 1000)
+        self.failUnlessEqual(record.healthy, True)
+        self.failUnlessEqual(record.verified, False)
+        self.failUnlessEqual(record.count_shares_good, 10)
+        self.failUnlessEqual(record.seqnum, None)
+        self.failUnlessEqual(check_index.get_check_index(dbfile).get("URI:CHK-Verifier:b"),
+                             None)
+
+
+class FakeCheckResults(object):
+    def is_healthy(self):
+        return True
+    def get_happiness(self):
+        return 10
+    def get_encoding_needed(self):
+        return 3
+    def get_encoding_expected(self):
+        return 10
+    def get_share_counter_good(self):
+        return 10
+    def get_host_counter_good_shares(self):
+        return 10
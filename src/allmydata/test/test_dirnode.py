@@ -20,11 +20,12 @@ from zope.interface import implementer
 from twisted.trial import unittest
 from twisted.internet import defer
 from twisted.internet.interfaces import IConsumer
-from allmydata import uri, dirnode
+from foolscap.api import fireEventually
+from allmydata import uri, dirnode, sharded_dirnode
 from allmydata.client import _Client
 from allmydata.immutable import upload
 from allmydata.immutable.literal import LiteralFileNode
-from allmydata.interfaces import IImmutableFileNode, IMutableFileNode, \
+from allmydata.interfaces import IImmutableFileNode, IMutableFileNode, IDirectoryNode, \
      ExistingChildError, NoSuchChildError, MustNotBeUnknownRWError, \
      MustBeDeepImmutableError, MustBeReadonlyError, \
      IDeepCheckResults, IDeepCheckAndRepairResults, \
@@ -33,7 +34,7 @@ from allmydata.mutable.filenode import MutableFileNode
 from allmydata.mutable.common import UncoordinatedWriteError
 from allmydata.util import hashutil, base32
 from allmydata.util.netstring import split_netstring
-from allmydata.monitor import Monitor
+from allmydata.monitor import Monitor, OperationCancelledError
 from allmydata.test.common import make_chk_file_uri, make_mutable_file_uri, \
      ErrorMixin
 from allmydata.test.no_network import GridTestMixin
@@ -1592,7 +1593,7 @@ class FakeMutableFile(object):  # type: ignore # incomplete implementation
     def get_write_uri(self):
         return self.uri.to_string()
 
-    def download_best_version(self):
+    def download_best_version(self, max_age=None):
         return defer.succeed(self.data)
 
     def get_writekey(self):
@@ -1615,7 +1616,8 @@ class FakeMutableFile(object):  # type: ignore # incomplete implementation
 
     def modify(self, modifier):
         data = modifier(self.data, None, True)
-        self.data = data
+        if data is not None:
+            self.data = data
         return defer.succeed(None)
 
 class FakeNodeMaker(NodeMaker):
@@ -1820,6 +1822,63 @@ class Dirnode2(testutil.ReallyEqualMixin, testutil.ShouldFailMixin, unittest.Tes
         for (i, n) in imm_prefixed:
             self.failUnless(n.get_readonly_uri().startswith(b"imm."), i)
 
+    @defer.inlineCallbacks
+    def test_lazy_unpacking(self):
+        """
+        Looking up one child unpacks only that child, once per version of
+        the directory, and callers get their own copy of its metadata.
+        """
+        kids = dict((u"child-%d" % i, (LiteralFileNode(uri.from_string(one_uri)),
+                                       {"i": i}))
+                    for i in range(20))
+        n = yield self.nodemaker.create_new_mutable_directory(kids)
+        unpacked = []
+        decrypt = n._decrypt_rwcapdata
+        def _decrypt(encwrcap):
+            unpacked.append(encwrcap)
+            return decrypt(encwrcap)
+        self.patch(n, "_decrypt_rwcapdata", _decrypt)
+
+        child = yield n.get(u"child-7")
+        self.failUnlessReallyEqual(child.get_uri(), one_uri)
+        self.failUnlessReallyEqual(len(unpacked), 1)
+        self.failUnless((yield n.has_child(u"child-7")))
+        self.failIf((yield n.has_child(u"child-20")))
+        metadata = yield n.get_metadata_for(u"child-7")
+        self.failUnlessReallyEqual(metadata["i"], 7)
+        metadata["i"] = 8
+        (child, metadata) = yield n.get_child_and_metadata(u"child-7")
+        self.failUnlessReallyEqual(metadata["i"], 7)
+        self.failUnlessReallyEqual(len(unpacked), 1)
+
+        children = yield n.list()
+        self.failUnlessReallyEqual(sorted(children), sorted(kids))
+        self.failUnlessReallyEqual(len(unpacked), 20)
+
+        # a new version is unpacked afresh
+        yield n.set_uri(u"child-20", one_uri, one_uri)
+        del unpacked[:]
+        self.failUnless((yield n.has_child(u"child-20")))
+        yield n.get(u"child-7")
+        self.failUnlessReallyEqual(len(unpacked), 2)
+
+    def test_parsed_directory_cache(self):
+        cache = dirnode.ParsedDirectoryCache(max_entries=2, max_bytes=10)
+        parsed = [dirnode._ParsedDirectory(None, b"%d" % i) for i in range(4)]
+        cache.put(b"a", parsed[0])
+        self.failUnlessIdentical(cache.get(b"a", b"0"), parsed[0])
+        self.failUnlessReallyEqual(cache.get(b"a", b"1"), None)
+        cache.put(b"b", parsed[1])
+        cache.put(b"a", parsed[2])
+        cache.put(b"c", parsed[3])
+        self.failUnlessReallyEqual(cache.get(b"b", b"1"), None)
+        self.failUnlessIdentical(cache.get(b"a", b"2"), parsed[2])
+        # a directory bigger than max_bytes is still kept, on its own
+        big = dirnode._ParsedDirectory(None, b"x" * 20)
+        cache.put(b"d", big)
+        self.failUnlessIdentical(cache.get(b"d", b"x" * 20), big)
+        self.failUnlessReallyEqual(cache.get(b"a", b"2"), None)
+
 
 
 class DeepStats(testutil.ReallyEqualMixin, unittest.TestCase):
@@ -1988,3 +2047,285 @@ class Adder(GridTestMixin, unittest.TestCase, testutil.ShouldFailMixin):
 
         d.addCallback(_test_adder)
         return d
+
+
+class Coalescing(GridTestMixin, testutil.ShouldFailMixin, unittest.TestCase):
+
+    def _count_modifications(self, n):
+        modifications = []
+        original = n._node.modify
+        def modify(modifier, *args, **kwargs):
+            modifications.append(modifier)
+            return original(modifier, *args, **kwargs)
+        self.patch(n._node, "modify", modify)
+        return modifications
+
+    @defer.inlineCallbacks
+    def test_concurrent_changes(self):
+        self.basedir = "dirnode/Coalescing/test_concurrent_changes"
+        self.set_up_grid(oneshare=True)
+        c = self.g.clients[0]
+        n = yield c.create_dirnode()
+        yield n.set_uri(u"old", uri.LiteralFileURI(b"old").to_string(), None)
+        modifications = self._count_modifications(n)
+
+        ds = [n.set_uri(u"child-%d" % i,
+                        uri.LiteralFileURI(b"data %d" % i).to_string(), None)
+              for i in range(10)]
+        ds.append(n.set_children({u"child-1": (uri.LiteralFileURI(b"new 1").to_string(), None),
+                                  u"other": (uri.LiteralFileURI(b"other").to_string(), None)}))
+        ds.append(n.delete(u"old"))
+        yield defer.gatherResults(ds)
+        # the first change was published on its own, and the others waited
+        # for it and were published together
+        self.assertEqual(len(modifications), 2)
+
+        children = yield n.list()
+        self.assertEqual(sorted(children.keys()),
+                         sorted([u"child-%d" % i for i in range(10)] + [u"other"]))
+        self.assertEqual(children[u"child-1"][0].get_uri(),
+                         uri.LiteralFileURI(b"new 1").to_string())
+
+    @defer.inlineCallbacks
+    def test_failures_are_separate(self):
+        self.basedir = "dirnode/Coalescing/test_failures_are_separate"
+        self.set_up_grid(oneshare=True)
+        c = self.g.clients[0]
+        n = yield c.create_dirnode()
+        yield n.set_uri(u"old", uri.LiteralFileURI(b"old").to_string(), None)
+
+        first = n.set_uri(u"first", uri.LiteralFileURI(b"first").to_string(), None)
+        existing = n.set_uri(u"old", uri.LiteralFileURI(b"new").to_string(), None,
+                             overwrite=False)
+        missing = n.delete(u"missing")
+        new = n.set_uri(u"new", uri.LiteralFileURI(b"new").to_string(), None)
+        deleted = n.delete(u"old")
+        yield first
+        yield self.shouldFail(ExistingChildError, "existing", None,
+                              lambda: existing)
+        yield self.shouldFail(NoSuchChildError, "missing", None,
+                              lambda: missing)
+        yield new
+        old_child = yield deleted
+        self.assertEqual(old_child.get_uri(), uri.LiteralFileURI(b"old").to_string())
+
+        children = yield n.list()
+        self.assertEqual(sorted(children.keys()), [u"first", u"new"])
+
+
+class ConcurrencyWalker(object):
+    """I record what a deep traversal tells me, and how many directories it
+    visits at once (from the add_node() of a directory to its
+    enter_directory())."""
+
+    def __init__(self):
+        self.paths = []
+        self.active = 0
+        self.max_active = 0
+
+    def set_monitor(self, monitor):
+        pass
+
+    def add_node(self, node, path):
+        self.paths.append(tuple(path))
+        if IDirectoryNode.providedBy(node):
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            # give the traversal a chance to start other visits
+            return fireEventually()
+
+    def enter_directory(self, parent, children):
+        self.active -= 1
+
+    def add_shard(self, shard, path):
+        pass
+
+    def finish(self):
+        return self.paths
+
+
+class DeepTraversal(GridTestMixin, unittest.TestCase):
+
+    @defer.inlineCallbacks
+    def _make_tree(self):
+        # a root with four subdirectories, each with three of their own,
+        # and one file (shared by all of them) in each directory
+        c = self.g.clients[0]
+        root = yield c.create_dirnode()
+        filecap = uri.LiteralFileURI(b"file").to_string()
+        expected = [(), (u"file",)]
+        yield root.set_uri(u"file", filecap, None)
+        for i in range(4):
+            sub = yield root.create_subdirectory(u"sub-%d" % i)
+            yield sub.set_uri(u"file", filecap, None)
+            expected.extend([(u"sub-%d" % i,), (u"sub-%d" % i, u"file")])
+            for j in range(3):
+                subsub = yield sub.create_subdirectory(u"subsub-%d" % j)
+                yield subsub.set_uri(u"file", filecap, None)
+                expected.extend([(u"sub-%d" % i, u"subsub-%d" % j),
+                                 (u"sub-%d" % i, u"subsub-%d" % j, u"file")])
+            # the same directory, reachable twice, is visited once
+            yield sub.set_node(u"again", sub)
+        defer.returnValue((root, expected))
+
+    @defer.inlineCallbacks
+    def test_concurrency(self):
+        self.basedir = "dirnode/DeepTraversal/test_concurrency"
+        self.set_up_grid(oneshare=True)
+        c = self.g.clients[0]
+        (root, expected) = yield self._make_tree()
+        self.patch(c.nodemaker, "traversal_parameters",
+                   {"concurrency": 3, "max_frontier": 100})
+        walker = ConcurrencyWalker()
+        paths = yield root.deep_traverse(walker).when_done()
+        self.assertEqual(sorted(paths), sorted(expected))
+        self.assertEqual(walker.max_active, 3)
+
+    @defer.inlineCallbacks
+    def test_max_frontier(self):
+        self.basedir = "dirnode/DeepTraversal/test_max_frontier"
+        self.set_up_grid(oneshare=True)
+        c = self.g.clients[0]
+        (root, expected) = yield self._make_tree()
+        # the frontier holds more than one directory until the very last one
+        # is taken from it, so until then directories are visited one at a
+        # time
+        self.patch(c.nodemaker, "traversal_parameters",
+                   {"concurrency": 3, "max_frontier": 1})
+        walker = ConcurrencyWalker()
+        paths = yield root.deep_traverse(walker).when_done()
+        self.assertEqual(sorted(paths), sorted(expected))
+        self.assertEqual(walker.max_active, 2)
+
+    @defer.inlineCallbacks
+    def test_cancel(self):
+        self.basedir = "dirnode/DeepTraversal/test_cancel"
+        self.set_up_grid(oneshare=True)
+        (root, expected) = yield self._make_tree()
+        walker = ConcurrencyWalker()
+        monitor = root.deep_traverse(walker)
+        monitor.cancel()
+        yield self.assertFailure(monitor.when_done(), OperationCancelledError)
+        self.assertTrue(len(walker.paths) < len(expected))
+
+
+class Sharding(GridTestMixin, testutil.ShouldFailMixin, unittest.TestCase):
+
+    def _make_children(self, count, prefix=u"child"):
+        return dict((u"%s-%d" % (prefix, i),
+                     (uri.LiteralFileURI(b"data %d" % i).to_string(), None))
+                    for i in range(count))
+
+    @defer.inlineCallbacks
+    def test_convert(self):
+        self.basedir = "dirnode/Sharding/test_convert"
+        self.set_up_grid(oneshare=True)
+        c = self.g.clients[0]
+        n = yield c.create_dirnode()
+        yield n.set_children(self._make_children(3))
+        before = yield n.list()
+
+        yield n.make_sharded()
+        data = yield n._node.download_best_version()
+        self.assertTrue(data.startswith(sharded_dirnode.LEAF_HEADER))
+        # converting it again does nothing
+        yield n.make_sharded()
+        data2 = yield n._node.download_best_version()
+        self.assertEqual(data2, data)
+
+        # a fresh node for the same cap reads it like before
+        n2 = c.create_node_from_uri(n.get_uri())
+        after = yield n2.list()
+        self.assertEqual(sorted(after.keys()), sorted(before.keys()))
+        for name in before:
+            self.assertEqual(after[name][0].get_uri(), before[name][0].get_uri())
+            self.assertEqual(after[name][1], before[name][1])
+        child = yield n2.get(u"child-1")
+        self.assertEqual(child.get_uri(), before[u"child-1"][0].get_uri())
+        ro = c.create_node_from_uri(n.get_readonly_uri())
+        has = yield ro.has_child(u"child-2")
+        self.assertTrue(has)
+
+        yield n2.delete(u"child-0")
+        yield n2.set_uri(u"new", uri.LiteralFileURI(b"new").to_string(), None)
+        children = yield n.list()
+        self.assertEqual(sorted(children.keys()), [u"child-1", u"child-2", u"new"])
+        yield self.shouldFail(NoSuchChildError, "delete", "child-0",
+                              n.delete, u"child-0")
+        yield self.shouldFail(dirnode.NotWriteableError, "make_sharded", None,
+                              ro.make_sharded)
+
+    @defer.inlineCallbacks
+    def test_split(self):
+        self.basedir = "dirnode/Sharding/test_split"
+        self.set_up_grid(oneshare=True)
+        # every shard is a mutable file with a new RSA key, so keep the tree
+        # small
+        self.patch(sharded_dirnode, "FANOUT", 2)
+        self.patch(sharded_dirnode.ShardedDirectory, "MAX_LEAF_ENTRIES", 4)
+        c = self.g.clients[0]
+        n = yield c.create_dirnode()
+        yield n.make_sharded()
+        # adding children one at a time splits the root leaf into a table
+        for i in range(6):
+            yield n.set_uri(u"single-%d" % i,
+                            uri.LiteralFileURI(b"single %d" % i).to_string(),
+                            None, metadata={u"i": i})
+        data = yield n._node.download_best_version()
+        self.assertTrue(data.startswith(sharded_dirnode.TABLE_HEADER))
+        # so do many at once, and a conversion of a large directory
+        yield n.set_children(self._make_children(8))
+        big = yield c.create_dirnode()
+        yield big.set_children(self._make_children(8))
+        yield big.make_sharded()
+        data = yield big._node.download_best_version()
+        self.assertTrue(data.startswith(sharded_dirnode.TABLE_HEADER))
+
+        n2 = c.create_node_from_uri(n.get_uri())
+        children = yield n2.list()
+        self.assertEqual(len(children), 14)
+        self.assertEqual(children[u"single-3"][1][u"i"], 3)
+        shards = n2.get_shard_nodes()
+        self.assertTrue(len(shards) >= sharded_dirnode.FANOUT)
+
+        yield n2.delete(u"single-3")
+        yield n2.set_metadata_for(u"child-7", {u"seven": 7})
+        md = yield n.get_metadata_for(u"child-7")
+        self.assertEqual(md[u"seven"], 7)
+        has = yield n.has_child(u"single-3")
+        self.assertFalse(has)
+        yield self.shouldFail(NoSuchChildError, "get", "single-3",
+                              n.get, u"single-3")
+        ro = c.create_node_from_uri(n.get_readonly_uri())
+        child = yield ro.get(u"single-4")
+        self.assertTrue(child.is_readonly())
+        children = yield ro.list()
+        self.assertEqual(len(children), 13)
+
+        # deep-check reaches every shard, and adds leases to them
+        res = yield n.start_deep_check(add_lease=True).when_done()
+        self.assertEqual(res.get_counters()["count-objects-checked"],
+                         1 + len(shards))
+        self.assertEqual(res.get_counters()["count-objects-healthy"],
+                         1 + len(shards))
+        manifest = yield n.build_manifest().when_done()
+        for shard in shards:
+            self.assertIn(base32.b2a(shard.get_storage_index()),
+                          manifest["storage-index"])
+
+    def test_bucket_for(self):
+        si = b"\x00" * 16
+        buckets = set(sharded_dirnode.bucket_for(si, u"name-%d" % i, 0)
+                      for i in range(200))
+        self.assertEqual(buckets, set(u"%x" % i for i in range(16)))
+        self.assertEqual(sharded_dirnode.bucket_for(si, u"name", 3),
+                         sharded_dirnode.bucket_for(si, u"name", 3))
+
+    def test_bucket_for_fanout(self):
+        si = b"\x00" * 16
+        names = [u"name-%d" % i for i in range(200)]
+        wide = [sharded_dirnode.bucket_for(si, name, 1) for name in names]
+        self.patch(sharded_dirnode, "FANOUT", 2)
+        narrow = [sharded_dirnode.bucket_for(si, name, 1) for name in names]
+        self.assertEqual(narrow, [u"%x" % (int(b, 16) % 2) for b in wide])
+        self.assertEqual(set(narrow), set([u"0", u"1"]))
@@ -23,6 +23,7 @@ import six
 import os
 from twisted.trial import unittest
 from twisted.internet import defer, reactor
+from twisted.internet.task import Clock
 from allmydata import uri
 from allmydata.storage.server import storage_index_to_dir
 from allmydata.util import base32, fileutil, spans, log, hashutil
@@ -35,7 +36,9 @@ from allmydata.interfaces import NotEnoughSharesError, NoSharesError, \
 from allmydata.immutable.downloader.common import BadSegmentNumberError, \
      BadCiphertextHashError, COMPLETE, OVERDUE, DEAD
 from allmydata.immutable.downloader.status import DownloadStatus
+from allmydata.immutable.downloader import fetcher
 from allmydata.immutable.downloader.fetcher import SegmentFetcher
+from allmydata.immutable.downloader.node import DownloadNode
 from allmydata.codec import CRSDecoder
 from foolscap.eventual import eventually, fireEventually, flushEventualQueue
 
@@ -871,6 +874,27 @@ class DownloadTest(_Base, unittest.TestCase):
         d = self.download_immutable()
         return d
 
+    def test_download_hedged(self):
+        # with extra block requests in flight, the download still works, and
+        # the DownloadStatus records the hedged requests
+        self.basedir = self.mktemp()
+        self.set_up_grid()
+        self.c0 = self.g.clients[0]
+        self.c0.download_params["hedge_extra_requests"] = 2
+
+        self.load_shares()
+        n = self.c0.create_node_from_uri(immutable_uri)
+        d = download_to_data(n)
+        def _got_data(data):
+            self.failUnlessEqual(data, plaintext)
+            ds = n._cnode._node._download_status
+            self.failUnless(ds.segments_fetched > 0)
+            self.failUnless(ds.hedge_requests > 0)
+            self.failUnless(ds.get_hedge_rate() > 0)
+            self.failUnless(0.0 <= ds.get_hedge_win_rate() <= 1.0)
+        d.addCallback(_got_data)
+        return d
+
     def test_verifycap(self):
         self.basedir = self.mktemp()
         self.set_up_grid()
@@ -1351,6 +1375,42 @@ class Status(unittest.TestCase):
         e2.finished(now+3)
         self.failUnlessEqual(ds.get_active(), False)
 
+    def test_hedging(self):
+        ds = DownloadStatus("si-1", 123)
+        self.failUnlessEqual(ds.get_hedge_rate(), None)
+        self.failUnlessEqual(ds.get_hedge_win_rate(), None)
+        ds.add_hedge_results(0, 0)
+        self.failUnlessEqual(ds.get_hedge_rate(), 0.0)
+        self.failUnlessEqual(ds.get_hedge_win_rate(), None)
+        ds.add_hedge_results(2, 1)
+        ds.add_hedge_results(1, 0)
+        self.failUnlessEqual(ds.get_hedge_rate(), 1.0)
+        self.failUnlessEqual(ds.get_hedge_win_rate(), 1/3)
+
+class HedgeDelay(unittest.TestCase):
+    def _make_node(self, download_params):
+        verifycap = uri.from_string(immutable_uri).get_verify_cap()
+        ds = DownloadStatus(verifycap.storage_index, verifycap.size)
+        return DownloadNode(verifycap, None, None, None, None, ds,
+                            download_params)
+
+    def test_disabled(self):
+        n = self._make_node(None)
+        n._segment_fetch_times.extend([1.0, 2.0, 3.0, 4.0])
+        self.failUnlessEqual(n._get_hedge_delay(), None)
+
+    def test_percentile(self):
+        n = self._make_node({"hedge_percentile": 75})
+        # not enough history yet
+        n._segment_fetch_times.extend([4.0, 1.0])
+        self.failUnlessEqual(n._get_hedge_delay(), None)
+        n._segment_fetch_times.extend([3.0, 2.0])
+        self.failUnlessEqual(n._get_hedge_delay(), 4.0)
+        n._download_params["hedge_percentile"] = 50
+        self.failUnlessEqual(n._get_hedge_delay(), 3.0)
+        n._download_params["hedge_percentile"] = 100
+        self.failUnlessEqual(n._get_hedge_delay(), 4.0)
+
 def make_server(clientid):
     tubid = hashutil.tagged_hash(b"clientid", clientid)[:20]
     return NoNetworkServer(tubid, None)
@@ -1717,3 +1777,127 @@ class Selection(unittest.TestCase):
                                                       2: "block-2"}) )
         d.addCallback(_check4)
         return d
+
+    def test_hedged_extra_requests(self):
+        node = FakeNode()
+        sf = MySegmentFetcher(node, 0, 3, None, extra_requests=2)
+        shares = [MyShare(i, make_server(b"peer-%d" % i), i) for i in range(10)]
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _check1(ign):
+            self.failUnlessEqual(node.want_more, 0)
+            self.failUnlessEqual(sf._test_start_shares, shares[:5])
+            self.failUnlessEqual(sf.hedges_sent, 2)
+            # the two hedged requests win the race
+            for sh in [shares[0], shares[3], shares[4]]:
+                sf._block_request_activity(sh, sh._shnum, COMPLETE,
+                                           "block-%d" % sh._shnum)
+            return flushEventualQueue()
+        d.addCallback(_check1)
+        def _check2(ign):
+            self.failUnlessEqual(node.processed, (0, {0: "block-0",
+                                                      3: "block-3",
+                                                      4: "block-4"}) )
+            self.failUnlessEqual(sf.hedge_wins, 2)
+        d.addCallback(_check2)
+        return d
+
+    def test_hedged_keeps_first_k(self):
+        node = FakeNode()
+        sf = MySegmentFetcher(node, 0, 3, None, extra_requests=2)
+        shares = [MyShare(i, make_server(b"peer-%d" % i), i) for i in range(10)]
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _check1(ign):
+            # all five requests complete before the fetcher's loop runs
+            for sh in reversed(sf._test_start_shares):
+                sf._block_request_activity(sh, sh._shnum, COMPLETE,
+                                           "block-%d" % sh._shnum)
+            return flushEventualQueue()
+        d.addCallback(_check1)
+        def _check2(ign):
+            self.failUnlessEqual(node.processed, (0, {4: "block-4",
+                                                      3: "block-3",
+                                                      2: "block-2"}) )
+            self.failUnlessEqual(sf.hedge_wins, 2)
+        d.addCallback(_check2)
+        return d
+
+    def test_hedged_respects_diversity(self):
+        # hedged requests never pull a second share from a server
+        node = FakeNode()
+        sf = MySegmentFetcher(node, 0, 3, None, extra_requests=2)
+        servers = make_servers([b"peer-A", b"peer-B", b"peer-C", b"peer-D"])
+        shares = [MyShare(0, servers[b"peer-A"], 0.0),
+                  MyShare(1, servers[b"peer-B"], 1.0),
+                  MyShare(2, servers[b"peer-C"], 2.0),
+                  MyShare(3, servers[b"peer-C"], 3.0),
+                  MyShare(4, servers[b"peer-D"], 4.0),
+                  ]
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _check1(ign):
+            self.failUnlessEqual(node.want_more, 0)
+            self.failUnlessEqual(sf._test_start_shares,
+                                 [shares[0], shares[1], shares[2], shares[4]])
+            self.failUnlessEqual(sf.hedges_sent, 1)
+        d.addCallback(_check1)
+        return d
+
+    def test_hedge_delay(self):
+        clock = Clock()
+        self.patch(fetcher, "reactor", clock)
+        node = FakeNode()
+        sf = MySegmentFetcher(node, 0, 3, None, hedge_delay=2.0)
+        shares = [MyShare(i, make_server(b"peer-%d" % i), i) for i in range(10)]
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _check1(ign):
+            self.failUnlessEqual(sf._test_start_shares, shares[:3])
+            clock.advance(1.0)
+            return flushEventualQueue()
+        d.addCallback(_check1)
+        def _check2(ign):
+            self.failUnlessEqual(sf._test_start_shares, shares[:3])
+            clock.advance(1.0)
+            return flushEventualQueue()
+        d.addCallback(_check2)
+        def _check3(ign):
+            # the segment is late, so one backup request was sent
+            self.failUnlessEqual(sf._test_start_shares, shares[:4])
+            self.failUnlessEqual(sf.hedges_sent, 1)
+            for sh in sf._test_start_shares[1:]:
+                sf._block_request_activity(sh, sh._shnum, COMPLETE,
+                                           "block-%d" % sh._shnum)
+            return flushEventualQueue()
+        d.addCallback(_check3)
+        def _check4(ign):
+            self.failUnlessEqual(node.processed, (0, {1: "block-1",
+                                                      2: "block-2",
+                                                      3: "block-3"}) )
+            self.failUnlessEqual(sf.hedge_wins, 1)
+            self.failUnlessEqual(clock.getDelayedCalls(), [])
+        d.addCallback(_check4)
+        return d
+
+    def test_hedge_timer_cancelled(self):
+        clock = Clock()
+        self.patch(fetcher, "reactor", clock)
+        node = FakeNode()
+        sf = MySegmentFetcher(node, 0, 3, None, hedge_delay=2.0)
+        shares = [MyShare(i, make_server(b"peer-%d" % i), i) for i in range(10)]
+        sf.add_shares(shares)
+        d = flushEventualQueue()
+        def _check1(ign):
+            self.failUnlessEqual(len(clock.getDelayedCalls()), 1)
+            for sh in sf._test_start_shares:
+                sf._block_request_activity(sh, sh._shnum, COMPLETE,
+                                           "block-%d" % sh._shnum)
+            return flushEventualQueue()
+        d.addCallback(_check1)
+        def _check2(ign):
+            self.failIfEqual(node.processed, None)
+            self.failUnlessEqual(sf.hedges_sent, 0)
+            self.failUnlessEqual(clock.getDelayedCalls(), [])
+        d.addCallback(_check2)
+        return d
@@ -15,7 +15,7 @@ from zope.interface import implementer
 from twisted.trial import unittest
 from twisted.internet import defer
 from twisted.python.failure import Failure
-from foolscap.api import fireEventually
+from foolscap.api import fireEventually, flushEventualQueue
 from allmydata import uri
 from allmydata.immutable import encode, upload, checker
 from allmydata.util import hashutil
@@ -360,6 +360,126 @@ class Encode(unittest.TestCase):
         return self.do_encode(25, 101, 100, 5, 15, 8)
 
 
+class HeldBucketWriterProxy(FakeBucketReaderWriterProxy):
+    # put_block() stores the block right away, but does not acknowledge it
+    # until release() is called. Like a WriteBucketProxy, it complains if a
+    # second block arrives before the first was acknowledged.
+    def __init__(self, *args, **kwargs):
+        FakeBucketReaderWriterProxy.__init__(self, *args, **kwargs)
+        self.held = []
+
+    def put_block(self, segmentnum, data):
+        assert not self.held, "put_block() while a block is outstanding"
+        d = FakeBucketReaderWriterProxy.put_block(self, segmentnum, data)
+        held = defer.Deferred()
+        d.addCallback(lambda ign: self.held.append(held))
+        return held
+
+    def release(self):
+        self.held.pop(0).callback(None)
+
+
+class SegmentWindow(unittest.TestCase):
+    NUM_SHARES = 4
+    NUM_SEGMENTS = 5
+
+    def setUp(self):
+        self.status = upload.UploadStatus()
+
+    def start_encoder(self, max_segments_in_flight, slow_shnums=()):
+        e = encode.Encoder(upload_status=self.status,
+                           max_segments_in_flight=max_segments_in_flight)
+        u = upload.Data(make_data(100), convergence=b"some convergence string")
+        u.set_default_encoding_parameters({'max_segment_size': 20,
+                                           'k': 2, 'happy': 2,
+                                           'n': self.NUM_SHARES})
+        eu = upload.EncryptAnUploadable(u)
+        d = e.set_encrypted_uploadable(eu)
+        self.peers = {}
+        def _ready(res):
+            _assert(e.get_param("num_segments") == self.NUM_SEGMENTS)
+            servermap = {}
+            for shnum in range(self.NUM_SHARES):
+                peerid = b"peer-%d" % shnum
+                if shnum in slow_shnums:
+                    peer = HeldBucketWriterProxy(peerid=peerid)
+                else:
+                    peer = FakeBucketReaderWriterProxy(peerid=peerid)
+                self.peers[shnum] = peer
+                servermap[shnum] = set([peerid])
+            e.set_shareholders(self.peers.copy(), servermap)
+            self.finished = []
+            self.done = e.start()
+            self.done.addBoth(lambda res: self.finished.append(res) or res)
+        d.addCallback(_ready)
+        self.successResultOf(d)
+        return e
+
+    @defer.inlineCallbacks
+    def test_fast_shareholders_run_ahead(self):
+        e = self.start_encoder(3, slow_shnums=[0])
+        slow, fast = self.peers[0], self.peers[1]
+        yield flushEventualQueue()
+        # the window starts with one segment, which the slow shareholder
+        # has not yet acknowledged
+        self.failUnlessEqual(sorted(slow.blocks), [0])
+        self.failUnlessEqual(sorted(fast.blocks), [0])
+        self.failUnlessEqual(e.get_segment_window(), (1, 1, 3))
+
+        # we were waiting for that acknowledgement, so the window grows and
+        # the fast shareholders get two more segments. The slow one gets
+        # them one at a time.
+        slow.release()
+        yield flushEventualQueue()
+        self.failUnlessEqual(sorted(slow.blocks), [0, 1])
+        self.failUnlessEqual(sorted(fast.blocks), [0, 1, 2])
+        self.failUnlessEqual(e.get_segment_window(), (2, 2, 3))
+
+        while not self.finished:
+            slow.release()
+            yield flushEventualQueue()
+        verifycap = yield self.done
+        self.failUnlessEqual(verifycap.size, 100)
+        for peer in self.peers.values():
+            self.failUnless(peer.closed)
+            self.failUnlessEqual(sorted(peer.blocks),
+                                 list(range(self.NUM_SEGMENTS)))
+        (window, achieved, maximum) = e.get_segment_window()
+        self.failUnlessEqual(achieved, 3)
+        self.failUnlessEqual(self.status.get_segments_in_flight(), 3)
+
+    @defer.inlineCallbacks
+    def test_one_segment_at_a_time(self):
+        e = self.start_encoder(1, slow_shnums=[0])
+        slow, fast = self.peers[0], self.peers[1]
+        yield flushEventualQueue()
+        slow.release()
+        yield flushEventualQueue()
+        # nobody gets ahead of the slowest shareholder
+        self.failUnlessEqual(sorted(slow.blocks), [0, 1])
+        self.failUnlessEqual(sorted(fast.blocks), [0, 1])
+        while not self.finished:
+            slow.release()
+            yield flushEventualQueue()
+        yield self.done
+        self.failUnlessEqual(e.get_segment_window(), (1, 1, 1))
+        self.failUnlessEqual(self.status.get_segments_in_flight(), 1)
+
+    @defer.inlineCallbacks
+    def test_block_hashes_in_order(self):
+        # segments in flight must not disturb the block hash trees: compare
+        # against an upload that sends one segment at a time
+        results = []
+        for window in (1, 4):
+            e = self.start_encoder(window)
+            yield flushEventualQueue()
+            yield self.done
+            self.failUnlessEqual(e.get_segment_window()[2], window)
+            results.append([self.peers[shnum].block_hashes
+                            for shnum in range(self.NUM_SHARES)])
+        self.failUnlessEqual(results[0], results[1])
+
+
 class Roundtrip(GridTestMixin, unittest.TestCase):
 
     # a series of 3*3 tests to check out edge conditions. One axis is how the
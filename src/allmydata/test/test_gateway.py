@@ -0,0 +1,321 @@
+"""
+Tests for allmydata.gateway.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os
+
+from zope.interface.verify import verifyObject
+import treq
+from treq.client import HTTPClient
+from twisted.trial import unittest
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import Factory, Protocol
+from twisted.internet.task import Clock
+from twisted.python.failure import Failure
+from twisted.internet.error import ProcessDone
+from twisted.web.client import Agent, HTTPConnectionPool
+from twisted.web.resource import Resource
+from twisted.web.static import Data
+
+from allmydata import client
+from allmydata.gateway import (
+    GatewayCoordinator,
+    GatewayPrimary,
+    _Gateway,
+    listen_reuseport,
+    parse_tcp_port,
+    reuseport_supported,
+    worker_config,
+)
+from allmydata.interfaces import IGateway
+from allmydata.monitor import Monitor
+from allmydata.node import config_from_string
+from allmydata.web.operations import OphandleTable
+from allmydata.webish import TahoeLAFSSite
+
+
+class FakeWorker(object):
+    """I stand in for the Referenceable of a gateway worker."""
+
+    def __init__(self):
+        self.watchers = []
+
+    def notifyOnDisconnect(self, f, *args):
+        self.watchers.append((f, args))
+
+    def disconnect(self):
+        for (f, args) in self.watchers:
+            f(*args)
+
+
+class FakeTransport(object):
+    def __init__(self, protocol):
+        self.protocol = protocol
+        self.signals = []
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+        self.protocol.processEnded(Failure(ProcessDone(0)))
+
+
+class FakeReactor(Clock):
+    def __init__(self):
+        Clock.__init__(self)
+        self.spawned = []
+
+    def spawnProcess(self, protocol, executable, args, env=None, path=None):
+        transport = FakeTransport(protocol)
+        self.spawned.append((args, transport))
+        return transport
+
+
+class FakeRequest(object):
+    def __init__(self, **args):
+        self.args = dict((k.encode("ascii"), [v]) for (k, v) in args.items())
+        self.fields = None
+
+
+class ParseTCPPort(unittest.TestCase):
+
+    def test_forms(self):
+        self.assertEqual(parse_tcp_port("3456"), (3456, ""))
+        self.assertEqual(parse_tcp_port("tcp:3456"), (3456, ""))
+        self.assertEqual(parse_tcp_port("tcp:port=3456"), (3456, ""))
+        self.assertEqual(parse_tcp_port("tcp:3456:interface=127.0.0.1"),
+                         (3456, "127.0.0.1"))
+
+    def test_bad(self):
+        for webport in ["unix:web.sock", "tcp:", "tcp:3456:7890",
+                        "ssl:3456", "tcp:http"]:
+            with self.assertRaises(ValueError):
+                parse_tcp_port(webport)
+
+
+class ListenReusePort(unittest.TestCase):
+
+    def setUp(self):
+        if not reuseport_supported():
+            raise unittest.SkipTest("this platform has no SO_REUSEPORT")
+
+    @defer.inlineCallbacks
+    def test_two_listeners(self):
+        """
+        Two listeners may share a port, and connections are accepted while
+        either of them is listening.
+        """
+        factory = Factory.forProtocol(Protocol)
+        p1 = listen_reuseport(reactor, 0, factory, "127.0.0.1")
+        self.addCleanup(p1.stopListening)
+        port = p1.getHost().port
+        p2 = listen_reuseport(reactor, port, factory, "127.0.0.1")
+        self.addCleanup(p2.stopListening)
+        self.assertEqual(p2.getHost().port, port)
+        yield p1.stopListening()
+        self.assertEqual(p2.getHost().port, port)
+
+
+class Coordinator(unittest.TestCase):
+
+    def test_lock_fifo(self):
+        c = GatewayCoordinator()
+        si = b"\x00" * 16
+        self.assertIs(c.remote_lock_mutable(si, 0), None)
+        d1 = c.remote_lock_mutable(si, 1)
+        d2 = c.remote_lock_mutable(si, 2)
+        self.assertFalse(d1.called)
+        # only the holder may release the lock
+        c.remote_unlock_mutable(si, 2)
+        self.assertFalse(d1.called)
+        c.remote_unlock_mutable(si, 0)
+        self.assertTrue(d1.called)
+        self.assertFalse(d2.called)
+        c.remote_unlock_mutable(si, 1)
+        self.assertTrue(d2.called)
+        c.remote_unlock_mutable(si, 2)
+        self.assertEqual(c._locks, {})
+
+    def test_other_files(self):
+        c = GatewayCoordinator()
+        self.assertIs(c.remote_lock_mutable(b"\x00" * 16, 0), None)
+        self.assertIs(c.remote_lock_mutable(b"\x01" * 16, 1), None)
+
+    def test_worker_lost(self):
+        """
+        When a worker disconnects, the coordinator forgets its port and its
+        ophandles, and passes on the locks it held or waited for.
+        """
+        c = GatewayCoordinator()
+        w1 = FakeWorker()
+        c.remote_register_worker(1, 1234, w1)
+        self.assertEqual(c.remote_find_worker(1), 1234)
+        c.remote_claim_ophandle(b"h1", 1)
+        c.remote_claim_ophandle(b"h2", 0)
+        si, si2 = b"\x00" * 16, b"\x01" * 16
+        c.remote_lock_mutable(si, 1)
+        d0 = c.remote_lock_mutable(si, 0)
+        c.remote_lock_mutable(si2, 0)
+        d1 = c.remote_lock_mutable(si2, 1)
+        w1.disconnect()
+        self.assertIs(c.remote_find_worker(1), None)
+        self.assertIs(c.remote_find_ophandle(b"h1"), None)
+        self.assertEqual(c.remote_find_ophandle(b"h2"), 0)
+        self.assertTrue(d0.called)
+        self.assertEqual(c._locks[si][0], 0)
+        self.assertFalse(d1.called)
+        c.remote_unlock_mutable(si2, 0)
+        self.assertNotIn(si2, c._locks)
+
+    def test_ophandles(self):
+        c = GatewayCoordinator()
+        c.remote_claim_ophandle(b"h1", 1)
+        self.assertEqual(c.remote_find_ophandle(b"h1"), 1)
+        c.remote_release_ophandle(b"h1", 2)
+        self.assertEqual(c.remote_find_ophandle(b"h1"), 1)
+        c.remote_release_ophandle(b"h1", 1)
+        self.assertIs(c.remote_find_ophandle(b"h1"), None)
+
+    @defer.inlineCallbacks
+    def test_local_gateway(self):
+        """
+        By itself, a _Gateway provides IGateway with a coordinator of its
+        own.
+        """
+        gateway = _Gateway(0, 1)
+        verifyObject(IGateway, gateway)
+        si = b"\x00" * 16
+        yield gateway.lock_mutable(si)
+        self.assertEqual(gateway.coordinator._locks[si][0], 0)
+        gateway.unlock_mutable(si)
+        self.assertNotIn(si, gateway.coordinator._locks)
+        yield gateway.claim_ophandle(b"h1")
+        holder = yield gateway.find_ophandle(b"h1")
+        self.assertEqual(holder, 0)
+
+
+class Workers(unittest.TestCase):
+
+    def _config(self, web_config):
+        basedir = self.mktemp()
+        os.makedirs(os.path.join(basedir, "private"))
+        return config_from_string(
+            basedir, "client.port",
+            "[node]\n" + web_config +
+            "[storage]\nenabled = true\n",
+            _valid_config=client._valid_config(),
+        )
+
+    def test_worker_config(self):
+        """
+        A worker serves the web port that the node process is listening on,
+        runs no servers of its own, and keeps its own per-process files.
+        """
+        config = self._config("web.port = tcp:0:interface=127.0.0.1\n"
+                              "web.workers = 3\n")
+        wc = worker_config(config, 2, 4567)
+        self.assertEqual(wc.get_config("node", "web.port"),
+                         "tcp:4567:interface=127.0.0.1")
+        self.assertEqual(wc.get_config("node", "tub.port"), "disabled")
+        self.assertFalse(wc.get_config("storage", "enabled", boolean=True))
+        self.assertFalse(wc.get_config("helper", "enabled", False,
+                                       boolean=True))
+        self.assertEqual(wc.get_private_path("node.pem"),
+                         config.get_private_path("gateway-worker-2",
+                                                 "node.pem"))
+        self.assertTrue(os.path.isdir(config.get_private_path("gateway-worker-2")))
+        self.assertEqual(wc.get_private_path("api_auth_token"),
+                         config.get_private_path("api_auth_token"))
+        wc.write_config_file("my_nodeid", "nope\n")
+        self.assertFalse(os.path.exists(os.path.join(
+            config.get_config_path(), "my_nodeid")))
+        # the node's own config is untouched
+        self.assertEqual(config.get_config("node", "web.port"),
+                         "tcp:0:interface=127.0.0.1")
+
+    @defer.inlineCallbacks
+    def test_primary_starts_workers(self):
+        """
+        Once its web server listens, the primary starts the other workers,
+        restarts them when they exit, and stops them when it stops.
+        """
+        config = self._config("web.port = tcp:0\n")
+        fake = FakeReactor()
+        primary = GatewayPrimary(config, 3, reactor=fake)
+        self.assertTrue(os.path.exists(config.get_private_path("gateway.furl")))
+        primary.startService()
+        primary.web_listening(4567, 4568)
+        self.assertEqual(primary.coordinator.remote_find_worker(0), 4568)
+        self.assertEqual([args[-3:] for (args, t) in fake.spawned],
+                         [["1", "3", "4567"], ["2", "3", "4567"]])
+
+        (args, transport) = fake.spawned[0]
+        transport.protocol.processEnded(Failure(ProcessDone(0)))
+        self.assertEqual(len(fake.spawned), 2)
+        fake.advance(GatewayPrimary.RESTART_DELAY)
+        self.assertEqual(len(fake.spawned), 3)
+        self.assertEqual(fake.spawned[2][0][-3:], ["1", "3", "4567"])
+
+        yield primary.stopService()
+        self.assertEqual(fake.spawned[1][1].signals, ["TERM"])
+        self.assertEqual(fake.spawned[2][1].signals, ["TERM"])
+        fake.advance(GatewayPrimary.RESTART_DELAY)
+        self.assertEqual(len(fake.spawned), 3)
+
+
+class ForwardOphandle(unittest.TestCase):
+    """
+    A request for an operation handle held by another worker is forwarded
+    to that worker.
+    """
+
+    def _serve(self, gateway):
+        table = OphandleTable(gateway=gateway)
+        root = Resource()
+        root.putChild(b"operations", table)
+        port = reactor.listenTCP(0, TahoeLAFSSite(self.mktemp(), root),
+                                 interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        return table, port.getHost().port
+
+    def _get(self, port, path):
+        pool = HTTPConnectionPool(reactor, persistent=False)
+        http = HTTPClient(Agent(reactor, pool=pool))
+        url = "http://127.0.0.1:%d%s" % (port, path)
+        d = http.get(url)
+        d.addCallback(lambda resp: treq.content(resp).addCallback(
+            lambda body: (resp.code, body)))
+        return d
+
+    @defer.inlineCallbacks
+    def test_forward(self):
+        coordinator = GatewayCoordinator()
+        gateway0 = _Gateway(0, 2, coordinator)
+        gateway1 = _Gateway(1, 2, coordinator)
+        table0, port0 = self._serve(gateway0)
+        table1, port1 = self._serve(gateway1)
+        yield gateway0.web_listening(None, port0)
+        yield gateway1.web_listening(None, port1)
+
+        yield table1.add_monitor(FakeRequest(ophandle=b"h1"), Monitor(),
+                                 Data(b"results", "text/plain"))
+        self.assertEqual(coordinator.remote_find_ophandle(b"h1"), 1)
+
+        (code, body) = yield self._get(port0, "/operations/h1")
+        self.assertEqual((code, body), (200, b"results"))
+        (code, body) = yield self._get(port1, "/operations/h1")
+        self.assertEqual((code, body), (200, b"results"))
+        (code, body) = yield self._get(port0, "/operations/h2")
+        self.assertEqual(code, 404)
+        self.assertIn(b"unknown/expired handle", body)
+
+        table1._release_ophandle(b"h1")
+        self.assertIs(coordinator.remote_find_ophandle(b"h1"), None)
+        (code, body) = yield self._get(port0, "/operations/h1")
+        self.assertEqual(code, 404)
@@ -231,3 +231,37 @@ class Incomplete(unittest.TestCase):
             iht.set_hashes(chain, leaves={4: tagged_hash(b"tag", b"4")})
         except hashtree.BadHashError as e:
             self.fail("bad hash: %s" % e)
+
+    def test_replace_leaves(self):
+        ht = make_tree(6)
+        iht = hashtree.IncompleteHashTree(6)
+        # learn just enough to validate leaves 1 and 2
+        needed = iht.needed_hashes(1) | iht.needed_hashes(2)
+        iht.set_hashes(dict([(i, ht[i]) for i in needed] + [(0, ht[0])]),
+                       leaves={1: ht.get_leaf(1), 2: ht.get_leaf(2)})
+
+        new_leaves = dict([(i, tagged_hash(b"tag", b"new %d" % i))
+                           for i in (1, 2)])
+        changed = iht.replace_leaves(new_leaves)
+
+        leaves = [ht.get_leaf(i) for i in range(6)]
+        leaves[1] = new_leaves[1]
+        leaves[2] = new_leaves[2]
+        new_ht = hashtree.HashTree(leaves)
+        # the leaves, their ancestors, and nothing else
+        self.failUnlessEqual(set(changed.keys()), set([8, 9, 3, 4, 1, 0]))
+        for i,h in changed.items():
+            self.failUnlessEqual(h, new_ht[i])
+            self.failUnlessEqual(iht[i], new_ht[i])
+
+    def test_replace_leaves_not_enough_hashes(self):
+        ht = make_tree(6)
+        iht = hashtree.IncompleteHashTree(6)
+        iht.set_hashes({0: ht[0], 2: ht[2], 4: ht[4], 8: ht[8]},
+                       leaves={0: ht.get_leaf(0)})
+        before = list(iht)
+        # the sibling of leaf 4 (node 12) is unknown
+        self.failUnlessRaises(hashtree.NotEnoughHashesError,
+                              iht.replace_leaves,
+                              {4: tagged_hash(b"tag", b"new 4")})
+        self.failUnlessEqual(list(iht), before)
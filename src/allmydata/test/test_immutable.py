@@ -126,6 +126,8 @@ class TestShareFinder(unittest.TestCase):
                 self.servers = servers
             def get_servers_for_psi(self, si):
                 return self.servers
+            def iter_servers_for_psi(self, si):
+                return iter(self.servers)
 
         class MockDownloadStatus(object):
             def add_dyhb_request(self, server, when):
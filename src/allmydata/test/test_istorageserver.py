@@ -1168,6 +1168,75 @@ class HTTPImmutableAPIsTests(
 ):
     """HTTP-specific tests for immutable ``IStorageServer`` APIs."""
 
+    @inlineCallbacks
+    def test_allocate_buckets_repeat(self):
+        """
+        ``IStorageServer.allocate_buckets()`` with the same storage index does
+        not return work-in-progress buckets to a different uploader, but will
+        add any newly added buckets.
+        """
+        storage_index = new_storage_index()
+        (already_got, allocated) = yield self.storage_client.allocate_buckets(
+            storage_index,
+            new_secret(),
+            new_secret(),
+            set(range(4)),
+            1024,
+            Referenceable(),
+        )
+        (already_got2, allocated2) = yield self.storage_client.allocate_buckets(
+            storage_index,
+            new_secret(),
+            new_secret(),
+            set(range(5)),
+            1024,
+            Referenceable(),
+        )
+        self.assertEqual(already_got, already_got2)
+        self.assertEqual(set(allocated2.keys()), {4})
+
+    @inlineCallbacks
+    def test_allocate_buckets_resume(self):
+        """
+        ``IStorageServer.allocate_buckets()`` returns work-in-progress buckets
+        to the uploader that started them (the one with the same lease renewal
+        secret), and writes to them report the ranges that are still required.
+        """
+        storage_index, renew_secret, cancel_secret = (
+            new_storage_index(),
+            new_secret(),
+            new_secret(),
+        )
+        (_, allocated) = yield self.storage_client.allocate_buckets(
+            storage_index,
+            renew_secret,
+            cancel_secret,
+            {0},
+            1024,
+            Referenceable(),
+        )
+        required = yield allocated[0].callRemote("write", 0, b"1" * 512)
+        self.assertEqual([(r.start, r.stop) for r in required.ranges()],
+                         [(512, 1024)])
+
+        (already_got, allocated) = yield self.storage_client.allocate_buckets(
+            storage_index,
+            renew_secret,
+            cancel_secret,
+            {0},
+            1024,
+            Referenceable(),
+        )
+        self.assertEqual(already_got, set())
+        self.assertEqual(set(allocated.keys()), {0})
+        required = yield allocated[0].callRemote("write", 512, b"2" * 512)
+        self.assertEqual(list(required.ranges()), [])
+        yield allocated[0].callRemote("close")
+
+        buckets = yield self.storage_client.get_buckets(storage_index)
+        data = yield buckets[0].callRemote("read", 0, 1024)
+        self.assertEqual(data, b"1" * 512 + b"2" * 512)
+
 
 class FoolscapMutableAPIsTests(
     _FoolscapMixin, IStorageServerMutableAPIsTestsMixin, AsyncTestCase
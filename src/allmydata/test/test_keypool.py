@@ -0,0 +1,272 @@
+"""
+Tests for allmydata.keypool.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+import os, stat, errno
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+from twisted.trial import unittest
+from twisted.internet import defer
+from twisted.internet.task import Clock
+
+from allmydata.crypto import rsa
+from allmydata.keypool import KeyPool, _generate_signing_key
+from allmydata.util import fileutil
+
+
+class FakeThreadPool(object):
+    def callInThreadWithCallback(self, onResult, f, *args, **kwargs):
+        onResult(True, f(*args, **kwargs))
+
+
+class FakeReactor(Clock):
+    def callFromThread(self, f, *args, **kwargs):
+        f(*args, **kwargs)
+
+    def getThreadPool(self):
+        return FakeThreadPool()
+
+
+class FakeExecutor(object):
+    """I hold on to submitted jobs until the test completes them."""
+
+    def __init__(self):
+        self.jobs = []
+        self.shut_down = False
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        self.shut_down = True
+
+    def submit(self, f, *args):
+        future = Future()
+        self.jobs.append(future)
+        return future
+
+    def complete(self, der, count=1):
+        for i in range(count):
+            future = self.jobs.pop(0)
+            future.set_running_or_notify_cancel()
+            future.set_result(der)
+
+    def fail(self, exception, count=1):
+        for i in range(count):
+            future = self.jobs.pop(0)
+            future.set_running_or_notify_cancel()
+            future.set_exception(exception)
+
+
+_der = []
+
+def get_der():
+    """Return a serialized signing key, the same one every time."""
+    if not _der:
+        _der.append(_generate_signing_key(KeyPool.KEY_SIZE))
+    return _der[0]
+
+
+class KeyPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.der = get_der()
+        self.basedir = self.mktemp()
+        fileutil.make_dirs(self.basedir, 0o700)
+        self.spares_file = os.path.join(self.basedir, "spare-rsa-keys")
+
+    def make_pool(self, size):
+        self.reactor = FakeReactor()
+        self.executor = FakeExecutor()
+        pool = KeyPool(size, self.spares_file, executor=self.executor,
+                       reactor=self.reactor)
+        pool.startService()
+        self.addCleanup(pool.stopService)
+        return pool
+
+    def assertKeypair(self, result):
+        (verifier, signer) = result
+        self.assertEqual(rsa.der_string_from_signing_key(signer), self.der)
+        signature = rsa.sign_data(signer, b"data")
+        rsa.verify_signature(verifier, signature, b"data")
+
+    def test_reserve(self):
+        """
+        The pool fills its reserve when it starts, hands out spare keys
+        without waiting, and replaces them.
+        """
+        pool = self.make_pool(2)
+        self.assertEqual(len(self.executor.jobs), 2)
+        self.executor.complete(self.der, 2)
+        self.assertEqual(pool.get_stats()["keypool.spares"], 2)
+
+        d = pool.generate()
+        self.assertKeypair(self.successResultOf(d))
+        self.assertEqual(len(self.executor.jobs), 1)
+        stats = pool.get_stats()
+        self.assertEqual(stats["keypool.spares"], 1)
+        self.assertEqual(stats["keypool.generating"], 1)
+        self.assertEqual(stats["keypool.requests"], 1)
+        self.assertEqual(stats["keypool.waits"], 0)
+
+    def test_wait(self):
+        """
+        When the reserve is empty, callers wait for the next key and the
+        time they waited is recorded.
+        """
+        pool = self.make_pool(1)
+        d1 = pool.generate()
+        d2 = pool.generate()
+        self.assertNoResult(d1)
+        # one key for the reserve, one for each caller
+        self.assertEqual(len(self.executor.jobs), 3)
+        self.assertEqual(pool.get_stats()["keypool.waiting"], 2)
+
+        self.reactor.advance(2)
+        self.executor.complete(self.der)
+        self.assertKeypair(self.successResultOf(d1))
+        self.assertNoResult(d2)
+        self.reactor.advance(1)
+        self.executor.complete(self.der, 2)
+        self.assertKeypair(self.successResultOf(d2))
+
+        stats = pool.get_stats()
+        self.assertEqual(stats["keypool.spares"], 1)
+        self.assertEqual(stats["keypool.waits"], 2)
+        self.assertEqual(stats["keypool.wait_time"], 5)
+        self.assertEqual(stats["keypool.max_wait_time"], 3)
+        self.assertEqual(stats["keypool.average_wait_time"], 2.5)
+
+    def test_failure(self):
+        """
+        If a key cannot be generated, the waiting callers get one made the
+        slow way, and so does everybody after them.
+        """
+        pool = self.make_pool(0)
+        d = pool.generate()
+        self.executor.fail(ValueError("no workers"))
+        (verifier, signer) = self.successResultOf(d)
+        rsa.verify_signature(verifier, rsa.sign_data(signer, b"data"), b"data")
+        self.successResultOf(pool.generate())
+        self.assertEqual(self.executor.jobs, [])
+
+    def test_broken_pool(self):
+        """
+        When the pool of workers breaks, keys are made the slow way until a
+        new pool replaces it, which happens after a delay that grows while
+        the new pools keep breaking.
+        """
+        self.reactor = FakeReactor()
+        executors = []
+        def make_executor():
+            executors.append(FakeExecutor())
+            return executors[-1]
+        pool = KeyPool(1, self.spares_file, reactor=self.reactor)
+        pool._make_executor = make_executor
+        pool.startService()
+        self.addCleanup(pool.stopService)
+
+        d = pool.generate()
+        # a broken pool fails every job it had
+        executors[0].fail(BrokenProcessPool("a worker died"), 2)
+        (verifier, signer) = self.successResultOf(d)
+        rsa.verify_signature(verifier, rsa.sign_data(signer, b"data"), b"data")
+        self.assertTrue(executors[0].shut_down)
+
+        (verifier, signer) = self.successResultOf(pool.generate())
+        rsa.verify_signature(verifier, rsa.sign_data(signer, b"data"), b"data")
+        self.assertEqual(len(executors), 1)
+
+        self.reactor.advance(pool.RETRY_DELAY)
+        self.assertEqual(len(executors), 2)
+        executors[1].fail(BrokenProcessPool("a worker died again"))
+        self.reactor.advance(pool.RETRY_DELAY)
+        self.assertEqual(len(executors), 2)
+        self.reactor.advance(pool.RETRY_DELAY)
+        self.assertEqual(len(executors), 3)
+
+        executors[2].complete(self.der)
+        self.assertKeypair(self.successResultOf(pool.generate()))
+        self.assertEqual(pool._retry_delay, pool.RETRY_DELAY)
+
+    def test_broken_given_executor(self):
+        """
+        An executor that was passed in cannot be replaced, so once it is
+        broken keys are made the slow way.
+        """
+        pool = self.make_pool(1)
+        self.executor.fail(BrokenProcessPool("a worker died"))
+        self.assertFalse(self.executor.shut_down)
+        (verifier, signer) = self.successResultOf(pool.generate())
+        rsa.verify_signature(verifier, rsa.sign_data(signer, b"data"), b"data")
+        self.assertEqual(self.executor.jobs, [])
+
+    @defer.inlineCallbacks
+    def test_spares_survive_restart(self):
+        """
+        Spare keys are saved, readable only by their owner, when the pool
+        stops, and removed from disk when they are loaded again.
+        """
+        pool = self.make_pool(2)
+        self.executor.complete(self.der, 2)
+        yield pool.stopService()
+        self.assertTrue(os.path.exists(self.spares_file))
+        if os.name == "posix":
+            mode = stat.S_IMODE(os.stat(self.spares_file).st_mode)
+            self.assertEqual(mode, 0o600)
+
+        pool = self.make_pool(2)
+        self.assertFalse(os.path.exists(self.spares_file))
+        self.assertEqual(len(self.executor.jobs), 0)
+        self.assertKeypair(self.successResultOf(pool.generate()))
+
+    def test_bad_spares(self):
+        """
+        Unparseable spare keys are ignored.
+        """
+        fileutil.write(self.spares_file, b"notakey\n")
+        pool = self.make_pool(1)
+        self.assertEqual(pool.get_stats()["keypool.spares"], 0)
+        self.assertFalse(os.path.exists(self.spares_file))
+
+    @defer.inlineCallbacks
+    def test_worker_processes(self):
+        """
+        By default keys are generated in worker processes.
+        """
+        pool = KeyPool(1, self.spares_file)
+        pool.startService()
+        self.addCleanup(pool.stopService)
+        (verifier, signer) = yield pool.generate()
+        signature = rsa.sign_data(signer, b"data")
+        rsa.verify_signature(verifier, signature, b"data")
+
+    @defer.inlineCallbacks
+    def test_workers_exit(self):
+        """
+        The worker processes do not hold on to our stdio, and they have
+        exited by the time the pool has stopped.
+        """
+        pool = KeyPool(1, self.spares_file, workers=2)
+        pool.startService()
+        yield pool.generate()
+        pids = list(pool._executor._processes)
+        self.assertEqual(len(pids), 2)
+        if os.path.isdir("/proc/self/fd"):
+            for pid in pids:
+                for fd in (0, 1, 2):
+                    target = os.readlink("/proc/%d/fd/%d" % (pid, fd))
+                    self.assertEqual(target, os.devnull)
+        yield pool.stopService()
+        for pid in pids:
+            try:
+                os.kill(pid, 0)
+            except OSError as e:
+                self.assertEqual(e.errno, errno.ESRCH)
+            else:
+                self.fail("worker process %d is still running" % (pid,))
@@ -51,6 +51,7 @@ from twisted.python.runtime import (
     platform,
 )
 from allmydata.util import fileutil, pollmixin
+from allmydata import uri
 from allmydata.util.encodingutil import unicode_to_argv
 from allmydata.test import common_util
 import allmydata
@@ -147,6 +148,96 @@ class ParseOrExitTests(SyncTestCase):
         )
 
 
+# The most time running a subcommand that talks to a node over HTTP may take,
+# in seconds, from importing the runner until the subcommand exits.  This is
+# generous, since the test machine may be slow or busy: it is here to catch
+# the import of a whole new subsystem, not a few milliseconds.
+IMPORT_TIME_BUDGET = 1.5
+
+# Modules that such a subcommand has no use for, and which are slow to import.
+HEAVY_MODULES = [
+    "twisted.internet.reactor",
+    "foolscap.api",
+    "wormhole",
+    "allmydata.interfaces",
+    "allmydata.client",
+    "allmydata.storage.server",
+    "allmydata.storage_client",
+    "allmydata.scripts.tahoe_run",
+]
+
+# The child prints how long the whole run took as the last line of stdout.
+RUN_CODE = """
+import time
+start = time.time()
+from allmydata.scripts.runner import run
+try:
+    run(argv=%r)
+except SystemExit:
+    pass
+print(time.time() - start)
+"""
+
+
+def import_times(code):
+    """
+    Run ``code`` in a child Python process with ``-X importtime``.
+
+    :return: A two-tuple of a dict mapping the name of each module that was
+        imported to the cumulative time its import took, in seconds, and the
+        child's stdout (unicode).
+    """
+    # Run it next to this allmydata, which "-c" puts first on sys.path.
+    p = Popen([sys.executable, "-X", "importtime", "-c", code],
+              stdout=PIPE, stderr=PIPE,
+              cwd=os.path.dirname(os.path.dirname(allmydata.__file__)))
+    out, err = p.communicate()
+    if p.returncode != 0:
+        raise AssertionError("child failed: %r" % (err,))
+    times = {}
+    for line in err.decode("utf-8").splitlines():
+        # import time: self [us] | cumulative | imported package
+        m = re.match(r"import time:\s+\d+\s+\|\s+(\d+)\s+\|\s+(\S+)", line)
+        if m:
+            times[m.group(2)] = int(m.group(1)) / 1000000
+    return times, out.decode("utf-8")
+
+
+class ImportTimeTests(SyncTestCase):
+    """
+    Tests for how much running a file store command imports.
+    """
+    def test_file_store_command(self):
+        """
+        Running ``tahoe ls`` on an alias, from the command line to the
+        subcommand's exit, imports none of the modules that only running a
+        node needs, and takes less than ``IMPORT_TIME_BUDGET``.
+        """
+        nodedir = self.mktemp()
+        fileutil.make_dirs(os.path.join(nodedir, "private"))
+        rootcap = uri.DirectoryURI(
+            uri.WriteableSSKFileURI(b"\x00" * 16, b"\x00" * 32),
+        ).to_string()
+        fileutil.write(
+            os.path.join(nodedir, "private", "aliases"),
+            b"tahoe: " + rootcap + b"\n",
+        )
+        # Nothing listens on port 1, so the subcommand fails once it has
+        # tried to talk to the node.
+        times, out = import_times(RUN_CODE % ([
+            "tahoe", "--node-directory", os.path.abspath(nodedir),
+            "ls", "--node-url", "http://127.0.0.1:1/", "tahoe:",
+        ],))
+        self.assertIn("allmydata.scripts.runner", times)
+        self.assertIn("allmydata.uri", times)
+        self.assertIn("allmydata.scripts.tahoe_ls", times)
+        self.assertEqual(
+            [name for name in HEAVY_MODULES if name in times],
+            [],
+        )
+        self.assertLess(float(out.split()[-1]), IMPORT_TIME_BUDGET)
+
+
 @log_call(action_type="run-bin-tahoe")
 def run_bintahoe(extra_argv, python_options=None):
     """
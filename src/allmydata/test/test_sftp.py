@@ -78,7 +78,11 @@ class Handler(GridTestMixin, ShouldFailMixin, ReallyEqualMixin, unittest.TestCas
             self.root = node
             self.root_uri = node.get_uri()
             sftpd._reload()
-            self.handler = sftpd.SFTPUserHandler(self.client, self.root, self.username)
+            # a long max_age, so that the tests see anything the cache
+            # fails to forget when a directory changes
+            self.caches = sftpd.DirectoryCaches(self.client.nodemaker, 60)
+            self.handler = sftpd.SFTPUserHandler(self.client, self.root, self.username,
+                                                 self.caches.get_cache(self.username))
         d.addCallback(_created_root)
         return d
 
@@ -347,6 +351,51 @@ class Handler(GridTestMixin, ShouldFailMixin, ReallyEqualMixin, unittest.TestCas
         d.addCallback(lambda ign: self.failUnlessEqual(self.handler._heisenfiles, {}))
         return d
 
+    @defer.inlineCallbacks
+    def test_directory_cache(self):
+        yield self._set_up("directory_cache", num_clients=2)
+        yield self.root.add_file(u"small", upload.Data(b"0123456789", None))
+        cache = self.handler._directory_cache
+        now = [1000.0]
+        cache._now = lambda: now[0]
+        def _names(listing):
+            return sorted(name for (name, longname, attrs) in listing)
+
+        listing = yield self.handler.openDirectory(b"")
+        self.failUnlessReallyEqual(_names(listing), [b"small"])
+        self.failUnlessReallyEqual(self.caches.get_stats()['sftp.cache.misses'], 1)
+        attrs = yield self.handler.getAttrs(b"small", True)
+        self.failUnlessReallyEqual(attrs['size'], 10)
+        listing = yield self.handler.openDirectory(b"")
+        self.failUnlessReallyEqual(_names(listing), [b"small"])
+        stats = self.caches.get_stats()
+        self.failUnlessReallyEqual(stats['sftp.cache.hits'], 2)
+        self.failUnlessReallyEqual(stats['sftp.cache.misses'], 1)
+        self.failUnlessReallyEqual(stats['sftp.cache.hit_rate'], 2.0 / 3)
+
+        # a change made through this gateway is seen at once
+        yield self.root.add_file(u"other", upload.Data(b"abc", None))
+        self.failUnlessReallyEqual(self.caches.get_stats()['sftp.cache.invalidations'], 1)
+        listing = yield self.handler.openDirectory(b"")
+        self.failUnlessReallyEqual(_names(listing), [b"other", b"small"])
+
+        # one made through another gateway is seen when the listing expires
+        other_root = self.g.clients[1].create_node_from_uri(self.root_uri)
+        yield other_root.delete(u"other")
+        listing = yield self.handler.openDirectory(b"")
+        self.failUnlessReallyEqual(_names(listing), [b"other", b"small"])
+        now[0] += 61
+        listing = yield self.handler.openDirectory(b"")
+        self.failUnlessReallyEqual(_names(listing), [b"small"])
+        yield self.shouldFailWithSFTPError(sftp.FX_NO_SUCH_FILE, "getAttrs other",
+                                           self.handler.getAttrs, b"other", True)
+
+        # each session has a cache of its own unless per_user is set
+        self.failIf(self.caches.get_cache(self.username) is cache)
+        caches = sftpd.DirectoryCaches(self.client.nodemaker, 60, per_user=True)
+        self.failUnless(caches.get_cache(u"bob") is caches.get_cache(u"bob"))
+        self.failIf(caches.get_cache(u"bob") is caches.get_cache(u"carol"))
+
     def test_openFile_read(self):
         d = self._set_up("openFile_read")
         d.addCallback(lambda ign: self._set_up_tree())
@@ -545,6 +594,65 @@ class Handler(GridTestMixin, ShouldFailMixin, ReallyEqualMixin, unittest.TestCas
         d.addCallback(lambda ign: self.failUnlessEqual(self.handler._heisenfiles, {}))
         return d
 
+    @defer.inlineCallbacks
+    def test_openFile_read_ranges(self):
+        # a large file opened read-only is read a block (segment) at a
+        # time, as the reads ask for them
+        yield self._set_up("openFile_read_ranges")
+        data = b"".join(b"%07d\n" % (i,) for i in range(40000)) # 320000 bytes
+        yield self.root.add_file(u"big", upload.Data(data, None))
+
+        rf = yield self.handler.openFile(b"big", sftp.FXF_READ, {})
+        self.failUnless(isinstance(rf, sftpd.RandomAccessReadOnlySFTPFile), rf)
+        block_size = sftpd.RandomAccessReadOnlySFTPFile.BLOCK_SIZE
+
+        # a read near the end fetches only the last block
+        got = yield rf.readChunk(len(data) - 20, 100)
+        self.failUnlessReallyEqual(got, data[-20:])
+        self.failUnlessReallyEqual(list(rf._blocks), [(2*block_size, len(data) - 2*block_size)])
+
+        # a read that spans two blocks
+        got = yield rf.readChunk(block_size - 5, 10)
+        self.failUnlessReallyEqual(got, data[block_size-5:block_size+5])
+        self.failUnlessReallyEqual(sorted(rf._blocks),
+                                   [(0, block_size), (block_size, block_size),
+                                    (2*block_size, len(data) - 2*block_size)])
+
+        # reads come from the cache once the blocks are there
+        rf._blocks[(0, block_size)] = b"x" * block_size
+        got = yield rf.readChunk(0, 4)
+        self.failUnlessReallyEqual(got, b"xxxx")
+
+        yield self.shouldFailWithSFTPError(sftp.FX_EOF, "readChunk starting at EOF",
+                                           rf.readChunk, len(data), 1)
+        attrs = yield rf.getAttrs()
+        self._compareAttributes(attrs, {'permissions': S_IFREG | 0o666, 'size': len(data)})
+        yield rf.close()
+        self.failUnlessReallyEqual(len(rf._blocks), 0)
+
+        # sequential reads fetch the next blocks ahead of time
+        rf = yield self.handler.openFile(b"big", sftp.FXF_READ, {})
+        got = yield rf.readChunk(0, 1000)
+        self.failUnlessReallyEqual(got, data[:1000])
+        self.failUnlessReallyEqual(list(rf._blocks), [(0, block_size)])
+        got = yield rf.readChunk(1000, 1000)
+        self.failUnlessReallyEqual(got, data[1000:2000])
+        self.failUnlessReallyEqual(sorted(set(rf._blocks) | set(rf._fetching)),
+                                   [(0, block_size), (block_size, block_size),
+                                    (2*block_size, len(data) - 2*block_size)])
+        chunks = []
+        offset = 2000
+        while True:
+            try:
+                chunk = yield rf.readChunk(offset, 32768)
+            except sftp.SFTPError as e:
+                self.failUnlessReallyEqual(e.code, sftp.FX_EOF)
+                break
+            chunks.append(chunk)
+            offset += len(chunk)
+        self.failUnlessReallyEqual(b"".join(chunks), data[2000:])
+        yield rf.close()
+
     def test_openFile_read_error(self):
         # The check at the end of openFile_read tested this for large files,
         # but it trashed the grid in the process, so this needs to be a
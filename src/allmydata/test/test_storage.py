@@ -430,6 +430,27 @@ class RemoteBucket(object):
         return defer.maybeDeferred(_call)
 
 
+class RequiredRangesBucket(object):
+    """
+    Call a ``BucketWriter`` the way the HTTP storage protocol does, answering
+    each write with the ranges of the share that are still required.
+    """
+
+    def __init__(self, bw):
+        self.bw = bw
+        self.writes = []
+
+    def callRemote(self, methname, *args):
+        if methname == "write":
+            offset, data = args
+            self.writes.append(offset)
+            self.bw.write(offset, data)
+            return defer.succeed(self.bw.required_ranges())
+        assert methname == "close"
+        self.bw.close()
+        return defer.succeed(None)
+
+
 class BucketProxy(unittest.TestCase):
     def make_bucket(self, name, size):
         basedir = os.path.join("storage", "BucketProxy", name)
@@ -550,6 +571,62 @@ class BucketProxy(unittest.TestCase):
         return self._do_test_readwrite("test_readwrite_v2",
                                        0x44, WriteBucketProxy_v2, ReadBucketProxy)
 
+    @defer.inlineCallbacks
+    def test_resume(self):
+        """
+        A resumed ``WriteBucketProxy`` skips the writes that the server says
+        it already has, and the share comes out the same.
+        """
+        sharesize = 0x24 + 95 + 7*32 + 7*32 + 7*32 + 3*(2+32) + 4+500
+        hashes = [hashutil.tagged_hash(b"crypt", b"bar%d" % i)
+                  for i in range(7)]
+        share_hashes = [(i, hashutil.tagged_hash(b"share", b"bar%d" % i))
+                        for i in (1,9,13)]
+        uri_extension = b"s" + b"E"*498 + b"e"
+        bw, _, sharefname = self.make_bucket("test_resume", sharesize)
+        def make_proxy():
+            rb = RequiredRangesBucket(bw)
+            bp = WriteBucketProxy(rb, None,
+                                  data_size=95,
+                                  block_size=25,
+                                  num_segments=4,
+                                  num_share_hashes=3,
+                                  uri_extension_size_max=len(uri_extension))
+            return rb, bp
+
+        # the first upload is interrupted after two blocks
+        rb, bp = make_proxy()
+        yield bp.put_header()
+        yield bp.put_block(0, b"a"*25)
+        yield bp.put_block(1, b"b"*25)
+        self.failUnless(bp.is_resumable())
+        self.failUnlessEqual(bp.get_acked_ranges(), [(0, 0x24 + 50)])
+
+        rb, bp = make_proxy()
+        bp.resume()
+        yield bp.put_header()
+        for (segnum, data) in enumerate([b"a"*25, b"b"*25, b"c"*25, b"d"*20]):
+            yield bp.put_block(segnum, data)
+        yield bp.put_crypttext_hashes(hashes)
+        yield bp.put_block_hashes(hashes)
+        yield bp.put_share_hashes(share_hashes)
+        yield bp.put_uri_extension(uri_extension)
+        yield bp.close()
+        # the header is always sent again, the first two blocks are not
+        self.failUnlessEqual(rb.writes[:2], [0, 0x24 + 50])
+        # everything but the (unused) plaintext hash tree has been written
+        self.failUnlessEqual(bp.get_acked_ranges(),
+                             [(0, 0x24 + 95), (0x24 + 95 + 7*32, sharesize)])
+
+        br = BucketReader(self, sharefname)
+        rbp = ReadBucketProxy(RemoteBucket(FoolscapBucketReader(br)),
+                              NoNetworkServer(b"abc", None), storage_index=b"")
+        for (segnum, data) in enumerate([b"a"*25, b"b"*25, b"c"*25, b"d"*20]):
+            block = yield rbp.get_block_data(segnum, 25, len(data))
+            self.failUnlessEqual(block, data)
+        ueb = yield rbp.get_uri_extension()
+        self.failUnlessEqual(ueb, uri_extension)
+
 class Server(unittest.TestCase):
 
     def setUp(self):
@@ -2170,6 +2247,25 @@ class MDMFProxies(unittest.TestCase, ShouldFailMixin):
         return d
 
 
+    def test_read_some_blockhashes(self):
+        self.block_hash_tree = [hashutil.tagged_hash(b"block", b"%d" % i)
+                                for i in range(6)]
+        self.block_hash_tree_s = self.serialize_blockhashes(
+            self.block_hash_tree)
+        self.write_test_share_to_server(b"si1")
+        mr = MDMFSlotReadProxy(self.storage_server, b"si1", 0)
+        d = mr.get_some_blockhashes(set([0, 2, 3, 5]))
+        d.addCallback(lambda blockhashes:
+            self.failUnlessEqual(blockhashes,
+                                 dict([(i, self.block_hash_tree[i])
+                                       for i in (0, 2, 3, 5)])))
+        d.addCallback(lambda ignored:
+            mr.get_some_blockhashes(set()))
+        d.addCallback(lambda blockhashes:
+            self.failUnlessEqual(blockhashes, {}))
+        return d
+
+
     def test_read_with_different_tail_segment_size(self):
         self.write_test_share_to_server(b"si1", tail_segment=True)
         mr = MDMFSlotReadProxy(self.storage_server, b"si1", 0)
@@ -26,6 +26,8 @@ from hypothesis.strategies import (
     integers,
 )
 
+from collections_extended import RangeMap
+
 from twisted.trial import unittest
 from twisted.python.failure import Failure
 from twisted.internet import defer, task
@@ -34,9 +36,12 @@ from foolscap.api import fireEventually
 import allmydata # for __full_version__
 from allmydata import uri, monitor, client
 from allmydata.immutable import upload, encode
+from allmydata.immutable.segsize import SegmentSizePolicy
+from allmydata.immutable.journal import UploadJournals
 from allmydata.interfaces import FileTooLargeError, UploadUnhappinessError
 from allmydata.util import log, base32
 from allmydata.util.assertutil import precondition
+from allmydata.util.mathutil import next_multiple
 from allmydata.util.deferredutil import DeferredListShouldSucceed
 from allmydata.test.no_network import GridTestMixin
 from allmydata.storage_client import StorageFarmBroker
@@ -134,6 +139,8 @@ class FakeStorageServer(object):
     def __init__(self, mode, reactor=None):
         self.mode = mode
         self.allocated = []
+        # (storage_index, shnum) -> FakeBucketWriter, for mode="resumable"
+        self.buckets = {}
         self._alloc_queries = 0
         self._get_queries = 0
         self.version = {
@@ -177,6 +184,17 @@ class FakeStorageServer(object):
             return (set(), {},)
         elif self.mode == "already got them":
             return (set(sharenums), {},)
+        elif self.mode == "resumable":
+            # like an HTTP server: the uploader that started a share can
+            # carry on writing it
+            for shnum in sharenums:
+                if (storage_index, shnum) not in self.buckets:
+                    self.buckets[(storage_index, shnum)] = FakeBucketWriter(
+                        share_size, report_required=True)
+            return (set(),
+                    dict([( shnum, self.buckets[(storage_index, shnum)] )
+                          for shnum in sharenums]),
+                    )
         else:
             for shnum in sharenums:
                 self.allocated.append( (storage_index, shnum) )
@@ -199,10 +217,15 @@ class FakeStorageServer(object):
 
 class FakeBucketWriter(object):
     # a diagnostic version of storageserver.BucketWriter
-    def __init__(self, size):
+    def __init__(self, size, report_required=False):
         self.data = BytesIO()
         self.closed = False
         self._size = size
+        # offsets of the writes we have received
+        self.writes = []
+        # like the HTTP storage protocol, answer writes with the ranges
+        # that are still required
+        self._written = RangeMap() if report_required else None
 
     def callRemote(self, methname, *args, **kwargs):
         def _call():
@@ -227,6 +250,14 @@ class FakeBucketWriter(object):
                      (offset, len(data), self._size))
         self.data.seek(offset)
         self.data.write(data)
+        self.writes.append(offset)
+        if self._written is not None:
+            self._written.set(True, offset, offset + len(data))
+            required = RangeMap()
+            required.set(True, 0, self._size)
+            for r in self._written.ranges():
+                required.empty(r.start, r.stop)
+            return required
 
     def remote_close(self):
         precondition(not self.closed)
@@ -452,6 +483,215 @@ class GoodServer(unittest.TestCase, ShouldFailMixin, SetDEPMixin):
         d.addCallback(self._check_large, SIZE_LARGE)
         return d
 
+    def test_streaming_large(self):
+        # the data is written only after the upload has started, a piece
+        # at a time, and with segments smaller than the pieces
+        data = self.get_data(SIZE_LARGE)
+        self.set_encoding_parameters(25, 25, 100, int(SIZE_LARGE / 2.5))
+        u = upload.StreamingUploadable(len(data))
+        d = self.u.upload(u)
+        for i in range(0, len(data), 100):
+            u.write(data[i:i+100])
+        d.addCallback(extract_uri)
+        d.addCallback(self._check_large, SIZE_LARGE)
+        return d
+
+class SegmentSize(unittest.TestCase, SetDEPMixin):
+    KiB = 1024
+
+    def test_small_files_unchanged(self):
+        p = SegmentSizePolicy()
+        p.observe_rtt(1.0)
+        for size in (0, 1000, 128*self.KiB, 2*MiB):
+            self.failUnlessEqual(p.get_segment_size(size, 3, 10, 128*self.KiB),
+                                 128*self.KiB)
+        # a small configured segment size is taken as deliberate
+        self.failUnlessEqual(p.get_segment_size(400, 1, 4, 5), 5)
+
+    def test_many_segments(self):
+        p = SegmentSizePolicy()
+        GB = 1000*MiB
+        # 256MiB still fits in TARGET_SEGMENTS default-sized segments
+        self.failUnlessEqual(p.get_segment_size(256*MiB, 3, 10, 128*self.KiB),
+                             128*self.KiB)
+        self.failUnlessEqual(p.get_segment_size(1*GB, 3, 10, 128*self.KiB),
+                             512*self.KiB)
+        # but never beyond MAX_SEGMENT_SIZE
+        self.failUnlessEqual(p.get_segment_size(50*GB, 3, 10, 128*self.KiB),
+                             1*MiB)
+        # nor beyond MAX_ENCODED_SEGMENT_SIZE, for expansive encodings
+        self.failUnlessEqual(p.get_max_segment_size(1, 10),
+                             p.MAX_ENCODED_SEGMENT_SIZE // 10)
+        self.failUnlessEqual(p.get_segment_size(50*GB, 1, 10, 128*self.KiB),
+                             p.MAX_ENCODED_SEGMENT_SIZE // 10)
+        # and never below the configured size
+        self.failUnlessEqual(p.get_segment_size(50*GB, 3, 10, 2*MiB), 2*MiB)
+
+    def test_wide_encoding(self):
+        p = SegmentSizePolicy()
+        # 25-of-40 makes 5KiB blocks out of 128KiB segments
+        self.failUnlessEqual(p.get_segment_size(8*MiB, 25, 40, 128*self.KiB),
+                             512*self.KiB)
+
+    def test_rtt(self):
+        p = SegmentSizePolicy()
+        self.failUnlessEqual(p.get_segment_size(8*MiB, 3, 10, 128*self.KiB),
+                             128*self.KiB)
+        p.observe_rtt(0.1)
+        self.failUnlessEqual(p.rtt, 0.1)
+        # 100ms round trips want 100KiB blocks
+        self.failUnlessEqual(p.get_segment_size(8*MiB, 3, 10, 128*self.KiB),
+                             512*self.KiB)
+        p.observe_rtt(0.6)
+        self.failUnlessAlmostEqual(p.rtt, 0.2)
+        self.failUnlessEqual(p.get_segment_size(8*MiB, 3, 10, 128*self.KiB),
+                             1*MiB)
+
+    def test_upload(self):
+        self.node = FakeClient(mode="good")
+        self.set_encoding_parameters(3, 7, 10, 128*self.KiB)
+        policy = SegmentSizePolicy()
+        u = upload.Uploader(segment_size_policy=policy)
+        u.running = True
+        u.parent = self.node
+        data = b"\x01" * (4*MiB)
+
+        d = upload_data(u, data)
+        def _check_default(results):
+            # (rounded up to a multiple of k)
+            self.failUnlessEqual(
+                results.get_uri_extension_data()["segment_size"],
+                next_multiple(128*self.KiB, 3))
+            # the uploader measured the servers while it was at it
+            self.failIfEqual(policy.rtt, None)
+            policy.rtt = 1.0
+            return upload_data(u, data)
+        d.addCallback(_check_default)
+        def _check_slow(results):
+            self.failUnlessEqual(
+                results.get_uri_extension_data()["segment_size"],
+                next_multiple(1*MiB, 3))
+            # but not for a convergent upload, which keeps the configured
+            # segment size (and so its cap), whatever the policy says
+            policy.MIN_BLOCK_SIZE = 200*self.KiB
+            return u.upload(upload.Data(data, convergence=b"secret"))
+        d.addCallback(_check_slow)
+        def _check_convergent(results):
+            self.failUnlessEqual(
+                results.get_uri_extension_data()["segment_size"],
+                next_multiple(128*self.KiB, 3))
+            policy.rtt = 0.01
+            d2 = u.upload(upload.Data(data, convergence=b"secret"))
+            d2.addCallback(lambda again:
+                           self.failUnlessEqual(again.get_uri(),
+                                                results.get_uri()))
+            return d2
+        d.addCallback(_check_convergent)
+        return d
+
+class InterruptedData(upload.Data):
+    """I fail when asked to read beyond the first fail_after bytes."""
+    def __init__(self, data, fail_after):
+        upload.Data.__init__(self, data, convergence=b"")
+        self._fail_after = fail_after
+    def read(self, length):
+        if self._filehandle.tell() + length > self._fail_after:
+            raise GotTooFarError("interrupted")
+        return upload.Data.read(self, length)
+
+class ResumableUpload(unittest.TestCase, ShouldFailMixin, SetDEPMixin):
+    def test_journal(self):
+        journals = UploadJournals(self.mktemp())
+        j = journals.get_journal("t-1")
+        self.failUnlessEqual(j.get_encoding_parameters(1000), None)
+        j.start(b"\x01" * 16, 1000, (3, 7, 10, 300))
+        j.set_placement(0, b"\x02" * 20)
+        j.set_acked_ranges(0, [(0, 36), (50, 100)])
+        j.set_placement(1, b"\x03" * 20)
+        j.save()
+
+        j = journals.get_journal("t-1")
+        self.failUnlessEqual(j.get_encoding_parameters(1000), (3, 7, 10, 300))
+        self.failUnlessEqual(j.get_encoding_parameters(1001), None)
+        self.failUnlessEqual(j.get_placements(),
+                             {0: b"\x02" * 20, 1: b"\x03" * 20})
+        self.failUnlessEqual(j.get_acked_ranges(0, b"\x02" * 20),
+                             [(0, 36), (50, 100)])
+        # the share went somewhere else, so it starts from scratch
+        self.failUnlessEqual(j.get_acked_ranges(0, b"\x03" * 20), [])
+        # a different file makes the journal start over
+        j.start(b"\x04" * 16, 1000, (3, 7, 10, 300))
+        self.failUnlessEqual(j.get_placements(), {})
+        j.delete()
+        self.failUnlessEqual(journals.get_journal("t-1").storage_index, None)
+
+        self.failUnlessRaises(ValueError, journals.get_journal, "../t")
+        self.failUnlessRaises(ValueError, journals.get_journal, "")
+
+    def make_uploader(self):
+        self.node = FakeClient(mode="resumable", num_servers=10)
+        self.set_encoding_parameters(3, 7, 10, 3000)
+        u = upload.Uploader(journals=UploadJournals(self.basedir))
+        u.running = True
+        u.parent = self.node
+        return u
+
+    def get_buckets(self):
+        buckets = {}
+        for server in self.node.last_servers:
+            for ((si, shnum), bucket) in server.buckets.items():
+                buckets[shnum] = bucket
+        return buckets
+
+    @defer.inlineCallbacks
+    def test_resume(self):
+        self.basedir = self.mktemp()
+        data = b"".join([b"%09d\n" % i for i in range(3000)])
+        u = self.make_uploader()
+
+        uploadable = InterruptedData(data, 15000)
+        uploadable.resume_token = "t1"
+        yield self.shouldFail(GotTooFarError, "first attempt", None,
+                              u.upload, uploadable)
+        yield fireEventually()
+        j = UploadJournals(self.basedir).get_journal("t1")
+        self.failUnlessEqual(j.get_encoding_parameters(len(data)),
+                             (3, 7, 10, 3000))
+        self.failUnlessEqual(len(j.get_placements()), 10)
+        buckets = self.get_buckets()
+        first_writes = dict((shnum, set(b.writes))
+                            for (shnum, b) in buckets.items())
+        self.failUnless(all(len(w) > 1 for w in first_writes.values()))
+        for b in buckets.values():
+            self.failIf(b.closed)
+            b.writes = []
+
+        # the journal determines the encoding, whatever the current defaults
+        self.set_encoding_parameters(2, 4, 6, 5000)
+        uploadable = upload.Data(data, convergence=b"")
+        uploadable.resume_token = "t1"
+        results = yield u.upload(uploadable)
+        cap = uri.from_string(results.get_uri())
+        self.failUnlessEqual((cap.needed_shares, cap.total_shares), (3, 10))
+        self.failUnlessEqual(results.get_uri_extension_data()["segment_size"],
+                             3000)
+        self.failIf(os.path.exists(os.path.join(self.basedir, "t1")))
+        self.failUnlessEqual(self.get_buckets(), buckets)
+        for (shnum, b) in buckets.items():
+            self.failUnless(b.closed)
+            # the header is written again, the blocks that landed are not
+            self.failUnlessEqual(b.writes[0], 0)
+            self.failUnlessEqual(first_writes[shnum] & set(b.writes), {0})
+
+        # and the shares are the same as those of an uninterrupted upload
+        resumed = dict((shnum, b.data.getvalue())
+                       for (shnum, b) in buckets.items())
+        u = self.make_uploader()
+        yield u.upload(upload.Data(data, convergence=b""))
+        self.failUnlessEqual(dict((shnum, b.data.getvalue())
+                                  for (shnum, b) in self.get_buckets().items()),
+                             resumed)
+
 class ServerErrors(unittest.TestCase, ShouldFailMixin, SetDEPMixin):
     def make_node(self, mode, num_servers=10):
         self.node = FakeClient(mode, num_servers)
@@ -924,6 +1164,92 @@ class FileHandleTests(unittest.TestCase):
         )
 
 
+class FakeProducer(object):
+    paused = False
+
+    def pauseProducing(self):
+        assert not self.paused
+        self.paused = True
+
+    def resumeProducing(self):
+        assert self.paused
+        self.paused = False
+
+
+class StreamingUploadableTests(unittest.TestCase):
+    """
+    Tests for ``StreamingUploadable``.
+    """
+    def test_read_waits_for_data(self):
+        """
+        A read of more than has been written fires once enough has been
+        written, or all of it.
+        """
+        u = upload.StreamingUploadable(10)
+        self.assertEqual(self.successResultOf(u.get_size()), 10)
+        d = u.read(4)
+        self.assertNoResult(d)
+        u.write(b"abc")
+        self.assertNoResult(d)
+        u.write(b"def")
+        self.assertEqual(b"".join(self.successResultOf(d)), b"abcd")
+        d = u.read(8)
+        u.write(b"ghijklmn")
+        # only the declared size is kept
+        self.assertEqual(b"".join(self.successResultOf(d)), b"efghij")
+        self.assertTrue(u.is_complete())
+        self.assertEqual(self.successResultOf(u.read(8)), [])
+
+    def test_random_key(self):
+        """
+        Each ``StreamingUploadable`` gets its own random encryption key.
+        """
+        k1 = self.successResultOf(upload.StreamingUploadable(10).get_encryption_key())
+        k2 = self.successResultOf(upload.StreamingUploadable(10).get_encryption_key())
+        self.assertEqual(len(k1), 16)
+        self.assertNotEqual(k1, k2)
+
+    def test_backpressure(self):
+        """
+        The producer is paused while buffer_size bytes are waiting to be
+        read, but not while a read is waiting for more, and not once all of
+        the data has arrived.
+        """
+        producer = FakeProducer()
+        u = upload.StreamingUploadable(20, producer, buffer_size=4)
+        u.write(b"abc")
+        self.assertFalse(producer.paused)
+        u.write(b"d")
+        self.assertTrue(producer.paused)
+        self.successResultOf(u.read(2))
+        self.assertFalse(producer.paused)
+        d = u.read(10)
+        u.write(b"efghijkl")
+        self.assertFalse(producer.paused)
+        self.successResultOf(d)
+        u.write(b"mnopqr")
+        self.assertTrue(producer.paused)
+        u.write(b"st")
+        self.assertFalse(producer.paused)
+
+    def test_abort(self):
+        """
+        After ``abort``, reads fail and the producer is resumed.
+        """
+        producer = FakeProducer()
+        u = upload.StreamingUploadable(20, producer, buffer_size=4)
+        u.write(b"abcd")
+        d = u.read(2)
+        self.successResultOf(d)
+        d = u.read(10)
+        u.abort(ValueError("no more"))
+        self.failureResultOf(d, ValueError)
+        self.assertFalse(producer.paused)
+        u.write(b"efghijklmn")
+        self.assertFalse(producer.paused)
+        self.failureResultOf(u.read(1), ValueError)
+
+
 class EncodingParameters(GridTestMixin, unittest.TestCase, SetDEPMixin,
     ShouldFailMixin):
 
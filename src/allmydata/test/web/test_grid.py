@@ -17,6 +17,7 @@ from six.moves import StringIO
 
 from bs4 import BeautifulSoup
 
+from twisted.internet import defer
 from twisted.web import resource
 from allmydata import uri, dirnode
 from allmydata.util import base32
@@ -27,6 +28,7 @@ from allmydata.unknown import UnknownNode
 from allmydata.storage.shares import get_share_file
 from allmydata.scripts.debug import CorruptShareOptions, corrupt_share
 from allmydata.immutable import upload
+from allmydata.interfaces import MDMF_VERSION
 from allmydata.mutable import publish
 
 from ...web.common import (
@@ -1298,6 +1300,37 @@ class Grid(GridTestMixin, WebErrorMixin, ShouldFailMixin, testutil.ReallyEqualMi
 
         return d
 
+    @defer.inlineCallbacks
+    def test_download_etags_and_ranges(self):
+        self.basedir = "web/Grid/download_etags_and_ranges"
+        self.set_up_grid()
+        c0 = self.g.clients[0]
+        DATA = os.urandom(300000)
+        ranges = {"range": "bytes=10-19,200000-200009"}
+
+        ur = yield c0.upload(upload.Data(DATA, convergence=None))
+        n = yield c0.create_mutable_file(publish.MutableData(DATA),
+                                         version=MDMF_VERSION)
+        for cap in (ur.get_uri(), n.get_uri()):
+            url = "uri/" + url_quote(cap)
+            body, status, headers = yield self.GET(url, return_response=True,
+                                                   headers=ranges)
+            self.failUnlessReallyEqual(status, "206")
+            self.assertThat(body, Contains(DATA[10:20]))
+            self.assertThat(body, Contains(DATA[200000:200010]))
+            etag = headers.getRawHeaders("etag")[0]
+            _, status, _ = yield self.GET(url, return_response=True,
+                                          headers={"if-none-match": etag})
+            self.failUnlessReallyEqual(status, "304")
+
+        # publishing a new version of the mutable file changes its ETag
+        yield n.overwrite(publish.MutableData(DATA[:1000]))
+        body, status, headers = yield self.GET(
+            url, return_response=True, headers={"if-none-match": etag})
+        self.failUnlessReallyEqual(status, "200")
+        self.failUnlessReallyEqual(body, DATA[:1000])
+        self.assertNotEqual(headers.getRawHeaders("etag")[0], etag)
+
     def test_blacklist(self):
         # download from a blacklisted URI, get an error
         self.basedir = "web/Grid/blacklist"
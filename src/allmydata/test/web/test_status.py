@@ -22,9 +22,11 @@ from allmydata.web.status import (
 
 from zope.interface import implementer
 
+from allmydata.gateway import _Gateway
 from allmydata.interfaces import IDownloadResults
-from allmydata.web.status import DownloadStatusElement
+from allmydata.web.status import DownloadStatusElement, UploadStatusElement
 from allmydata.immutable.downloader.status import DownloadStatus
+from allmydata.immutable.upload import UploadStatus
 
 from .common import (
     assert_soup_has_favicon,
@@ -37,8 +39,8 @@ from .test_web import FakeHistory
 # Test that status.StatusElement can render HTML.
 class StatusTests(TrialTestCase):
 
-    def _render_status_page(self, active, recent):
-        elem = StatusElement(active, recent)
+    def _render_status_page(self, active, recent, gateway=None):
+        elem = StatusElement(active, recent, gateway)
         d = flattenString(None, elem)
         return self.successResultOf(d)
 
@@ -87,6 +89,29 @@ class StatusTests(TrialTestCase):
             "Recent Operations:"
         )
 
+    def test_status_page_gateway(self):
+        """
+        In a multi-process gateway, the status page links to the pages of
+        the other workers, and its links name the worker which holds the
+        operations.
+        """
+        status = Status(FakeHistory())
+        doc = self._render_status_page(
+            status._get_active_operations(),
+            status._get_recent_operations(),
+            _Gateway(1, 3),
+        )
+        soup = BeautifulSoup(doc, 'html5lib')
+        hrefs = [a["href"] for a in soup.find_all("a")]
+        for index in range(3):
+            self.assertIn("/status/worker-%d/" % (index,), hrefs)
+        op_links = [href for href in hrefs
+                    if href.startswith("/status/") and "-" in href[8:]
+                    and not href.startswith("/status/worker-")]
+        self.assertEqual(op_links, [])
+        self.assertTrue(any(href.startswith("/status/worker-1/down-")
+                            for href in hrefs))
+
 
 @implementer(IDownloadResults)
 class FakeDownloadResults(object):
@@ -219,6 +244,26 @@ class DownloadStatusElementTests(TrialTestCase):
             self, soup, u"li", u"[omwtg]: 3.00s, 2.00s"
         )
 
+    def test_download_status_element_hedging(self):
+        """
+        The page reports how many hedged block requests were sent and how
+        many of them were used.
+        """
+        status = FakeDownloadStatus(b"si-1", 123)
+        result = self._render_download_status_element(status)
+        soup = BeautifulSoup(result, 'html5lib')
+        assert_soup_has_tag_with_content(
+            self, soup, u"li", u"Hedged Requests: none"
+        )
+
+        status.add_hedge_results(3, 1)
+        status.add_hedge_results(1, 1)
+        result = self._render_download_status_element(status)
+        soup = BeautifulSoup(result, 'html5lib')
+        assert_soup_has_tag_with_content(
+            self, soup, u"li", u"Hedged Requests: 4 (2.00 per segment, 50.0% used)"
+        )
+
     def test_download_status_element_partial(self):
         """
         See if we can render the page with incomplete download status.
@@ -238,3 +283,36 @@ class DownloadStatusElementTests(TrialTestCase):
         assert_soup_has_tag_with_content(
             self, soup, u"li", u"Total: None (None)"
         )
+
+
+class UploadStatusElementTests(TrialTestCase):
+    """
+    Tests for ```allmydata.web.status.UploadStatusElement```.
+    """
+
+    def _render_upload_status_element(self, status):
+        """
+        :param IUploadStatus status:
+        :return: HTML string rendered by UploadStatusElement
+        """
+        elem = UploadStatusElement(status)
+        d = flattenString(None, elem)
+        return self.successResultOf(d)
+
+    def test_segments_in_flight(self):
+        """
+        The page reports the most segments the encoder had in flight at once.
+        """
+        status = UploadStatus()
+        result = self._render_upload_status_element(status)
+        soup = BeautifulSoup(result, 'html5lib')
+        assert_soup_has_tag_with_content(
+            self, soup, u"li", u"Segments In Flight (max): (unknown)"
+        )
+
+        status.set_segments_in_flight(3)
+        result = self._render_upload_status_element(status)
+        soup = BeautifulSoup(result, 'html5lib')
+        assert_soup_has_tag_with_content(
+            self, soup, u"li", u"Segments In Flight (max): 3"
+        )
@@ -27,13 +27,15 @@ from twisted.internet.task import Clock
 from twisted.web import client, error, http
 from twisted.python import failure, log
 
-from allmydata import interfaces, uri, webish
+from allmydata import interfaces, sharded_dirnode, uri, webish
 from allmydata.storage_client import StorageFarmBroker, StubServer
 from allmydata.immutable import upload
+from allmydata.immutable.literal import LiteralFileNode
 from allmydata.immutable.downloader.status import DownloadStatus
 from allmydata.dirnode import DirectoryNode
 from allmydata.nodemaker import NodeMaker
 from allmydata.web.common import MultiFormatResource
+from allmydata.web.directory import DirectoryJSONProducer
 from allmydata.util import fileutil, base32, hashutil, jsonbytes as json
 from allmydata.util.consumer import download_to_data
 from allmydata.util.encodingutil import to_bytes
@@ -772,6 +774,71 @@ class MultiFormatResourceTests(TrialTestCase):
         )
 
 
+class ProducerRequest(object):
+    """I stand in for a request that a producer writes to."""
+
+    def __init__(self):
+        self.written = []
+        self.producer = None
+
+    def setHeader(self, name, value):
+        pass
+
+    def write(self, data):
+        self.written.append(data)
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+
+class DirectoryJSONProducerTests(TrialTestCase):
+    """
+    Tests for ``DirectoryJSONProducer``.
+    """
+    def _start(self):
+        node = LiteralFileNode(uri.LiteralFileURI(b"data"))
+        children = dict((u"file-%04d" % i, (node, {})) for i in range(250))
+        req = ProducerRequest()
+        producer = DirectoryJSONProducer(req, None, children,
+                                         sorted(children)[:200], None)
+        return req, producer, producer.start()
+
+    def test_page_only(self):
+        """
+        The producer keeps only the children on the page it writes.
+        """
+        req, producer, d = self._start()
+        self.assertEqual(len(producer.children), 200)
+
+    def test_connection_lost(self):
+        """
+        When the connection goes before the listing is written, the
+        Deferred from ``start`` fails with ``CancelledError`` and nothing
+        more is written.
+        """
+        req, producer, d = self._start()
+        req.producer.resumeProducing()
+        written = len(req.written)
+        req.producer.stopProducing()
+        self.failureResultOf(d, defer.CancelledError)
+        producer.resumeProducing()
+        producer.stopProducing()
+        self.assertEqual(len(req.written), written)
+
+    def test_cancel(self):
+        """
+        Cancelling the Deferred from ``start`` stops the producer.
+        """
+        req, producer, d = self._start()
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        producer.resumeProducing()
+        self.assertEqual(len(req.written), 1)
+
+
 class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixin, TrialTestCase):
     maxDiff = None
 
@@ -1397,6 +1464,171 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_got)
         return d
 
+    def _parse_byteranges(self, body, headers):
+        # return the [(content-range, data)] of a multipart/byteranges body
+        ctype = headers.getRawHeaders("content-type")[0]
+        self.failUnless(ctype.startswith("multipart/byteranges; boundary="),
+                        ctype)
+        boundary = ctype.split("=", 1)[1].encode("ascii")
+        self.failUnless(body.endswith(b"--%s--\r\n" % boundary), body)
+        parts = body.split(b"--%s" % boundary)
+        self.failUnlessReallyEqual(parts[0], b"")
+        self.failUnlessReallyEqual(parts[-1], b"--\r\n")
+        results = []
+        for part in parts[1:-1]:
+            head, data = part.split(b"\r\n\r\n", 1)
+            self.failUnless(data.endswith(b"\r\n"), data)
+            content_range = [line for line in head.split(b"\r\n")
+                             if line.startswith(b"Content-Range: ")]
+            results.append((content_range[0][len(b"Content-Range: "):],
+                            data[:-2]))
+        return results
+
+    @inlineCallbacks
+    def test_GET_FILEURL_multiple_ranges(self):
+        length = len(self.BAR_CONTENTS)
+        headers = {"range": "bytes=1-3, 10-12,-2"}
+        res, status, headers = yield self.GET(self.public_url + "/foo/bar.txt",
+                                              headers=headers,
+                                              return_response=True)
+        self.failUnlessReallyEqual(int(status), 206)
+        self.failUnlessReallyEqual(
+            self._parse_byteranges(res, headers),
+            [(b"bytes 1-3/%d" % length, self.BAR_CONTENTS[1:4]),
+             (b"bytes 10-12/%d" % length, self.BAR_CONTENTS[10:13]),
+             (b"bytes %d-%d/%d" % (length-2, length-1, length),
+              self.BAR_CONTENTS[-2:])])
+
+        # HEAD describes the same response
+        _, status, headers = yield self.HEAD(
+            self.public_url + "/foo/bar.txt",
+            headers={"range": "bytes=1-3, 10-12,-2"}, return_response=True)
+        self.failUnlessReallyEqual(int(status), 206)
+        self.failUnlessReallyEqual(int(headers.getRawHeaders("content-length")[0]),
+                                   len(res))
+
+    @inlineCallbacks
+    def test_GET_FILEURL_overlapping_ranges(self):
+        # ranges which overlap or touch are sent as one
+        headers = {"range": "bytes=5-8,1-3,4-6,100-200"}
+        res, status, headers = yield self.GET(self.public_url + "/foo/bar.txt",
+                                              headers=headers,
+                                              return_response=True)
+        self.failUnlessReallyEqual(int(status), 206)
+        self.failUnlessReallyEqual(headers.getRawHeaders("content-range")[0],
+                                   "bytes 1-8/%d" % len(self.BAR_CONTENTS))
+        self.failUnlessReallyEqual(res, self.BAR_CONTENTS[1:9])
+
+    @inlineCallbacks
+    def test_GET_FILEURL_distant_ranges(self):
+        # ranges more than a segment apart are read separately
+        contents = os.urandom(3 * interfaces.DEFAULT_MAX_SEGMENT_SIZE)
+        cap = yield self.PUT("/uri", contents)
+        end = len(contents)
+        headers = {"range": "bytes=0-9,%d-%d,%d-" % (end//2, end//2 + 9, end-10)}
+        res, status, headers = yield self.GET("/uri/%s" % str(cap, "ascii"),
+                                              headers=headers,
+                                              return_response=True)
+        self.failUnlessReallyEqual(int(status), 206)
+        self.failUnlessReallyEqual(
+            [data for (content_range, data) in
+             self._parse_byteranges(res, headers)],
+            [contents[:10], contents[end//2:end//2 + 10], contents[-10:]])
+
+    @inlineCallbacks
+    def test_GET_FILEURL_mutable_multiple_ranges(self):
+        headers = {"range": "bytes=0-1,5-6"}
+        res, status, headers = yield self.GET(self.public_url + "/foo/quux.txt",
+                                              headers=headers,
+                                              return_response=True)
+        self.failUnlessReallyEqual(int(status), 206)
+        self.failUnlessReallyEqual(
+            [data for (content_range, data) in
+             self._parse_byteranges(res, headers)],
+            [self.QUUX_CONTENTS[0:2], self.QUUX_CONTENTS[5:7]])
+
+    @inlineCallbacks
+    def test_GET_FILEURL_if_range(self):
+        url = self.public_url + "/foo/bar.txt"
+        _, _, headers = yield self.GET(url, return_response=True)
+        etag = headers.getRawHeaders("etag")[0]
+        # the client has the current version, so gets just the range
+        res, status, _ = yield self.GET(url, return_response=True,
+                                        headers={"range": "bytes=1-10",
+                                                 "if-range": etag})
+        self.failUnlessReallyEqual(int(status), 206)
+        self.failUnlessReallyEqual(res, self.BAR_CONTENTS[1:11])
+        # the client has some other version, so gets all of this one
+        res, status, _ = yield self.GET(url, return_response=True,
+                                        headers={"range": "bytes=1-10",
+                                                 "if-range": '"other"'})
+        self.failUnlessReallyEqual(int(status), 200)
+        self.failUnlessReallyEqual(res, self.BAR_CONTENTS)
+
+    @inlineCallbacks
+    def test_GET_FILEURL_cache_headers(self):
+        # an immutable file named by its own cap never changes
+        url = "/uri/%s" % (str(self._bar_txt_uri, "ascii"),)
+        _, _, headers = yield self.GET(url, return_response=True)
+        self.failUnlessIn("immutable",
+                          headers.getRawHeaders("cache-control")[0])
+        etag = headers.getRawHeaders("etag")[0]
+        self.failUnless(etag.startswith('"') and etag.endswith('"'), etag)
+
+        # any of the tags given may match
+        res, status, headers = yield self.GET(
+            url, return_response=True,
+            headers={"if-none-match": '"other", W/%s' % (etag,)})
+        self.failUnlessReallyEqual(int(status), http.NOT_MODIFIED)
+        self.failUnlessReallyEqual(res, b"")
+        self.failUnlessIn("immutable",
+                          headers.getRawHeaders("cache-control")[0])
+
+        _, _, headers = yield self.GET(
+            "/file/%s/@@named=/bar.txt" % (str(self._bar_txt_uri, "ascii"),),
+            return_response=True)
+        self.failUnlessIn("immutable",
+                          headers.getRawHeaders("cache-control")[0])
+
+    @inlineCallbacks
+    def test_GET_FILEURL_path_cache_headers(self):
+        # but a path through a directory may later lead to another file, so
+        # caches must revalidate
+        url = self.public_url + "/foo/bar.txt"
+        _, _, headers = yield self.GET(url, return_response=True)
+        self.failUnlessReallyEqual(headers.getRawHeaders("cache-control"),
+                                   ["no-cache"])
+        etag = headers.getRawHeaders("etag")[0]
+        _, status, _ = yield self.GET(url, return_response=True,
+                                      headers={"if-none-match": etag})
+        self.failUnlessReallyEqual(int(status), http.NOT_MODIFIED)
+
+        yield self.PUT(url, b"new contents of bar.txt")
+        res, status, headers = yield self.GET(url, return_response=True,
+                                              headers={"if-none-match": etag})
+        self.failUnlessReallyEqual(int(status), http.OK)
+        self.failUnlessReallyEqual(res, b"new contents of bar.txt")
+        self.failIfEqual(headers.getRawHeaders("etag")[0], etag)
+
+    @inlineCallbacks
+    def test_GET_FILEURL_mutable_etag(self):
+        url = self.public_url + "/foo/quux.txt"
+        _, _, headers = yield self.GET(url, return_response=True)
+        self.failUnlessReallyEqual(headers.getRawHeaders("cache-control"),
+                                   ["no-cache"])
+        etag = headers.getRawHeaders("etag")[0]
+        _, status, _ = yield self.GET(url, return_response=True,
+                                      headers={"if-none-match": etag})
+        self.failUnlessReallyEqual(int(status), http.NOT_MODIFIED)
+
+        # a new version has a new ETag
+        yield self.PUT(url, b"new contents of quux.txt")
+        res, status, headers = yield self.GET(url, return_response=True,
+                                              headers={"if-none-match": etag})
+        self.failUnlessReallyEqual(int(status), http.OK)
+        self.failUnlessReallyEqual(res, b"new contents of quux.txt")
+        self.failIfEqual(headers.getRawHeaders("etag")[0], etag)
+
     def test_HEAD_FILEURL(self):
         d = self.HEAD(self.public_url + "/foo/bar.txt", return_response=True)
         def _got(res_and_status_and_headers):
@@ -1576,7 +1808,8 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
                 self.failUnless(all([r[0] for r in results]))
                 # the etag for the t=json form should be just like the etag
                 # fo the default t='' form, but with a 'json' suffix
-                self.failUnlessEqual(results[0][1] + 'json', results[1][1])
+                self.failUnlessEqual(results[0][1].strip('"') + 'json',
+                                     results[1][1].strip('"'))
             d.addCallback(_check)
             return d
 
@@ -2000,6 +2233,29 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         toolbars = soup.find_all(u"li", {u"class": u"toolbar-item"})
         self.assertTrue(any(li.text == u"Return to Welcome page" for li in toolbars))
         self.failUnlessIn(b"quux", data)
+        self.failIfIn(b"Next page", data)
+
+    @inlineCallbacks
+    def test_GET_DIRECTORY_html_paged(self):
+        data = yield self.GET(self.public_url + "/foo?limit=3",
+                              followRedirect=True)
+        # the first three children in order of name
+        self.failUnlessIn(b"bar.txt", data)
+        self.failUnlessIn(b"baz.txt", data)
+        self.failIfIn(b"quux.txt", data)
+        soup = BeautifulSoup(data, 'html5lib')
+        links = dict((a.text, a[u"href"]) for a in soup.find_all(u"a"))
+        self.failUnlessEqual(links[u"Next page"], u"?limit=3&after=baz.txt")
+        self.failIfIn(u"First page", links)
+
+        data = yield self.GET(self.public_url + "/foo?limit=3&after=baz.txt",
+                              followRedirect=True)
+        self.failIfIn(b"bar.txt", data)
+        self.failUnlessIn(b"blockingfile", data)
+        soup = BeautifulSoup(data, 'html5lib')
+        links = dict((a.text, a[u"href"]) for a in soup.find_all(u"a"))
+        self.failUnlessEqual(links[u"First page"], u"?limit=3")
+        self.failUnlessEqual(links[u"Next page"], u"?limit=3&after=n%C3%BC.txt")
 
     @inlineCallbacks
     def test_GET_DIRECTORY_html_filenode_encoding(self):
@@ -2133,6 +2389,68 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(self.failUnlessIsFooJSON)
         return d
 
+    def test_GET_DIRURL_json_max_age(self):
+        d = self.GET(self.public_url + "/foo?t=json&max-age=30")
+        d.addCallback(self.failUnlessIsFooJSON)
+        return d
+
+    @inlineCallbacks
+    def test_GET_DIRURL_json_bad_max_age(self):
+        url = self.webish_url + self.public_url + "/foo?t=json&max-age=-1"
+        yield self.assertHTTPError(url, 400, "invalid max-age= argument")
+
+    @inlineCallbacks
+    def test_GET_DIRURL_json_paged(self):
+        all_names = sorted([self._htmlname_unicode, u"bar.txt", u"baz.txt",
+                            u"blockingfile", u"empty", u"nü.txt",
+                            u"quux.txt", u"sub"])
+        names = []
+        url = self.public_url + "/foo?t=json&limit=3"
+        while True:
+            data = json.loads((yield self.GET(url)))
+            self.failUnlessEqual(data[0], "dirnode")
+            self.failUnless(data[1]["mutable"])
+            page = list(data[1]["children"])
+            self.failUnless(len(page) <= 3, page)
+            names.extend(page)
+            if "next_after" not in data[1]:
+                break
+            self.failUnlessEqual(data[1]["next_after"], page[-1])
+            url = (self.public_url + "/foo?t=json&limit=3&after=" +
+                   urlquote(data[1]["next_after"].encode("utf-8")))
+        # the pages are in order of name, and between them hold every child
+        self.failUnlessEqual(names, all_names)
+
+    @inlineCallbacks
+    def test_GET_DIRURL_json_after(self):
+        data = json.loads((yield self.GET(self.public_url +
+                                          "/foo?t=json&after=empty")))
+        self.failUnlessEqual(list(data[1]["children"]),
+                             [u"nü.txt", u"quux.txt", u"sub"])
+        self.failIfIn("next_after", data[1])
+
+    @inlineCallbacks
+    def test_GET_DIRURL_json_bad_limit(self):
+        for limit in ["0", "-1", "many"]:
+            url = self.webish_url + self.public_url + "/foo?t=json&limit=" + limit
+            yield self.assertHTTPError(url, 400,
+                                       "limit= must be a positive integer")
+
+    @inlineCallbacks
+    def test_GET_DIRURL_json_many_children(self):
+        # more children than the listing writes at once
+        kids = dict((u"file-%04d" % i, (self._bar_txt_uri, None))
+                    for i in range(250))
+        yield self._foo_node.set_children(kids)
+        data = json.loads((yield self.GET(self.public_url + "/foo?t=json")))
+        self.failUnlessEqual(data[0], "dirnode")
+        self.failUnlessEqual(len(data[1]["children"]), 250 + 8)
+        child = data[1]["children"][u"file-0123"]
+        self.failUnlessEqual(child[0], "filenode")
+        self.failUnlessReallyEqual(to_bytes(child[1]["ro_uri"]),
+                                   self._bar_txt_uri)
+        self.failUnlessReallyEqual(to_bytes(data[1]["rw_uri"]), self._foo_uri)
+
     def test_GET_DIRURL_json_format(self):
         d = self.PUT(self.public_url + \
                      "/foo/sdmf.txt?format=sdmf",
@@ -3839,6 +4157,19 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
     def test_POST_set_children_with_hyphen(self):
         return self.test_POST_set_children(command_name="set-children")
 
+    @inlineCallbacks
+    def test_POST_DIRURL_shard(self):
+        res = yield self.POST(self.public_url + "/foo", t="shard")
+        self.assertIn(b"directory sharded", res)
+        data = yield self._foo_node._node.download_best_version()
+        self.assertTrue(data.startswith(sharded_dirnode.LEAF_HEADER))
+        # the directory still works as before
+        res = yield self.GET(self.public_url + "/foo?t=json")
+        self.failUnlessIsFooJSON(res)
+        yield self.PUT(self.public_url + "/foo/new.txt", self.NEWFILE_CONTENTS)
+        yield self.failUnlessChildContentsAre(self._foo_node, u"new.txt",
+                                              self.NEWFILE_CONTENTS)
+
     def test_POST_link_uri(self):
         contents, n, newuri = self.makefile(8)
         d = self.POST(self.public_url + "/foo", t="uri", name="new.txt", uri=newuri)
@@ -4542,6 +4873,62 @@ class Web(WebMixin, WebErrorMixin, testutil.StallMixin, testutil.ReallyEqualMixi
         d.addCallback(_check2)
         return d
 
+    def test_PUT_NEWFILE_URI_resume_token(self):
+        file_contents = b"New file contents here\n"
+        d = self.PUT("/uri?resume-token=upload_1-a", file_contents)
+        def _check(uri):
+            self.failUnlessReallyEqual(self.get_all_contents()[uri],
+                                       file_contents)
+        d.addCallback(_check)
+        return d
+
+    @inlineCallbacks
+    def test_PUT_NEWFILE_URI_bad_resume_token(self):
+        url = self.webish_url + "/uri?resume-token=../private"
+        yield self.assertHTTPError(url, 400, "invalid resume-token= argument",
+                                   method="put", data=b"New file contents\n")
+
+    def test_PUT_NEWFILE_URI_streaming(self):
+        # big enough that it would otherwise be spooled to a temporary file
+        file_contents = b"streamed\n" * 250000
+        d = self.PUT("/uri?streaming=true", file_contents)
+        def _check(uri):
+            self.failUnlessReallyEqual(self.get_all_contents()[uri],
+                                       file_contents)
+        d.addCallback(_check)
+        return d
+
+    def test_PUT_NEWFILEURL_streaming(self):
+        d = self.PUT(self.public_url + "/foo/new.txt?streaming=true",
+                     self.NEWFILE_CONTENTS)
+        d.addCallback(self.failUnlessURIMatchesROChild, self._foo_node, u"new.txt")
+        d.addCallback(lambda res:
+                      self.failUnlessChildContentsAre(self._foo_node, u"new.txt",
+                                                      self.NEWFILE_CONTENTS))
+        return d
+
+    @inlineCallbacks
+    def test_PUT_NEWFILE_URI_streaming_resume_token(self):
+        url = self.webish_url + "/uri?streaming=true&resume-token=upload_1-a"
+        yield self.assertHTTPError(url, 400, "cannot be used with streaming=true",
+                                   method="put", data=b"New file contents\n")
+
+    @inlineCallbacks
+    def test_PUT_streaming_to_mutable_file(self):
+        # the error is sent before the body has been read: the rest of it
+        # must be discarded
+        url = self.webish_url + self.public_url + "/foo/quux.txt?streaming=true"
+        yield self.assertHTTPError(url, 400, "only supported for immutable files",
+                                   method="put", data=b"x" * 2000000)
+        yield self.failUnlessChildContentsAre(self._foo_node, u"quux.txt",
+                                              self.QUUX_CONTENTS)
+
+    @inlineCallbacks
+    def test_PUT_streaming_to_directory(self):
+        url = self.webish_url + self.public_url + "/foo?streaming=true"
+        yield self.assertHTTPError(url, 400, "PUT to a directory",
+                                   method="put", data=b"x" * 2000000)
+
     def test_PUT_NEWFILE_URI_only_PUT(self):
         d = self.PUT("/uri?t=bogus", b"")
         d.addBoth(self.shouldFail, error.Error,
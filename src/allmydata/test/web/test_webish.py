@@ -48,6 +48,12 @@ from twisted.python.filepath import (
 from twisted.web.test.requesthelper import (
     DummyChannel,
 )
+from twisted.web.http import (
+    HTTPChannel,
+)
+from twisted.internet.testing import (
+    StringTransport,
+)
 from twisted.web.resource import (
     Resource,
 )
@@ -56,9 +62,11 @@ from ..common import (
     SyncTestCase,
 )
 
+from ... import webish
 from ...webish import (
     TahoeLAFSRequest,
     TahoeLAFSSite,
+    _get_request_line,
 )
 
 
@@ -166,6 +174,61 @@ class TahoeLAFSRequestTests(SyncTestCase):
                           data, Equals(None))
 
 
+class RequestLineTests(SyncTestCase):
+    """
+    Tests for ``_get_request_line``, which streaming uploads depend on.
+    """
+    def _request_line_at_headers(self):
+        """
+        Feed the headers of a streaming upload, but not its body, to a real
+        ``HTTPChannel``, and return what ``_get_request_line`` said about
+        it and the request it made.
+        """
+        seen = []
+        class Recorder(TahoeLAFSRequest):
+            def gotLength(self, length):
+                seen.append(_get_request_line(self.channel))
+                super(Recorder, self).gotLength(length)
+        channel = HTTPChannel()
+        channel.site = TahoeLAFSSite(self.mktemp(), Resource())
+        channel.requestFactory = Recorder
+        channel.makeConnection(StringTransport())
+        channel.dataReceived(b"PUT /uri?streaming=true HTTP/1.1\r\n"
+                             b"Content-Length: 10\r\n\r\n")
+        self.assertThat(seen, HasLength(1))
+        return (seen[0], channel.requests[0])
+
+    def test_channel_keeps_request_line(self):
+        """
+        ``HTTPChannel`` still keeps the request line where
+        ``_get_request_line`` looks for it, in this version of Twisted.  If
+        this fails, streaming uploads are silently spooled instead, and
+        ``_CHANNEL_KEEPS_REQUEST_LINE`` must not include this version.
+        """
+        self.assertTrue(webish._CHANNEL_KEEPS_REQUEST_LINE)
+        (request_line, request) = self._request_line_at_headers()
+        self.assertThat(
+            request_line,
+            Equals((b"PUT", b"/uri?streaming=true", b"HTTP/1.1")),
+        )
+
+    def test_other_versions(self):
+        """
+        In other versions of Twisted, the request line is not looked for,
+        and a streaming upload is spooled like any other.
+        """
+        self.patch(webish, "_CHANNEL_KEEPS_REQUEST_LINE", False)
+        (request_line, request) = self._request_line_at_headers()
+        self.assertThat(request_line, Equals(None))
+        self.assertThat(request.streaming_body, Equals(None))
+
+    def test_other_channels(self):
+        """
+        A channel which does not keep the request line gives ``None``.
+        """
+        self.assertThat(_get_request_line(DummyChannel()), Equals(None))
+
+
 class TahoeLAFSSiteTests(SyncTestCase):
     """
     Tests for ``TahoeLAFSSite``.
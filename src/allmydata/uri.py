@@ -30,10 +30,11 @@ except ImportError:
 from zope.interface import implementer
 from twisted.python.components import registerAdapter
 
-from allmydata.storage.server import si_a2b, si_b2a
 from allmydata.util import base32, hashutil
 from allmydata.util.assertutil import _assert
-from allmydata.interfaces import IURI, IDirnodeURI, IFileURI, IImmutableFileURI, \
+# Not allmydata.interfaces: it pulls in foolscap (and the reactor), and
+# the CLI parses caps without needing either.
+from allmydata._uri_interfaces import IURI, IDirnodeURI, IFileURI, IImmutableFileURI, \
     IVerifierURI, IMutableFileURI, IDirectoryURI, IReadonlyDirectoryURI, \
     MustBeDeepImmutableError, MustBeReadonlyError, CapConstraintError
 
@@ -156,7 +157,7 @@ class CHKFileVerifierURI(_BaseURI):
         mo = cls.STRING_RE.search(uri)
         if not mo:
             raise BadURIError("'%s' doesn't look like a %s cap" % (uri, cls))
-        return cls(si_a2b(mo.group(1)), base32.a2b(mo.group(2)),
+        return cls(base32.a2b(mo.group(1)), base32.a2b(mo.group(2)),
                    int(mo.group(3)), int(mo.group(4)), int(mo.group(5)))
 
     def to_string(self):
@@ -165,7 +166,7 @@ class CHKFileVerifierURI(_BaseURI):
         assert isinstance(self.size, (int,long))
 
         return (b'URI:CHK-Verifier:%s:%s:%d:%d:%d' %
-                (si_b2a(self.storage_index),
+                (base32.b2a(self.storage_index),
                  base32.b2a(self.uri_extension_hash),
                  self.needed_shares,
                  self.total_shares,
@@ -337,12 +338,12 @@ class SSKVerifierURI(_BaseURI):
         mo = cls.STRING_RE.search(uri)
         if not mo:
             raise BadURIError("%r doesn't look like a %s cap" % (uri, cls))
-        return cls(si_a2b(mo.group(1)), base32.a2b(mo.group(2)))
+        return cls(base32.a2b(mo.group(1)), base32.a2b(mo.group(2)))
 
     def to_string(self):
         assert isinstance(self.storage_index, bytes)
         assert isinstance(self.fingerprint, bytes)
-        return b'URI:SSK-Verifier:%s:%s' % (si_b2a(self.storage_index),
+        return b'URI:SSK-Verifier:%s:%s' % (base32.b2a(self.storage_index),
                                             base32.b2a(self.fingerprint))
 
     def is_readonly(self):
@@ -472,12 +473,12 @@ class MDMFVerifierURI(_BaseURI):
         mo = cls.STRING_RE.search(uri)
         if not mo:
             raise BadURIError("%r doesn't look like a %s cap" % (uri, cls))
-        return cls(si_a2b(mo.group(1)), base32.a2b(mo.group(2)))
+        return cls(base32.a2b(mo.group(1)), base32.a2b(mo.group(2)))
 
     def to_string(self):
         assert isinstance(self.storage_index, bytes)
         assert isinstance(self.fingerprint, bytes)
-        ret = b'URI:MDMF-Verifier:%s:%s' % (si_b2a(self.storage_index),
+        ret = b'URI:MDMF-Verifier:%s:%s' % (base32.b2a(self.storage_index),
                                             base32.b2a(self.fingerprint))
         return ret
 
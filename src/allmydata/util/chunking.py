@@ -0,0 +1,66 @@
+"""
+Content-defined chunking.
+
+A file is split where a rolling hash of the last few bytes happens to have
+its top bits clear, so the chunk boundaries depend on the contents around
+them rather than on their offsets. Inserting or removing bytes then changes
+only the chunks around the change, and the rest of the file splits into the
+same chunks as before.
+
+This is FastCDC 2020, with the gear table of its reference implementation,
+as computed by pyfastcdc: in Cython where a wheel for the platform is
+available (and then about as fast as the disk), and otherwise in pure Python
+with the same results. The normalization level and the sizes decide where
+files are split, so changing them makes every chunk new.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from future.utils import PY2
+if PY2:
+    from builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
+
+from pyfastcdc import FastCDC
+
+AVERAGE_CHUNK_SIZE = 1024*1024
+
+# the limits that pyfastcdc puts on the average size
+MIN_AVERAGE_CHUNK_SIZE = 256
+MAX_AVERAGE_CHUNK_SIZE = 4*1024*1024
+
+# boundaries are hard to find before the average size and easy to find
+# after it (the "NC2" of the FastCDC paper), so most chunks are close to it
+NORMALIZATION = 2
+
+
+class Chunker(object):
+    """
+    I split files into chunks of between a quarter of and four times
+    avg_size bytes (which must be a power of two), most of them close to
+    avg_size. Only the last chunk of a file may be smaller.
+    """
+
+    def __init__(self, avg_size=AVERAGE_CHUNK_SIZE):
+        if (avg_size & (avg_size - 1) or
+            not MIN_AVERAGE_CHUNK_SIZE <= avg_size <= MAX_AVERAGE_CHUNK_SIZE):
+            raise ValueError("the average chunk size must be a power of two "
+                             "from %d to %d, not %r"
+                             % (MIN_AVERAGE_CHUNK_SIZE,
+                                MAX_AVERAGE_CHUNK_SIZE, avg_size))
+        self.avg_size = avg_size
+        self.min_size = avg_size // 4
+        self.max_size = avg_size * 4
+        self._cdc = FastCDC(avg_size,
+                            min_size=self.min_size,
+                            max_size=self.max_size,
+                            normalized_chunking=NORMALIZATION)
+
+    def chunks(self, f):
+        """Read the file-like f to the end, and yield its chunks (as bytes)
+        one after another."""
+        for chunk in self._cdc.cut_stream(f):
+            # the chunk's memoryview is reused for the next one
+            yield bytes(chunk.data)
@@ -28,7 +28,6 @@ import warnings
 from allmydata.util.assertutil import precondition, _assert
 from twisted.python import usage
 from twisted.python.filepath import FilePath
-from allmydata.util import log
 from allmydata.util.fileutil import abspath_expanduser_unicode
 
 NoneType = type(None)
@@ -36,6 +35,9 @@ NoneType = type(None)
 
 def canonical_encoding(encoding):
     if encoding is None:
+        # allmydata.util.log brings in Foolscap and the reactor, which the
+        # CLI commands need not wait for
+        from allmydata.util import log
         log.msg("Warning: falling back to UTF-8 encoding.", level=log.WEIRD)
         encoding = 'utf-8'
     encoding = encoding.lower()
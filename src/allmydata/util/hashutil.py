@@ -94,6 +94,7 @@ FILE_RENEWAL_TAG = b"allmydata_file_renewal_secret_v1"
 FILE_CANCEL_TAG = b"allmydata_file_cancel_secret_v1"
 BUCKET_RENEWAL_TAG = b"allmydata_bucket_renewal_secret_v1"
 BUCKET_CANCEL_TAG = b"allmydata_bucket_cancel_secret_v1"
+BUCKET_UPLOAD_TAG = b"allmydata_bucket_upload_secret_v1"
 
 # mutable
 MUTABLE_WRITEKEY_TAG = b"allmydata_mutable_privkey_to_writekey_v1"
@@ -249,6 +250,10 @@ def bucket_cancel_secret_hash(file_cancel_secret, peerid):
     return tagged_pair_hash(BUCKET_CANCEL_TAG, file_cancel_secret, peerid)
 
 
+def bucket_upload_secret_hash(bucket_renewal_secret):
+    return tagged_hash(BUCKET_UPLOAD_TAG, bucket_renewal_secret)
+
+
 def _xor(a, b):
     return b"".join([byteschr(c ^ b) for c in future_bytes(a)])
 
@@ -312,5 +317,12 @@ def backupdb_dirhash(contents):
     return tagged_hash(BACKUPDB_DIRHASH_TAG, contents)
 
 
+BACKUPDB_CHUNKHASH_TAG = b"allmydata_backupdb_chunkhash_v1"
+
+
+def backupdb_chunkhash(contents):
+    return tagged_hash(BACKUPDB_CHUNKHASH_TAG, contents)
+
+
 def permute_server_hash(peer_selection_index, server_permutation_seed):
     return hashlib.sha1(peer_selection_index + server_permutation_seed).digest()
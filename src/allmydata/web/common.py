@@ -21,6 +21,7 @@ except ImportError:
 import time
 import json
 from functools import wraps
+from urllib.parse import quote as url_quote
 
 from hyperlink import (
     DecodedURL,
@@ -48,6 +49,9 @@ from twisted.web.template import (
 from twisted.web.server import (
     NOT_DONE_YET,
 )
+from twisted.web.proxy import (
+    ReverseProxyResource,
+)
 from twisted.web.util import (
     DeferredResource,
     FailureElement,
@@ -77,6 +81,7 @@ from allmydata.interfaces import (
     MustBeDeepImmutableError,
     MustBeReadonlyError,
     MustNotBeUnknownRWError,
+    IUploadable,
     NoSharesError,
     NoSuchChildError,
     NotEnoughSharesError,
@@ -84,6 +89,7 @@ from allmydata.interfaces import (
     SDMF_VERSION,
 )
 from allmydata.mutable.common import UnrecoverableFileError
+from allmydata.immutable.journal import is_valid_resume_token
 from allmydata.util.time_format import (
     format_delta,
     format_time,
@@ -166,6 +172,78 @@ def get_mutable_type(file_format): # accepts result of get_format()
         return None
 
 
+def get_resume_token(req):  # type: (IRequest) -> Optional[str]
+    """
+    Return the resume-token= argument of an immutable upload, or None.
+    """
+    arg = get_arg(req, "resume-token", None)
+    if arg is None:
+        return None
+    token = str(arg, "utf-8", errors="replace")
+    if not is_valid_resume_token(token):
+        raise WebError("invalid resume-token= argument: %s" % (token,),
+                       http.BAD_REQUEST)
+    return token
+
+
+def get_streaming_upload(req):  # type: (IRequest) -> Optional[IUploadable]
+    """
+    Return the body of an immutable upload with streaming=true, as an
+    uploadable which is fed as the body arrives, or None if streaming was
+    not asked for.
+    """
+    if not boolean_of_arg(get_arg(req, "streaming", "false")):
+        return None
+    body = getattr(req, "streaming_body", None)
+    if body is None:
+        if req.getHeader("content-length") is None:
+            raise WebError("streaming=true requires a Content-Length",
+                           http.LENGTH_REQUIRED)
+        raise WebError("streaming=true is not possible for this request",
+                       http.BAD_REQUEST)
+    if get_arg(req, "resume-token", None) is not None:
+        raise WebError("a streaming upload cannot be resumed, so"
+                       " resume-token= cannot be used with streaming=true",
+                       http.BAD_REQUEST)
+    return body
+
+
+def get_max_age(req):  # type: (IRequest) -> Optional[float]
+    """
+    Return the max-age= argument (how old, in seconds, a cached mutable
+    servermap may be), or None.
+    """
+    arg = get_arg(req, "max-age", None)
+    if arg is None:
+        return None
+    try:
+        max_age = float(arg)
+    except ValueError:
+        max_age = -1
+    if not max_age >= 0:
+        raise WebError("invalid max-age= argument: %r" % (ensure_str(arg),),
+                       http.BAD_REQUEST)
+    return max_age
+
+
+def get_recheck_age(req):  # type: (IRequest) -> Optional[float]
+    """
+    Return the recheck-age= argument (how long, in seconds, a deep-check may
+    rely on an earlier check of an object which was found healthy), or None.
+    """
+    arg = get_arg(req, "recheck-age", None)
+    if arg is None:
+        return None
+    try:
+        recheck_age = float(arg)
+    except ValueError:
+        recheck_age = -1
+    if not recheck_age >= 0:
+        raise WebError("invalid recheck-age= argument: %r" % (ensure_str(arg),),
+                       http.BAD_REQUEST)
+    return recheck_age
+
+
 def parse_offset_arg(offset):  # type: (bytes) -> Union[int,None]
     # XXX: This will raise a ValueError when invoked on something that
     # is not an integer. Is that okay? Or do we want a better error
@@ -548,6 +626,61 @@ def render_exception(render):
     return g
 
 
+# set on a request that one gateway worker forwards to another, so that it
+# is never forwarded again
+GATEWAY_FORWARDED_HEADER = b"x-tahoe-gateway-forwarded"
+
+
+class ForwardToWorker(resource.Resource, object):
+    """
+    I forward a request to another process of a multi-process gateway (see
+    allmydata.gateway), which answers it on the port that it keeps for
+    forwarded requests.
+
+    :ivar find_index: a no-argument callable which returns a Deferred that
+        fires with the index of the worker which can answer, or None if
+        none can.
+
+    :ivar bytes path: the path of the request on that worker.
+
+    :ivar not_found: the message of the 404 to answer with if no other
+        worker can answer.
+    """
+
+    def __init__(self, gateway, find_index, path, not_found):
+        super(ForwardToWorker, self).__init__()
+        self._gateway = gateway
+        self._find_index = find_index
+        self._path = path
+        self._not_found = not_found
+
+    def getChild(self, name, req):
+        return ForwardToWorker(self._gateway, self._find_index,
+                               self._path + b"/" + url_quote(name, safe=b"").encode("ascii"),
+                               self._not_found)
+
+    @render_exception
+    def render(self, req):
+        if req.requestHeaders.hasHeader(GATEWAY_FORWARDED_HEADER):
+            raise WebError(self._not_found, http.NOT_FOUND)
+        d = self._find_index()
+        def _got_index(index):
+            if index is None or index == self._gateway.index:
+                raise WebError(self._not_found, http.NOT_FOUND)
+            return self._gateway.find_worker(index)
+        d.addCallback(_got_index)
+        def _got_port(port):
+            if port is None:
+                raise WebError("that gateway worker is not running",
+                               http.SERVICE_UNAVAILABLE)
+            req.requestHeaders.setRawHeaders(GATEWAY_FORWARDED_HEADER,
+                                             [b"%d" % (self._gateway.index,)])
+            return ReverseProxyResource("127.0.0.1", port,
+                                        self._path).render(req)
+        d.addCallback(_got_port)
+        return d
+
+
 def _finish(result, render, request):
     """
     Try to finish rendering the response to a request.
@@ -12,12 +12,13 @@ if PY2:
     # Don't use Future's str so that we don't get leaks into bad byte formatting
     from past.builtins import unicode as str
 
-from urllib.parse import quote as url_quote
+from urllib.parse import quote as url_quote, urlencode
 from datetime import timedelta
+import bisect
 
 from zope.interface import implementer
 from twisted.internet import defer
-from twisted.internet.interfaces import IPushProducer
+from twisted.internet.interfaces import IPushProducer, IPullProducer
 from twisted.python.failure import Failure
 from twisted.web import http
 from twisted.web.resource import ErrorPage
@@ -48,6 +49,7 @@ from allmydata.interfaces import IDirectoryNode, IFileNode, IFilesystemNode, \
      IImmutableFileNode, IMutableFileNode, ExistingChildError, \
      NoSuchChildError, EmptyPathnameComponentError, SDMF_VERSION, MDMF_VERSION
 from allmydata.blacklist import ProhibitedNode
+from allmydata.check_index import IncrementalChecker
 from allmydata.monitor import Monitor, OperationCancelledError
 from allmydata import dirnode
 from allmydata.web.common import (
@@ -63,7 +65,9 @@ from allmydata.web.common import (
     humanize_exception,
     convert_children_json,
     get_format,
+    get_max_age,
     get_mutable_type,
+    get_recheck_age,
     get_filenode_metadata,
     render_time,
     MultiFormatResource,
@@ -236,8 +240,15 @@ class DirectoryNodeHandler(ReplaceMeMixin, Resource, object):
         FIXED_OUTPUT_TYPES =  ["", "json", "uri", "readonly-uri"]
         if not self.node.is_mutable() and t in FIXED_OUTPUT_TYPES:
             si = self.node.get_storage_index()
-            if si and req.setETag(b'DIR:%s-%s' % (base32.b2a(si), t.encode("ascii") or b"")):
-                return b""
+            if si:
+                etag = b'DIR:%s-%s' % (base32.b2a(si), t.encode("ascii") or b"")
+                limit, after = get_page_args(req)
+                if limit is not None or after is not None:
+                    # each page of the listing is a different entity
+                    etag += b"-%d-%s" % (limit or 0,
+                                         base32.b2a((after or "").encode("utf-8")))
+                if req.setETag(etag):
+                    return b""
 
         if not t:
             # render the directory as HTML
@@ -246,6 +257,7 @@ class DirectoryNodeHandler(ReplaceMeMixin, Resource, object):
                 DirectoryAsHTML(
                     self.node,
                     self.client.mutable_file_default,
+                    *get_page_args(req)
                 )
             )
 
@@ -321,6 +333,8 @@ class DirectoryNodeHandler(ReplaceMeMixin, Resource, object):
             d = self._POST_stream_manifest(req)
         elif t == "set_children" or t == "set-children":
             d = self._POST_set_children(req)
+        elif t == "shard":
+            d = self._POST_shard(req)
         else:
             raise WebError("POST to a directory with bad t=%s" % t)
 
@@ -541,8 +555,9 @@ class DirectoryNodeHandler(ReplaceMeMixin, Resource, object):
         return d
 
     def _start_operation(self, monitor, renderer, req):
-        self._operations.add_monitor(req, monitor, renderer)
-        return self._operations.redirect_to(req)
+        d = self._operations.add_monitor(req, monitor, renderer)
+        d.addCallback(lambda ign: self._operations.redirect_to(req))
+        return d
 
     def _POST_start_deep_check(self, req):
         # check this directory and everything reachable from it
@@ -551,11 +566,13 @@ class DirectoryNodeHandler(ReplaceMeMixin, Resource, object):
         verify = boolean_of_arg(get_arg(req, "verify", "false"))
         repair = boolean_of_arg(get_arg(req, "repair", "false"))
         add_lease = boolean_of_arg(get_arg(req, "add-lease", "false"))
+        recheck_age = get_recheck_age(req)
         if repair:
-            monitor = self.node.start_deep_check_and_repair(verify, add_lease)
+            monitor = self.node.start_deep_check_and_repair(verify, add_lease,
+                                                            recheck_age)
             renderer = DeepCheckAndRepairResultsRenderer(self.client, monitor)
         else:
-            monitor = self.node.start_deep_check(verify, add_lease)
+            monitor = self.node.start_deep_check(verify, add_lease, recheck_age)
             renderer = DeepCheckResultsRenderer(self.client, monitor)
         return self._start_operation(monitor, renderer, req)
 
@@ -563,7 +580,10 @@ class DirectoryNodeHandler(ReplaceMeMixin, Resource, object):
         verify = boolean_of_arg(get_arg(req, "verify", "false"))
         repair = boolean_of_arg(get_arg(req, "repair", "false"))
         add_lease = boolean_of_arg(get_arg(req, "add-lease", "false"))
-        walker = DeepCheckStreamer(req, self.node, verify, repair, add_lease)
+        recheck_age = get_recheck_age(req)
+        walker = DeepCheckStreamer(req, self.node, verify, repair, add_lease,
+                                   self.client.nodemaker.check_index,
+                                   recheck_age)
         monitor = self.node.deep_traverse(walker)
         walker.setMonitor(monitor)
         # register to hear stopProducing. The walker ignores pauseProducing.
@@ -656,6 +676,11 @@ class DirectoryNodeHandler(ReplaceMeMixin, Resource, object):
         # TODO: results
         return d
 
+    def _POST_shard(self, req):
+        d = self.node.make_sharded()
+        d.addCallback(lambda res: "directory sharded")
+        return d
+
 def abbreviated_dirnode(dirnode):
     u = from_string_dirnode(dirnode.get_uri())
     return u.abbrev_si()
@@ -667,9 +692,12 @@ class DirectoryAsHTML(Element):
     # human+browser -oriented HTML.
     loader = XMLFile(FilePath(__file__).sibling("directory.xhtml"))
 
-    def __init__(self, node, default_mutable_format):
+    def __init__(self, node, default_mutable_format, limit=None, after=None):
         super(DirectoryAsHTML, self).__init__()
         self.node = node
+        self.limit = limit
+        self.after = after
+        self.next_after = None
         if default_mutable_format not in (MDMF_VERSION, SDMF_VERSION):
             raise ValueError(
                 "Uknown mutable format '{}'".format(default_mutable_format)
@@ -705,14 +733,34 @@ class DirectoryAsHTML(Element):
 
     @renderer
     def children(self, req, tag):
+        names, self.next_after = page_of_children(self.dirnode_children,
+                                                  self.limit, self.after)
         return SlotsSequenceElement(
             tag,
             [
-                self._child_slots(req, fname, data[0], data[1])
-                for fname, data in self.dirnode_children.items()
+                self._child_slots(req, fname, *self.dirnode_children[fname])
+                for fname in names
             ]
         )
 
+    @renderer
+    def pages(self, req, tag):
+        # links to the first and next pages of a paged listing
+        if self.dirnode_children is None:
+            return ""
+        links = []
+        if self.after is not None:
+            query = {"limit": self.limit} if self.limit else {}
+            links.append(tags.a("First page", href="?" + urlencode(query)))
+        if self.next_after is not None:
+            if links:
+                links.append(" ")
+            links.append(tags.a("Next page", href="?" + urlencode(
+                {"limit": self.limit, "after": self.next_after})))
+        if not links:
+            return ""
+        return tag(links)
+
     @renderer
     def title(self, req, tag):
         si_s = str(abbreviated_dirnode(self.node), "utf-8")
@@ -1019,49 +1067,157 @@ class DirectoryAsHTML(Element):
     def results(self, req, tag):
         return get_arg(req, "results", "")
 
-def _directory_json_metadata(req, dirnode):
-    d = dirnode.list()
-    def _got(children):
-        kids = {}
-        for name, (childnode, metadata) in list(children.items()):
-            assert IFilesystemNode.providedBy(childnode), childnode
-            rw_uri = childnode.get_write_uri()
-            ro_uri = childnode.get_readonly_uri()
-            if IFileNode.providedBy(childnode):
-                kiddata = ("filenode", get_filenode_metadata(childnode))
-            elif IDirectoryNode.providedBy(childnode):
-                kiddata = ("dirnode", {'mutable': childnode.is_mutable()})
-            else:
-                kiddata = ("unknown", {})
-
-            kiddata[1]["metadata"] = metadata
-            if rw_uri:
-                kiddata[1]["rw_uri"] = rw_uri
-            if ro_uri:
-                kiddata[1]["ro_uri"] = ro_uri
-            verifycap = childnode.get_verify_cap()
-            if verifycap:
-                kiddata[1]['verify_uri'] = verifycap.to_string()
-
-            kids[name] = kiddata
-
-        drw_uri = dirnode.get_write_uri()
-        dro_uri = dirnode.get_readonly_uri()
-        contents = { 'children': kids }
+def get_page_args(req):
+    """
+    Return the (limit, after) arguments which select a page of a directory
+    listing. Either may be None.
+    """
+    limit = get_arg(req, "limit", None)
+    if limit is not None:
+        try:
+            limit = int(limit)
+        except ValueError:
+            limit = 0
+        if limit < 1:
+            raise WebError("limit= must be a positive integer",
+                           http.BAD_REQUEST)
+    after = get_arg(req, "after", None)
+    if after is not None:
+        after = str(after, "utf-8")
+    return limit, after
+
+
+def page_of_children(children, limit, after):
+    """
+    Return the names of the children (a dict from name to (node, metadata))
+    on the page selected by limit and after, and the after= argument which
+    selects the next page, or None if this is the last. Paged listings are in
+    order of name: a page starts after the name given, and holds at most
+    limit children. If neither is given, all of the names are returned, in
+    the order of the dict.
+    """
+    if limit is None and after is None:
+        return list(children), None
+    names = sorted(children)
+    if after is not None:
+        names = names[bisect.bisect_right(names, after):]
+    if limit is not None and len(names) > limit:
+        names = names[:limit]
+        return names, names[-1]
+    return names, None
+
+
+def _child_json_metadata(childnode, metadata):
+    assert IFilesystemNode.providedBy(childnode), childnode
+    rw_uri = childnode.get_write_uri()
+    ro_uri = childnode.get_readonly_uri()
+    if IFileNode.providedBy(childnode):
+        kiddata = ("filenode", get_filenode_metadata(childnode))
+    elif IDirectoryNode.providedBy(childnode):
+        kiddata = ("dirnode", {'mutable': childnode.is_mutable()})
+    else:
+        kiddata = ("unknown", {})
+
+    kiddata[1]["metadata"] = metadata
+    if rw_uri:
+        kiddata[1]["rw_uri"] = rw_uri
+    if ro_uri:
+        kiddata[1]["ro_uri"] = ro_uri
+    verifycap = childnode.get_verify_cap()
+    if verifycap:
+        kiddata[1]['verify_uri'] = verifycap.to_string()
+    return kiddata
+
+
+@implementer(IPullProducer)
+class DirectoryJSONProducer(object):
+    """
+    I write the t=json form of a directory to a request, a few children at a
+    time whenever its transport wants more, so that the listing of a huge
+    directory is neither encoded nor buffered all at once. (The children
+    themselves have all been read and unpacked by then: dirnode.list() gives
+    them all at once.)
+    """
+    BATCH_SIZE = 100
+
+    def __init__(self, req, dirnode, children, names, next_after):
+        self.req = req
+        self.dirnode = dirnode
+        # only those on this page, so the rest can be freed
+        self.children = dict((name, children[name]) for name in names)
+        self.names = names
+        self.next_after = next_after
+        self.index = 0
+        self.stopped = False
+        self.done = defer.Deferred(self._cancel)
+
+    def start(self):
+        """Start writing, and return a Deferred that fires when I have
+        written everything."""
+        self.req.setHeader("content-type", "text/plain")
+        self.req.write(b'[\n "dirnode",\n {\n  "children": {')
+        self.req.registerProducer(self, False)
+        return self.done
+
+    def resumeProducing(self):
+        if self.stopped:
+            return
+        batch = self.names[self.index:self.index+self.BATCH_SIZE]
+        if batch:
+            entries = [json.dumps(name) + ": " +
+                       json.dumps(_child_json_metadata(*self.children[name]))
+                       for name in batch]
+            separator = ",\n   " if self.index else "\n   "
+            self.index += len(batch)
+            self.req.write((separator + ",\n   ".join(entries)).encode("utf-8"))
+            return
+        self.stopped = True
+        self.req.unregisterProducer()
+        self.req.write(self._tail().encode("utf-8"))
+        self.done.callback(None)
+
+    def stopProducing(self):
+        # the connection has gone, so the rest will never be written
+        if not self.stopped:
+            self.stopped = True
+            self.done.errback(defer.CancelledError())
+
+    def _cancel(self, d):
+        self.stopped = True
+
+    def _tail(self):
+        contents = {}
+        drw_uri = self.dirnode.get_write_uri()
+        dro_uri = self.dirnode.get_readonly_uri()
         if dro_uri:
             contents['ro_uri'] = dro_uri
         if drw_uri:
             contents['rw_uri'] = drw_uri
-        verifycap = dirnode.get_verify_cap()
+        verifycap = self.dirnode.get_verify_cap()
         if verifycap:
             contents['verify_uri'] = verifycap.to_string()
-        contents['mutable'] = dirnode.is_mutable()
-        data = ("dirnode", contents)
-        return json.dumps(data, indent=1) + "\n"
+        contents['mutable'] = self.dirnode.is_mutable()
+        if self.next_after is not None:
+            contents['next_after'] = self.next_after
+        return "".join(["\n  }"] +
+                       [",\n  %s: %s" % (json.dumps(k), json.dumps(v))
+                        for (k, v) in contents.items()] +
+                       ["\n }\n]\n"])
+
+
+def _directory_json_metadata(req, dirnode):
+    limit, after = get_page_args(req)
+    d = dirnode.list(max_age=get_max_age(req))
+    def _got(children):
+        names, next_after = page_of_children(children, limit, after)
+        return DirectoryJSONProducer(req, dirnode, children, names,
+                                     next_after).start()
     d.addCallback(_got)
-    d.addCallback(text_plain, req)
 
     def error(f):
+        if req.startedWriting:
+            # the listing has begun, so the response code has gone
+            return f
         message, code = humanize_failure(f)
         req.setResponseCode(code)
         return json.dumps({
@@ -1383,6 +1539,16 @@ class ManifestStreamer(dirnode.DeepStats):
         assert "\n" not in j
         self.req.write(j.encode("utf-8")+b"\n")
 
+    def add_shard(self, shard, path):
+        d = {"type": "directory-shard",
+             "path": path,
+             "verifycap": shard.get_verify_cap().to_string(),
+             "storage-index": base32.b2a(shard.get_storage_index()),
+             }
+        j = json.dumps(d, ensure_ascii=True)
+        assert "\n" not in j
+        self.req.write(j.encode("utf-8")+b"\n")
+
     def finish(self):
         stats = dirnode.DeepStats.get_results(self)
         d = {"type": "stats",
@@ -1396,12 +1562,15 @@ class ManifestStreamer(dirnode.DeepStats):
 @implementer(IPushProducer)
 class DeepCheckStreamer(dirnode.DeepStats):
 
-    def __init__(self, req, origin, verify, repair, add_lease):
+    def __init__(self, req, origin, verify, repair, add_lease,
+                 check_index=None, recheck_age=None):
         dirnode.DeepStats.__init__(self, origin)
         self.req = req
-        self.verify = verify
         self.repair = repair
-        self.add_lease = add_lease
+        self.checker = IncrementalChecker(check_index, verify, repair,
+                                          add_lease, recheck_age)
+        # directories whose check waits for their contents -> line data
+        self.waiting = {}
 
     def setMonitor(self, monitor):
         self.monitor = monitor
@@ -1439,11 +1608,29 @@ class DeepCheckStreamer(dirnode.DeepStats):
             si = base32.b2a(si)
         data["storage-index"] = si or ""
 
+        if self.checker.must_wait_for_contents(node):
+            self.waiting[node] = data
+            return None
+        return self.check(node, data)
+
+    def enter_directory(self, parent, children):
+        dirnode.DeepStats.enter_directory(self, parent, children)
+        if parent in self.waiting:
+            return self.check(parent, self.waiting.pop(parent))
+
+    def add_shard(self, shard, path):
+        data = {"type": "directory-shard",
+                "path": path,
+                "verifycap": shard.get_verify_cap().to_string(),
+                "storage-index": base32.b2a(shard.get_storage_index()),
+                }
+        return self.check(shard, data)
+
+    def check(self, node, data):
+        d = self.checker.check(node, self.monitor)
         if self.repair:
-            d = node.check_and_repair(self.monitor, self.verify, self.add_lease)
             d.addCallback(self.add_check_and_repair, data)
         else:
-            d = node.check(self.monitor, self.verify, self.add_lease)
             d.addCallback(self.add_check, data)
         d.addCallback(self.write_line)
         return d
@@ -1462,6 +1649,7 @@ class DeepCheckStreamer(dirnode.DeepStats):
         self.req.write(j.encode("utf-8")+b"\n")
 
     def finish(self):
+        self.checker.flush()
         stats = dirnode.DeepStats.get_results(self)
         d = {"type": "stats",
              "stats": stats,
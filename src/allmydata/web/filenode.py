@@ -14,19 +14,24 @@ if PY2:
     from past.builtins import unicode as str
 from past.builtins import long
 
+import os
+
+from zope.interface import implementer
 from twisted.web import http, static
 from twisted.internet import defer
+from twisted.internet.interfaces import IConsumer
 from twisted.web.resource import (
     Resource,  # note: Resource is an old-style class
     ErrorPage,
 )
 
-from allmydata.interfaces import ExistingChildError
+from allmydata.interfaces import ExistingChildError, DEFAULT_MAX_SEGMENT_SIZE
 from allmydata.monitor import Monitor
 from allmydata.immutable.upload import FileHandle
 from allmydata.mutable.publish import MutableFileHandle
 from allmydata.mutable.common import MODE_READ
 from allmydata.util import log, base32
+from allmydata.util.hashutil import tagged_hash
 from allmydata.util.encodingutil import quote_output
 from allmydata.blacklist import (
     FileProhibited,
@@ -39,7 +44,10 @@ from allmydata.web.common import (
     get_arg,
     get_filenode_metadata,
     get_format,
+    get_max_age,
     get_mutable_type,
+    get_resume_token,
+    get_streaming_upload,
     parse_offset_arg,
     parse_replace_arg,
     render_exception,
@@ -57,6 +65,55 @@ from allmydata.web.info import MoreInfo
 from allmydata.util import jsonbytes as json
 
 
+def file_etag(filenode, t=""):
+    """
+    Return a strong ETag (a quoted string) for the t= form of the given
+    immutable file node or mutable file version. It is derived from the
+    verify cap of a CHK file, from the data of a LIT file, and from the
+    storage index and root hash of a mutable file version, so it changes
+    whenever the contents do.
+    """
+    if filenode.is_mutable():
+        base = b"%s:%s" % (filenode.get_storage_index(),
+                           filenode.get_root_hash())
+    else:
+        verifycap = filenode.get_verify_cap()
+        # LIT files have no verify cap: their URI holds their data
+        base = verifycap.to_string() if verifycap else filenode.get_uri()
+    etag = base32.b2a(tagged_hash(b"allmydata_file_etag_v1", base))
+    return '"%s-%s"' % (str(etag, "ascii"), t)
+
+
+def _etag_matches(header, etag):
+    """
+    Return True if the given If-None-Match header (a comma-separated list of
+    entity tags, or "*") matches etag, by the weak comparison that RFC 7232
+    asks for.
+    """
+    if not header:
+        return False
+    for tag in header.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag in ("*", etag):
+            return True
+    return False
+
+
+def _set_etag(req, etag):
+    """
+    Set the ETag of the response, and return True if the client already
+    has it (in which case the response is now 304 Not Modified, with no
+    body).
+    """
+    req.setHeader("etag", etag)
+    if _etag_matches(req.getHeader("if-none-match"), etag):
+        req.setResponseCode(http.NOT_MODIFIED)
+        return True
+    return False
+
+
 class ReplaceMeMixin(object):
     def replace_me_with_a_child(self, req, client, replace):
         # a new file is being uploaded in our place.
@@ -73,7 +130,11 @@ class ReplaceMeMixin(object):
             d.addCallback(_uploaded)
         else:
             assert file_format == "CHK"
-            uploadable = FileHandle(req.content, convergence=client.convergence)
+            uploadable = get_streaming_upload(req)
+            if uploadable is None:
+                uploadable = FileHandle(req.content,
+                                        convergence=client.convergence)
+                uploadable.resume_token = get_resume_token(req)
             d = self.parentnode.add_file(self.name, uploadable,
                                          overwrite=replace)
         def _done(filenode):
@@ -116,6 +177,7 @@ class ReplaceMeMixin(object):
             return d
 
         uploadable = FileHandle(contents.file, convergence=client.convergence)
+        uploadable.resume_token = get_resume_token(req)
         d = self.parentnode.add_file(self.name, uploadable, overwrite=replace)
         d.addCallback(lambda newnode: newnode.get_uri())
         return d
@@ -175,6 +237,11 @@ class FileNodeHandler(Resource, ReplaceMeMixin, object):
         self.parentnode = parentnode
         self.name = name
 
+    def _by_cap(self):
+        # was I reached by the file's own cap, rather than by a path
+        # through a directory (whose entry may later name another file)?
+        return self.parentnode is None
+
     @exception_to_child
     def getChild(self, name, req):
         if isinstance(self.node, ProhibitedNode):
@@ -197,12 +264,13 @@ class FileNodeHandler(Resource, ReplaceMeMixin, object):
         t = str(get_arg(req, b"t", b"").strip(), "ascii")
 
         # t=info contains variable ophandles, so is not allowed an ETag.
-        FIXED_OUTPUT_TYPES = ["", "json", "uri", "readonly-uri"]
+        # The contents get theirs from FileDownloader, which knows which
+        # version of a mutable file they come from.
+        FIXED_OUTPUT_TYPES = ["json", "uri", "readonly-uri"]
         if not self.node.is_mutable() and t in FIXED_OUTPUT_TYPES:
             # if the client already has the ETag then we can
             # short-circuit the whole process.
-            si = self.node.get_storage_index()
-            if si and req.setETag(b'%s-%s' % (base32.b2a(si), t.encode("ascii") or b"")):
+            if _set_etag(req, file_etag(self.node, t)):
                 return b""
 
         if not t:
@@ -220,7 +288,8 @@ class FileNodeHandler(Resource, ReplaceMeMixin, object):
             # with itself, and echo back the same bytes that we were given.
             filename = get_arg(req, "filename", self.name) or "unknown"
             d = self.node.get_best_readable_version()
-            d.addCallback(lambda dn: FileDownloader(dn, filename))
+            d.addCallback(lambda dn: FileDownloader(dn, filename,
+                                                    self._by_cap()))
             return d
         if t == "json":
             # We do this to make sure that fields like size and
@@ -232,7 +301,8 @@ class FileNodeHandler(Resource, ReplaceMeMixin, object):
             # a mode specifically designed to fill in these fields, and
             # then update it in that mode.
             if self.node.is_mutable():
-                d = self.node.get_servermap(MODE_READ)
+                d = self.node.get_servermap(MODE_READ,
+                                            max_age=get_max_age(req))
             else:
                 d = defer.succeed(None)
             if self.parentnode and self.name:
@@ -257,7 +327,8 @@ class FileNodeHandler(Resource, ReplaceMeMixin, object):
             raise WebError("HEAD file: bad t=%s" % t)
         filename = get_arg(req, b"filename", self.name) or "unknown"
         d = self.node.get_best_readable_version()
-        d.addCallback(lambda dn: FileDownloader(dn, filename))
+        d.addCallback(lambda dn: FileDownloader(dn, filename,
+                                                self._by_cap()))
         return d
 
     @render_exception
@@ -279,6 +350,9 @@ class FileNodeHandler(Resource, ReplaceMeMixin, object):
                 if self.node.is_readonly():
                     raise WebError("PUT to a mutable file: replace or update"
                                    " requested with read-only cap")
+                if get_streaming_upload(req) is not None:
+                    raise WebError("PUT to a mutable file: streaming=true is"
+                                   " only supported for immutable files")
                 if offset is None:
                     return self.replace_my_contents(req)
 
@@ -383,10 +457,13 @@ class FileNodeHandler(Resource, ReplaceMeMixin, object):
 
 
 class FileDownloader(Resource, object):
-    def __init__(self, filenode, filename):
+    def __init__(self, filenode, filename, by_cap=False):
         super(FileDownloader, self).__init__()
         self.filenode = filenode
         self.filename = filename
+        # True if the URL names the file by its cap, so that it will always
+        # give the same contents if the file is immutable
+        self.by_cap = by_cap
 
     def parse_range_header(self, range_header):
         # Parse a byte ranges according to RFC 2616 "14.35.1 Byte
@@ -436,6 +513,22 @@ class FileDownloader(Resource, object):
         except ValueError:
             return None
 
+    def satisfiable_ranges(self, ranges):
+        # Clip the given (first,last) ranges to the file, drop those which
+        # lie beyond its end, and merge those which overlap or are adjacent
+        # (as RFC 7233 allows), returning them in order.
+        filesize = self.filenode.get_size()
+        clipped = sorted((max(0, first), min(filesize-1, last))
+                         for (first, last) in ranges
+                         if first < filesize)
+        merged = []
+        for (first, last) in clipped:
+            if merged and first <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], last))
+            else:
+                merged.append((first, last))
+        return merged
+
     @render_exception
     def render(self, req):
         gte = static.getTypeAndEncoding
@@ -457,42 +550,54 @@ class FileDownloader(Resource, object):
 
         filesize = self.filenode.get_size()
         assert isinstance(filesize, (int,long)), filesize
-        first, size = 0, None
-        contentsize = filesize
         req.setHeader("accept-ranges", "bytes")
 
-        # TODO: for mutable files, use the roothash. For LIT, hash the data.
-        # or maybe just use the URI for CHK and LIT.
-        rangeheader = req.getHeader('range')
-        if rangeheader:
-            ranges = self.parse_range_header(rangeheader)
-
-            # ranges = None means the header didn't parse, so ignore
-            # the header as if it didn't exist.  If is more than one
-            # range, then just return the first for now, until we can
-            # generate multipart/byteranges.
-            if ranges is not None:
-                first, last = ranges[0]
-
-                if first >= filesize:
-                    raise WebError('First beyond end of file',
-                                   http.REQUESTED_RANGE_NOT_SATISFIABLE)
-                else:
-                    first = max(0, first)
-                    last = min(filesize-1, last)
-
-                    req.setResponseCode(http.PARTIAL_CONTENT)
-                    req.setHeader('content-range',"bytes %s-%s/%s" %
-                                  (str(first), str(last),
-                                   str(filesize)))
-                    contentsize = last - first + 1
-                    size = contentsize
-
-        req.setHeader("content-length", b"%d" % contentsize)
-        if req.method == b"HEAD":
+        if self.filenode.is_mutable() or not self.by_cap:
+            # a new version may be published at any time, or the directory
+            # entry on the path may be changed to another file, so caches
+            # must check (with the ETag) before reusing this one
+            req.setHeader("cache-control", "no-cache")
+        else:
+            req.setHeader("cache-control", "max-age=31536000, immutable")
+        etag = file_etag(self.filenode)
+        if _set_etag(req, etag):
             return b""
 
-        d = self.filenode.read(req, first, size)
+        ranges = None
+        rangeheader = req.getHeader('range')
+        # If-Range names the version the client has part of: if that is not
+        # this one, it needs the whole file. We only hand out ETags, so
+        # anything else (a date, say) cannot match.
+        ifrange = req.getHeader('if-range')
+        if rangeheader and (ifrange is None or ifrange.strip() == etag):
+            # ranges = None means the header didn't parse, so ignore
+            # the header as if it didn't exist.
+            ranges = self.parse_range_header(rangeheader)
+        if ranges is not None:
+            ranges = self.satisfiable_ranges(ranges)
+            if not ranges:
+                req.setHeader('content-range', "bytes */%d" % (filesize,))
+                raise WebError('First beyond end of file',
+                               http.REQUESTED_RANGE_NOT_SATISFIABLE)
+            req.setResponseCode(http.PARTIAL_CONTENT)
+
+        if ranges is None:
+            req.setHeader("content-length", b"%d" % filesize)
+            if req.method == b"HEAD":
+                return b""
+            d = self.filenode.read(req, 0, None)
+        elif len(ranges) == 1:
+            [(first, last)] = ranges
+            req.setHeader('content-range', "bytes %d-%d/%d" %
+                          (first, last, filesize))
+            req.setHeader("content-length", b"%d" % (last - first + 1))
+            if req.method == b"HEAD":
+                return b""
+            d = self.filenode.read(req, first, last - first + 1)
+        else:
+            d = self._render_byteranges(req, ctype, ranges)
+            if req.method == b"HEAD":
+                return b""
 
         def _error(f):
             if f.check(defer.CancelledError):
@@ -520,6 +625,81 @@ class FileDownloader(Resource, object):
         )
         return d
 
+    def _render_byteranges(self, req, ctype, ranges):
+        # Send several ranges as a multipart/byteranges response. Ranges
+        # which are less than a segment apart are read together, so that
+        # every segment is fetched at most once. This returns a Deferred
+        # that fires once the body has been written, or (for HEAD) None.
+        filesize = self.filenode.get_size()
+        if not isinstance(ctype, bytes):
+            ctype = ctype.encode("ascii")
+        boundary = base32.b2a(os.urandom(12))
+        req.setHeader("content-type",
+                      b"multipart/byteranges; boundary=" + boundary)
+        parts = [(first, last,
+                  b"--%s\r\nContent-Type: %s\r\n"
+                  b"Content-Range: bytes %d-%d/%d\r\n\r\n"
+                  % (boundary, ctype, first, last, filesize))
+                 for (first, last) in ranges]
+        trailer = b"--%s--\r\n" % (boundary,)
+        length = sum(len(header) + (last - first + 1) + 2
+                     for (first, last, header) in parts) + len(trailer)
+        req.setHeader("content-length", b"%d" % length)
+        if req.method == b"HEAD":
+            return None
+
+        spans = [[parts[0]]]
+        for part in parts[1:]:
+            if part[0] - spans[-1][-1][1] <= DEFAULT_MAX_SEGMENT_SIZE:
+                spans[-1].append(part)
+            else:
+                spans.append([part])
+        d = defer.succeed(None)
+        for span in spans:
+            first = span[0][0]
+            size = span[-1][1] - first + 1
+            d.addCallback(lambda ign, first=first, size=size, span=span:
+                          self.filenode.read(_ByteRangesConsumer(req, first,
+                                                                 span),
+                                             first, size))
+        d.addCallback(lambda ign: req.write(trailer))
+        return d
+
+
+@implementer(IConsumer)
+class _ByteRangesConsumer(object):
+    """
+    I receive the data of one span of a file, starting at offset, and write
+    the parts of a multipart/byteranges response which lie within it to the
+    request: each is a (first, last, header) tuple.
+    """
+    def __init__(self, request, offset, parts):
+        self._request = request
+        self._offset = offset
+        self._parts = list(parts)
+
+    def registerProducer(self, producer, streaming):
+        self._request.registerProducer(producer, streaming)
+
+    def unregisterProducer(self):
+        self._request.unregisterProducer()
+
+    def write(self, data):
+        start = self._offset
+        self._offset += len(data)
+        while self._parts:
+            first, last, header = self._parts[0]
+            if first >= self._offset:
+                break
+            if first >= start:
+                self._request.write(header)
+            self._request.write(data[max(first, start) - start:
+                                     min(last + 1, self._offset) - start])
+            if last >= self._offset:
+                break
+            self._request.write(b"\r\n")
+            self._parts.pop(0)
+
 
 def _file_json_metadata(req, filenode, edge_metadata):
     rw_uri = filenode.get_write_uri()
@@ -11,6 +11,7 @@ if PY2:
     from future.builtins import filter, map, zip, ascii, chr, hex, input, next, oct, open, pow, round, super, bytes, dict, list, object, range, str, max, min  # noqa: F401
 
 import time
+from urllib.parse import quote as url_quote
 from hyperlink import (
     DecodedURL,
 )
@@ -29,6 +30,7 @@ from twisted.web.html import escape
 from twisted.application import service
 
 from allmydata.web.common import (
+    ForwardToWorker,
     WebError,
     get_arg,
     boolean_of_arg,
@@ -49,7 +51,7 @@ class OphandleTable(resource.Resource, service.Service):
     UNCOLLECTED_HANDLE_LIFETIME = 4*DAY
     COLLECTED_HANDLE_LIFETIME = 1*DAY
 
-    def __init__(self, clock=None):
+    def __init__(self, clock=None, gateway=None):
         super(OphandleTable, self).__init__()
         # both of these are indexed by ophandle
         self.handles = {} # tuple of (monitor, renderer, when_added)
@@ -59,6 +61,10 @@ class OphandleTable(resource.Resource, service.Service):
         # they can test ophandle expiration. If this is provided, I'll
         # use it schedule the expiration of ophandles.
         self.clock = clock
+        # In a multi-process gateway, the request for a handle may arrive at
+        # a different process from the one which holds it, which it is then
+        # forwarded to.
+        self.gateway = gateway
 
     def stopService(self):
         for t in self.timers.values():
@@ -73,6 +79,8 @@ class OphandleTable(resource.Resource, service.Service):
         :param allmydata.webish.MyRequest req:
         :param allmydata.monitor.Monitor monitor:
         :param allmydata.web.directory.ManifestResults renderer:
+
+        :return: a Deferred that fires when the handle can be used.
         """
         ophandle = get_arg(req, "ophandle")
         assert ophandle
@@ -82,6 +90,9 @@ class OphandleTable(resource.Resource, service.Service):
         if retain_for is not None:
             self._set_timer(ophandle, int(retain_for))
         monitor.when_done().addBoth(self._operation_complete, ophandle)
+        if self.gateway is None:
+            return defer.succeed(None)
+        return self.gateway.claim_ophandle(ophandle)
 
     def _operation_complete(self, res, ophandle):
         if ophandle in self.handles:
@@ -111,6 +122,12 @@ class OphandleTable(resource.Resource, service.Service):
     @exception_to_child
     def getChild(self, name, req):
         ophandle = name
+        if ophandle not in self.handles and self.gateway is not None:
+            return ForwardToWorker(
+                self.gateway,
+                lambda: self.gateway.find_ophandle(ophandle),
+                b"/operations/" + url_quote(ophandle, safe=b"").encode("ascii"),
+                "unknown/expired handle '%s'" % escape(str(ophandle, "utf-8")))
         if ophandle not in self.handles:
             raise WebError("unknown/expired handle '%s'" % escape(str(ophandle, "utf-8")),
                            NOT_FOUND)
@@ -153,7 +170,8 @@ class OphandleTable(resource.Resource, service.Service):
         if ophandle in self.timers and self.timers[ophandle].active():
             self.timers[ophandle].cancel()
         self.timers.pop(ophandle, None)
-        self.handles.pop(ophandle, None)
+        if self.handles.pop(ophandle, None) and self.gateway is not None:
+            self.gateway.release_ophandle(ophandle)
 
 
 class ReloadMixin(object):
@@ -226,13 +226,14 @@ class Root(MultiFormatResource):
 
     addSlash = True
 
-    def __init__(self, client, clock=None, now_fn=None):
+    def __init__(self, client, clock=None, now_fn=None, gateway=None):
         """
         Render root page ("/") of the URI.
 
         :client allmydata.client._Client: a stats provider.
         :clock: unused here.
         :now_fn: a function that returns current time.
+        :gateway: this process's view of a multi-process gateway, or None.
 
         """
         super(Root, self).__init__()
@@ -249,7 +250,7 @@ class Root(MultiFormatResource):
 
         self.putChild(b"file", FileHandler(client))
         self.putChild(b"named", FileHandler(client))
-        self.putChild(b"status", status.Status(client.get_history()))
+        self.putChild(b"status", status.Status(client.get_history(), gateway))
         self.putChild(b"statistics", status.Statistics(client.stats_provider))
         static_dir = resource_filename("allmydata.web", "static")
         for filen in os.listdir(static_dir):
@@ -17,6 +17,7 @@ import hashlib
 import re
 from twisted.internet import defer
 from twisted.python.filepath import FilePath
+from twisted.web import http
 from twisted.web.resource import Resource
 from twisted.web.template import (
     Element,
@@ -30,6 +31,7 @@ from allmydata.web.common import (
     abbreviate_time,
     abbreviate_rate,
     abbreviate_size,
+    ForwardToWorker,
     exception_to_child,
     plural,
     compute_rate,
@@ -281,6 +283,13 @@ class UploadStatusElement(UploadResultsRendererMixin):
     def status(self, req, tag):
         return tag(self._upload_status.get_status())
 
+    @renderer
+    def segments_in_flight(self, req, tag):
+        in_flight = self._upload_status.get_segments_in_flight()
+        if in_flight is None:
+            return tag("(unknown)")
+        return tag(str(in_flight))
+
 
 def _find_overlap(events, start_key, end_key):
     """
@@ -693,6 +702,16 @@ class DownloadStatusElement(Element):
     def status(self, req, tag):
         return tag(self._download_status.get_status())
 
+    @renderer
+    def hedging(self, req, tag):
+        ds = self._download_status
+        hedge_rate = ds.get_hedge_rate()
+        if not hedge_rate:
+            return tag("none")
+        win_rate = ds.get_hedge_win_rate()
+        return tag("%d (%.2f per segment, %.1f%% used)"
+                   % (ds.hedge_requests, hedge_rate, 100.0 * win_rate))
+
     @renderer
     def servers_used(self, req, tag):
         servers_used = self.download_results().servers_used
@@ -1266,17 +1285,24 @@ def marshal_json(s):
 class Status(MultiFormatResource):
     """Renders /status page."""
 
-    def __init__(self, history):
+    def __init__(self, history, gateway=None):
         """
         :param allmydata.history.History history: provides operation statuses.
+
+        :param gateway: this process's view of a multi-process gateway, or
+            None. Each process has its own history, so the status pages of
+            a worker are then under /status/worker-N/, which any of them can
+            serve.
         """
         super(Status, self).__init__()
         self.history = history
+        self.gateway = gateway
 
     @render_exception
     def render_HTML(self, req):
         elem = StatusElement(self._get_active_operations(),
-                             self._get_recent_operations())
+                             self._get_recent_operations(),
+                             self.gateway)
         return renderElement(req, elem)
 
     @render_exception
@@ -1293,6 +1319,10 @@ class Status(MultiFormatResource):
         for s in self._get_recent_operations():
             recent.append(marshal_json(s))
 
+        if self.gateway is not None:
+            data["worker"] = self.gateway.index
+            data["workers"] = self.gateway.workers
+
         return json.dumps(data, indent=1) + "\n"
 
     @exception_to_child
@@ -1308,6 +1338,20 @@ class Status(MultiFormatResource):
         if not path and request.postpath != [b'']:
             return self
 
+        if self.gateway is not None and path.startswith(b"worker-"):
+            try:
+                index = int(path[len(b"worker-"):])
+            except ValueError:
+                raise WebError("bad gateway worker '{}'".format(str(path, "utf-8")))
+            if index == self.gateway.index:
+                return self
+            if not 0 <= index < self.gateway.workers:
+                raise WebError("no such gateway worker", http.NOT_FOUND)
+            return ForwardToWorker(self.gateway,
+                                   lambda: defer.succeed(index),
+                                   b"/status",
+                                   "no such gateway worker")
+
         h = self.history
         try:
             stype, count_s = path.split(b"-")
@@ -1370,23 +1414,43 @@ class StatusElement(Element):
 
     loader = XMLFile(FilePath(__file__).sibling("status.xhtml"))
 
-    def __init__(self, active, recent):
+    def __init__(self, active, recent, gateway=None):
         super(StatusElement, self).__init__()
         self._active = active
         self._recent = recent
+        self._gateway = gateway
+        self._link_prefix = "/status/"
+        if gateway is not None:
+            self._link_prefix = "/status/worker-%d/" % (gateway.index,)
+
+    @renderer
+    def gateway_workers(self, req, tag):
+        if self._gateway is None:
+            return ""
+        links = []
+        for index in range(self._gateway.workers):
+            links.append(" ")
+            links.append(tags.a("worker %d" % (index,),
+                                href="/status/worker-%d/" % (index,)))
+        return tag("This gateway has %d worker processes, and this page"
+                   " shows the operations of worker %d. The pages of each"
+                   " worker:"
+                   % (self._gateway.workers, self._gateway.index), links)
 
     @renderer
     def active_operations(self, req, tag):
-        active = [self.get_op_state(op) for op in self._active]
+        active = [self.get_op_state(op, self._link_prefix)
+                  for op in self._active]
         return SlotsSequenceElement(tag, active)
 
     @renderer
     def recent_operations(self, req, tag):
-        recent = [self.get_op_state(op) for op in self._recent]
+        recent = [self.get_op_state(op, self._link_prefix)
+                  for op in self._recent]
         return SlotsSequenceElement(tag, recent)
 
     @staticmethod
-    def get_op_state(op):
+    def get_op_state(op, link_prefix="/status/"):
         result = dict()
 
         started_s = render_time(op.get_started())
@@ -1436,7 +1500,7 @@ class StatusElement(Element):
             result["progress"] = "%.1f%%" % (100.0 * progress)
 
         result["status"] = tags.a(op.get_status(),
-                                  href="/status/{}".format(link))
+                                  href="{}{}".format(link_prefix, link))
 
         return result
 
@@ -31,6 +31,8 @@ from allmydata.web.common import (
     WebError,
     get_format,
     get_mutable_type,
+    get_resume_token,
+    get_streaming_upload,
     render_exception,
     url_for_string,
 )
@@ -38,7 +40,10 @@ from allmydata.web import status
 
 def PUTUnlinkedCHK(req, client):
     # "PUT /uri", to create an unlinked file.
-    uploadable = FileHandle(req.content, client.convergence)
+    uploadable = get_streaming_upload(req)
+    if uploadable is None:
+        uploadable = FileHandle(req.content, client.convergence)
+        uploadable.resume_token = get_resume_token(req)
     d = client.upload(uploadable)
     d.addCallback(lambda results: results.get_uri())
     # that fires with the URI of the new file
@@ -70,6 +75,7 @@ def PUTUnlinkedCreateDirectory(req, client):
 def POSTUnlinkedCHK(req, client):
     fileobj = req.fields["file"].file
     uploadable = FileHandle(fileobj, client.convergence)
+    uploadable.resume_token = get_resume_token(req)
     d = client.upload(uploadable)
     when_done = get_arg(req, "when_done", None)
     if when_done:
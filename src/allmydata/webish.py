@@ -21,6 +21,7 @@ from io import (
     BytesIO,
 )
 
+import twisted
 from twisted.application import service, strports, internet
 from twisted.web import static
 from twisted.web.http import (
@@ -31,11 +32,16 @@ from twisted.web.server import (
     Site,
 )
 from twisted.internet import defer
+from twisted.internet.interfaces import (
+    IPushProducer,
+)
 from twisted.internet.address import (
     IPv4Address,
     IPv6Address,
 )
 from allmydata.util import log, fileutil
+from allmydata.gateway import ReusePortServer, parse_tcp_port
+from allmydata.immutable.upload import StreamingUploadable
 
 from allmydata.web import introweb, root
 from allmydata.web.operations import OphandleTable
@@ -89,8 +95,76 @@ class TahoeLAFSRequest(Request, object):
     :ivar NoneType|FieldStorage fields: For POST requests, a structured
         representation of the contents of the request body.  For anything
         else, ``None``.
+
+    :ivar NoneType|StreamingUploadable streaming_body: For a PUT of an
+        immutable file with ``streaming=true`` and a Content-Length, the
+        request body, which is handed to the uploader as it arrives; such a
+        request is processed as soon as its headers have been received.  For
+        anything else, ``None``.
     """
     fields = None
+    streaming_body = None
+    _streaming_started = False
+    _body_received = False
+    _finish_when_body_received = False
+
+    def gotLength(self, length):
+        """
+        Called by channel when all headers have been received.
+
+        Override the base implementation to start processing a streaming
+        upload now, rather than once its body has been spooled.  The channel
+        still calls ``requestReceived`` when the body has all arrived, and
+        that second call only releases the response.
+        """
+        request_line = _get_request_line(self.channel)
+        producer = IPushProducer(self.channel.transport, None)
+        if (length is None or request_line is None or producer is None
+            or not _is_streaming_upload(request_line[0], request_line[1])):
+            super(TahoeLAFSRequest, self).gotLength(length)
+            return
+        self.content = BytesIO()
+        self._held_response = []
+        self.streaming_body = StreamingUploadable(length, producer=producer)
+        self.requestReceived(*request_line)
+
+    def handleContentChunk(self, data):
+        if self.streaming_body is not None:
+            self.streaming_body.write(data)
+        else:
+            super(TahoeLAFSRequest, self).handleContentChunk(data)
+
+    def write(self, data):
+        if self.streaming_body is not None and not self._body_received:
+            # see finish()
+            self._held_response.append(data)
+            return
+        super(TahoeLAFSRequest, self).write(data)
+
+    def finish(self):
+        """
+        Override the base implementation so that the response to a
+        streaming upload which ends early (with an error, say) waits for the
+        rest of the body, which is discarded: the channel cannot read the
+        next request until then, and clients do not expect a response
+        before they have sent their request.
+        """
+        if self.streaming_body is not None:
+            if self._disconnected:
+                # there is nobody left to respond to
+                return
+            if not self._body_received:
+                self.streaming_body.abort(
+                    Exception("the response was sent before the upload"
+                              " was complete"))
+                self._finish_when_body_received = True
+                return
+        super(TahoeLAFSRequest, self).finish()
+
+    def connectionLost(self, reason):
+        if self.streaming_body is not None:
+            self.streaming_body.abort(reason)
+        super(TahoeLAFSRequest, self).connectionLost(reason)
 
     def requestReceived(self, command, path, version):
         """
@@ -100,6 +174,18 @@ class TahoeLAFSRequest(Request, object):
         and to provide less memory-intensive multipart/form-post handling for
         large file uploads.
         """
+        if self.streaming_body is not None:
+            if self._streaming_started:
+                # the body of a streaming upload, which gotLength started
+                # processing, has now arrived
+                self._body_received = True
+                for data in self._held_response:
+                    super(TahoeLAFSRequest, self).write(data)
+                self._held_response = []
+                if self._finish_when_body_received:
+                    super(TahoeLAFSRequest, self).finish()
+                return
+            self._streaming_started = True
         self.content.seek(0)
         self.args = {}
         self.stack = []
@@ -154,6 +240,49 @@ class TahoeLAFSRequest(Request, object):
         self.setHeader("Referrer-Policy", "no-referrer")
 
 
+# HTTPChannel has no public API for the request line of a request whose body
+# has not arrived yet: it keeps it in private attributes until then. They
+# are only looked for in the versions of Twisted known to keep them (see
+# test_webish.RequestLineTests); anywhere else, streaming uploads are
+# spooled like any other.
+_CHANNEL_KEEPS_REQUEST_LINE = (19, 10) <= (twisted.version.major,
+                                           twisted.version.minor) < (26, 0)
+
+
+def _get_request_line(channel):
+    """
+    Return the ``(command, path, version)`` of the request whose headers
+    ``channel`` has just received, or ``None`` if that cannot be known
+    before its body has arrived.
+    """
+    if not _CHANNEL_KEEPS_REQUEST_LINE:
+        return None
+    try:
+        return (channel._command, channel._path, channel._version)
+    except AttributeError:
+        return None
+
+
+def _is_streaming_upload(command, uri):
+    """
+    Return True if the request line given is that of a streaming upload: a
+    PUT of an immutable file (with no ``t=``, ``offset=`` or mutable
+    ``format=``) with ``streaming=true``.
+    """
+    if command != b"PUT":
+        return False
+    x = uri.split(b"?", 1)
+    if len(x) == 1:
+        return False
+    args = parse_qs(x[1], 1)
+    def arg(name):
+        return args.get(name, [b""])[0].strip().lower()
+    return (arg(b"streaming") in (b"true", b"t", b"1", b"on")
+            and not arg(b"t") and not arg(b"offset")
+            and arg(b"format") in (b"", b"chk")
+            and arg(b"mutable") in (b"", b"false", b"f", b"0", b"off"))
+
+
 def _get_client_ip(request):
     try:
         get = request.getClientAddress
@@ -233,9 +362,10 @@ class TahoeLAFSSite(Site, object):
 
 class WebishServer(service.MultiService):
     name = "webish"
+    _gateway = None
 
     def __init__(self, client, webport, tempdir, nodeurl_path=None, staticdir=None,
-                 clock=None, now_fn=time.time):
+                 clock=None, now_fn=time.time, gateway=None):
         service.MultiService.__init__(self)
         # the 'data' argument to all render() methods default to the Client
         # the 'clock' argument to root.Root is, if set, a
@@ -243,12 +373,15 @@ class WebishServer(service.MultiService):
         # so that they can test features that involve the passage of
         # time in a deterministic manner.
 
-        self.root = root.Root(client, clock, now_fn)
+        # gateway, if set, is this process's view of a multi-process
+        # gateway (see allmydata.gateway), whose processes all serve webport
+        self._gateway = gateway
+        self.root = root.Root(client, clock, now_fn, gateway)
         self.buildServer(webport, tempdir, nodeurl_path, staticdir)
 
         # If set, clock is a twisted.internet.task.Clock that the tests
         # use to test ophandle expiration.
-        self._operations = OphandleTable(clock)
+        self._operations = OphandleTable(clock, gateway)
         self._operations.setServiceParent(self)
         self.root.putChild(b"operations", self._operations)
 
@@ -260,12 +393,22 @@ class WebishServer(service.MultiService):
         self.staticdir = staticdir # so tests can check
         if staticdir:
             self.root.putChild(b"static", static.File(staticdir))
-        if re.search(r'^\d', webport):
-            webport = "tcp:"+webport # twisted warns about bare "0" or "3456"
-        # strports must be native strings.
-        webport = ensure_str(webport)
-        s = strports.service(webport, self.site)
-        s.setServiceParent(self)
+        if self._gateway is not None:
+            # the other workers listen on this port too, and send us the
+            # requests that only we can answer on a port of our own
+            (portnum, interface) = parse_tcp_port(webport)
+            s = ReusePortServer(portnum, self.site, interface)
+            s.setServiceParent(self)
+            self._private_listener = internet.TCPServer(0, self.site,
+                                                        interface="127.0.0.1")
+            self._private_listener.setServiceParent(self)
+        else:
+            if re.search(r'^\d', webport):
+                webport = "tcp:"+webport # twisted warns about bare "0" or "3456"
+            # strports must be native strings.
+            webport = ensure_str(webport)
+            s = strports.service(webport, self.site)
+            s.setServiceParent(self)
 
         self._scheme = None
         self._portnum = None
@@ -273,6 +416,9 @@ class WebishServer(service.MultiService):
         self._listener = s # stash it so we can query for the portnum
 
         self._started = defer.Deferred()
+        if self._gateway is not None:
+            self._started.addCallback(lambda ign: self._gateway.web_listening(
+                self._portnum, self._private_listener._port.getHost().port))
         if nodeurl_path:
             def _write_nodeurl_file(ign):
                 # this file will be created with default permissions
@@ -311,8 +457,8 @@ class WebishServer(service.MultiService):
             else:
                 self._scheme = 'http'
             s._waitingForPort.addCallbacks(_got_port, _fail)
-        elif isinstance(s, internet.TCPServer):
-            # Twisted <= 10.1
+        elif isinstance(s, (internet.TCPServer, ReusePortServer)):
+            # Twisted <= 10.1, or a port shared with other gateway workers
             self._scheme = 'http'
             _got_port(s._port)
         elif isinstance(s, internet.SSLServer):